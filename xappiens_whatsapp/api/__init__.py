@@ -1,15 +1,25 @@
 # API module for xappiens_whatsapp
 
 # Import all API modules to make them available
+from . import avatars
 from . import baileys_proxy
 from . import base
+from . import broadcast
 from . import contacts
 from . import conversations
 from . import conversations_filters
+from . import media_proxy
+from . import media_queue
 from . import messages
+from . import message_sync
+from . import message_projection
+from . import outbound_queue
 from . import session
 from . import session_status
 from . import sync
+from . import sync_scheduler
 from . import unified_contacts
 from . import webhook
+from . import webhook_queue
+from . import webhook_batch
 from . import webhook_test
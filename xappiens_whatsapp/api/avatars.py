@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Descarga en segundo plano de los avatares de WhatsApp Contact.
+
+Los contactos pendientes se acumulan en un set de Redis (sin duplicados) y un
+job de la cola long lo drena por lotes: la URL de cada foto se pide a la API de
+forma secuencial y las imágenes se descargan en paralelo con un máximo de
+`avatar_download_concurrency` descargas simultáneas.
+
+- Si el hash del contenido coincide con `profile_pic_hash`, solo se actualiza
+  la fecha de la última comprobación.
+- Si ya existe un File público sin adjuntar con el mismo contenido, se
+  reutiliza en lugar de crear otro. Los File de avatares no se adjuntan a
+  ningún contacto: varios contactos pueden compartirlos y borrar uno no debe
+  borrar la foto de los demás.
+- `profile_pic` guarda la imagen original y `profile_pic_thumb` una miniatura
+  pequeña para las listas.
+- Un contacto no se vuelve a consultar hasta pasados `avatar_refresh_days`
+  desde `last_profile_pic_update`. La tarea horaria `queue_stale_avatars`
+  encola los que han caducado.
+- Si la descarga falla, el contacto espera antes del siguiente intento
+  (1 h, 2 h, 4 h... hasta `avatar_refresh_days`) para no reintentarlo cada hora.
+"""
+
+import hashlib
+import requests
+import frappe
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+from frappe.utils import add_days, add_to_date, cint, now_datetime
+from .base import WhatsAppAPIClient
+from xappiens_whatsapp.utils.images import AVATAR_THUMBNAIL_SIZE, make_thumbnail
+
+
+AVATAR_QUEUE_KEY = "whatsapp_avatar_queue"
+DEFAULT_REFRESH_DAYS = 7
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+# Contactos por lote y descarga simultánea
+BATCH_PER_WORKER = 5
+MAX_AVATAR_BYTES = 5 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 10
+DRAIN_TIMEOUT = 1500
+STALE_BATCH_LIMIT = 500
+# Fallos consecutivos de descarga por contacto (hash de Redis)
+AVATAR_FAILURES_KEY = "whatsapp_avatar_failures"
+FAILURE_BACKOFF_HOURS = 1
+
+PROFILE_PIC_KEYS = ["profilePicUrl", "profilePicURL", "profilePictureUrl"]
+AVATAR_FIELDS = [
+    "name", "session", "contact_id", "phone_number", "profile_pic_url",
+    "profile_pic", "profile_pic_thumb", "profile_pic_hash", "last_profile_pic_update",
+]
+IMAGE_EXTENSIONS = {"image/png": "png", "image/gif": "gif", "image/webp": "webp"}
+
+
+def _get_refresh_days() -> int:
+    return cint(frappe.db.get_single_value("WhatsApp Settings", "avatar_refresh_days")) or DEFAULT_REFRESH_DAYS
+
+
+def _get_download_concurrency() -> int:
+    return cint(frappe.db.get_single_value("WhatsApp Settings", "avatar_download_concurrency")) or DEFAULT_DOWNLOAD_CONCURRENCY
+
+
+def queue_avatar_refresh(contact_names: List[str]) -> int:
+    """
+    Añade contactos a la cola de avatares y programa el job que la drena.
+
+    Args:
+        contact_names: Nombres de documentos WhatsApp Contact
+
+    Returns:
+        Número de contactos encolados
+    """
+    if contact_names:
+        frappe.cache().sadd(AVATAR_QUEUE_KEY, *contact_names)
+
+    frappe.enqueue(
+        "xappiens_whatsapp.api.avatars.process_avatar_queue",
+        queue="long",
+        timeout=DRAIN_TIMEOUT,
+        job_id=f"whatsapp_avatar_queue::{frappe.local.site}",
+        deduplicate=True
+    )
+    return len(contact_names or [])
+
+
+def queue_stale_avatars(limit: int = STALE_BATCH_LIMIT) -> int:
+    """
+    Tarea programada (cada hora): encola los contactos sin avatar comprobado o
+    cuya última comprobación supera el TTL. También reprograma el drenado si
+    quedaron contactos en la cola de un job anterior.
+
+    Returns:
+        Número de contactos encolados
+    """
+    names = frappe.db.sql_list("""
+        SELECT name
+        FROM `tabWhatsApp Contact`
+        WHERE is_group = 0
+            AND (last_profile_pic_update IS NULL OR last_profile_pic_update < %(cutoff)s)
+        ORDER BY last_profile_pic_update ASC
+        LIMIT %(limit)s
+    """, {"cutoff": add_days(now_datetime(), -_get_refresh_days()), "limit": cint(limit)})
+
+    return queue_avatar_refresh(names)
+
+
+def process_avatar_queue():
+    """Job en segundo plano: drena la cola de avatares por lotes."""
+    cache = frappe.cache()
+    batch_size = _get_download_concurrency() * BATCH_PER_WORKER
+
+    while True:
+        names = []
+        for _ in range(batch_size):
+            name = cache.spop(AVATAR_QUEUE_KEY)
+            if not name:
+                break
+            names.append(name.decode() if isinstance(name, bytes) else name)
+
+        if not names:
+            break
+
+        refresh_avatars(names)
+        frappe.db.commit()
+
+
+def _get_avatar_url(client: WhatsAppAPIClient, contact: Dict[str, Any]) -> Optional[str]:
+    """URL actual de la foto de perfil (la guardada si la API no responde)."""
+    try:
+        response = client.get_contact_info(contact.contact_id or contact.phone_number)
+    except Exception:
+        return contact.profile_pic_url
+
+    if not response.get("success"):
+        return contact.profile_pic_url
+
+    payload = response.get("data") or response.get("contact") or {}
+    avatar_url = next((payload.get(key) for key in PROFILE_PIC_KEYS if payload.get(key)), None)
+    return None if avatar_url == "default" else avatar_url
+
+
+def _download_avatar(avatar_url: str) -> Dict[str, Any]:
+    """
+    Descarga una imagen. Se ejecuta en hilos: no accede a la base de datos.
+
+    Returns:
+        Dict con content y content_type, o error
+    """
+    try:
+        response = requests.get(avatar_url, timeout=DOWNLOAD_TIMEOUT, stream=True, headers={
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+        })
+        with response:
+            if response.status_code != 200:
+                return {"error": f"Error HTTP {response.status_code} al descargar imagen"}
+
+            content_type = response.headers.get('content-type', '')
+            if not content_type.startswith('image/'):
+                return {"error": "URL no es una imagen válida"}
+
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > MAX_AVATAR_BYTES:
+                    return {"error": "Imagen demasiado grande"}
+
+        return {"content": b"".join(chunks), "content_type": content_type}
+
+    except requests.exceptions.RequestException as e:
+        return {"error": f"Error de conexión: {str(e)}"}
+
+
+def _get_or_create_file(content: bytes, file_name: str) -> str:
+    """
+    URL de un File público sin adjuntar con este contenido; se crea solo si no
+    existe. El hash es el mismo que File.content_hash.
+    """
+    file_url = frappe.db.get_value("File", {
+        "content_hash": hashlib.md5(content).hexdigest(),
+        "is_private": 0,
+        "attached_to_doctype": ["is", "not set"],
+    }, "file_url")
+    if file_url:
+        return file_url
+
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": file_name,
+        "is_private": 0,
+        "content": content
+    })
+    file_doc.save(ignore_permissions=True)
+    return file_doc.file_url
+
+
+def _store_avatar(contact: Dict[str, Any], avatar_url: str, download: Dict[str, Any]) -> str:
+    """
+    Guarda el avatar descargado (original y miniatura) en el contacto.
+
+    Returns:
+        "unchanged" si la imagen no ha cambiado, "updated" si se ha guardado
+    """
+    content = download["content"]
+    content_hash = hashlib.sha256(content).hexdigest()
+    values = {"profile_pic_url": avatar_url, "last_profile_pic_update": now_datetime()}
+
+    if content_hash == contact.profile_pic_hash and contact.profile_pic_thumb:
+        frappe.db.set_value("WhatsApp Contact", contact.name, values, update_modified=False)
+        return "unchanged"
+
+    extension = IMAGE_EXTENSIONS.get(download["content_type"].split(";")[0].strip(), "jpg")
+    values["profile_pic"] = _get_or_create_file(content, f"avatar_{contact.contact_id}.{extension}")
+
+    thumbnail = make_thumbnail(content, AVATAR_THUMBNAIL_SIZE)
+    values["profile_pic_thumb"] = (
+        _get_or_create_file(thumbnail, f"avatar_{contact.contact_id}_thumb.jpg")
+        if thumbnail else values["profile_pic"]
+    )
+    values["profile_pic_hash"] = content_hash
+
+    frappe.db.set_value("WhatsApp Contact", contact.name, values, update_modified=False)
+    return "updated"
+
+
+def _record_download_failure(contact_name: str, refresh_days: int):
+    """
+    Aplaza el siguiente intento de un contacto cuya descarga ha fallado.
+
+    `last_profile_pic_update` se retrasa para que el contacto vuelva a caducar
+    tras la espera (1 h, 2 h, 4 h... como máximo el TTL normal), sin tocar la
+    foto guardada.
+    """
+    cache = frappe.cache()
+    failures = cint(cache.hget(AVATAR_FAILURES_KEY, contact_name)) + 1
+    cache.hset(AVATAR_FAILURES_KEY, contact_name, failures)
+
+    delay_hours = min(FAILURE_BACKOFF_HOURS * 2 ** (failures - 1), refresh_days * 24)
+    frappe.db.set_value("WhatsApp Contact", contact_name, {
+        "last_profile_pic_update": add_to_date(now_datetime(), days=-refresh_days, hours=delay_hours)
+    }, update_modified=False)
+
+
+def refresh_avatars(contact_names: List[str], force: bool = False, avatar_urls: Dict[str, str] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Actualiza el avatar de varios contactos.
+
+    Args:
+        contact_names: Nombres de documentos WhatsApp Contact
+        force: Ignorar el TTL de last_profile_pic_update
+        avatar_urls: URLs ya conocidas por contacto (no se piden a la API)
+
+    Returns:
+        Dict {contacto: {"status": updated|unchanged|removed|fresh|error, "message"}}
+    """
+    avatar_urls = avatar_urls or {}
+    refresh_days = _get_refresh_days()
+    cutoff = add_days(now_datetime(), -refresh_days)
+    contacts = frappe.get_all("WhatsApp Contact", filters={"name": ["in", contact_names]}, fields=AVATAR_FIELDS)
+
+    results = {}
+    pending = []
+    clients = {}
+
+    for contact in contacts:
+        if not force and contact.last_profile_pic_update and contact.last_profile_pic_update >= cutoff:
+            results[contact.name] = {"status": "fresh"}
+            continue
+
+        avatar_url = avatar_urls.get(contact.name)
+        if not avatar_url:
+            if contact.session not in clients:
+                session_id = frappe.db.get_value("WhatsApp Session", contact.session, "session_id")
+                clients[contact.session] = WhatsAppAPIClient(session_id)
+            avatar_url = _get_avatar_url(clients[contact.session], contact)
+
+        if not avatar_url:
+            frappe.db.set_value("WhatsApp Contact", contact.name, {
+                "profile_pic_url": None,
+                "profile_pic": None,
+                "profile_pic_thumb": None,
+                "profile_pic_hash": None,
+                "last_profile_pic_update": now_datetime()
+            }, update_modified=False)
+            results[contact.name] = {"status": "removed", "message": "Contacto sin foto de perfil"}
+            continue
+
+        pending.append((contact, avatar_url))
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=_get_download_concurrency()) as executor:
+            downloads = list(executor.map(_download_avatar, [avatar_url for _, avatar_url in pending]))
+
+        for (contact, avatar_url), download in zip(pending, downloads):
+            if download.get("error"):
+                _record_download_failure(contact.name, refresh_days)
+                results[contact.name] = {"status": "error", "message": download["error"]}
+                continue
+
+            try:
+                results[contact.name] = {"status": _store_avatar(contact, avatar_url, download)}
+                frappe.cache().hdel(AVATAR_FAILURES_KEY, contact.name)
+            except Exception as e:
+                frappe.log_error(f"Error guardando avatar de {contact.name}: {str(e)}", "WhatsApp Contact Avatar")
+                _record_download_failure(contact.name, refresh_days)
+                results[contact.name] = {"status": "error", "message": str(e)}
+
+    return results
@@ -10,13 +10,15 @@ import requests
 from typing import Dict, Any, Optional
 import json
 from datetime import datetime, timedelta
+from xappiens_whatsapp.utils import transport
 
 
 class WhatsAppAPIClient:
     """
     Cliente base para hacer requests al servidor de WhatsApp externo (Baileys/Inbox Hub).
-    Lee la configuración de WhatsApp Settings.
+    Lee la configuración de WhatsApp Settings (cacheada por worker).
     Usa solo API Key según nueva documentación simplificada.
+    Las peticiones reutilizan el pool de conexiones keep-alive de `utils.transport`.
     """
 
     def __init__(self, session_id: Optional[str] = None):
@@ -28,10 +30,10 @@ class WhatsAppAPIClient:
         """
         self.session_id = session_id
         self.settings = self._get_settings()
-        self.base_url = self.settings.api_base_url
-        self.api_key = self.settings.get_password("api_key")
-        self.timeout = self.settings.api_timeout or 30
-        self.retry_attempts = self.settings.api_retry_attempts or 3
+        self.base_url = self.settings.base_url
+        self.api_key = self.settings.api_key
+        self.timeout = self.settings.timeout
+        self.retry_attempts = self.settings.retry_attempts
         # Ya no se necesitan para autenticación JWT
         # self.email = self.settings.api_email
         # self.password = self.settings.get_password("api_password")
@@ -40,20 +42,18 @@ class WhatsAppAPIClient:
 
     def _get_settings(self) -> Any:
         """
-        Obtiene la configuración de WhatsApp Settings.
+        Obtiene la configuración de API de WhatsApp Settings.
+        Se cachea por worker para no releer el documento ni la API Key en cada cliente.
 
         Returns:
-            Documento WhatsApp Settings
+            frappe._dict con la configuración de API (ver `transport.get_api_config`)
         """
-        if not frappe.db.exists("DocType", "WhatsApp Settings"):
-            frappe.throw("WhatsApp Settings DocType no existe")
-
-        settings = frappe.get_single("WhatsApp Settings")
+        settings = transport.get_api_config()
 
         if not settings.enabled:
             frappe.throw("El módulo de WhatsApp está deshabilitado en Settings")
 
-        if not settings.api_base_url:
+        if not settings.base_url:
             frappe.throw("URL Base de API no configurada en WhatsApp Settings")
 
         return settings
@@ -126,7 +126,7 @@ class WhatsAppAPIClient:
         }
         for attempt in range(self.retry_attempts):
             try:
-                response = requests.request(
+                response = transport.request(
                     method=method,
                     url=url,
                     json=data,
@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Difusiones: un mismo mensaje (plantilla Jinja) a una lista de destinatarios.
+
+En lugar de llamar a `send_message_smart` una vez por número, se crea un
+`WhatsApp Broadcast` con sus destinatarios y lo procesa un job en segundo plano
+por lotes de BATCH_SIZE:
+
+1. Normaliza los números y busca de una vez las conversaciones existentes y
+   las sesiones conectadas; crea solo las conversaciones que faltan.
+2. Encola cada mensaje con prioridad "bulk" en la cola de envío de su sesión
+   (`outbound_queue`), que aplica el rate limiting y deja pasar antes las
+   respuestas de los agentes.
+3. Guarda el estado de cada destinatario y hace commit al final del lote: si
+   el worker se reinicia, el job (relanzado por `resume_broadcasts`) sigue por
+   los destinatarios aún "Pending" sin duplicar envíos.
+
+El resultado de cada envío (Sent, Delivered, Read, Failed) llega por el
+callback de estado de la cola (`on_message_status`) y se guarda en la fila del
+destinatario; `get_broadcast_report` devuelve el resumen y el detalle.
+
+Una difusión nunca queda esperando indefinidamente: si su sesión fija ya no
+existe los destinatarios fallan en el acto, y si no hay ninguna sesión
+conectada durante NO_SESSION_TIMEOUT_HOURS desde que empezó, los pendientes se
+dan por fallidos.
+"""
+
+import time
+import frappe
+from typing import Dict, Any, List, Optional
+from frappe.utils import add_to_date, cint, get_datetime, now_datetime
+from .outbound_queue import QUEUE_EXPIRY_HOURS, fail_queued_message, queue_outgoing_message, schedule_sender
+from xappiens_whatsapp.utils.locks import acquire_lock, is_locked, release_lock
+from xappiens_whatsapp.utils.phone import normalize_phone_number
+
+
+BATCH_SIZE = 100
+WORKER_QUEUE = "long"
+WORKER_TIMEOUT = 1500
+STATUS_CALLBACK = "xappiens_whatsapp.api.broadcast.on_message_status"
+# Lo mismo que espera un mensaje en la cola de envío antes de caducar
+NO_SESSION_TIMEOUT_HOURS = QUEUE_EXPIRY_HOURS
+# Orden de los estados de un envío: un aviso atrasado no hace retroceder al destinatario
+STATUS_RANK = {"Pending": 0, "Queued": 1, "Sent": 2, "Delivered": 3, "Read": 4}
+
+
+@frappe.whitelist()
+def create_broadcast(
+    recipients: Any,
+    message_template: str,
+    title: Optional[str] = None,
+    session: Optional[str] = None,
+    start: bool = True
+) -> Dict[str, Any]:
+    """
+    Crea una difusión y, por defecto, la pone en marcha.
+
+    Args:
+        recipients: Lista (o JSON) de teléfonos, o de dicts con phone_number,
+            recipient_name y el resto de claves como variables de la plantilla
+        message_template: Plantilla Jinja del mensaje ({{ recipient_name }}, {{ phone_number }}...)
+        title: Título de la difusión
+        session: Sesión desde la que enviar (opcional)
+        start: Encolar el envío al crearla
+
+    Returns:
+        Dict con el nombre de la difusión y el número de destinatarios
+    """
+    recipients = frappe.parse_json(recipients) if isinstance(recipients, str) else recipients
+    if not recipients:
+        return {"success": False, "message": "La difusión no tiene destinatarios"}
+
+    broadcast = frappe.get_doc({
+        "doctype": "WhatsApp Broadcast",
+        "title": title or f"Difusión {frappe.utils.format_datetime(now_datetime())}",
+        "session": session,
+        "message_template": message_template,
+        "recipients": [_build_recipient_row(recipient) for recipient in recipients],
+    })
+    broadcast.insert()
+
+    if cint(start):
+        start_broadcast(broadcast.name)
+    else:
+        frappe.db.commit()
+
+    return {
+        "success": True,
+        "broadcast": broadcast.name,
+        "total_recipients": broadcast.total_recipients,
+        "status": frappe.db.get_value("WhatsApp Broadcast", broadcast.name, "status"),
+    }
+
+
+def _build_recipient_row(recipient: Any) -> Dict[str, Any]:
+    if not isinstance(recipient, dict):
+        return {"phone_number": str(recipient)}
+
+    variables = dict(recipient)
+    phone_number = variables.pop("phone_number", None) or variables.pop("phone", None)
+    recipient_name = variables.pop("recipient_name", None) or variables.pop("name", None)
+    return {
+        "phone_number": str(phone_number or ""),
+        "recipient_name": recipient_name,
+        "variables": variables or None,
+    }
+
+
+@frappe.whitelist()
+def start_broadcast(broadcast: str) -> Dict[str, Any]:
+    """
+    Pone en marcha una difusión en borrador.
+
+    Args:
+        broadcast: Nombre del documento WhatsApp Broadcast
+
+    Returns:
+        Dict con resultado
+    """
+    doc = frappe.get_doc("WhatsApp Broadcast", broadcast)
+    doc.check_permission("write")
+
+    if doc.status != "Draft":
+        return {"success": False, "message": f"La difusión ya está en estado {doc.status}"}
+
+    doc.db_set({"status": "Queued", "started_at": now_datetime()})
+    _enqueue_broadcast(doc.name)
+    frappe.db.commit()
+
+    return {"success": True, "broadcast": doc.name, "status": "Queued"}
+
+
+@frappe.whitelist()
+def cancel_broadcast(broadcast: str) -> Dict[str, Any]:
+    """
+    Cancela una difusión: los destinatarios sin enviar quedan como omitidos y
+    sus mensajes salen de la cola de envío. Lo ya enviado no se toca.
+
+    Args:
+        broadcast: Nombre del documento WhatsApp Broadcast
+
+    Returns:
+        Dict con los contadores finales
+    """
+    doc = frappe.get_doc("WhatsApp Broadcast", broadcast)
+    doc.check_permission("write")
+
+    if doc.status not in ("Draft", "Queued", "Running"):
+        return {"success": False, "message": f"La difusión ya está en estado {doc.status}"}
+
+    error = "Difusión cancelada"
+    # Primero el estado: así el job deja de encolar y los avisos no la dan por completada
+    doc.db_set({"status": "Cancelled", "completed_at": now_datetime()})
+
+    # Los mensajes aún en la cola salen por el mismo camino que un fallo de
+    # envío, que avisa al frontend y marca al destinatario (on_message_status)
+    queued = frappe.get_all(
+        "WhatsApp Broadcast Recipient",
+        filters={"parent": broadcast, "parenttype": "WhatsApp Broadcast", "status": "Queued", "message": ["is", "set"]},
+        pluck="message",
+    )
+    for name in queued:
+        message = frappe.db.get_value(
+            "WhatsApp Message", name, ["name", "status", "conversation", "status_callback"], as_dict=True, for_update=True
+        )
+        if message and message.status == "Pending":
+            fail_queued_message(message, error)
+
+    _fail_pending_recipients(broadcast, error, status="Skipped")
+    progress = update_broadcast_progress(broadcast)
+    frappe.db.commit()
+
+    return {"success": True, "broadcast": broadcast, "status": "Cancelled", **progress}
+
+
+def _enqueue_broadcast(broadcast: str):
+    frappe.enqueue(
+        "xappiens_whatsapp.api.broadcast.process_broadcast",
+        queue=WORKER_QUEUE,
+        timeout=WORKER_TIMEOUT,
+        job_id=f"whatsapp_broadcast::{frappe.local.site}::{broadcast}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        broadcast=broadcast,
+    )
+
+
+def _lock_key(broadcast: str) -> str:
+    return f"broadcast:{broadcast}"
+
+
+def process_broadcast(broadcast: str):
+    """
+    Job en segundo plano: encola los mensajes de los destinatarios pendientes
+    por lotes, con un commit (punto de control) por lote.
+
+    Args:
+        broadcast: Nombre del documento WhatsApp Broadcast
+    """
+    token = acquire_lock(_lock_key(broadcast), timeout=WORKER_TIMEOUT)
+    if not token:
+        return
+
+    try:
+        doc = frappe.db.get_value(
+            "WhatsApp Broadcast", broadcast, ["name", "status", "session", "message_template", "started_at"], as_dict=True
+        )
+        if not doc or doc.status not in ("Queued", "Running"):
+            return
+
+        if doc.status == "Queued":
+            frappe.db.set_value("WhatsApp Broadcast", broadcast, "status", "Running")
+            frappe.db.commit()
+
+        template = frappe.get_jenv().from_string(doc.message_template or "")
+        deadline = time.monotonic() + WORKER_TIMEOUT - 60
+
+        while time.monotonic() < deadline:
+            rows = frappe.get_all(
+                "WhatsApp Broadcast Recipient",
+                filters={"parent": broadcast, "parenttype": "WhatsApp Broadcast", "status": "Pending"},
+                fields=["name", "phone_number", "recipient_name", "variables"],
+                order_by="idx asc",
+                limit=BATCH_SIZE,
+            )
+            if not rows:
+                break
+
+            processed = _fan_out(doc, template, rows)
+
+            # Sin sesiones conectadas el lote sigue "Pending" y lo retoma
+            # resume_broadcasts, pero solo hasta NO_SESSION_TIMEOUT_HOURS
+            if not processed and get_datetime(doc.started_at or now_datetime()) < add_to_date(
+                now_datetime(), hours=-NO_SESSION_TIMEOUT_HOURS
+            ):
+                _fail_pending_recipients(
+                    broadcast, f"Sin sesiones conectadas durante {NO_SESSION_TIMEOUT_HOURS} horas"
+                )
+
+            update_broadcast_progress(broadcast)
+            frappe.db.commit()
+
+            if not processed:
+                break
+
+    finally:
+        release_lock(_lock_key(broadcast), token)
+
+
+def _fan_out(broadcast: Dict[str, Any], template, rows: List[Dict[str, Any]]) -> int:
+    """
+    Encola el mensaje de un lote de destinatarios.
+
+    Returns:
+        Número de destinatarios que salen de "Pending" (encolados u omitidos)
+    """
+    processed = 0
+    phones = {}
+    for row in rows:
+        phone = normalize_phone_number(row.phone_number)
+        if phone:
+            phones[row.name] = phone
+        else:
+            _set_recipient(row.name, "Skipped", error="Número de teléfono no válido")
+            processed += 1
+
+    recipient_names = {phones[row.name]: row.recipient_name for row in rows if row.name in phones}
+    conversations, sessions = _resolve_conversations(recipient_names, broadcast.session)
+
+    # La sesión fija se ha borrado: no hay a dónde enviar, ni lo habrá
+    if broadcast.session and not sessions:
+        for row in rows:
+            if row.name in phones:
+                _set_recipient(row.name, "Failed", error=f"La sesión {broadcast.session} no existe")
+                processed += 1
+        return processed
+
+    used_sessions = set()
+    for row in rows:
+        phone = phones.get(row.name)
+        conversation = conversations.get(phone) if phone else None
+        if not conversation:
+            continue
+
+        processed += 1
+        try:
+            variables = frappe.parse_json(row.variables) if row.variables else {}
+            content = template.render({
+                **(variables if isinstance(variables, dict) else {}),
+                "recipient_name": row.recipient_name or phone,
+                "phone_number": phone,
+            }).strip()
+        except Exception as e:
+            _set_recipient(row.name, "Failed", conversation=conversation.name, error=f"Error en la plantilla: {str(e)}")
+            continue
+
+        if not content:
+            _set_recipient(row.name, "Skipped", conversation=conversation.name, error="La plantilla da un mensaje vacío")
+            continue
+
+        message_doc = queue_outgoing_message(
+            conversation,
+            sessions[conversation.session],
+            content,
+            content,
+            priority="bulk",
+            status_callback=STATUS_CALLBACK,
+            schedule=False,
+        )
+        _set_recipient(row.name, "Queued", conversation=conversation.name, message=message_doc.name)
+        used_sessions.add(conversation.session)
+
+    # Un job de envío por sesión, tras el commit del lote
+    for session in used_sessions:
+        schedule_sender(session)
+
+    return processed
+
+
+def _fail_pending_recipients(broadcast: str, error: str, status: str = "Failed"):
+    """Cierra los destinatarios que siguen "Pending" con el estado y motivo indicados."""
+    frappe.db.sql("""
+        UPDATE `tabWhatsApp Broadcast Recipient`
+        SET status = %s, error = %s
+        WHERE parent = %s AND parenttype = 'WhatsApp Broadcast' AND status = 'Pending'
+    """, (status, error, broadcast))
+
+
+def _set_recipient(name: str, status: str, conversation: Optional[str] = None,
+                   message: Optional[str] = None, error: Optional[str] = None):
+    values = {"status": status, "error": error}
+    if conversation:
+        values["conversation"] = conversation
+    if message:
+        values["message"] = message
+    frappe.db.set_value("WhatsApp Broadcast Recipient", name, values, update_modified=False)
+
+
+def _resolve_conversations(recipient_names: Dict[str, Optional[str]], session: Optional[str]) -> tuple:
+    """
+    Conversación de cada teléfono, creando las que falten.
+
+    Con sesión fija se usa siempre esa (si está desconectada, los mensajes
+    esperan en la cola). Sin ella se prefiere la sesión conectada que ya tenga
+    conversación con el número y si no, se reparten entre las conectadas.
+
+    Args:
+        recipient_names: {teléfono normalizado: nombre del destinatario}
+        session: Sesión fija de la difusión (opcional)
+
+    Returns:
+        Tupla ({teléfono: conversación}, {sesión: datos de la sesión})
+    """
+    session_fields = ["name", "phone_number"]
+    if session:
+        sessions = {row.name: row for row in frappe.get_all("WhatsApp Session", filters={"name": session}, fields=session_fields)}
+    else:
+        sessions = {
+            row.name: row
+            for row in frappe.get_all(
+                "WhatsApp Session",
+                filters={"is_connected": 1, "status": "Connected", "is_active": 1},
+                fields=session_fields,
+                order_by="name asc",
+            )
+        }
+    if not recipient_names or not sessions:
+        return {}, sessions
+
+    existing = {}
+    for conversation in frappe.get_all(
+        "WhatsApp Conversation",
+        filters={"normalized_phone": ["in", list(recipient_names)], "session": ["in", list(sessions)], "is_group": 0},
+        fields=["name", "session", "contact", "phone_number", "chat_id", "normalized_phone"],
+        order_by="last_message_time desc",
+    ):
+        existing.setdefault(conversation.normalized_phone, {}).setdefault(conversation.session, conversation)
+
+    session_names = list(sessions)
+    conversations = {}
+    for i, phone in enumerate(sorted(recipient_names)):
+        by_session = existing.get(phone) or {}
+        if by_session:
+            # La más reciente (get_all viene ordenado por último mensaje)
+            conversations[phone] = next(iter(by_session.values()))
+            continue
+
+        target = session_names[i % len(session_names)]
+        conversations[phone] = _create_conversation(target, phone, recipient_names.get(phone))
+
+    return conversations, sessions
+
+
+def _create_conversation(session: str, phone: str, recipient_name: Optional[str] = None):
+    # Formato de JID de Baileys, el mismo con el que el webhook busca la conversación
+    digits = phone.lstrip("+")
+    conversation = frappe.get_doc({
+        "doctype": "WhatsApp Conversation",
+        "session": session,
+        "phone_number": digits,
+        "contact_name": recipient_name or phone,
+        "chat_id": f"{digits}@s.whatsapp.net",
+        "status": "Active",
+    }).insert(ignore_permissions=True)
+
+    return frappe._dict({
+        "name": conversation.name,
+        "session": session,
+        "contact": conversation.contact,
+        "phone_number": conversation.phone_number,
+        "chat_id": conversation.chat_id,
+    })
+
+
+def on_message_status(message: str, status: str, error: Optional[str] = None):
+    """
+    Callback de estado de la cola de envío: guarda el resultado en la fila del
+    destinatario y actualiza el progreso de la difusión.
+    """
+    recipient = frappe.db.get_value(
+        "WhatsApp Broadcast Recipient", {"message": message}, ["name", "parent", "status"], as_dict=True
+    )
+    if not recipient:
+        return
+
+    if status == "Failed":
+        # Un fallo tardío no borra una entrega ya confirmada
+        if STATUS_RANK.get(recipient.status, 0) >= STATUS_RANK["Delivered"]:
+            return
+    elif status not in STATUS_RANK or STATUS_RANK[status] <= STATUS_RANK.get(recipient.status, -1):
+        return
+
+    _set_recipient(recipient.name, status, error=error)
+    update_broadcast_progress(recipient.parent)
+
+
+def update_broadcast_progress(broadcast: str) -> Dict[str, int]:
+    """
+    Recalcula los contadores de una difusión a partir de sus destinatarios y
+    la da por completada cuando ya no queda nada por enviar.
+
+    Returns:
+        Dict con los contadores
+    """
+    counts = {
+        row.status: cint(row.count)
+        for row in frappe.db.sql("""
+            SELECT status, COUNT(*) AS count
+            FROM `tabWhatsApp Broadcast Recipient`
+            WHERE parent = %s AND parenttype = 'WhatsApp Broadcast'
+            GROUP BY status
+        """, (broadcast,), as_dict=True)
+    }
+
+    progress = {
+        "pending_count": counts.get("Pending", 0) + counts.get("Queued", 0),
+        "sent_count": counts.get("Sent", 0) + counts.get("Delivered", 0) + counts.get("Read", 0),
+        "delivered_count": counts.get("Delivered", 0) + counts.get("Read", 0),
+        "read_count": counts.get("Read", 0),
+        "failed_count": counts.get("Failed", 0) + counts.get("Skipped", 0),
+    }
+    values = dict(progress)
+
+    status = frappe.db.get_value("WhatsApp Broadcast", broadcast, "status")
+    if status in ("Queued", "Running") and not progress["pending_count"]:
+        values.update({"status": "Completed", "completed_at": now_datetime()})
+
+    frappe.db.set_value("WhatsApp Broadcast", broadcast, values, update_modified=False)
+    frappe.publish_realtime("whatsapp_broadcast_progress", {"broadcast": broadcast, **values}, doctype="WhatsApp Broadcast", docname=broadcast)
+    return progress
+
+
+def resume_broadcasts():
+    """
+    Tarea programada: relanza las difusiones en marcha que aún tienen
+    destinatarios sin encolar (p. ej. tras reiniciar los workers o si no había
+    sesiones conectadas).
+    """
+    broadcasts = frappe.db.sql_list("""
+        SELECT DISTINCT broadcast.name
+        FROM `tabWhatsApp Broadcast` broadcast
+        INNER JOIN `tabWhatsApp Broadcast Recipient` recipient
+            ON recipient.parent = broadcast.name AND recipient.parenttype = 'WhatsApp Broadcast'
+        WHERE broadcast.status IN ('Queued', 'Running') AND recipient.status = 'Pending'
+    """)
+
+    for broadcast in broadcasts:
+        if not is_locked(_lock_key(broadcast)):
+            _enqueue_broadcast(broadcast)
+
+
+@frappe.whitelist()
+def get_broadcast_report(broadcast: str, status: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Resultado de una difusión: contadores y estado de cada destinatario.
+
+    Args:
+        broadcast: Nombre del documento WhatsApp Broadcast
+        status: Filtrar destinatarios por estado (opcional)
+
+    Returns:
+        Dict con el estado de la difusión, los contadores y recipients
+    """
+    frappe.has_permission("WhatsApp Broadcast", "read", broadcast, throw=True)
+
+    doc = frappe.db.get_value(
+        "WhatsApp Broadcast",
+        broadcast,
+        ["name", "title", "status", "started_at", "completed_at", "total_recipients",
+         "pending_count", "sent_count", "delivered_count", "read_count", "failed_count"],
+        as_dict=True,
+    )
+
+    filters = {"parent": broadcast, "parenttype": "WhatsApp Broadcast"}
+    if status:
+        filters["status"] = status
+
+    recipients = frappe.get_all(
+        "WhatsApp Broadcast Recipient",
+        filters=filters,
+        fields=["phone_number", "recipient_name", "status", "conversation", "message", "error"],
+        order_by="idx asc",
+    )
+
+    return {"success": True, **doc, "recipients": recipients}
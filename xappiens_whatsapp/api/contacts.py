@@ -7,11 +7,28 @@ Sincroniza contactos desde el servidor externo con WhatsApp Contact DocType.
 
 import frappe
 from .base import WhatsAppAPIClient
-from typing import Dict, Any, List
-import requests
+from .avatars import PROFILE_PIC_KEYS, queue_avatar_refresh, refresh_avatars
+from .messages import _parse_timestamp
+from typing import Dict, Any, List, Optional
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from frappe.utils import cint, get_datetime, get_system_timezone, now_datetime
+from xappiens_whatsapp.utils.phone import get_conversation_phone
 import base64
 
 
+# Filas por sentencia INSERT/UPDATE multi-fila de la sincronización de contactos
+CONTACT_CHUNK_SIZE = 500
+
+# Campos de WhatsApp Contact que se rellenan con los datos del servidor
+CONTACT_SYNC_FIELDS = [
+    "phone_number", "normalized_phone", "contact_name", "pushname", "short_name",
+    "about", "profile_pic_url", "is_user", "is_group", "is_my_contact",
+    "is_wa_contact", "is_blocked", "is_enterprise", "is_verified",
+    "verified_name", "verified_level", "first_seen", "last_seen",
+]
+
+
 def _get_first(data: Dict[str, Any], keys: List[str], default=None):
     """Helper para obtener el primer valor disponible en una lista de claves."""
     for key in keys:
@@ -130,66 +147,12 @@ def sync_contacts(session_name: str = None, limit: int = 1000) -> Dict[str, Any]
             contacts_data = response.get("contacts", [])
             total = response.get("total", len(contacts_data))
 
-        created = 0
-        updated = 0
-        errors = 0
-
-        for contact_data in contacts_data:
-            try:
-                contact_id = (
-                    contact_data.get("id", {}).get("_serialized")
-                    if isinstance(contact_data.get("id"), dict)
-                    else contact_data.get("id")
-                ) or contact_data.get("contactId") or contact_data.get("jid") or contact_data.get("waId")
-
-                if not contact_id:
-                    continue
-
-                phone_number = _extract_phone_number(contact_data, contact_id)
-
-                # Buscar si el contacto ya existe por contact_id o número
-                existing = None
-                if contact_id:
-                    existing = frappe.db.get_value(
-                        "WhatsApp Contact",
-                        {"session": session.name, "contact_id": contact_id},
-                        "name"
-                    )
-                if not existing and phone_number:
-                    existing = frappe.db.get_value(
-                        "WhatsApp Contact",
-                        {"session": session.name, "phone_number": phone_number},
-                        "name"
-                    )
-                if not existing and contact_id:
-                    existing = frappe.db.get_value(
-                        "WhatsApp Contact",
-                        {"session": session.name, "phone_number": contact_id},
-                        "name"
-                    )
-
-                if existing:
-                    # Actualizar contacto existente
-                    contact = frappe.get_doc("WhatsApp Contact", existing)
-                    _update_contact_from_data(contact, contact_data, session)
-                    updated += 1
-                else:
-                    # Crear nuevo contacto
-                    contact = _create_contact_from_data(contact_data, session)
-                    created += 1
-
-                # Sincronizar avatar - siempre intentar obtenerlo del servidor
-                try:
-                    update_contact_avatar(contact.name)
-                except:
-                    pass  # Continuar sin fallar si no se puede descargar el avatar
-
-            except Exception as e:
-                errors += 1
-                frappe.log_error(f"Error al sincronizar contacto {contact_id}: {str(e)}")
-
+        result = _bulk_upsert_contacts(session, contacts_data)
         frappe.db.commit()
 
+        # Avatares en segundo plano, fuera de la sincronización
+        queue_avatar_refresh(result["avatars"])
+
         # Actualizar estadísticas de la sesión
         total_contacts = frappe.db.count("WhatsApp Contact", {"session": session.name})
         try:
@@ -204,12 +167,14 @@ def sync_contacts(session_name: str = None, limit: int = 1000) -> Dict[str, Any]
             "success": True,
             "total_from_server": total,
             "processed": len(contacts_data),
-            "created": created,
-            "updated": updated,
-            "errors": errors
+            "created": result["created"],
+            "updated": result["updated"],
+            "unchanged": result["unchanged"],
+            "errors": result["errors"]
         }
 
     except Exception as e:
+        frappe.db.rollback()
         return {
             "success": False,
             "message": str(e)
@@ -663,7 +628,8 @@ def get_leads_count_by_phone(phone_number: str) -> Dict[str, Any]:
 @frappe.whitelist()
 def update_contact_avatar(contact_name: str, avatar_url: str = None) -> Dict[str, Any]:
     """
-    Actualiza el avatar de un contacto descargándolo del servidor.
+    Actualiza el avatar de un contacto ahora, sin esperar a la cola ni al TTL
+    (ver api/avatars.py).
 
     Args:
         contact_name: Nombre del documento WhatsApp Contact
@@ -672,75 +638,24 @@ def update_contact_avatar(contact_name: str, avatar_url: str = None) -> Dict[str
     Returns:
         Dict con resultado
     """
-    contact = frappe.get_doc("WhatsApp Contact", contact_name)
-    session = frappe.get_doc("WhatsApp Session", contact.session)
-
     try:
-        # Si no se provee URL, obtenerla del servidor
-        if not avatar_url:
-            client = WhatsAppAPIClient(session.session_id)
-            lookup_id = contact.contact_id or contact.phone_number
-            response = client.get_contact_info(lookup_id)
-
-            if response.get("success"):
-                payload = response.get("data") or response.get("contact") or {}
-                avatar_url = _get_first(payload, ["profilePicUrl", "profilePicURL", "profilePictureUrl"])
-            else:
-                return {"success": False, "message": response.get("message") or "No se pudo obtener URL del avatar"}
-
-        if not avatar_url or avatar_url == "default":
-            return {"success": False, "message": "Contacto sin foto de perfil"}
-
-        # Descargar imagen
-        try:
-            img_response = requests.get(avatar_url, timeout=10, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            })
-
-            if img_response.status_code == 200:
-                # Verificar que sea una imagen válida
-                content_type = img_response.headers.get('content-type', '')
-                if not content_type.startswith('image/'):
-                    return {"success": False, "message": "URL no es una imagen válida"}
-
-                # Determinar extensión del archivo
-                file_extension = 'jpg'
-                if 'png' in content_type:
-                    file_extension = 'png'
-                elif 'gif' in content_type:
-                    file_extension = 'gif'
-                elif 'webp' in content_type:
-                    file_extension = 'webp'
-
-                # Guardar como archivo en Frappe
-                file_doc = frappe.get_doc({
-                    "doctype": "File",
-                    "file_name": f"avatar_{contact.contact_id}.{file_extension}",
-                    "attached_to_doctype": "WhatsApp Contact",
-                    "attached_to_name": contact.name,
-                    "is_private": 0,
-                    "content": img_response.content
-                })
-                file_doc.save(ignore_permissions=True)
+        result = refresh_avatars(
+            [contact_name],
+            force=True,
+            avatar_urls={contact_name: avatar_url} if avatar_url else None
+        ).get(contact_name)
 
-                # Actualizar contacto
-                contact.profile_pic_url = avatar_url
-                contact.profile_pic_thumb = file_doc.file_url
-                contact.last_profile_pic_update = frappe.utils.now()
-                contact.save(ignore_permissions=True)
-                frappe.db.commit()
+        if not result:
+            return {"success": False, "message": "Contacto no encontrado"}
+        if result["status"] in ("removed", "error"):
+            return {"success": False, "message": result.get("message")}
 
-                return {
-                    "success": True,
-                    "avatar_url": file_doc.file_url,
-                    "message": "Avatar actualizado correctamente"
-                }
-            else:
-                return {"success": False, "message": f"Error HTTP {img_response.status_code} al descargar imagen"}
-        except requests.exceptions.RequestException as e:
-            return {"success": False, "message": f"Error de conexión: {str(e)}"}
-        except Exception as e:
-            return {"success": False, "message": f"Error inesperado: {str(e)}"}
+        frappe.db.commit()
+        return {
+            "success": True,
+            "avatar_url": frappe.db.get_value("WhatsApp Contact", contact_name, "profile_pic"),
+            "message": "Avatar actualizado correctamente" if result["status"] == "updated" else "El avatar no ha cambiado"
+        }
 
     except Exception as e:
         return {
@@ -749,164 +664,183 @@ def update_contact_avatar(contact_name: str, avatar_url: str = None) -> Dict[str
         }
 
 
-def _create_contact_from_data(contact_data: Dict, session: Any) -> Any:
+def _to_system_datetime(value) -> Optional[datetime]:
+    """Timestamp del servidor en hora del sistema y sin zona, como se guarda en la BD."""
+    timestamp = _parse_timestamp(value)
+    if timestamp and timestamp.tzinfo:
+        timestamp = timestamp.astimezone(ZoneInfo(get_system_timezone())).replace(tzinfo=None)
+    return timestamp
+
+
+def _contact_values_from_data(contact_data: Dict, contact_id: str) -> Dict[str, Any]:
     """
-    Crea un nuevo documento WhatsApp Contact desde datos del servidor.
+    Valores de WhatsApp Contact a partir de los datos del servidor.
+
+    Los indicadores se incluyen siempre; los textos y fechas solo si el
+    servidor los envía, para no borrar los que ya había.
 
     Args:
         contact_data: Datos del contacto del servidor
-        session: Documento WhatsApp Session
+        contact_id: ID del contacto
 
     Returns:
-        Documento WhatsApp Contact creado
+        Dict {campo: valor} con campos de CONTACT_SYNC_FIELDS
     """
-    contact_id = _extract_contact_id(contact_data)
-    phone_number = _extract_phone_number(contact_data, contact_id)
+    phone_number = _extract_phone_number(contact_data, contact_id) or contact_id
+    is_group = cint(contact_data.get("isGroup", False))
+    verified_name = _get_first(contact_data, ["verifiedName", "businessName"])
+
+    values = {
+        "phone_number": phone_number,
+        "normalized_phone": get_conversation_phone(phone_number, contact_id, is_group),
+        "is_user": cint(contact_data.get("isUser", False)),
+        "is_group": is_group,
+        "is_my_contact": cint(contact_data.get("isMyContact", False)),
+        "is_wa_contact": cint(contact_data.get("isWAContact", False) or contact_data.get("isWhatsApp", False)),
+        "is_blocked": cint(contact_data.get("isBlocked", False)),
+        "is_enterprise": cint(contact_data.get("isEnterprise", False)),
+        "is_verified": cint(contact_data.get("isVerified", False) or bool(verified_name)),
+        "verified_level": contact_data.get("verifiedLevel") or "Unverified",
+    }
 
     # Truncar campos largos para evitar errores de longitud
-    # Usar el número de teléfono como nombre si no hay otros datos
-    contact_name = (_get_first(contact_data, ["name", "pushname", "verifiedName", "formattedName", "number"], contact_id) or contact_id)[:140]
-    pushname = (_get_first(contact_data, ["pushname", "verifiedName", "formattedName"], "") or "")[:140]
-    short_name = (_get_first(contact_data, ["shortName", "short_name"], "") or "")[:140]
-    about = (_get_first(contact_data, ["about", "statusMessage"], "") or "")[:140]
-    verified_name = (_get_first(contact_data, ["verifiedName", "businessName"], "") or "")[:140]
-
-    # Procesar fechas
-    first_seen = None
-    last_seen = None
-    if contact_data.get("firstSeen") or contact_data.get("firstSeenAt"):
-        from datetime import datetime
-        ts = contact_data.get("firstSeen") or contact_data.get("firstSeenAt")
-        if isinstance(ts, (int, float)) and ts > 1_000_000_000_000:
-            ts = ts / 1000
-        try:
-            if isinstance(ts, str):
-                first_seen = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-            else:
-                first_seen = datetime.fromtimestamp(ts)
-        except Exception:
-            first_seen = None
-    if contact_data.get("lastSeen") or contact_data.get("lastSeenAt"):
-        from datetime import datetime
-        ts = contact_data.get("lastSeen") or contact_data.get("lastSeenAt")
-        if isinstance(ts, (int, float)) and ts > 1_000_000_000_000:
-            ts = ts / 1000
-        try:
-            if isinstance(ts, str):
-                last_seen = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-            else:
-                last_seen = datetime.fromtimestamp(ts)
-        except Exception:
-            last_seen = None
-
-    profile_pic_url = _get_first(contact_data, ["profilePicUrl", "profilePicURL", "profilePictureUrl"])
-
-    contact = frappe.get_doc({
-        "doctype": "WhatsApp Contact",
-        "session": session.name,
-        "contact_id": contact_id,
-        "phone_number": phone_number or contact_id,
-        "contact_name": contact_name,
-        "pushname": pushname,
-        "short_name": short_name,
-        "profile_pic_url": profile_pic_url,
-        "about": about,
-        "last_profile_pic_update": frappe.utils.now() if profile_pic_url else None,
-        "is_user": contact_data.get("isUser", False),
-        "is_group": contact_data.get("isGroup", False),
-        "is_my_contact": contact_data.get("isMyContact", False),
-        "is_wa_contact": contact_data.get("isWAContact", False) or contact_data.get("isWhatsApp", False),
-        "is_blocked": contact_data.get("isBlocked", False),
-        "is_enterprise": contact_data.get("isEnterprise", False),
-        "is_verified": contact_data.get("isVerified", False) or bool(_get_first(contact_data, ["verifiedName", "businessName"])),
+    texts = {
+        "contact_name": _get_first(contact_data, ["name", "pushname", "verifiedName", "formattedName", "number"]),
+        "pushname": _get_first(contact_data, ["pushname", "verifiedName", "formattedName"]),
+        "short_name": _get_first(contact_data, ["shortName", "short_name"]),
+        "about": _get_first(contact_data, ["about", "statusMessage"]),
         "verified_name": verified_name,
-        "verified_level": contact_data.get("verifiedLevel"),
-        "verification_date": frappe.utils.now() if (contact_data.get("isVerified") or verified_name) else None,
-        "first_seen": first_seen,
-        "last_seen": last_seen,
-        "last_sync": frappe.utils.now(),
-        "sync_status": "Synced"
-    })
+    }
+    for field, value in texts.items():
+        if value:
+            values[field] = str(value)[:140]
 
-    contact.insert(ignore_permissions=True)
-    return contact
+    profile_pic_url = _get_first(contact_data, PROFILE_PIC_KEYS)
+    if profile_pic_url:
+        values["profile_pic_url"] = profile_pic_url
 
+    first_seen = _to_system_datetime(_get_first(contact_data, ["firstSeen", "firstSeenAt"]))
+    if first_seen:
+        values["first_seen"] = first_seen
+    last_seen = _to_system_datetime(_get_first(contact_data, ["lastSeen", "lastSeenAt"]))
+    if last_seen:
+        values["last_seen"] = last_seen
 
-def _update_contact_from_data(contact: Any, contact_data: Dict, session: Any):
+    return values
+
+
+def _diff_contact(existing: Dict[str, Any], values: Dict[str, Any]) -> Dict[str, Any]:
+    """Campos de `values` que difieren de la fila guardada."""
+    changes = {}
+    for field, value in values.items():
+        current = existing.get(field)
+        if isinstance(value, datetime):
+            same = bool(current) and get_datetime(current) == value
+        elif isinstance(value, int):
+            same = cint(current) == value
+        else:
+            same = (current or "") == value
+        if not same:
+            changes[field] = value
+    return changes
+
+
+def _bulk_upsert_contacts(session: Any, contacts_data: List[Dict]) -> Dict[str, Any]:
     """
-    Actualiza un documento WhatsApp Contact con datos del servidor.
+    Inserta y actualiza los contactos de una sesión con sentencias multi-fila.
+
+    Los contactos existentes de la sesión se cargan en una sola consulta y se
+    indexan por contact_id y teléfono; solo se escriben las filas que cambian.
+    No dispara los controladores del DocType: normalized_phone se calcula aquí.
 
     Args:
-        contact: Documento WhatsApp Contact
-        contact_data: Datos del contacto del servidor
         session: Documento WhatsApp Session
-    """
-    # Truncar campos largos para evitar errores de longitud
-    contact_name = (_get_first(contact_data, ["name", "pushname", "verifiedName", "formattedName", "number"], contact.contact_name) or contact.contact_name)[:140]
-    pushname = (_get_first(contact_data, ["pushname", "verifiedName", "formattedName"], contact.pushname) or contact.pushname or "")[:140]
-    short_name = (_get_first(contact_data, ["shortName", "short_name"], contact.short_name or "") or "")[:140]
-    about = (_get_first(contact_data, ["about", "statusMessage"], contact.about or "") or "")[:140]
-    verified_name = (_get_first(contact_data, ["verifiedName", "businessName"], contact.verified_name or "") or "")[:140]
-
-    # Procesar fechas
-    first_seen = None
-    last_seen = None
-    if contact_data.get("firstSeen") or contact_data.get("firstSeenAt"):
-        from datetime import datetime
-        ts = contact_data.get("firstSeen") or contact_data.get("firstSeenAt")
-        if isinstance(ts, (int, float)) and ts > 1_000_000_000_000:
-            ts = ts / 1000
-        try:
-            if isinstance(ts, str):
-                first_seen = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-            else:
-                first_seen = datetime.fromtimestamp(ts)
-        except Exception:
-            first_seen = None
-    if contact_data.get("lastSeen") or contact_data.get("lastSeenAt"):
-        from datetime import datetime
-        ts = contact_data.get("lastSeen") or contact_data.get("lastSeenAt")
-        if isinstance(ts, (int, float)) and ts > 1_000_000_000_000:
-            ts = ts / 1000
-        try:
-            if isinstance(ts, str):
-                last_seen = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-            else:
-                last_seen = datetime.fromtimestamp(ts)
-        except Exception:
-            last_seen = None
-
-    contact.contact_name = contact_name
-    contact.pushname = pushname
-    contact.short_name = short_name
-    contact.about = about
-    contact.verified_name = verified_name
-    contact.is_user = contact_data.get("isUser", False)
-    contact.is_group = contact_data.get("isGroup", False)
-    contact.is_wa_contact = contact_data.get("isWAContact", False) or contact_data.get("isWhatsApp", False)
-    contact.is_my_contact = contact_data.get("isMyContact", False)
-    contact.is_blocked = contact_data.get("isBlocked", False)
-    contact.is_enterprise = contact_data.get("isEnterprise", False)
-    contact.is_verified = contact_data.get("isVerified", False) or bool(_get_first(contact_data, ["verifiedName", "businessName"]))
-    contact.verified_level = contact_data.get("verifiedLevel")
-    profile_pic_url = _get_first(contact_data, ["profilePicUrl", "profilePicURL", "profilePictureUrl"])
-    contact.profile_pic_url = profile_pic_url
-
-    phone_number = _extract_phone_number(contact_data, contact.contact_id)
-    if phone_number:
-        contact.phone_number = phone_number
-
-    # Actualizar fechas si están disponibles
-    if first_seen:
-        contact.first_seen = first_seen
-    if last_seen:
-        contact.last_seen = last_seen
-    if profile_pic_url:
-        contact.last_profile_pic_update = frappe.utils.now()
-    if contact.is_verified:
-        contact.verification_date = frappe.utils.now()
+        contacts_data: Contactos devueltos por el servidor
 
-    contact.last_sync = frappe.utils.now()
-    contact.sync_status = "Synced"
-
-    contact.save(ignore_permissions=True)
+    Returns:
+        Dict con created, updated, unchanged, errors y avatars (contactos cuyo
+        avatar hay que descargar)
+    """
+    existing_rows = frappe.get_all(
+        "WhatsApp Contact",
+        filters={"session": session.name},
+        fields=["name", "contact_id"] + CONTACT_SYNC_FIELDS
+    )
+    by_contact_id = {row.contact_id: row for row in existing_rows}
+    by_phone = {}
+    for row in existing_rows:
+        by_phone.setdefault(row.phone_number, row)
+
+    now = now_datetime()
+    inserts = {}
+    updates = {}
+    avatars = []
+    unchanged = 0
+
+    for contact_data in contacts_data:
+        contact_id = _extract_contact_id(contact_data)
+        if not contact_id:
+            continue
+
+        values = _contact_values_from_data(contact_data, contact_id)
+        existing = by_contact_id.get(contact_id) or by_phone.get(values["phone_number"]) or by_phone.get(contact_id)
+
+        if not existing:
+            inserts[contact_id] = values
+            continue
+
+        changes = _diff_contact(existing, values)
+        if not changes:
+            unchanged += 1
+            continue
+
+        if changes.get("is_verified"):
+            changes["verification_date"] = now
+        if "profile_pic_url" in changes:
+            # Fuera del TTL: la cola de avatares la vuelve a descargar
+            changes["last_profile_pic_update"] = None
+            avatars.append(existing.name)
+        changes.update({"last_sync": now, "sync_status": "Synced"})
+        updates[existing.name] = changes
+        existing.update(changes)
+
+    if updates:
+        frappe.db.bulk_update("WhatsApp Contact", updates, chunk_size=CONTACT_CHUNK_SIZE)
+
+    created = []
+    if inserts:
+        user = frappe.session.user
+        fields = ["name", "creation", "modified", "owner", "modified_by", "session", "contact_id",
+            "last_sync", "sync_count", "sync_status", "verification_date"] + CONTACT_SYNC_FIELDS
+        rows = []
+        for contact_id, values in inserts.items():
+            values.setdefault("contact_name", contact_id)
+            values.setdefault("first_seen", now)
+            rows.append([
+                contact_id, now, now, user, user, session.name, contact_id,
+                now, 1, "Synced", now if values["is_verified"] else None,
+            ] + [values.get(field) for field in CONTACT_SYNC_FIELDS])
+
+        # El name es el contact_id: los que ya existen en otra sesión se omiten
+        frappe.db.bulk_insert("WhatsApp Contact", fields, rows, ignore_duplicates=True, chunk_size=CONTACT_CHUNK_SIZE)
+        created = frappe.get_all(
+            "WhatsApp Contact",
+            filters={"session": session.name, "name": ["in", list(inserts)]},
+            pluck="name"
+        )
+        avatars += created
+
+    errors = len(inserts) - len(created)
+    if errors:
+        frappe.log_error(
+            f"{errors} contactos de la sesión {session.name} ya existen en otra sesión y no se han importado",
+            "WhatsApp Contact Sync"
+        )
+
+    return {
+        "created": len(created),
+        "updated": len(updates),
+        "unchanged": unchanged,
+        "errors": errors,
+        "avatars": avatars
+    }
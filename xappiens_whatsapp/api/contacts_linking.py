@@ -3,6 +3,41 @@
 
 import frappe
 
+from xappiens_whatsapp.utils.phone import normalize_phone_number, phone_variants
+
+
+LEAD_LOOKUP_CHUNK_SIZE = 500
+
+
+def find_leads_by_phone(phones, fields=None):
+    """
+    Busca leads del CRM por teléfono con consultas IN por bloques, probando
+    los formatos habituales de mobile_no (+34..., 34..., nacional).
+
+    Args:
+        phones: Números en cualquier formato
+        fields: Campos del lead a devolver
+
+    Returns:
+        Dict {teléfono normalizado: lead}
+    """
+    fields = list(set((fields or ["name", "lead_name"]) + ["mobile_no"]))
+    normalized = sorted({normalize_phone_number(phone) for phone in phones} - {""})
+
+    leads = {}
+    for start in range(0, len(normalized), LEAD_LOOKUP_CHUNK_SIZE):
+        variants = []
+        for phone in normalized[start:start + LEAD_LOOKUP_CHUNK_SIZE]:
+            variants += phone_variants(phone)
+
+        for lead in frappe.get_all("CRM Lead",
+                                   filters={"mobile_no": ["in", variants]},
+                                   fields=fields,
+                                   order_by="creation asc"):
+            leads.setdefault(normalize_phone_number(lead.mobile_no), lead)
+
+    return leads
+
 
 @frappe.whitelist()
 def bulk_auto_link_contacts():
@@ -17,7 +52,16 @@ def bulk_auto_link_contacts():
         # Obtener todos los contactos de WhatsApp con número de teléfono
         contacts = frappe.get_all("WhatsApp Contact",
             filters={"phone_number": ["!=", ""]},
-            fields=["name", "contact_id", "phone_number", "linked_lead"]
+            fields=["name", "contact_id", "phone_number", "normalized_phone", "linked_lead"]
+        )
+
+        for contact in contacts:
+            contact.normalized_phone = contact.normalized_phone or normalize_phone_number(contact.phone_number)
+
+        # Una búsqueda por lotes para todos los contactos sin vincular
+        leads_by_phone = find_leads_by_phone(
+            [contact.normalized_phone for contact in contacts if not contact.linked_lead],
+            ["name", "lead_name"]
         )
 
         stats = {
@@ -41,34 +85,10 @@ def bulk_auto_link_contacts():
                     })
                     continue
 
-                # Extraer número limpio del phone_number (quitar @c.us)
-                clean_phone = contact.phone_number
-                if "@c.us" in clean_phone:
-                    clean_phone = clean_phone.replace("@c.us", "")
-                elif "@lid" in clean_phone:
-                    clean_phone = clean_phone.replace("@lid", "")
-
-                # Normalizar número para búsqueda (agregar +)
-                phone_with_plus = f"+{clean_phone}"
-
-                # Buscar lead con diferentes formatos
-                search_terms = [
-                    phone_with_plus,  # +34657032985
-                    clean_phone,      # 34657032985
-                    f"+{clean_phone}", # +34657032985
-                ]
-
-                leads = []
-                for term in search_terms:
-                    leads = frappe.get_all("CRM Lead",
-                        filters={"mobile_no": term},
-                        fields=["name", "lead_name", "mobile_no"],
-                        limit=1
-                    )
-                    if leads:
-                        break
-
-                if not leads:
+                phone_with_plus = contact.normalized_phone
+                lead = leads_by_phone.get(phone_with_plus)
+
+                if not lead:
                     stats["no_lead_found"] += 1
                     stats["details"].append({
                         "contact": contact.contact_id,
@@ -78,7 +98,6 @@ def bulk_auto_link_contacts():
                     continue
 
                 # Vincular
-                lead = leads[0]
                 frappe.db.set_value("WhatsApp Contact", contact.name, "linked_lead", lead.name)
 
                 stats["newly_linked"] += 1
@@ -135,42 +154,16 @@ def auto_link_single_contact(contact_name):
                 "message": "No hay número de teléfono para vincular"
             }
 
-        # Extraer número limpio del phone_number (quitar @c.us)
-        clean_phone = contact.phone_number
-        if "@c.us" in clean_phone:
-            clean_phone = clean_phone.replace("@c.us", "")
-        elif "@lid" in clean_phone:
-            clean_phone = clean_phone.replace("@lid", "")
-
-        # Normalizar número para búsqueda (agregar +)
-        phone_with_plus = f"+{clean_phone}"
-
-        # Buscar lead con diferentes formatos
-        search_terms = [
-            phone_with_plus,  # +34657032985
-            clean_phone,      # 34657032985
-            f"+{clean_phone}", # +34657032985
-        ]
-
-        leads = []
-        for term in search_terms:
-            leads = frappe.get_all("CRM Lead",
-                filters={"mobile_no": term},
-                fields=["name", "lead_name", "mobile_no", "status"],
-                limit=1
-            )
-            if leads:
-                break
-
-        if not leads:
+        phone_with_plus = contact.normalized_phone or normalize_phone_number(contact.phone_number)
+        lead = find_leads_by_phone([phone_with_plus], ["name", "lead_name", "status"]).get(phone_with_plus)
+
+        if not lead:
             return {
                 "success": False,
                 "message": f"No se encontró lead con número {phone_with_plus}",
                 "phone_searched": phone_with_plus
             }
 
-        lead = leads[0]
-
         # Verificar si ya está vinculado
         if contact.linked_lead == lead.name:
             return {
@@ -6,8 +6,18 @@ Sincroniza chats desde el servidor externo con WhatsApp Conversation DocType.
 """
 
 import frappe
+from frappe.utils import cint, now_datetime, time_diff_in_seconds
 from .base import WhatsAppAPIClient
 from typing import Dict, Any, List
+from xappiens_whatsapp.utils.locks import is_locked, lock
+from xappiens_whatsapp.utils.conversation_stats import invalidate_conversation_stats
+from xappiens_whatsapp.utils.timestamps import parse_remote_timestamp
+
+
+DEFAULT_STALENESS_SECONDS = 300
+# Tras una sincronización fallida (p. ej. sesión desconectada) no se reintenta antes de esto
+REFRESH_RETRY_SECONDS = 60
+REFRESH_LOCK_TIMEOUT = 900
 
 
 @frappe.whitelist()
@@ -126,12 +136,16 @@ def sync_conversations(session_name: str = None, limit: int = 1000) -> Dict[str,
                 errors += 1
                 # Continuar sin fallar por errores individuales
 
+        invalidate_conversation_stats(session.name)
         frappe.db.commit()
 
-        # Actualizar estadísticas de la sesión
+        # Actualizar estadísticas de la sesión y la marca de última sincronización
         total_chats = frappe.db.count("WhatsApp Conversation", {"session": session.name})
         try:
-            frappe.db.set_value("WhatsApp Session", session.name, "total_chats", total_chats)
+            frappe.db.set_value("WhatsApp Session", session.name, {
+                "total_chats": total_chats,
+                "last_conversations_sync": now_datetime()
+            })
             frappe.db.commit()
         except:
             # Continuar sin fallar por las estadísticas
@@ -154,6 +168,251 @@ def sync_conversations(session_name: str = None, limit: int = 1000) -> Dict[str,
         }
 
 
+CONVERSATION_LIST_FIELDS = [
+    "name", "contact_name", "phone_number", "last_message",
+    "last_message_time", "last_message_from_me", "unread_count",
+    "is_muted", "is_pinned", "is_archived", "linked_lead",
+    "linked_customer", "total_messages", "session", "contact",
+    "chat_id", "is_group"
+]
+
+
+def enrich_conversations(conversations: List[Dict]) -> List[Dict[str, Any]]:
+    """
+    Añade contacto, último mensaje y lead a una página de conversaciones.
+
+    Usa tres consultas IN para toda la página (contactos, últimos mensajes y
+    leads), independientemente del número de conversaciones.
+
+    Args:
+        conversations: Filas de WhatsApp Conversation con CONVERSATION_LIST_FIELDS
+
+    Returns:
+        Lista de conversaciones en el formato de get_conversations
+    """
+    if not conversations:
+        return []
+
+    contacts = _get_contacts_by_name([c.contact for c in conversations if c.contact])
+    last_messages = _get_last_messages([c.name for c in conversations])
+    leads = _get_leads_by_name([c.linked_lead for c in conversations if c.linked_lead])
+
+    enriched_conversations = []
+    for conv in conversations:
+        # Construir objeto enriquecido
+        enriched_conv = {
+            "name": conv.name,
+            "phone_number": conv.phone_number,
+            "unread_count": conv.unread_count or 0,
+            "is_muted": conv.is_muted,
+            "is_pinned": conv.is_pinned,
+            "is_archived": conv.is_archived,
+            "total_messages": conv.total_messages or 0,
+            "is_group": conv.is_group or False,
+            "chat_id": conv.chat_id
+        }
+
+        # Información del contacto
+        contact_info = contacts.get(conv.contact) if conv.contact else None
+        if contact_info:
+            enriched_conv["contact_name"] = contact_info.contact_name or contact_info.pushname or conv.contact_name
+            enriched_conv["profile_pic"] = contact_info.profile_pic_thumb
+            enriched_conv["is_verified"] = contact_info.is_verified
+        else:
+            enriched_conv["contact_name"] = conv.contact_name
+            enriched_conv["profile_pic"] = None
+            enriched_conv["is_verified"] = False
+
+        # Información del último mensaje
+        last_message_info = last_messages.get(conv.name)
+        if last_message_info:
+            enriched_conv["last_message"] = last_message_info.content
+            enriched_conv["last_message_time"] = _serialize_timestamp(last_message_info.timestamp)
+            enriched_conv["last_message_from_me"] = last_message_info.from_me
+            enriched_conv["last_message_type"] = last_message_info.message_type
+            enriched_conv["last_message_status"] = last_message_info.status
+        else:
+            enriched_conv["last_message"] = conv.last_message
+            enriched_conv["last_message_time"] = _serialize_timestamp(conv.last_message_time)
+            enriched_conv["last_message_from_me"] = conv.last_message_from_me
+            enriched_conv["last_message_type"] = "text"
+            enriched_conv["last_message_status"] = "sent"
+
+        # Información del lead si está vinculado
+        if conv.linked_lead and conv.linked_lead in leads:
+            enriched_conv["lead"] = leads[conv.linked_lead]
+
+        enriched_conversations.append(enriched_conv)
+
+    return enriched_conversations
+
+
+def _serialize_timestamp(timestamp):
+    """Convierte el timestamp a string para serialización (ya está en la zona horaria correcta)."""
+    if timestamp and hasattr(timestamp, "isoformat"):
+        return timestamp.isoformat()
+    return str(timestamp) if timestamp else timestamp
+
+
+def _get_contacts_by_name(names: List[str]) -> Dict[str, Any]:
+    """Contactos de WhatsApp indexados por nombre (una consulta)."""
+    if not names:
+        return {}
+
+    return {
+        contact.name: contact
+        for contact in frappe.get_all("WhatsApp Contact",
+                                      filters={"name": ["in", list(set(names))]},
+                                      fields=["name", "contact_name", "profile_pic_thumb", "is_verified", "is_group", "pushname"])
+    }
+
+
+def _get_last_messages(conversation_names: List[str]) -> Dict[str, Any]:
+    """
+    Último mensaje de cada conversación en una sola consulta
+    (usa el índice (conversation, timestamp)).
+    """
+    if not conversation_names:
+        return {}
+
+    rows = frappe.db.sql("""
+        SELECT m.conversation, m.content, m.timestamp, m.from_me, m.message_type, m.status
+        FROM `tabWhatsApp Message` m
+        INNER JOIN (
+            SELECT conversation, MAX(timestamp) AS max_timestamp
+            FROM `tabWhatsApp Message`
+            WHERE conversation IN %(conversations)s
+            GROUP BY conversation
+        ) latest ON latest.conversation = m.conversation AND latest.max_timestamp = m.timestamp
+        ORDER BY m.creation DESC
+    """, {"conversations": tuple(conversation_names)}, as_dict=True)
+
+    last_messages = {}
+    for row in rows:
+        # Con timestamps empatados gana el último creado
+        last_messages.setdefault(row.conversation, row)
+
+    return last_messages
+
+
+def _get_leads_by_name(names: List[str]) -> Dict[str, Any]:
+    """Leads del CRM indexados por nombre (una consulta)."""
+    if not names or not frappe.db.table_exists("CRM Lead"):
+        return {}
+
+    return {
+        lead.name: lead
+        for lead in frappe.get_all("CRM Lead",
+                                   filters={"name": ["in", list(set(names))]},
+                                   fields=["name", "lead_name", "status"])
+    }
+
+
+def get_default_session_name() -> str:
+    """Primera sesión activa y conectada (sesión por defecto de las bandejas)."""
+    sessions = frappe.get_all("WhatsApp Session",
+                            filters={"is_active": 1, "is_connected": 1},
+                            pluck="name",
+                            limit=1)
+    return sessions[0] if sessions else None
+
+
+def _get_staleness_window() -> int:
+    """Segundos tras los que las conversaciones de una sesión se consideran desactualizadas."""
+    value = frappe.db.get_single_value("WhatsApp Settings", "conversation_staleness_seconds")
+    return DEFAULT_STALENESS_SECONDS if value is None else cint(value)
+
+
+def _is_stale(last_synced_at) -> bool:
+    if not last_synced_at:
+        return True
+    return time_diff_in_seconds(now_datetime(), last_synced_at) > _get_staleness_window()
+
+
+def ensure_conversations_fresh(session_name: str) -> Dict[str, Any]:
+    """
+    Comprueba la marca de última sincronización de la sesión y, si supera la
+    ventana de frescura, programa una sincronización en segundo plano.
+    Nunca sincroniza en la petición: la lista se sirve desde la BD local.
+
+    Args:
+        session_name: Nombre del documento WhatsApp Session
+
+    Returns:
+        Dict con last_synced_at, stale y refreshing
+    """
+    last_synced_at = frappe.db.get_value("WhatsApp Session", session_name, "last_conversations_sync")
+    stale = _is_stale(last_synced_at)
+
+    refreshing = False
+    if stale:
+        refreshing = _schedule_conversation_refresh(session_name)
+
+    return {
+        "last_synced_at": last_synced_at,
+        "stale": stale,
+        "refreshing": refreshing
+    }
+
+
+def _schedule_conversation_refresh(session_name: str) -> bool:
+    """
+    Programa la sincronización de la sesión (single-flight): el job está
+    deduplicado por sesión y un lock evita ejecuciones concurrentes.
+
+    Returns:
+        True si hay una sincronización en curso o programada
+    """
+    if is_locked(f"conversation_refresh:{session_name}"):
+        return True
+
+    if frappe.cache().get_value(f"whatsapp_conversation_refresh_backoff:{session_name}"):
+        return False
+
+    frappe.enqueue(
+        "xappiens_whatsapp.api.conversations.refresh_conversations",
+        queue="default",
+        timeout=REFRESH_LOCK_TIMEOUT,
+        job_id=f"whatsapp_conversation_refresh::{frappe.local.site}::{session_name}",
+        deduplicate=True,
+        session_name=session_name
+    )
+    return True
+
+
+def refresh_conversations(session_name: str):
+    """
+    Job en segundo plano que sincroniza las conversaciones de una sesión
+    desactualizada y avisa al frontend para que recargue la lista.
+
+    Args:
+        session_name: Nombre del documento WhatsApp Session
+    """
+    with lock(f"conversation_refresh:{session_name}", timeout=REFRESH_LOCK_TIMEOUT) as acquired:
+        if not acquired:
+            return
+
+        # Otra sincronización pudo completarse mientras este job esperaba
+        last_synced_at = frappe.db.get_value("WhatsApp Session", session_name, "last_conversations_sync")
+        if not _is_stale(last_synced_at):
+            return
+
+        result = sync_conversations(session_name=session_name)
+
+        if not result.get("success"):
+            frappe.cache().set_value(
+                f"whatsapp_conversation_refresh_backoff:{session_name}", 1,
+                expires_in_sec=REFRESH_RETRY_SECONDS
+            )
+            return
+
+        frappe.publish_realtime("whatsapp_conversations_refreshed", {
+            "session": session_name,
+            "created": result.get("created", 0),
+            "updated": result.get("updated", 0)
+        }, after_commit=True)
+
+
 @frappe.whitelist()
 def create_whatsapp_conversation(contact_name: str, session_name: str = None) -> Dict[str, Any]:
     """
@@ -383,18 +642,8 @@ def _create_conversation_from_data(chat_data: Dict, session: Any) -> Any:
             or chat_data.get("lastMessageAt")
         )
         if timestamp:
-            from datetime import datetime
-            # Algunas respuestas ya envían timestamps en ms o en ISO-8601
-            try:
-                if isinstance(timestamp, (int, float)):
-                    # Detectar si viene en milisegundos
-                    if timestamp > 1_000_000_000_000:
-                        timestamp = timestamp / 1000
-                    last_message_time = datetime.fromtimestamp(timestamp)
-                elif isinstance(timestamp, str):
-                    last_message_time = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-            except Exception:
-                last_message_time = None
+            # Segundos, ms o ISO-8601, en la misma zona que los mensajes y la marca de agua
+            last_message_time = parse_remote_timestamp(timestamp)
 
         body = (
             last_message.get("body")
@@ -408,13 +657,11 @@ def _create_conversation_from_data(chat_data: Dict, session: Any) -> Any:
     # Procesar información adicional
     first_message_time = None
     if chat_data.get("firstMessageTime"):
-        from datetime import datetime
-        first_message_time = datetime.fromtimestamp(chat_data.get("firstMessageTime"))
+        first_message_time = parse_remote_timestamp(chat_data.get("firstMessageTime"))
 
     mute_expiration = None
     if chat_data.get("muteExpiration"):
-        from datetime import datetime
-        mute_expiration = datetime.fromtimestamp(chat_data.get("muteExpiration"))
+        mute_expiration = parse_remote_timestamp(chat_data.get("muteExpiration"))
 
     title = (chat_data.get("name") or chat_data.get("contactName") or chat_id or "")[:140]
     contact_name = (chat_data.get("contactName") or chat_data.get("name") or "")[:140]
@@ -473,16 +720,8 @@ def _update_conversation_from_data(conversation: Any, chat_data: Dict, session:
             or chat_data.get("lastMessageAt")
         )
         if timestamp:
-            from datetime import datetime
-            try:
-                if isinstance(timestamp, (int, float)):
-                    if timestamp > 1_000_000_000_000:
-                        timestamp = timestamp / 1000
-                    last_message_time = datetime.fromtimestamp(timestamp)
-                elif isinstance(timestamp, str):
-                    last_message_time = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-            except Exception:
-                last_message_time = None
+            # Segundos, ms o ISO-8601, en la misma zona que los mensajes y la marca de agua
+            last_message_time = parse_remote_timestamp(timestamp)
         body = (
             last_message.get("body")
             or last_message.get("message")
@@ -541,11 +780,8 @@ def get_conversations(session_id: str = None, limit: int = 50, offset: int = 0)
     try:
         # Si no se proporciona session_id, buscar sesión activa
         if not session_id:
-            sessions = frappe.get_all("WhatsApp Session",
-                                    filters={"is_active": 1, "is_connected": 1},
-                                    fields=["name", "session_id"],
-                                    limit=1)
-            if not sessions:
+            session_id = get_default_session_name()
+            if not session_id:
                 frappe.log_error("No active session found")
                 return {
                     "success": False,
@@ -553,144 +789,28 @@ def get_conversations(session_id: str = None, limit: int = 50, offset: int = 0)
                     "conversations": [],
                     "total": 0
                 }
-            session_id = sessions[0].name
-            frappe.log_error(f"Using session: {session_id}")
 
-        # Sincronizar antes de devolver resultados para asegurar datos frescos
-        try:
-            sync_result = sync_conversations(session_name=session_id)
-            if isinstance(sync_result, dict) and not sync_result.get("success", True):
-                frappe.log_error(f"Auto sync from get_conversations returned error: {sync_result}")
-        except Exception as sync_error:
-            frappe.log_error(f"Auto sync from get_conversations failed: {sync_error}")
+        # Se sirve siempre desde la BD local; si la sesión está desactualizada
+        # se programa una única sincronización en segundo plano
+        freshness = ensure_conversations_fresh(session_id)
 
         # Obtener conversaciones desde DocType
         conversations = frappe.get_all("WhatsApp Conversation",
                                      filters={"session": session_id, "is_archived": 0},
-                                     fields=["name", "contact_name", "phone_number", "last_message",
-                                           "last_message_time", "last_message_from_me", "unread_count",
-                                           "is_muted", "is_pinned", "is_archived", "linked_lead",
-                                           "linked_customer", "total_messages", "session", "contact",
-                                           "chat_id", "is_group"],
+                                     fields=CONVERSATION_LIST_FIELDS,
                                      order_by="last_message_time desc",
                                      limit=limit,
                                      start=offset)
 
-        frappe.log_error(f"Found {len(conversations)} conversations for session {session_id}")
-        # Log conversation names in chunks to avoid character limit
-        conv_names = [c.name for c in conversations]
-        if conv_names:
-            # Log first few names only to stay within character limit
-            sample_names = conv_names[:5]  # Show first 5 names
-            frappe.log_error(f"Sample conversation names: {sample_names}")
-            if len(conv_names) > 5:
-                frappe.log_error(f"Total conversations: {len(conv_names)}")
-
-        # Enriquecer con información adicional
-        enriched_conversations = []
-        for conv in conversations:
-            frappe.log_error(f"Processing conversation: {conv.name}")
-            # Obtener información del contacto
-            contact_info = None
-            if conv.contact:
-                contact = frappe.get_all("WhatsApp Contact",
-                                       filters={"name": conv.contact},
-                                       fields=["name", "contact_name", "profile_pic_thumb", "is_verified", "is_group", "pushname"],
-                                       limit=1)
-                if contact:
-                    contact_info = contact[0]
-                    frappe.log_error(f"Found contact info for {conv.name}: {contact_info.contact_name}")
-
-            # Obtener último mensaje
-            last_message_info = None
-            last_message = frappe.get_all("WhatsApp Message",
-                                       filters={"conversation": conv.name},
-                                       fields=["content", "timestamp", "from_me", "message_type", "status"],
-                                       order_by="timestamp desc",
-                                       limit=1)
-            if last_message:
-                last_message_info = last_message[0]
-
-            # Construir objeto enriquecido
-            enriched_conv = {
-                "name": conv.name,
-                "phone_number": conv.phone_number,
-                "unread_count": conv.unread_count or 0,
-                "is_muted": conv.is_muted,
-                "is_pinned": conv.is_pinned,
-                "is_archived": conv.is_archived,
-                "total_messages": conv.total_messages or 0,
-                "is_group": conv.is_group or False,
-                "chat_id": conv.chat_id
-            }
-
-            # Información del contacto
-            if contact_info:
-                enriched_conv["contact_name"] = contact_info.contact_name or contact_info.pushname or conv.contact_name
-                enriched_conv["profile_pic"] = contact_info.profile_pic_thumb
-                enriched_conv["is_verified"] = contact_info.is_verified
-            else:
-                enriched_conv["contact_name"] = conv.contact_name
-                enriched_conv["profile_pic"] = None
-                enriched_conv["is_verified"] = False
-
-            # Información del último mensaje
-            if last_message_info:
-                # Usar timestamp directamente (ya está en zona horaria correcta)
-                timestamp = last_message_info.timestamp
-                if timestamp:
-                    try:
-                        # Convertir a string para serialización
-                        timestamp = timestamp.isoformat() if hasattr(timestamp, 'isoformat') else str(timestamp)
-                    except Exception:
-                        timestamp = last_message_info.timestamp
-
-                enriched_conv["last_message"] = last_message_info.content
-                enriched_conv["last_message_time"] = timestamp
-                enriched_conv["last_message_from_me"] = last_message_info.from_me
-                enriched_conv["last_message_type"] = last_message_info.message_type
-                enriched_conv["last_message_status"] = last_message_info.status
-            else:
-                # Usar timestamp directamente (ya está en zona horaria correcta)
-                timestamp = conv.last_message_time
-                if timestamp:
-                    try:
-                        # Convertir a string para serialización
-                        timestamp = timestamp.isoformat() if hasattr(timestamp, 'isoformat') else str(timestamp)
-                    except Exception:
-                        timestamp = conv.last_message_time
-
-                enriched_conv["last_message"] = conv.last_message
-                enriched_conv["last_message_time"] = timestamp
-                enriched_conv["last_message_from_me"] = conv.last_message_from_me
-                enriched_conv["last_message_type"] = "text"
-                enriched_conv["last_message_status"] = "sent"
-
-            # Información del lead si está vinculado
-            if conv.linked_lead:
-                lead_info = frappe.get_all("CRM Lead",
-                                         filters={"name": conv.linked_lead},
-                                         fields=["name", "lead_name", "status"],
-                                         limit=1)
-                if lead_info:
-                    enriched_conv["lead"] = lead_info[0]
-
-            enriched_conversations.append(enriched_conv)
-
-        frappe.log_error(f"Returning {len(enriched_conversations)} conversations")
-        # Log enriched conversation names in chunks to avoid character limit
-        enriched_names = [c['name'] for c in enriched_conversations]
-        if enriched_names:
-            # Log first few names only to stay within character limit
-            sample_enriched_names = enriched_names[:5]  # Show first 5 names
-            frappe.log_error(f"Sample enriched conversation names: {sample_enriched_names}")
-            if len(enriched_names) > 5:
-                frappe.log_error(f"Total enriched conversations: {len(enriched_names)}")
+        # Enriquecer con información adicional (número fijo de consultas por página)
+        enriched_conversations = enrich_conversations(conversations)
 
         return {
             "success": True,
             "conversations": enriched_conversations,
-            "total": len(enriched_conversations)
+            "total": len(enriched_conversations),
+            "last_synced_at": freshness["last_synced_at"],
+            "refreshing": freshness["refreshing"]
         }
 
     except Exception as e:
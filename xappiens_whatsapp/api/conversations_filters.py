@@ -5,12 +5,22 @@ API complementaria para filtros avanzados de conversaciones de WhatsApp.
 Extiende la funcionalidad existente sin modificar las APIs base.
 """
 
+import hashlib
+import json
+
 import frappe
 from frappe import _
-from frappe.utils import getdate, add_days, now_datetime, get_datetime
+from frappe.model import default_fields, no_value_fields
+from frappe.utils import getdate, add_days, now_datetime, get_datetime, cint
 from typing import Dict, Any, List, Optional
-from .conversations import get_conversations
+from .conversations import (
+    get_default_session_name,
+    ensure_conversations_fresh,
+    enrich_conversations,
+    CONVERSATION_LIST_FIELDS,
+)
 from .base import WhatsAppAPIClient
+from xappiens_whatsapp.utils.conversation_stats import get_cached_conversation_stats
 
 
 @frappe.whitelist()
@@ -228,12 +238,12 @@ def get_filtered_conversations(
     order_by: str = "last_message_time desc"
 ) -> Dict[str, Any]:
     """
-    Obtiene conversaciones filtradas usando la API base como fundamento.
-    Extiende get_conversations() sin modificar su funcionalidad.
+    Obtiene conversaciones filtradas con filtros, búsqueda, orden y paginación
+    resueltos en SQL. El enriquecimiento es el mismo que el de get_conversations().
 
     Args:
         session_id: ID de la sesión de WhatsApp
-        filters: Diccionario de filtros a aplicar
+        filters: Diccionario de filtros a aplicar ({campo: valor} o {campo: [operador, valor]})
         search: Término de búsqueda
         limit: Límite de resultados
         offset: Offset para paginación
@@ -242,39 +252,45 @@ def get_filtered_conversations(
     Returns:
         Dict con conversaciones filtradas y metadatos
     """
-    try:
-        # Usar la API base existente como fundamento
-        base_result = get_conversations(session_id=session_id, limit=limit * 2, offset=0)
+    frappe.has_permission("WhatsApp Conversation", "read", throw=True)
 
-        if not base_result.get("success", True):
-            return base_result
-
-        conversations = base_result.get("conversations", [])
+    try:
+        session_id = session_id or get_default_session_name()
+        if not session_id:
+            return {
+                "success": False,
+                "message": "No hay sesión activa",
+                "conversations": [],
+                "total_count": 0
+            }
 
-        # Aplicar filtros si se proporcionan
-        if filters:
-            conversations = apply_conversation_filters(conversations, filters)
+        freshness = ensure_conversations_fresh(session_id)
 
-        # Aplicar búsqueda si se proporciona
-        if search:
-            conversations = apply_search_filter(conversations, search)
+        filters = _parse_filters(filters)
+        where, params = build_conversation_conditions(session_id, filters, search)
+        params.update({"limit": cint(limit) or 50, "offset": cint(offset)})
 
-        # Aplicar ordenamiento
-        conversations = apply_sorting(conversations, order_by)
+        rows = frappe.db.sql(f"""
+            SELECT {", ".join(f"`{field}`" for field in CONVERSATION_LIST_FIELDS)}
+            FROM `tabWhatsApp Conversation`
+            WHERE {where}
+            ORDER BY {compile_order_by(order_by)}
+            LIMIT %(limit)s OFFSET %(offset)s
+        """, params, as_dict=True)
 
-        # Aplicar paginación
-        total_count = len(conversations)
-        conversations = conversations[offset:offset + limit]
+        conversations = enrich_conversations(rows)
 
-        # Enriquecer con estadísticas
-        stats = calculate_conversation_stats(conversations)
+        # Estadísticas y total del conjunto filtrado completo, no solo de la página
+        stats = calculate_conversation_stats(session_id, filters, search)
 
         return {
             "success": True,
             "conversations": conversations,
-            "total_count": total_count,
+            "total_count": stats["total"],
             "filtered_count": len(conversations),
-            "stats": stats
+            "stats": stats,
+            "last_synced_at": freshness["last_synced_at"],
+            "refreshing": freshness["refreshing"]
         }
 
     except Exception as e:
@@ -287,254 +303,221 @@ def get_filtered_conversations(
         }
 
 
-def apply_conversation_filters(conversations: List[Dict], filters: Dict[str, Any]) -> List[Dict]:
+def _parse_filters(filters) -> Dict[str, Any]:
+    """Acepta los filtros como dict o como JSON (llamadas desde el frontend)."""
+    if not filters:
+        return {}
+    if isinstance(filters, str):
+        filters = frappe.parse_json(filters)
+    return filters or {}
+
+
+def _get_filterable_columns() -> set:
+    """Columnas de tabWhatsApp Conversation admitidas en filtros y ordenamiento."""
+    meta = frappe.get_meta("WhatsApp Conversation")
+    columns = {df.fieldname for df in meta.fields if df.fieldtype not in no_value_fields}
+    return columns | set(default_fields)
+
+
+def build_conversation_conditions(session_id: str, filters: Dict[str, Any], search: str = None) -> tuple:
     """
-    Aplica filtros a la lista de conversaciones.
+    Construye el WHERE parametrizado de las conversaciones de una sesión.
+    Por defecto se excluyen las archivadas, salvo que se filtre por is_archived.
+    Incluye las condiciones de permisos del usuario actual.
 
     Args:
-        conversations: Lista de conversaciones
-        filters: Diccionario de filtros
+        session_id: Nombre del documento WhatsApp Session
+        filters: Filtros ya parseados
+        search: Término de búsqueda
 
     Returns:
-        Lista filtrada de conversaciones
+        Tupla (where, params)
     """
-    if not filters:
-        return conversations
+    params = {"session": session_id}
+    conditions = ["`session` = %(session)s"]
 
-    filtered = []
+    if "is_archived" not in (filters or {}):
+        conditions.append("`is_archived` = 0")
 
-    for conv in conversations:
-        include = True
+    conditions += compile_conversation_filters(filters, params)
 
-        for field_name, filter_value in filters.items():
-            if not include:
-                break
+    if search:
+        params["search"] = f"%{_escape_like(search)}%"
+        conditions.append(
+            "(`contact_name` LIKE %(search)s OR `phone_number` LIKE %(search)s"
+            " OR `last_message` LIKE %(search)s OR `chat_id` LIKE %(search)s)"
+        )
 
-            # Obtener valor del campo
-            field_value = get_conversation_field_value(conv, field_name)
+    permission_conditions = get_permission_conditions()
+    if permission_conditions:
+        conditions.append(f"({permission_conditions})")
 
-            # Aplicar filtro según el tipo
-            if isinstance(filter_value, list) and len(filter_value) == 2:
-                # Filtro con operador [operador, valor]
-                operator, value = filter_value
-                include = apply_filter_operator(field_value, operator, value)
-            else:
-                # Filtro de igualdad simple
-                include = (field_value == filter_value)
+    return " AND ".join(conditions), params
 
-        if include:
-            filtered.append(conv)
 
-    return filtered
+def get_permission_conditions() -> str:
+    """
+    Condiciones SQL de permisos del usuario actual sobre WhatsApp Conversation
+    (User Permissions y permission_query_conditions), igual que frappe.get_all.
+    Vacío si no hay restricciones.
+    """
+    return frappe.build_match_conditions("WhatsApp Conversation") or ""
 
 
-def apply_search_filter(conversations: List[Dict], search: str) -> List[Dict]:
+def compile_conversation_filters(filters: Dict[str, Any], params: Dict[str, Any]) -> List[str]:
     """
-    Aplica filtro de búsqueda de texto.
+    Compila los filtros a condiciones SQL parametrizadas.
+
+    Operadores: =, equals, !=, not equals, like, not like, >, <, >=, <=,
+    between, in, not in, is y is not. Un valor sin operador equivale a "=".
+    Los parámetros se añaden a `params`.
 
     Args:
-        conversations: Lista de conversaciones
-        search: Término de búsqueda
+        filters: Diccionario {campo: valor} o {campo: [operador, valor]}
+        params: Diccionario de parámetros de la consulta
 
     Returns:
-        Lista filtrada por búsqueda
+        Lista de condiciones
     """
-    if not search:
-        return conversations
-
-    search_lower = search.lower()
-    filtered = []
-
-    for conv in conversations:
-        # Campos donde buscar
-        searchable_fields = [
-            conv.get("contact_name", ""),
-            conv.get("phone_number", ""),
-            conv.get("last_message", ""),
-            conv.get("chat_id", "")
-        ]
+    if not filters:
+        return []
 
-        # Buscar en cualquier campo
-        found = any(
-            search_lower in str(field_value).lower()
-            for field_value in searchable_fields
-            if field_value
-        )
+    columns = _get_filterable_columns()
+    conditions = []
 
-        if found:
-            filtered.append(conv)
+    for index, (field_name, filter_value) in enumerate(filters.items()):
+        if field_name not in columns:
+            frappe.throw(_("Campo de filtro no válido: {0}").format(field_name))
 
-    return filtered
+        if isinstance(filter_value, (list, tuple)) and len(filter_value) == 2 and isinstance(filter_value[0], str):
+            operator, value = filter_value
+        else:
+            operator, value = "=", filter_value
 
+        conditions.append(_compile_operator(f"`{field_name}`", operator.lower().strip(), value, f"f{index}", params))
 
-def apply_sorting(conversations: List[Dict], order_by: str) -> List[Dict]:
-    """
-    Aplica ordenamiento a las conversaciones.
+    return conditions
 
-    Args:
-        conversations: Lista de conversaciones
-        order_by: Campo y dirección de ordenamiento
 
-    Returns:
-        Lista ordenada
-    """
-    if not order_by:
-        return conversations
+def _compile_operator(column: str, operator: str, value: Any, key: str, params: Dict[str, Any]) -> str:
+    """Traduce un operador de filtro a SQL (ver compile_conversation_filters)."""
+    if operator in ("=", "equals"):
+        params[key] = value
+        return f"{column} = %({key})s"
 
-    # Parsear order_by (ej: "last_message_time desc")
-    parts = order_by.split()
-    field_name = parts[0]
-    direction = parts[1].lower() if len(parts) > 1 else "asc"
-    reverse = (direction == "desc")
+    if operator in ("!=", "not equals"):
+        params[key] = value
+        return f"{column} != %({key})s"
 
-    try:
-        return sorted(
-            conversations,
-            key=lambda x: get_conversation_field_value(x, field_name) or "",
-            reverse=reverse
-        )
-    except Exception:
-        # Si falla el ordenamiento, devolver sin ordenar
-        return conversations
+    if operator in ("like", "not like"):
+        params[key] = f"%{_escape_like(str(value).replace('%', ''))}%"
+        return f"{column} {'NOT LIKE' if operator == 'not like' else 'LIKE'} %({key})s"
 
+    if operator in (">", "<", ">=", "<="):
+        params[key] = value
+        return f"{column} {operator} %({key})s"
 
-def get_conversation_field_value(conversation: Dict, field_name: str) -> Any:
-    """
-    Obtiene el valor de un campo de la conversación.
-    Maneja tanto campos directos como metadata.
+    if operator == "between":
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            frappe.throw(_("El operador between requiere dos valores"))
+        params[f"{key}_from"], params[f"{key}_to"] = value
+        return f"{column} BETWEEN %({key}_from)s AND %({key}_to)s"
 
-    Args:
-        conversation: Diccionario de conversación
-        field_name: Nombre del campo
+    if operator in ("in", "not in"):
+        values = value if isinstance(value, (list, tuple)) else [v.strip() for v in str(value or "").split(",") if v.strip()]
+        if not values:
+            # in []: nada coincide; not in []: cualquier valor no nulo
+            return "1 = 0" if operator == "in" else f"{column} IS NOT NULL"
+        params[key] = tuple(values)
+        return f"{column} {'NOT IN' if operator == 'not in' else 'IN'} %({key})s"
 
-    Returns:
-        Valor del campo
+    if operator in ("is", "is not"):
+        # Convención del CRM: ["is", "set"] / ["is", "not set"]; cualquier otro valor equivale a "not set"
+        is_set = str(value).lower() == "set"
+        if operator == "is not":
+            is_set = not is_set
+        return f"IFNULL({column}, '') {'!=' if is_set else '='} ''"
+
+    frappe.throw(_("Operador de filtro no soportado: {0}").format(operator))
+
+
+def compile_order_by(order_by: str) -> str:
     """
-    # Mapeo de campos
-    field_map = {
-        "contact_name": conversation.get("contact_name"),
-        "phone_number": conversation.get("phone_number"),
-        "chat_id": conversation.get("name") or conversation.get("chat_id"),
-        "last_message": conversation.get("last_message"),
-        "last_message_time": conversation.get("last_message_time"),
-        "unread_count": conversation.get("unread_count", 0),
-        "is_group": conversation.get("is_group", False),
-        "assigned_to": (
-            conversation.get("assigned_to") or
-            conversation.get("metadata", {}).get("assigned_to")
-        ),
-        "linked_lead": (
-            conversation.get("crm_lead") or
-            conversation.get("metadata", {}).get("linked_lead")
-        ),
-        "linked_customer": (
-            conversation.get("crm_customer") or
-            conversation.get("metadata", {}).get("linked_customer")
-        ),
-        "linked_deal": (
-            conversation.get("crm_deal") or
-            conversation.get("metadata", {}).get("linked_deal")
-        ),
-        "creation": conversation.get("creation"),
-        "modified": conversation.get("modified"),
-        "owner": conversation.get("owner")
-    }
-
-    return field_map.get(field_name, conversation.get(field_name))
-
-
-def apply_filter_operator(field_value: Any, operator: str, filter_value: Any) -> bool:
+    Valida y compila el ordenamiento ("campo [asc|desc]"). El nombre se añade
+    como desempate para que la paginación sea estable.
     """
-    Aplica un operador de filtro específico.
+    parts = (order_by or "").split()
+    field_name = parts[0] if parts else "last_message_time"
+    direction = parts[1].lower() if len(parts) > 1 else "asc"
 
-    Args:
-        field_value: Valor del campo
-        operator: Operador (=, !=, like, >, <, etc.)
-        filter_value: Valor del filtro
+    if field_name not in _get_filterable_columns():
+        field_name, direction = "last_message_time", "desc"
+    if direction not in ("asc", "desc"):
+        direction = "asc"
 
-    Returns:
-        True si pasa el filtro, False si no
-    """
-    if field_value is None:
-        return operator.lower() in ["is", "is not"] and filter_value in [None, ""]
+    return f"`{field_name}` {direction}, `name` {direction}"
 
-    operator = operator.lower()
 
-    try:
-        if operator in ["=", "equals"]:
-            return field_value == filter_value
-        elif operator in ["!=", "not equals"]:
-            return field_value != filter_value
-        elif operator == "like":
-            return str(filter_value).replace("%", "") in str(field_value)
-        elif operator == "not like":
-            return str(filter_value).replace("%", "") not in str(field_value)
-        elif operator == ">":
-            return field_value > filter_value
-        elif operator == "<":
-            return field_value < filter_value
-        elif operator == ">=":
-            return field_value >= filter_value
-        elif operator == "<=":
-            return field_value <= filter_value
-        elif operator == "between":
-            if isinstance(filter_value, list) and len(filter_value) == 2:
-                return filter_value[0] <= field_value <= filter_value[1]
-        elif operator == "in":
-            return field_value in filter_value if isinstance(filter_value, list) else False
-        elif operator == "not in":
-            return field_value not in filter_value if isinstance(filter_value, list) else True
-        elif operator == "is":
-            return field_value is None or field_value == ""
-        elif operator == "is not":
-            return field_value is not None and field_value != ""
-
-    except Exception:
-        return False
-
-    return False
-
-
-def calculate_conversation_stats(conversations: List[Dict]) -> Dict[str, Any]:
+def _escape_like(value: str) -> str:
+    """Escapa los comodines de LIKE en un valor introducido por el usuario."""
+    return str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+EMPTY_STATS = {
+    "total": 0,
+    "unread": 0,
+    "groups": 0,
+    "individual": 0,
+    "assigned": 0,
+    "with_crm_link": 0
+}
+
+
+def calculate_conversation_stats(session_id: str, filters: Dict[str, Any] = None, search: str = None) -> Dict[str, Any]:
     """
-    Calcula estadísticas de las conversaciones filtradas.
+    Calcula las estadísticas de las conversaciones filtradas con un único
+    SELECT de agregados condicionales. El resultado se cachea por sesión,
+    filtro y condiciones de permisos del usuario, de modo que usuarios con
+    distintos permisos no comparten contadores (ver utils/conversation_stats.py).
 
     Args:
-        conversations: Lista de conversaciones
+        session_id: Nombre del documento WhatsApp Session
+        filters: Filtros ya parseados
+        search: Término de búsqueda
 
     Returns:
         Diccionario con estadísticas
     """
-    if not conversations:
-        return {
-            "total": 0,
-            "unread": 0,
-            "groups": 0,
-            "individual": 0,
-            "assigned": 0,
-            "with_crm_link": 0
-        }
-
-    stats = {
-        "total": len(conversations),
-        "unread": sum(1 for c in conversations if (c.get("unread_count", 0) > 0)),
-        "groups": sum(1 for c in conversations if c.get("is_group", False)),
-        "individual": sum(1 for c in conversations if not c.get("is_group", False)),
-        "assigned": sum(1 for c in conversations if (
-            c.get("assigned_to") or
-            c.get("metadata", {}).get("assigned_to")
-        )),
-        "with_crm_link": sum(1 for c in conversations if (
-            c.get("crm_lead") or
-            c.get("crm_customer") or
-            c.get("crm_deal") or
-            c.get("metadata", {}).get("linked_lead") or
-            c.get("metadata", {}).get("linked_customer") or
-            c.get("metadata", {}).get("linked_deal")
-        ))
-    }
-
-    return stats
+    filters_key = hashlib.sha1(
+        json.dumps(
+            {"filters": filters or {}, "search": search or "", "permissions": get_permission_conditions()},
+            sort_keys=True,
+            default=str,
+        ).encode()
+    ).hexdigest()
+
+    def generator():
+        where, params = build_conversation_conditions(session_id, filters, search)
+        row = frappe.db.sql(f"""
+            SELECT
+                COUNT(*) AS total,
+                SUM(`unread_count` > 0) AS unread,
+                SUM(`is_group` = 1) AS `groups`,
+                SUM(IFNULL(`assigned_to`, '') != '') AS assigned,
+                SUM(
+                    IFNULL(`linked_lead`, '') != ''
+                    OR IFNULL(`linked_customer`, '') != ''
+                    OR IFNULL(`linked_deal`, '') != ''
+                ) AS with_crm_link
+            FROM `tabWhatsApp Conversation`
+            WHERE {where}
+        """, params, as_dict=True)[0]
+
+        stats = {key: cint(row.get(key)) for key in EMPTY_STATS if key != "individual"}
+        stats["individual"] = stats["total"] - stats["groups"]
+        return stats
+
+    return get_cached_conversation_stats(session_id, filters_key, generator)
 
 
 @frappe.whitelist()
@@ -550,21 +533,24 @@ def get_conversation_stats(session_id: str = None, filters: Dict[str, Any] = Non
     Returns:
         Diccionario con estadísticas
     """
-    try:
-        result = get_filtered_conversations(
-            session_id=session_id,
-            filters=filters,
-            limit=1000  # Límite alto para estadísticas precisas
-        )
+    frappe.has_permission("WhatsApp Conversation", "read", throw=True)
 
-        if result.get("success"):
+    try:
+        session_id = session_id or get_default_session_name()
+        if not session_id:
             return {
-                "success": True,
-                "stats": result.get("stats", {}),
-                "total_count": result.get("total_count", 0)
+                "success": False,
+                "message": "No hay sesión activa",
+                "stats": dict(EMPTY_STATS)
             }
-        else:
-            return result
+
+        stats = calculate_conversation_stats(session_id, _parse_filters(filters))
+
+        return {
+            "success": True,
+            "stats": stats,
+            "total_count": stats["total"]
+        }
 
     except Exception as e:
         frappe.log_error(f"Error getting conversation stats: {str(e)}", "WhatsApp Filters Error")
@@ -7,10 +7,13 @@ Maneja descarga, subida y procesamiento de medios.
 
 import frappe
 import os
-import requests
 from frappe.utils import now, get_files_path
-from frappe.utils.file_manager import save_file
 from .base import WhatsAppAPIClient
+from xappiens_whatsapp.utils import transport
+from xappiens_whatsapp.utils.media_previews import queue_media_preview
+from xappiens_whatsapp.utils.media_storage import (
+    MediaTooLargeError, find_stored_media, get_media_path, normalize_sha256, store_media
+)
 from typing import Dict, Any, Optional
 import mimetypes
 
@@ -20,6 +23,10 @@ def download_media_from_message(session: str, message: str) -> Dict[str, Any]:
     """
     Descarga archivo multimedia desde WhatsApp API usando el ID del mensaje.
 
+    El contenido se guarda en el almacén por SHA-256: si el hash del webhook
+    (`media_hash`) ya está almacenado no se descarga, y si tras descargar el
+    contenido ya existía se enlaza el archivo existente.
+
     Args:
         session: Nombre del documento WhatsApp Session
         message: Nombre del documento WhatsApp Message
@@ -30,87 +37,130 @@ def download_media_from_message(session: str, message: str) -> Dict[str, Any]:
     try:
         # Obtener documentos
         message_doc = frappe.get_doc("WhatsApp Message", message)
-        session_doc = frappe.get_doc("WhatsApp Session", session)
 
         if not message_doc.has_media:
-            return {"success": False, "message": "El mensaje no tiene archivos multimedia"}
+            return {"success": False, "retryable": False, "message": "El mensaje no tiene archivos multimedia"}
+
+        item = message_doc.media_items[0] if message_doc.media_items else None
+        known_hash = normalize_sha256(item.media_hash) if item else None
+        file_url = find_stored_media(known_hash)
+
+        if file_url:
+            # Contenido ya almacenado (reenviado o repetido): solo se enlaza
+            filename = item.filename or os.path.basename(file_url)
+            mimetype = item.mimetype or _guess_mimetype_from_filename(file_url) or "application/octet-stream"
+            stored = {
+                "file_url": file_url,
+                "size": os.path.getsize(get_media_path(file_url)),
+                "sha256": known_hash,
+                "reused": True
+            }
+            media_url = item.url
+        else:
+            remote = _get_remote_media(session, message_doc)
+            if not remote["success"]:
+                return remote
 
-        if not session_doc.is_connected:
-            return {"success": False, "message": "La sesión no está conectada"}
+            media_url, filename, mimetype = remote["media_url"], remote["filename"], remote["mimetype"]
 
-        # Usar API client para descargar
-        client = WhatsAppAPIClient(session_doc.session_id)
+            # Descargar por bloques directamente al almacén
+            stored = store_media(transport.get(media_url, timeout=30, stream=True), filename)
 
-        # Endpoint para descarga de medios
-        response = client.get(f"/api/messages/{session_doc.session_id}/{message_doc.message_id}/media")
+        _attach_stored_media(message_doc, stored, filename, mimetype, media_url)
 
-        if not response.get("success"):
-            return {
-                "success": False,
-                "message": f"Error descargando desde API: {response.get('message', 'Error desconocido')}"
-            }
+        return {
+            "success": True,
+            "message": "Archivo descargado exitosamente",
+            "file_path": stored["file_url"],
+            "filename": filename,
+            "filesize": stored["size"],
+            "mimetype": mimetype,
+            "sha256": stored["sha256"],
+            "reused": stored["reused"]
+        }
 
-        media_data = response.get("data", {})
-        media_url = media_data.get("url") or media_data.get("media_url")
+    except MediaTooLargeError as e:
+        return {"success": False, "retryable": False, "message": str(e)}
 
-        if not media_url:
-            return {"success": False, "message": "URL de descarga no disponible"}
+    except Exception as e:
+        frappe.log_error(f"Error downloading media: {str(e)}", "WhatsApp Media Download")
+        return {"success": False, "message": str(e)}
 
-        # Descargar archivo
-        media_response = requests.get(media_url, timeout=30)
-        media_response.raise_for_status()
 
-        # Determinar nombre y tipo de archivo
-        filename = media_data.get("filename") or f"media_{message_doc.message_id}"
-        mimetype = media_data.get("mimetype") or "application/octet-stream"
+def _get_remote_media(session: str, message_doc) -> Dict[str, Any]:
+    """
+    Pide al servidor de WhatsApp la URL de descarga de la media de un mensaje.
 
-        # Agregar extensión si no la tiene
-        if not os.path.splitext(filename)[1]:
-            extension = mimetypes.guess_extension(mimetype) or ".bin"
-            filename += extension
+    Args:
+        session: Nombre del documento WhatsApp Session
+        message_doc: Documento WhatsApp Message
 
-        # Guardar archivo en Frappe
-        file_doc = save_file(
-            filename,
-            media_response.content,
-            "WhatsApp Message",
-            message,
-            is_private=0
-        )
+    Returns:
+        Dict con success, media_url, filename (con extensión) y mimetype, o el error
+    """
+    session_doc = frappe.get_doc("WhatsApp Session", session)
+    if not session_doc.is_connected:
+        return {"success": False, "message": "La sesión no está conectada"}
 
-        # Actualizar mensaje con información del archivo
-        if message_doc.media_items:
-            # Actualizar item existente
-            for item in message_doc.media_items:
-                item.file = file_doc.file_url
-                item.filename = filename
-                item.filesize = len(media_response.content)
-                item.mimetype = mimetype
-                break
-        else:
-            # Crear nuevo item
-            message_doc.append("media_items", {
-                "media_type": _get_media_type_from_mimetype(mimetype),
-                "file": file_doc.file_url,
-                "filename": filename,
-                "filesize": len(media_response.content),
-                "mimetype": mimetype,
-                "url": media_url
-            })
-
-        message_doc.save(ignore_permissions=True)
+    # Usar API client para descargar
+    client = WhatsAppAPIClient(session_doc.session_id)
+
+    # Endpoint para descarga de medios
+    response = client.get(f"/api/messages/{session_doc.session_id}/{message_doc.message_id}/media")
 
+    if not response.get("success"):
         return {
-            "success": True,
-            "message": "Archivo descargado exitosamente",
-            "file_path": file_doc.file_url,
-            "filename": filename,
-            "filesize": len(media_response.content)
+            "success": False,
+            "message": f"Error descargando desde API: {response.get('message', 'Error desconocido')}"
         }
 
-    except Exception as e:
-        frappe.log_error(f"Error downloading media: {str(e)}", "WhatsApp Media Download")
-        return {"success": False, "message": str(e)}
+    media_data = response.get("data", {})
+    media_url = media_data.get("url") or media_data.get("media_url")
+
+    if not media_url:
+        return {"success": False, "message": "URL de descarga no disponible"}
+
+    # Determinar nombre y tipo de archivo
+    filename = media_data.get("filename") or f"media_{message_doc.message_id}"
+    mimetype = media_data.get("mimetype") or "application/octet-stream"
+
+    # Agregar extensión si no la tiene
+    if not os.path.splitext(filename)[1]:
+        extension = mimetypes.guess_extension(mimetype) or ".bin"
+        filename += extension
+
+    return {"success": True, "media_url": media_url, "filename": filename, "mimetype": mimetype}
+
+
+def _attach_stored_media(message_doc, stored: Dict[str, Any], filename: str, mimetype: str, media_url: str = None):
+    """
+    Enlaza un archivo del almacén con el primer item de media del mensaje (o
+    lo crea), guarda el mensaje y programa la generación de su vista previa.
+    """
+    if message_doc.media_items:
+        # Actualizar item existente
+        item = message_doc.media_items[0]
+        item.file = stored["file_url"]
+        item.filename = filename
+        item.filesize = stored["size"]
+        item.mimetype = mimetype
+        item.media_hash = stored["sha256"]
+    else:
+        # Crear nuevo item
+        message_doc.append("media_items", {
+            "media_type": _get_media_type_from_mimetype(mimetype),
+            "file": stored["file_url"],
+            "filename": filename,
+            "filesize": stored["size"],
+            "mimetype": mimetype,
+            "url": media_url,
+            "media_hash": stored["sha256"]
+        })
+
+    message_doc.save(ignore_permissions=True)
+
+    # Miniatura, póster y dimensiones en un job aparte
+    queue_media_preview(message_doc.name, message_doc.media_items[0].media_type)
 
 
 @frappe.whitelist()
@@ -305,7 +355,8 @@ def get_media_info(message: str) -> Dict[str, Any]:
                 "mimetype": item.mimetype,
                 "file_url": item.file,
                 "thumbnail": item.thumbnail,
-                "is_downloaded": bool(item.file)
+                "is_downloaded": bool(item.file),
+                "stream_url": f"/api/method/xappiens_whatsapp.api.media_proxy.stream_media?message={message}"
             }
             media_list.append(media_info)
 
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Acceso bajo demanda a la media de los mensajes.
+
+`stream_media` sirve el adjunto de un mensaje al navegador:
+
+- Si ya está en disco, los archivos públicos se redirigen a su URL (el
+  servidor web atiende los Range) y los privados se sirven con soporte de
+  Range desde aquí.
+- Si no, se transmite desde el servidor de WhatsApp mientras se escribe en el
+  almacén por contenido; al terminar la transmisión el archivo se registra y se
+  enlaza con el mensaje, y las siguientes vistas ya son locales.
+- Las peticiones Range que no empiezan en 0 (saltos en vídeo o audio) se
+  reenvían al servidor tal cual y se encola la descarga completa en segundo
+  plano, porque un trozo suelto no sirve para la caché.
+
+Así la media de los tipos configurados en `lazy_media_types` solo se descarga
+cuando alguien la abre.
+"""
+
+import os
+import frappe
+from frappe import _
+from typing import Dict, Any, Optional
+from urllib.parse import quote
+from werkzeug.utils import redirect
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+from .media import _attach_stored_media, _get_remote_media, _guess_mimetype_from_filename
+from .media_queue import mark_media_downloaded, queue_media_download
+from xappiens_whatsapp.utils import transport
+from xappiens_whatsapp.utils.media_storage import (
+    CHUNK_SIZE, MediaTooLargeError, MediaWriter, find_stored_media, get_media_path,
+    normalize_sha256, register_file
+)
+
+
+# Cabeceras de la respuesta del servidor que se reenvían al navegador
+PASSTHROUGH_HEADERS = ["Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified"]
+STREAM_TIMEOUT = 30
+
+
+@frappe.whitelist()
+def stream_media(message: str):
+    """
+    Sirve el adjunto de un mensaje, descargándolo del servidor de WhatsApp la
+    primera vez que se abre.
+
+    Args:
+        message: Nombre del documento WhatsApp Message
+
+    Returns:
+        Respuesta HTTP con el contenido (200/206) o redirección al archivo local
+    """
+    frappe.has_permission("WhatsApp Message", "read", message, throw=True)
+    message_doc = frappe.get_doc("WhatsApp Message", message)
+    if not message_doc.has_media:
+        frappe.throw(_("El mensaje no tiene archivos multimedia"), frappe.DoesNotExistError)
+
+    item = message_doc.media_items[0] if message_doc.media_items else None
+    filename = (item and item.filename) or f"media_{message_doc.message_id}"
+
+    file_url = _get_local_file(message_doc, item)
+    if file_url:
+        mimetype = (item and item.mimetype) or _guess_mimetype_from_filename(file_url) or "application/octet-stream"
+        return _serve_local(file_url, mimetype, filename)
+
+    remote = _get_remote_media(message_doc.session, message_doc)
+    if not remote["success"]:
+        frappe.throw(remote["message"])
+
+    range_header = (frappe.request.headers.get("Range") or "").strip()
+    if range_header and range_header.replace(" ", "") != "bytes=0-":
+        return _proxy_range(message_doc, item, remote, range_header)
+
+    upstream = transport.get(remote["media_url"], timeout=STREAM_TIMEOUT, stream=True)
+    if upstream.status_code != 200:
+        upstream.close()
+        frappe.throw(_("Error descargando desde API: HTTP {0}").format(upstream.status_code))
+
+    try:
+        writer = MediaWriter(remote["filename"], content_addressed=True)
+    except OSError as e:
+        frappe.log_error(f"No se puede cachear la media de {message}: {str(e)}", "WhatsApp Media Proxy")
+        writer = None
+
+    on_complete = _LinkCachedMedia(message_doc.name, remote)
+    response = Response(
+        _stream_and_cache(upstream, writer, on_complete),
+        status=200,
+        mimetype=remote["mimetype"],
+        direct_passthrough=True,
+    )
+    if upstream.headers.get("Content-Length"):
+        response.headers["Content-Length"] = upstream.headers["Content-Length"]
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Content-Disposition"] = _content_disposition(remote["filename"])
+    return response
+
+
+def _get_local_file(message_doc, item) -> Optional[str]:
+    """URL del archivo local del mensaje (propio o del almacén por contenido), si existe."""
+    if not item:
+        return None
+
+    if item.file and os.path.exists(get_media_path(item.file)):
+        return item.file
+
+    media_hash = normalize_sha256(item.media_hash)
+    file_url = find_stored_media(media_hash)
+    if file_url:
+        # Contenido ya almacenado por otro mensaje: se enlaza sin descargar
+        stored = {"file_url": file_url, "size": os.path.getsize(get_media_path(file_url)), "sha256": media_hash}
+        _attach_stored_media(message_doc, stored, item.filename or os.path.basename(file_url), item.mimetype)
+        frappe.db.commit()
+
+    return file_url
+
+
+def _serve_local(file_url: str, mimetype: str, filename: str) -> Response:
+    """Redirige a un archivo público o sirve uno privado con soporte de Range."""
+    if not file_url.startswith("/private/"):
+        return redirect(file_url)
+
+    path = get_media_path(file_url)
+    response = Response(
+        wrap_file(frappe.request.environ, open(path, "rb")),
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+    response.headers["Content-Disposition"] = _content_disposition(filename)
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response.make_conditional(frappe.request.environ, accept_ranges=True, complete_length=os.path.getsize(path))
+
+
+def _proxy_range(message_doc, item, remote: Dict[str, Any], range_header: str) -> Response:
+    """
+    Reenvía una petición Range al servidor sin cachearla y encola la descarga
+    completa para que las siguientes vistas sean locales.
+    """
+    media_item = {"media_type": item.media_type if item else None, "filename": remote["filename"], "mimetype": remote["mimetype"]}
+    queue_media_download(message_doc.session, message_doc.name, media_item, message_doc.conversation, force=True)
+    frappe.db.commit()
+
+    upstream = transport.get(remote["media_url"], timeout=STREAM_TIMEOUT, stream=True, headers={"Range": range_header})
+    response = Response(_iter_upstream(upstream), status=upstream.status_code, direct_passthrough=True)
+    for header in PASSTHROUGH_HEADERS:
+        if upstream.headers.get(header):
+            response.headers[header] = upstream.headers[header]
+    response.headers.setdefault("Content-Type", remote["mimetype"])
+    return response
+
+
+def _iter_upstream(upstream):
+    try:
+        yield from upstream.iter_content(chunk_size=CHUNK_SIZE)
+    finally:
+        upstream.close()
+
+
+def _stream_and_cache(upstream, writer, on_complete):
+    """
+    Generador de la respuesta: reenvía cada bloque al navegador y lo escribe en
+    el almacén. Si el cliente corta o se supera `max_media_size`, se descarta
+    la caché pero no la respuesta.
+    """
+    try:
+        for chunk in upstream.iter_content(chunk_size=CHUNK_SIZE):
+            if writer:
+                try:
+                    writer.write(chunk)
+                except (MediaTooLargeError, OSError):
+                    writer.abort()
+                    writer = None
+            yield chunk
+
+        if writer:
+            stored = writer.commit()
+            writer = None
+            on_complete(stored)
+
+    finally:
+        if writer:
+            writer.abort()
+        upstream.close()
+
+
+class _LinkCachedMedia:
+    """
+    Registra en la BD un archivo cacheado durante el streaming.
+
+    Se ejecuta cuando el servidor WSGI ya ha consumido la respuesta, después de
+    que Frappe haya cerrado el contexto de la petición, así que abre uno propio
+    para el sitio.
+    """
+
+    def __init__(self, message: str, remote: Dict[str, Any]):
+        self.message = message
+        self.remote = remote
+        self.site = frappe.local.site
+        self.sites_path = frappe.local.sites_path
+
+    def __call__(self, stored: Dict[str, Any]):
+        if getattr(frappe.local, "site", None) == self.site and getattr(frappe.local, "db", None):
+            self._link(stored)
+            return
+
+        frappe.init(site=self.site, sites_path=self.sites_path)
+        try:
+            frappe.connect()
+            frappe.set_user("Administrator")
+            self._link(stored)
+        finally:
+            frappe.destroy()
+
+    def _link(self, stored: Dict[str, Any]):
+        try:
+            if not frappe.db.exists("File", {"file_url": stored["file_url"]}):
+                register_file(stored)
+
+            message_doc = frappe.get_doc("WhatsApp Message", self.message)
+            _attach_stored_media(message_doc, stored, self.remote["filename"], self.remote["mimetype"], self.remote["media_url"])
+
+            result = {
+                "file_path": stored["file_url"],
+                "filename": self.remote["filename"],
+                "filesize": stored["size"],
+                "mimetype": self.remote["mimetype"],
+                "sha256": stored["sha256"],
+            }
+            for name in frappe.get_all(
+                "WhatsApp Media File",
+                filters={"message": self.message, "status": ["!=", "Downloaded"]},
+                pluck="name"
+            ):
+                mark_media_downloaded(name, result)
+
+            frappe.db.commit()
+
+        except Exception as e:
+            frappe.db.rollback()
+            frappe.log_error(f"Error registrando media cacheada de {self.message}: {str(e)}", "WhatsApp Media Proxy")
+
+
+def _content_disposition(filename: str) -> str:
+    return f"inline; filename*=UTF-8''{quote(filename)}"
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cola de descargas de media entrantes.
+
+Cada descarga se registra en un `WhatsApp Media File` (uno por mensaje, así que
+volver a encolar el mismo mensaje no duplica el trabajo) y la procesan unos
+pocos jobs de una cola dedicada:
+
+- Como mucho `media_max_concurrency` jobs trabajan a la vez en el sitio (un
+  job_id fijo por hueco) y cada sesión descarga como mucho
+  `media_session_concurrency` archivos a la vez (huecos con lock en Redis).
+- Los fallos se reintentan con espera exponencial (`next_attempt_at`) hasta
+  MAX_RETRIES; después quedan en "Failed" con el último error.
+- La tarea programada `schedule_media_downloads` relanza los workers cuando
+  vence una espera y devuelve a "Pending" las descargas de workers caídos.
+  Los locks de una descarga duran lo que el job (WORKER_TIMEOUT), así que
+  nunca caducan mientras el worker sigue vivo, y una descarga solo se da por
+  huérfana cuando ha pasado ese tiempo y su lock ya no existe.
+- `get_media_queue_status` muestra el backlog por estado y por sesión.
+
+Los tipos de `lazy_media_types` no se descargan al recibirlos: se sirven bajo
+demanda con `media_proxy.stream_media`.
+"""
+
+import time
+import frappe
+from typing import Dict, Any, List, Optional
+from frappe.utils import add_to_date, cint, now_datetime
+from xappiens_whatsapp.utils.locks import acquire_lock, is_locked, release_lock
+
+
+DEFAULT_WORKER_QUEUE = "long"
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_SESSION_CONCURRENCY = 2
+MAX_RETRIES = 5
+RETRY_BASE_SECONDS = 30
+MAX_RETRY_DELAY = 60 * 60
+# Margen al final del job para no empezar una descarga que no le da tiempo a terminar
+DOWNLOAD_TIMEOUT = 300
+WORKER_TIMEOUT = 1500
+# Los locks de hueco y de archivo duran lo que el job: RQ lo mata al llegar al
+# timeout, así que no caducan mientras la descarga sigue en curso
+LOCK_TIMEOUT = WORKER_TIMEOUT
+# Descargas en "Downloading" más antiguas que esto (y sin lock) son de un worker caído
+STALE_DOWNLOAD_SECONDS = WORKER_TIMEOUT + 60
+CLAIM_BATCH = 50
+
+
+def _get_queue_config() -> Dict[str, Any]:
+    settings = frappe.get_single("WhatsApp Settings")
+    return {
+        "enabled": bool(settings.enable_media_download),
+        "queue": settings.get("media_worker_queue") or DEFAULT_WORKER_QUEUE,
+        "max_concurrency": cint(settings.get("media_max_concurrency")) or DEFAULT_MAX_CONCURRENCY,
+        "session_concurrency": cint(settings.get("media_session_concurrency")) or DEFAULT_SESSION_CONCURRENCY,
+        "lazy_types": _parse_media_types(settings.get("lazy_media_types")),
+    }
+
+
+def _parse_media_types(value: Optional[str]) -> set:
+    return {t.strip().lower() for t in (value or "").replace("\n", ",").split(",") if t.strip()}
+
+
+def queue_media_download(
+    session: str,
+    message: str,
+    media_item: Optional[Dict[str, Any]] = None,
+    conversation: Optional[str] = None,
+    force: bool = False
+) -> Optional[str]:
+    """
+    Registra la descarga de la media de un mensaje y programa los workers.
+    Si el mensaje ya tiene su WhatsApp Media File no se crea otro. Los tipos
+    de `lazy_media_types` no se encolan salvo con `force` (ver media_proxy).
+
+    Args:
+        session: Nombre del documento WhatsApp Session
+        message: Nombre del documento WhatsApp Message
+        media_item: Datos de la media (media_type, filename, mimetype, url...)
+        conversation: Nombre del documento WhatsApp Conversation
+        force: Encolar aunque el tipo sea de descarga al abrir
+
+    Returns:
+        Nombre del WhatsApp Media File, o None si no se descarga en segundo plano
+    """
+    config = _get_queue_config()
+    media_item = media_item or {}
+    if not config["enabled"]:
+        return None
+    if not force and (media_item.get("media_type") or "document") in config["lazy_types"]:
+        return None
+
+    existing = frappe.db.get_value("WhatsApp Media File", {"message": message}, "name")
+    if existing:
+        return existing
+
+    media_file = frappe.get_doc({
+        "doctype": "WhatsApp Media File",
+        "message": message,
+        "session": session,
+        "conversation": conversation,
+        "media_type": media_item.get("media_type") or "document",
+        "status": "Pending",
+        "filename": media_item.get("filename"),
+        "original_filename": media_item.get("filename"),
+        "filesize": media_item.get("filesize"),
+        "mimetype": media_item.get("mimetype"),
+        "download_url": media_item.get("url"),
+        "remote_media_id": media_item.get("remote_media_id"),
+        "retry_count": 0,
+    })
+    media_file.insert(ignore_permissions=True)
+
+    _schedule_workers(config)
+    return media_file.name
+
+
+def _schedule_workers(config: Optional[Dict[str, Any]] = None, pending: Optional[int] = None):
+    """
+    Encola un worker por hueco libre, sin pasar de `media_max_concurrency` ni
+    del número de descargas pendientes. Los jobs se encolan tras el commit para
+    que vean los WhatsApp Media File recién creados.
+    """
+    config = config or _get_queue_config()
+    if pending is None:
+        pending = _count_ready()
+
+    for slot in range(min(config["max_concurrency"], pending)):
+        frappe.enqueue(
+            "xappiens_whatsapp.api.media_queue.process_media_queue",
+            queue=config["queue"],
+            timeout=WORKER_TIMEOUT,
+            job_id=f"whatsapp_media_worker::{frappe.local.site}::{slot}",
+            deduplicate=True,
+            enqueue_after_commit=True,
+        )
+
+
+def _count_ready() -> int:
+    return cint(frappe.db.sql("""
+        SELECT COUNT(*)
+        FROM `tabWhatsApp Media File`
+        WHERE status = 'Pending' AND (next_attempt_at IS NULL OR next_attempt_at <= %s)
+    """, (now_datetime(),))[0][0])
+
+
+def _session_slot_key(session: str, slot: int) -> str:
+    return f"media_download:{session}:{slot}"
+
+
+def _media_file_lock_key(name: str) -> str:
+    return f"media_file:{name}"
+
+
+def _acquire_session_slot(session: str, session_concurrency: int) -> Optional[tuple]:
+    """
+    Toma un hueco de descarga de la sesión.
+
+    Returns:
+        Tupla (clave del lock del hueco, token) o None si están todos ocupados
+    """
+    for slot in range(session_concurrency):
+        key = _session_slot_key(session, slot)
+        token = acquire_lock(key, timeout=LOCK_TIMEOUT)
+        if token:
+            return key, token
+    return None
+
+
+def _release_locks(locks: List[tuple]):
+    """Libera los locks (clave, token) tomados para una descarga."""
+    for key, token in locks:
+        release_lock(key, token)
+
+
+def _claim_next(session_concurrency: int) -> Optional[tuple]:
+    """
+    Reserva la siguiente descarga lista cuya sesión tenga un hueco libre y la
+    marca como "Downloading".
+
+    Returns:
+        Tupla (fila del WhatsApp Media File, locks (clave, token) del archivo
+        y del hueco de la sesión) o None
+    """
+    rows = frappe.db.sql("""
+        SELECT name, session, message, retry_count
+        FROM `tabWhatsApp Media File`
+        WHERE status = 'Pending' AND (next_attempt_at IS NULL OR next_attempt_at <= %s)
+        ORDER BY creation ASC
+        LIMIT %s
+    """, (now_datetime(), CLAIM_BATCH), as_dict=True)
+
+    busy_sessions = set()
+    for row in rows:
+        if row.session in busy_sessions:
+            continue
+
+        slot_lock = _acquire_session_slot(row.session, session_concurrency)
+        if slot_lock is None:
+            busy_sessions.add(row.session)
+            continue
+
+        # Otro worker puede haber reservado la misma fila
+        file_key = _media_file_lock_key(row.name)
+        file_token = acquire_lock(file_key, timeout=LOCK_TIMEOUT)
+        if not file_token:
+            _release_locks([slot_lock])
+            continue
+
+        locks = [(file_key, file_token), slot_lock]
+
+        # FOR UPDATE lee el estado confirmado, no el de la instantánea de esta transacción
+        if frappe.db.get_value("WhatsApp Media File", row.name, "status", for_update=True) != "Pending":
+            _release_locks(locks)
+            continue
+
+        frappe.db.set_value("WhatsApp Media File", row.name, "status", "Downloading")
+        frappe.db.commit()
+        return row, locks
+
+    return None
+
+
+def process_media_queue():
+    """
+    Job en segundo plano: descarga media pendiente hasta vaciar la cola (o
+    agotar su tiempo), respetando el máximo por sesión.
+    """
+    from .media import download_media_from_message
+
+    config = _get_queue_config()
+    deadline = time.monotonic() + WORKER_TIMEOUT - DOWNLOAD_TIMEOUT
+
+    while time.monotonic() < deadline:
+        claimed = _claim_next(config["session_concurrency"])
+        if not claimed:
+            break
+
+        row, locks = claimed
+        try:
+            try:
+                result = download_media_from_message(row.session, row.message)
+            except Exception as e:
+                frappe.db.rollback()
+                result = {"success": False, "message": str(e)}
+
+            _record_result(row, result)
+            frappe.db.commit()
+        finally:
+            _release_locks(locks)
+
+
+def _retry_delay(retry_count: int) -> int:
+    """Espera antes del reintento número `retry_count` (30 s, 60 s, 120 s...)."""
+    return min(RETRY_BASE_SECONDS * 2 ** max(retry_count - 1, 0), MAX_RETRY_DELAY)
+
+
+def _record_result(row: Dict[str, Any], result: Dict[str, Any]):
+    """Guarda el resultado de una descarga y programa el reintento si procede."""
+    if result.get("success"):
+        mark_media_downloaded(row.name, result)
+        return
+
+    retry_count = cint(row.retry_count) + 1
+    retry = result.get("retryable", True) and retry_count < MAX_RETRIES
+    frappe.db.set_value("WhatsApp Media File", row.name, {
+        "status": "Pending" if retry else "Failed",
+        "retry_count": retry_count,
+        "download_error": (result.get("message") or "Error desconocido")[:1000],
+        "next_attempt_at": add_to_date(now_datetime(), seconds=_retry_delay(retry_count)) if retry else None,
+    })
+
+
+def mark_media_downloaded(name: str, result: Dict[str, Any]):
+    """Marca un WhatsApp Media File como descargado con el resultado de `download_media_from_message`."""
+    frappe.db.set_value("WhatsApp Media File", name, {
+        "status": "Downloaded",
+        "file": result.get("file_path"),
+        "filename": result.get("filename"),
+        "filesize": result.get("filesize"),
+        "mimetype": result.get("mimetype"),
+        "sha256_hash": result.get("sha256"),
+        "is_downloaded": 1,
+        "downloaded_at": now_datetime(),
+        "download_error": None,
+        "next_attempt_at": None,
+    })
+
+
+def schedule_media_downloads():
+    """
+    Tarea programada de respaldo: devuelve a "Pending" las descargas de workers
+    caídos y relanza los workers si hay descargas listas (p. ej. reintentos
+    cuya espera ha vencido).
+    """
+    config = _get_queue_config()
+
+    # Ya no puede quedar vivo el job que la reservó; el lock lo confirma
+    stale = frappe.get_all(
+        "WhatsApp Media File",
+        filters={
+            "status": "Downloading",
+            "modified": ["<", add_to_date(now_datetime(), seconds=-STALE_DOWNLOAD_SECONDS)],
+        },
+        pluck="name",
+    )
+    orphaned = [name for name in stale if not is_locked(_media_file_lock_key(name))]
+    if orphaned:
+        frappe.db.sql("""
+            UPDATE `tabWhatsApp Media File`
+            SET status = 'Pending'
+            WHERE name IN %s AND status = 'Downloading'
+        """, (tuple(orphaned),))
+        frappe.db.commit()
+
+    if config["enabled"]:
+        _schedule_workers(config)
+
+
+@frappe.whitelist()
+def retry_failed_media(names: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Vuelve a encolar descargas fallidas.
+
+    Args:
+        names: WhatsApp Media File a reintentar (por defecto, todos los fallidos)
+
+    Returns:
+        Dict con el número de descargas reencoladas
+    """
+    frappe.only_for(["System Manager", "WhatsApp Manager"])
+
+    names = frappe.parse_json(names) if isinstance(names, str) else names
+    filters = {"status": "Failed"}
+    if names:
+        filters["name"] = ["in", names]
+
+    failed = frappe.get_all("WhatsApp Media File", filters=filters, pluck="name")
+    if failed:
+        frappe.db.sql("""
+            UPDATE `tabWhatsApp Media File`
+            SET status = 'Pending', retry_count = 0, next_attempt_at = NULL
+            WHERE name IN %s AND status = 'Failed'
+        """, (tuple(failed),))
+        _schedule_workers()
+
+    return {"success": True, "requeued": len(failed)}
+
+
+@frappe.whitelist()
+def get_media_queue_status() -> Dict[str, Any]:
+    """
+    Backlog de la cola de descargas de media: totales por estado, pendientes y
+    descargas en curso por sesión, y los últimos fallos.
+
+    Returns:
+        Dict con depth, sessions y recent_failures
+    """
+    frappe.only_for(["System Manager", "WhatsApp Manager"])
+
+    config = _get_queue_config()
+
+    by_status = frappe.db.sql("""
+        SELECT status, COUNT(*) AS count
+        FROM `tabWhatsApp Media File`
+        GROUP BY status
+    """, as_dict=True)
+
+    sessions = frappe.db.sql("""
+        SELECT
+            session,
+            SUM(status = 'Pending') AS pending,
+            SUM(status = 'Pending' AND retry_count > 0) AS retrying,
+            SUM(status = 'Downloading') AS downloading,
+            TIMESTAMPDIFF(SECOND, MIN(IF(status = 'Pending', creation, NULL)), NOW()) AS lag_seconds
+        FROM `tabWhatsApp Media File`
+        WHERE status IN ('Pending', 'Downloading')
+        GROUP BY session
+        ORDER BY pending DESC
+    """, as_dict=True)
+
+    for row in sessions:
+        row.active_slots = sum(
+            is_locked(_session_slot_key(row.session, slot)) for slot in range(config["session_concurrency"])
+        )
+
+    recent_failures = frappe.get_all(
+        "WhatsApp Media File",
+        filters={"status": "Failed"},
+        fields=["name", "session", "message", "media_type", "retry_count", "download_error", "modified"],
+        order_by="modified desc",
+        limit=20,
+    )
+
+    return {
+        "success": True,
+        "enabled": config["enabled"],
+        "max_concurrency": config["max_concurrency"],
+        "session_concurrency": config["session_concurrency"],
+        "depth": {row.status: row.count for row in by_status},
+        "ready": _count_ready(),
+        "sessions": sessions,
+        "recent_failures": recent_failures,
+    }
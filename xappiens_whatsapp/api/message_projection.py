@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Proyección compacta del historial de mensajes.
+
+Devuelve un conjunto fijo y mínimo de columnas (sin `raw_data`, `metadata` ni
+otras columnas JSON) en formato columnas + filas, con las fechas como epoch en
+milisegundos para que el tiempo relativo se calcule en el cliente. Pagina por
+cursor igual que `get_messages` (ver utils/pagination.py).
+"""
+
+from typing import Any, Dict, List, Optional
+from zoneinfo import ZoneInfo
+
+import frappe
+from frappe import _
+from frappe.model import no_value_fields
+from frappe.utils import cint, get_system_timezone
+
+from xappiens_whatsapp.utils.pagination import build_keyset_clause, paginate_rows
+from xappiens_whatsapp.utils.phone import normalize_phone_number
+
+
+DEFAULT_FIELDS = [
+    "name",
+    "message_id",
+    "timestamp",
+    "direction",
+    "message_type",
+    "content",
+    "status",
+    "has_media",
+    "quoted_message",
+]
+
+# Columnas adicionales que se pueden pedir con `fields`
+OPTIONAL_FIELDS = {
+    "session",
+    "conversation",
+    "from_me",
+    "from_number",
+    "to_number",
+    "quoted_message_content",
+    "is_forwarded",
+    "is_starred",
+    "is_reply",
+    "has_reaction",
+    "reaction",
+    "ack_status",
+    "error_message",
+    "has_location",
+    "location_latitude",
+    "location_longitude",
+    "location_description",
+    "sent_at",
+    "delivered_at",
+    "read_at",
+}
+
+DATETIME_FIELDS = {"timestamp", "sent_at", "delivered_at", "read_at"}
+
+# Necesarias para los cursores de paginación
+REQUIRED_FIELDS = ["name", "timestamp"]
+
+MAX_LIMIT = 500
+
+STANDARD_COLUMNS = ["name", "creation", "modified", "owner", "modified_by", "docstatus", "idx"]
+HEAVY_FIELDTYPES = {"JSON"}
+
+
+def resolve_fields(fields=None) -> List[str]:
+    """
+    Valida la selección de columnas (lista, JSON o separada por comas).
+    Sin selección se usan DEFAULT_FIELDS.
+    """
+    if not fields:
+        return list(DEFAULT_FIELDS)
+
+    if isinstance(fields, str):
+        fields = frappe.parse_json(fields) if fields.strip().startswith("[") else fields.split(",")
+
+    allowed = set(DEFAULT_FIELDS) | OPTIONAL_FIELDS
+    selected = []
+    for field in REQUIRED_FIELDS + [f.strip() for f in fields]:
+        if field not in allowed:
+            frappe.throw(_("Campo no disponible en la proyección: {0}").format(field))
+        if field not in selected:
+            selected.append(field)
+
+    return selected
+
+
+def get_light_message_columns() -> List[str]:
+    """Todas las columnas de WhatsApp Message salvo las JSON (raw_data, metadata...)."""
+    meta = frappe.get_meta("WhatsApp Message")
+    return STANDARD_COLUMNS + [
+        df.fieldname for df in meta.fields
+        if df.fieldtype not in no_value_fields and df.fieldtype not in HEAVY_FIELDTYPES
+    ]
+
+
+def to_epoch_millis(value, tz: ZoneInfo) -> Optional[int]:
+    """Convierte un Datetime de la BD (hora del sistema, sin zona) a epoch en ms."""
+    if not value:
+        return None
+    return int(value.replace(tzinfo=tz).timestamp() * 1000)
+
+
+@frappe.whitelist()
+def get_message_history(
+    conversation_id: str = None,
+    phone_number: str = None,
+    limit: int = 100,
+    before: str = None,
+    after: str = None,
+    fields=None
+) -> Dict[str, Any]:
+    """
+    Historial compacto de una conversación, o de todas las conversaciones
+    activas de un número (vista unificada entre sesiones).
+
+    Args:
+        conversation_id: ID de la conversación
+        phone_number: Número de teléfono (si no se indica conversación)
+        limit: Mensajes por página (máximo MAX_LIMIT)
+        before: Cursor next_cursor para mensajes más antiguos
+        after: Cursor latest_cursor para mensajes posteriores
+        fields: Columnas a devolver (por defecto DEFAULT_FIELDS)
+
+    Returns:
+        Dict con columns, rows (orden cronológico) y cursores
+    """
+    try:
+        columns = resolve_fields(fields)
+        limit = min(cint(limit) or 100, MAX_LIMIT)
+
+        if conversation_id:
+            conversations = [conversation_id]
+        elif phone_number:
+            normalized_phone = normalize_phone_number(phone_number)
+            conversations = frappe.get_all("WhatsApp Conversation",
+                filters={"normalized_phone": normalized_phone, "status": "Active"},
+                pluck="name"
+            ) if normalized_phone else []
+        else:
+            frappe.throw(_("Indica conversation_id o phone_number"))
+
+        if not conversations:
+            return {
+                "success": True,
+                "columns": columns,
+                "rows": [],
+                "has_more": False,
+                "next_cursor": None,
+                "latest_cursor": None
+            }
+
+        params = {"conversations": tuple(conversations), "limit": limit + 1}
+        cursor_condition, order_by, ascending = build_keyset_clause(params, before=before, after=after)
+
+        messages = frappe.db.sql(f"""
+            SELECT {", ".join(f"`{column}`" for column in columns)}
+            FROM `tabWhatsApp Message`
+            WHERE conversation IN %(conversations)s
+                {f"AND {cursor_condition}" if cursor_condition else ""}
+            ORDER BY {order_by}
+            LIMIT %(limit)s
+        """, params, as_dict=True)
+
+        page = paginate_rows(messages, limit, ascending)
+
+        tz = ZoneInfo(get_system_timezone())
+        datetime_columns = [column for column in columns if column in DATETIME_FIELDS]
+        rows = []
+        for message in page["messages"]:
+            for column in datetime_columns:
+                message[column] = to_epoch_millis(message[column], tz)
+            rows.append([message[column] for column in columns])
+
+        return {
+            "success": True,
+            "columns": columns,
+            "rows": rows,
+            "has_more": page["has_more"],
+            "next_cursor": page["next_cursor"],
+            "latest_cursor": page["latest_cursor"]
+        }
+
+    except Exception as e:
+        frappe.log_error(f"Error getting message history: {str(e)}", "WhatsApp Message History")
+        return {
+            "success": False,
+            "message": str(e),
+            "columns": [],
+            "rows": []
+        }
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sincronización incremental de mensajes por conversación.
+
+Cada WhatsApp Conversation guarda una marca de agua con el último mensaje
+remoto ya importado: `last_synced_at` (timestamp del mensaje) y
+`last_remote_message_id`. La API solo pagina del más reciente al más antiguo,
+así que se piden páginas hasta llegar a la marca de agua y se importan solo los
+mensajes posteriores. Las conversaciones cuyo último mensaje remoto (guardado en
+`last_message_time` por sync_conversations) no es posterior a la marca de agua
+no se consultan.
+
+Los mensajes nuevos y la marca de agua se confirman en la misma transacción, y
+la marca de agua nunca retrocede. Si una ejecución alcanza MAX_PAGES sin llegar
+a la marca de agua, esta no se mueve: se guarda en caché un punto de reanudación
+(página siguiente y mensaje más reciente importado) y la próxima ejecución
+continúa desde ahí. Como la API pagina del más reciente al más antiguo, los
+mensajes que lleguen entretanto solo desplazan los antiguos a páginas
+posteriores, así que no se salta ninguno. Al llegar por fin a la marca de agua,
+esta pasa al mensaje más reciente importado desde que se empezó.
+
+Todos los timestamps remotos pasan por `utils.timestamps.parse_remote_timestamp`
+(hora del sistema, sin zona), igual que los mensajes y `last_message_time`.
+"""
+
+import frappe
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from frappe.utils import cint, get_datetime
+from .base import WhatsAppAPIClient
+from .messages import (
+    _create_message_from_data, _extract_messages, _first,
+    _get_remote_message_id, _get_remote_status, _parse_timestamp
+)
+from xappiens_whatsapp.utils.conversation_stats import invalidate_conversation_stats
+
+
+# Máximo de la API de Baileys por página
+PAGE_SIZE = 100
+# Tope de páginas por conversación y ejecución
+MAX_PAGES = 20
+# Caducidad del punto de reanudación; sin él se vuelve a empezar por la página 1
+RESUME_PAGE_TTL = 7 * 24 * 60 * 60
+
+
+def _get_remote_timestamp(message_data: Dict):
+    """Timestamp del mensaje en hora del sistema y sin zona, como se guarda en la BD."""
+    return _parse_timestamp(
+        _first(message_data, ["timestamp", "messageTimestamp", "sentAt", "createdAt"])
+    )
+
+
+def _resume_key(conversation_name: str) -> str:
+    return f"whatsapp_sync_resume:{conversation_name}"
+
+
+def get_resume_point(conversation_name: str) -> Dict[str, Any]:
+    """
+    Punto de reanudación de una sincronización que no llegó a la marca de agua.
+
+    Returns:
+        Dict con page (1 si no hay) y newest ((timestamp, message_id) del
+        mensaje más reciente ya importado, o None)
+    """
+    point = frappe.cache().get_value(_resume_key(conversation_name)) or {}
+    newest = point.get("newest")
+    return {
+        "page": cint(point.get("page")) or 1,
+        "newest": (get_datetime(newest[0]), newest[1]) if newest else None,
+    }
+
+
+def set_resume_point(conversation_name: str, page: Optional[int] = None, newest: Optional[tuple] = None):
+    """Guarda el punto de reanudación de una conversación, o lo borra si no se indica página."""
+    if not page:
+        frappe.cache().delete_value(_resume_key(conversation_name))
+        return
+
+    frappe.cache().set_value(
+        _resume_key(conversation_name),
+        {"page": page, "newest": [str(newest[0]), newest[1]] if newest else None},
+        expires_in_sec=RESUME_PAGE_TTL,
+    )
+
+
+def get_conversations_to_sync(session_name: str, limit: int = None) -> List[Dict[str, Any]]:
+    """
+    Conversaciones activas de una sesión con mensajes remotos posteriores a su
+    marca de agua (o que nunca se han sincronizado).
+
+    Args:
+        session_name: Nombre del documento WhatsApp Session
+        limit: Máximo de conversaciones (las de actividad más reciente primero)
+
+    Returns:
+        Lista de conversaciones con name, chat_id y la marca de agua
+    """
+    return frappe.db.sql(f"""
+        SELECT name, chat_id, last_message_time, last_synced_at, last_remote_message_id
+        FROM `tabWhatsApp Conversation`
+        WHERE session = %(session)s
+            AND status = 'Active'
+            AND (last_synced_at IS NULL OR last_message_time > last_synced_at)
+        ORDER BY last_message_time DESC
+        {"LIMIT %(limit)s" if limit else ""}
+    """, {"session": session_name, "limit": cint(limit)}, as_dict=True)
+
+
+def fetch_messages_since(
+    client: WhatsAppAPIClient,
+    chat_id: str,
+    watermark_time=None,
+    watermark_id: str = None,
+    page_size: int = PAGE_SIZE,
+    max_pages: int = MAX_PAGES,
+    start_page: int = 1
+) -> Dict[str, Any]:
+    """
+    Pide páginas al servidor hasta alcanzar la marca de agua.
+
+    Sin marca de agua (primera sincronización) solo se pide la primera página.
+    Los mensajes con el mismo timestamp que la marca de agua se devuelven
+    también; la deduplicación por message_id los descarta después.
+
+    Args:
+        client: Cliente API de la sesión
+        chat_id: ID del chat
+        watermark_time: Timestamp del último mensaje importado
+        watermark_id: ID remoto del último mensaje importado
+        page_size: Mensajes por página
+        max_pages: Tope de páginas
+        start_page: Primera página (punto de reanudación)
+
+    Returns:
+        Dict con messages (lista de (timestamp, message_id, datos)), pages,
+        next_page y caught_up (False si se alcanzó el tope de páginas antes
+        que la marca)
+    """
+    watermark_time = get_datetime(watermark_time) if watermark_time else None
+    messages = []
+    seen = set()
+    caught_up = False
+    page = max(cint(start_page), 1) - 1
+    last_page = page + max_pages
+
+    while page < last_page:
+        page += 1
+        response = client.get_chat_messages(chat_id, page=page, limit=page_size)
+        if not response.get("success"):
+            frappe.throw(response.get("message") or response.get("error") or "Error al obtener mensajes del servidor")
+
+        items = _extract_messages(response)
+        for message_data in items:
+            message_id = _get_remote_message_id(message_data)
+            if not message_id or message_id in seen:
+                continue
+
+            timestamp = _get_remote_timestamp(message_data)
+            if message_id == watermark_id or (watermark_time and timestamp and timestamp < watermark_time):
+                caught_up = True
+                continue
+
+            seen.add(message_id)
+            messages.append((timestamp, message_id, message_data))
+
+        # Primera sincronización: solo la página más reciente
+        if caught_up or len(items) < page_size or not (watermark_time or watermark_id):
+            caught_up = True
+            break
+
+    return {
+        "messages": messages,
+        "pages": page - max(cint(start_page), 1) + 1,
+        "next_page": page + 1,
+        "caught_up": caught_up,
+    }
+
+
+def advance_watermark(conversation_name: str, watermark_time, watermark_id: str):
+    """
+    Mueve la marca de agua de una conversación en un único UPDATE condicional,
+    sin retroceder si otro proceso ya la adelantó.
+    """
+    frappe.db.sql("""
+        UPDATE `tabWhatsApp Conversation`
+        SET last_synced_at = %(ts)s, last_remote_message_id = %(message_id)s
+        WHERE name = %(name)s
+            AND (last_synced_at IS NULL OR last_synced_at <= %(ts)s)
+    """, {"name": conversation_name, "ts": watermark_time, "message_id": watermark_id})
+
+
+def sync_conversation_messages(
+    conversation_name: str,
+    client: WhatsAppAPIClient = None,
+    session: Any = None,
+    page_size: int = PAGE_SIZE,
+    max_pages: int = MAX_PAGES
+) -> Dict[str, Any]:
+    """
+    Importa los mensajes remotos posteriores a la marca de agua de una
+    conversación y adelanta la marca de agua.
+
+    Args:
+        conversation_name: Nombre del documento WhatsApp Conversation
+        client: Cliente API (se crea si no se indica)
+        session: Documento WhatsApp Session (se carga si no se indica)
+        page_size: Mensajes por página
+        max_pages: Tope de páginas
+
+    Returns:
+        Dict con resultado de la sincronización
+    """
+    conversation = frappe.db.get_value(
+        "WhatsApp Conversation",
+        conversation_name,
+        ["name", "session", "chat_id", "last_synced_at", "last_remote_message_id"],
+        as_dict=True
+    )
+    session = session or frappe.get_doc("WhatsApp Session", conversation.session)
+    client = client or WhatsAppAPIClient(session.session_id)
+
+    # Sin marca de agua no hay nada que reanudar (solo se pide la primera página)
+    resume = get_resume_point(conversation.name)
+    start_page = resume["page"] if conversation.last_synced_at or conversation.last_remote_message_id else 1
+    fetched = fetch_messages_since(
+        client,
+        conversation.chat_id,
+        watermark_time=conversation.last_synced_at,
+        watermark_id=conversation.last_remote_message_id,
+        page_size=page_size,
+        max_pages=max_pages,
+        start_page=start_page
+    )
+    messages = fetched["messages"]
+
+    existing = {}
+    if messages:
+        existing = {
+            row.message_id: row
+            for row in frappe.get_all(
+                "WhatsApp Message",
+                filters={"session": session.name, "message_id": ["in", [m[1] for m in messages]]},
+                fields=["name", "message_id", "status"]
+            )
+        }
+
+    created = 0
+    updated = 0
+    errors = 0
+
+    # Del más antiguo al más reciente, para que el último mensaje de la conversación quede bien
+    messages.sort(key=lambda m: (m[0] or datetime.min, m[1]))
+    for timestamp, message_id, message_data in messages:
+        try:
+            row = existing.get(message_id)
+            if row:
+                status = _get_remote_status(message_data)
+                if status and status != row.status:
+                    frappe.db.set_value("WhatsApp Message", row.name, "status", status, update_modified=False)
+                    updated += 1
+            else:
+                _create_message_from_data(message_data, conversation.name, session)
+                created += 1
+        except Exception as e:
+            errors += 1
+            frappe.log_error(
+                message=f"Message error: {str(e)[:100]}",
+                title=f"WA Msg - {message_id[:20]}"
+            )
+
+    # La marca solo avanza si se llegó a ella sin errores; si no, quedarían sin
+    # importar los mensajes entre la última página pedida y la marca. Si esta
+    # ejecución empezó en un punto de reanudación, cuenta también lo importado
+    # en las anteriores.
+    candidates = [(m[0], m[1]) for m in messages if m[0]]
+    if start_page > 1 and resume["newest"]:
+        candidates.append(resume["newest"])
+    newest = max(candidates, default=None)
+
+    advanced = bool(newest and not errors and fetched["caught_up"])
+    if advanced:
+        advance_watermark(conversation.name, newest[0], newest[1])
+
+    if created:
+        invalidate_conversation_stats(session.name)
+    frappe.db.commit()
+
+    # Con errores se repiten las mismas páginas en la siguiente ejecución
+    if not errors:
+        if fetched["caught_up"]:
+            set_resume_point(conversation.name)
+        else:
+            set_resume_point(conversation.name, fetched["next_page"], newest)
+
+    return {
+        "success": True,
+        "processed": len(messages),
+        "created": created,
+        "updated": updated,
+        "errors": errors,
+        "pages": fetched["pages"],
+        "caught_up": fetched["caught_up"],
+        "resume_page": None if fetched["caught_up"] else fetched["next_page"],
+        "watermark": newest[1] if advanced else conversation.last_remote_message_id
+    }
+
+
+def sync_session_messages(session: Any, client: WhatsAppAPIClient = None, limit: int = None) -> Dict[str, Any]:
+    """
+    Sincronización incremental de las conversaciones de una sesión con
+    mensajes nuevos; el resto se omite sin consultar al servidor.
+
+    Args:
+        session: Documento WhatsApp Session
+        client: Cliente API (se crea si no se indica)
+        limit: Máximo de conversaciones a sincronizar
+
+    Returns:
+        Dict con los totales
+    """
+    client = client or WhatsAppAPIClient(session.session_id)
+    conversations = get_conversations_to_sync(session.name, limit=limit)
+
+    totals = {
+        "conversations_synced": 0,
+        "conversations_skipped": frappe.db.count("WhatsApp Conversation", {"session": session.name, "status": "Active"}) - len(conversations),
+        "processed": 0,
+        "created": 0,
+        "updated": 0,
+        "errors": 0
+    }
+
+    for conv in conversations:
+        try:
+            result = sync_conversation_messages(conv.name, client=client, session=session)
+            totals["conversations_synced"] += 1
+            for key in ("processed", "created", "updated", "errors"):
+                totals[key] += result[key]
+        except Exception as e:
+            frappe.db.rollback()
+            totals["errors"] += 1
+            frappe.log_error(
+                message=f"Chat messages error: {str(e)[:100]}",
+                title=f"WA Chat Msgs - {(conv.chat_id or conv.name)[:20]}"
+            )
+
+    return totals
@@ -7,8 +7,34 @@ Sincroniza y envía mensajes con el servidor externo.
 
 import frappe
 from .base import WhatsAppAPIClient
+from .outbound_queue import queue_outgoing_message, queued_response
 from typing import Dict, Any, List, Optional
 from datetime import datetime
+from frappe.utils import cint
+from xappiens_whatsapp.utils.conversation_stats import invalidate_conversation_stats
+from xappiens_whatsapp.utils.pagination import build_keyset_clause, paginate_rows
+from xappiens_whatsapp.utils.timestamps import parse_remote_timestamp
+
+
+ACK_STATUS_MAP = {
+    -1: "Failed",
+    0: "Pending",
+    1: "Sent",
+    2: "Delivered",
+    3: "Read",
+    4: "Played"
+}
+
+STATUS_TEXT_MAP = {
+    "pending": "Pending",
+    "sent": "Sent",
+    "delivered": "Delivered",
+    "received": "Delivered",
+    "read": "Read",
+    "played": "Played",
+    "failed": "Failed",
+    "error": "Failed"
+}
 
 
 def _first(data: Dict[str, Any], keys: List[str], default=None):
@@ -21,44 +47,61 @@ def _first(data: Dict[str, Any], keys: List[str], default=None):
 
 
 def _parse_timestamp(value: Any) -> Optional[datetime]:
-    """Convierte timestamps en segundos, milisegundos o ISO-8601 a datetime."""
-    if not value:
-        return None
+    """Convierte timestamps en segundos, milisegundos o ISO-8601 a datetime en hora del sistema."""
+    return parse_remote_timestamp(value)
 
-    try:
-        if isinstance(value, (int, float)):
-            ts = float(value)
-            if ts > 1_000_000_000_000:
-                ts = ts / 1000
-            return datetime.fromtimestamp(ts)
-        if isinstance(value, str):
-            # Reemplazar Z por +00:00 para compatibilidad
-            return datetime.fromisoformat(value.replace("Z", "+00:00"))
-    except Exception:
-        return None
+
+def _get_remote_message_id(message_data: Dict[str, Any]) -> Optional[str]:
+    """ID de WhatsApp de un mensaje del servidor (no el ID interno numérico de Baileys)."""
+    raw_id = message_data.get("id")
+    if isinstance(raw_id, dict):
+        return raw_id.get("_serialized") or raw_id.get("id")
+    message_id = _first(message_data, ["whatsappMessageId", "messageId", "message_id"]) or raw_id
+    return str(message_id) if message_id else None
+
+
+def _get_remote_status(message_data: Dict[str, Any]) -> Optional[str]:
+    """Estado del mensaje a partir de `ack` o del texto de estado (None si no viene)."""
+    ack = message_data.get("ack")
+    if ack is not None:
+        return ACK_STATUS_MAP.get(ack)
+
+    status_text = _first(message_data, ["status", "ackStatus"])
+    if status_text:
+        return STATUS_TEXT_MAP.get(str(status_text).lower())
 
     return None
 
 
+def _extract_messages(response: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Lista de mensajes de una respuesta de la API (formato actual y anteriores)."""
+    payload = response.get("data") or {}
+    if isinstance(payload, dict):
+        return payload.get("items") or payload.get("messages") or payload.get("data") or []
+    if isinstance(payload, list):
+        return payload
+    return response.get("messages", [])
+
+
 @frappe.whitelist()
 def sync_messages(conversation_name: str, limit: int = 50) -> Dict[str, Any]:
     """
-    Sincroniza mensajes de una conversación desde el servidor externo.
+    Sincroniza los mensajes nuevos de una conversación desde el servidor externo.
+    Solo se importan los mensajes posteriores a la marca de agua de la
+    conversación (ver api/message_sync.py).
 
     Args:
         conversation_name: Nombre del documento WhatsApp Conversation
-        limit: Límite de mensajes a sincronizar
+        limit: Mensajes por página pedida al servidor
 
     Returns:
         Dict con resultado de la sincronización
     """
-    try:
-        conversation = frappe.get_doc("WhatsApp Conversation", conversation_name)
-        session = frappe.get_doc("WhatsApp Session", conversation.session)
+    from .message_sync import PAGE_SIZE, sync_conversation_messages
 
-        frappe.log_error(f"Syncing messages for conversation: {conversation_name}")
-        frappe.log_error(f"Conversation chat_id: {conversation.chat_id}")
-        frappe.log_error(f"Session: {session.name}, connected: {session.is_connected}")
+    try:
+        session_name = frappe.db.get_value("WhatsApp Conversation", conversation_name, "session")
+        session = frappe.get_doc("WhatsApp Session", session_name)
 
         if not session.is_connected:
             try:
@@ -76,71 +119,14 @@ def sync_messages(conversation_name: str, limit: int = 50) -> Dict[str, Any]:
                 "message": "La sesión no está conectada"
             }
 
-        client = WhatsAppAPIClient(session.session_id)
-
-        # Obtener mensajes del servidor
-        response = client.get_chat_messages(conversation.chat_id, limit=limit)
-
-        if not response.get("success"):
-            return {
-                "success": False,
-                "message": response.get("message") or "Error al obtener mensajes del servidor"
-            }
-
-        payload = response.get("data") or {}
-        if isinstance(payload, dict):
-            messages_data = payload.get("items") or payload.get("messages") or payload.get("data") or []
-        elif isinstance(payload, list):
-            messages_data = payload
-        else:
-            messages_data = response.get("messages", [])
-
-        created = 0
-        updated = 0
-        errors = 0
-
-        for message_data in messages_data:
-            try:
-                message_id = message_data.get("id", {}).get("_serialized") or message_data.get("id")
-
-                if not message_id:
-                    continue
-
-                # Buscar si el mensaje ya existe
-                existing = frappe.db.exists("WhatsApp Message", {
-                    "session": session.name,
-                    "message_id": message_id
-                })
-
-                if existing:
-                    # Actualizar mensaje existente
-                    message = frappe.get_doc("WhatsApp Message", existing)
-                    _update_message_from_data(message, message_data)
-                    updated += 1
-                else:
-                    # Crear nuevo mensaje
-                    message = _create_message_from_data(message_data, conversation, session)
-                    created += 1
-
-            except Exception as e:
-                errors += 1
-                # Continuar sin fallar por errores individuales
-
-        frappe.db.commit()
-
-        # Actualizar última sincronización de la conversación
-        frappe.db.set_value("WhatsApp Conversation", conversation_name, "modified", frappe.utils.now())
-        frappe.db.commit()
-
-        return {
-            "success": True,
-            "processed": len(messages_data),
-            "created": created,
-            "updated": updated,
-            "errors": errors
-        }
+        return sync_conversation_messages(
+            conversation_name,
+            session=session,
+            page_size=min(cint(limit) or PAGE_SIZE, PAGE_SIZE)
+        )
 
     except Exception as e:
+        frappe.db.rollback()
         frappe.log_error(f"Error syncing messages: {str(e)}")
         return {
             "success": False,
@@ -170,17 +156,9 @@ def get_chat_messages(conversation_name: str, limit: int = 50, offset: int = 0)
         response = client.get_chat_messages(conversation.chat_id, limit=limit, page=(offset // limit) + 1)
 
         if response.get("success"):
-            payload = response.get("data") or {}
-            if isinstance(payload, dict):
-                messages = payload.get("items") or payload.get("messages") or payload.get("data") or []
-            elif isinstance(payload, list):
-                messages = payload
-            else:
-                messages = response.get("messages", [])
-
             return {
                 "success": True,
-                "messages": messages
+                "messages": _extract_messages(response)
             }
         else:
             frappe.throw(response.get("message") or "Error al obtener mensajes")
@@ -204,11 +182,7 @@ def _create_message_from_data(message_data: Dict, conversation: str, session: An
     Returns:
         Documento WhatsApp Message creado
     """
-    message_id = (
-        message_data.get("id", {}).get("_serialized")
-        if isinstance(message_data.get("id"), dict)
-        else message_data.get("id")
-    ) or _first(message_data, ["messageId", "message_id"])
+    message_id = _get_remote_message_id(message_data)
 
     # Procesar timestamp
     message_time = _parse_timestamp(
@@ -253,28 +227,7 @@ def _create_message_from_data(message_data: Dict, conversation: str, session: An
 
     # Determinar estado
     ack = message_data.get("ack")
-    if ack is None:
-        status_text = _first(message_data, ["status", "ackStatus"])
-        status_map_text = {
-            "pending": "Pending",
-            "sent": "Sent",
-            "delivered": "Delivered",
-            "read": "Read",
-            "played": "Played",
-            "failed": "Failed",
-            "error": "Failed"
-        }
-        status = status_map_text.get(str(status_text).lower() if status_text else "", "Pending")
-    else:
-        status_map = {
-            -1: "Failed",
-            0: "Pending",
-            1: "Sent",
-            2: "Delivered",
-            3: "Read",
-            4: "Played"
-        }
-        status = status_map.get(ack, "Pending")
+    status = _get_remote_status(message_data) or "Pending"
 
     content = _first(
         message_data,
@@ -318,191 +271,39 @@ def _create_message_from_data(message_data: Dict, conversation: str, session: An
     return message
 
 
-def _update_message_from_data(message: Any, message_data: Dict):
-    """
-    Actualiza un documento WhatsApp Message con datos del servidor.
-
-    Args:
-        message: Documento WhatsApp Message
-        message_data: Datos del mensaje del servidor
-    """
-    # Actualizar solo campos que pueden cambiar
-    ack = message_data.get("ack")
-    if ack is not None:
-        status_map = {
-            -1: "Failed",
-            0: "Pending",
-            1: "Sent",
-            2: "Delivered",
-            3: "Read",
-            4: "Played"
-        }
-        message.status = status_map.get(ack, message.status)
-        message.ack = ack
-    else:
-        status_text = _first(message_data, ["status", "ackStatus"])
-        if status_text:
-            status_map_text = {
-                "pending": "Pending",
-                "sent": "Sent",
-                "delivered": "Delivered",
-                "read": "Read",
-                "played": "Played",
-                "failed": "Failed",
-                "error": "Failed"
-            }
-            message.status = status_map_text.get(str(status_text).lower(), message.status)
-
-    content = _first(
-        message_data,
-        ["body", "message", "text", "content", "caption", "description"],
-        message.content
-    )
-    if content is not None:
-        message.content = content
-
-    timestamp = _parse_timestamp(
-        _first(message_data, ["timestamp", "messageTimestamp", "sentAt", "createdAt"])
-    )
-    if timestamp:
-        message.timestamp = timestamp
-
-    message.is_starred = message_data.get("isStarred", message.is_starred)
-    message.has_media = message_data.get("hasMedia", message.has_media)
-    message.save(ignore_permissions=True)
-
-
 @frappe.whitelist()
-def send_message(conversation_id: str, content: str, message_type: str = "text") -> Dict[str, Any]:
+def send_message(conversation_id: str, content: str, message_type: str = "text", priority: str = "agent") -> Dict[str, Any]:
     """
-    Envía un mensaje a una conversación y lo guarda en el DocType.
+    Guarda un mensaje de una conversación y lo pone en la cola de envío
+    (ver outbound_queue). El envío real lo hace el job de la sesión respetando
+    el rate limiting; el estado final llega por realtime (whatsapp_message_status).
 
     Args:
         conversation_id: ID de la conversación
         content: Contenido del mensaje
         message_type: Tipo de mensaje (text, image, etc.)
+        priority: "agent" (por defecto) o "bulk" para envíos masivos
 
     Returns:
-        Dict con resultado del envío
+        Dict con resultado del encolado
     """
     try:
         # Obtener conversación
         conversation = frappe.get_doc("WhatsApp Conversation", conversation_id)
-        session = frappe.get_doc("WhatsApp Session", conversation.session)
-
-        if not session.is_connected:
-            try:
-                from .session_status import get_session_status as refresh_session_status
-
-                status_result = refresh_session_status(session_name=session.name)
-                if status_result.get("success"):
-                    session.reload()
-            except Exception:
-                pass
+        session = _get_connected_session(conversation.session)
 
-        if not session.is_connected:
+        if not session:
             return {
                 "success": False,
                 "message": "La sesión no está conectada"
             }
 
-        # Preparar datos para envío
-        client = WhatsAppAPIClient(session.session_id)
-
-        # Determinar identificador del destinatario
-        to_number = conversation.phone_number or conversation.chat_id
-        if to_number:
-            normalized = to_number.replace("+", "").replace(" ", "")
-            if "@" not in normalized:
-                to_number = f"{normalized}@s.whatsapp.net"
-            else:
-                to_number = normalized.replace("@c.us", "@s.whatsapp.net")
-
-        # Enviar mensaje al servidor externo
-        response = client.send_message(
-            to=to_number,
-            message=content,
-            message_type=message_type
+        message_doc = queue_outgoing_message(
+            conversation, session, content, content, message_type=message_type, priority=priority
         )
-
-        if not response.get("success"):
-            return {
-                "success": False,
-                "message": f"Error al enviar mensaje: {response.get('message', 'Error desconocido')}"
-            }
-
-        # Guardar mensaje en DocType
-        payload = response.get("data") or {}
-        message_data = payload.get("message") if isinstance(payload, dict) else response.get("message", {})
-        message_id = (
-            message_data.get("id", {}).get("_serialized")
-            if isinstance(message_data.get("id"), dict)
-            else message_data.get("id")
-        ) or payload.get("messageId") or response.get("messageId") or frappe.generate_hash(length=20)
-
-        # Crear documento WhatsApp Message
-        message_doc = frappe.get_doc({
-            "doctype": "WhatsApp Message",
-            "session": session.name,
-            "conversation": conversation_id,
-            "contact": conversation.contact,
-            "message_id": message_id,
-            "content": content,
-            "direction": "Outgoing",
-            "message_type": message_type,
-            "status": "sent",
-            "timestamp": frappe.utils.now_datetime(),
-            "from_number": session.phone_number,
-            "to_number": to_number,
-            "from_me": True,
-            "has_media": False,
-            "is_forwarded": False,
-            "is_starred": False,
-            "is_status": False
-        })
-
-        message_doc.insert(ignore_permissions=True)
-
-        # Actualizar estadísticas de la sesión
-        frappe.db.set_value("WhatsApp Session", session.name, "total_messages_sent",
-                           (session.total_messages_sent or 0) + 1)
-
-        # Actualizar última actividad de la conversación
-        now_ts = frappe.utils.now_datetime()
-        frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message", content)
-        frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message_time", now_ts)
-        frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message_from_me", True)
-        frappe.db.set_value("WhatsApp Conversation", conversation_id, "total_messages",
-                           (conversation.total_messages or 0) + 1)
-
         frappe.db.commit()
 
-        payload = {
-            "session": session.name,
-            "conversation": conversation_id,
-            "conversation_id": conversation_id,
-            "message_id": message_doc.name,
-            "message": content,
-            "content": content,
-            "from": session.phone_number,
-            "direction": "outgoing",
-            "timestamp": now_ts.isoformat() if hasattr(now_ts, "isoformat") else str(now_ts),
-        }
-
-        frappe.publish_realtime("whatsapp_message", payload, user="*")
-        frappe.publish_realtime("whatsapp_message_sent", payload, user="*")
-
-        return {
-            "success": True,
-            "message": "Mensaje enviado correctamente",
-            "content": content,  # Incluir contenido en la respuesta
-            "message_id": message_id,
-            "whatsapp_message": message_doc.name,
-            "conversation_id": conversation_id,
-            "timestamp": now_ts.isoformat() if hasattr(now_ts, "isoformat") else str(now_ts),
-            "direction": "Outgoing",
-            "status": "sent"
-        }
+        return queued_response(message_doc, "Mensaje en cola de envío")
 
     except Exception as e:
         frappe.log_error(f"Error sending message: {str(e)}")
@@ -512,6 +313,29 @@ def send_message(conversation_id: str, content: str, message_type: str = "text")
         }
 
 
+def _get_connected_session(session_name: str):
+    """
+    Sesión de una conversación si está conectada, refrescando su estado del
+    servidor antes de darla por desconectada.
+
+    Returns:
+        Documento WhatsApp Session, o None si no está conectada
+    """
+    session = frappe.get_doc("WhatsApp Session", session_name)
+
+    if not session.is_connected:
+        try:
+            from .session_status import get_session_status as refresh_session_status
+
+            status_result = refresh_session_status(session_name=session.name)
+            if status_result.get("success"):
+                session.reload()
+        except Exception:
+            pass
+
+    return session if session.is_connected else None
+
+
 @frappe.whitelist()
 def get_profile_pic(contact_id: str, session_id: str = None) -> Dict[str, Any]:
     """
@@ -631,6 +455,7 @@ def mark_as_read(conversation_id: str, session_id: str = None) -> Dict[str, Any]
 
         # Actualizar DocType de conversación
         frappe.db.set_value("WhatsApp Conversation", conversation_id, "unread_count", 0)
+        invalidate_conversation_stats(conversation.session)
         frappe.db.commit()
 
         # Actualizar mensajes no leídos en DocType
@@ -659,19 +484,68 @@ def mark_as_read(conversation_id: str, session_id: str = None) -> Dict[str, Any]
         }
 
 
+def _get_media_previews(message_names: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Items de media de varios mensajes con la URL de su miniatura.
+
+    Args:
+        message_names: Nombres de documentos WhatsApp Message
+
+    Returns:
+        Dict {mensaje: [{media_type, mimetype, filename, filesize, thumbnail_url, url}]}
+    """
+    if not message_names:
+        return {}
+
+    rows = frappe.get_all(
+        "WhatsApp Message Media",
+        filters={"parent": ["in", message_names], "parenttype": "WhatsApp Message"},
+        fields=["parent", "media_type", "mimetype", "filename", "filesize", "file", "thumbnail"],
+        order_by="idx asc",
+    )
+
+    media = {}
+    for row in rows:
+        media.setdefault(row.parent, []).append({
+            "media_type": row.media_type,
+            "mimetype": row.mimetype,
+            "filename": row.filename,
+            "filesize": row.filesize,
+            "thumbnail_url": row.thumbnail,
+            # Sin descargar: la media se transmite desde el servidor al abrirla
+            "url": row.file or f"/api/method/xappiens_whatsapp.api.media_proxy.stream_media?message={row.parent}",
+        })
+    return media
+
+
 @frappe.whitelist()
-def get_messages(conversation_id: str, limit: int = 50, offset: int = 0) -> Dict[str, Any]:
+def get_messages(
+    conversation_id: str,
+    limit: int = 50,
+    offset: int = 0,
+    before: str = None,
+    after: str = None
+) -> Dict[str, Any]:
     """
-    Obtiene mensajes de una conversación desde el DocType.
+    Obtiene mensajes de una conversación desde el DocType, paginados por cursor.
+
+    Sin cursor devuelve los mensajes más recientes. `before` pagina hacia
+    mensajes más antiguos y `after` devuelve los posteriores al cursor (relleno
+    de huecos tras reconectar). `offset` se mantiene por compatibilidad y solo
+    se aplica sin cursor.
 
     Args:
         conversation_id: ID de la conversación
         limit: Límite de mensajes
-        offset: Offset para paginación
+        offset: Offset para paginación (obsoleto, usar before)
+        before: Cursor next_cursor de una página anterior
+        after: Cursor latest_cursor del último mensaje conocido
 
     Returns:
-        Dict con lista de mensajes
+        Dict con lista de mensajes en orden cronológico y cursores
     """
+    frappe.has_permission("WhatsApp Message", "read", throw=True)
+
     try:
         # Verificar que la conversación existe
         if not frappe.db.exists("WhatsApp Conversation", conversation_id):
@@ -683,32 +557,36 @@ def get_messages(conversation_id: str, limit: int = 50, offset: int = 0) -> Dict
             }
 
         conversation = frappe.get_doc("WhatsApp Conversation", conversation_id)
-
-        # Obtener mensajes desde DocType WhatsApp Message
-        messages = frappe.get_all(
-            "WhatsApp Message",
-            filters={"conversation": conversation_id},
-            fields=[
-                "name",
-                "message_id",
-                "content",
-                "message_type",
-                "direction",
-                "timestamp",
-                "from_me",
-                "status",
-                "has_media",
-                "quoted_message",
-                "quoted_message_content",
-                "creation",
-            ],
-            order_by="timestamp desc",
-            limit=limit,
-            start=offset,
-        )
+        limit = cint(limit) or 50
+
+        # Obtener mensajes desde DocType WhatsApp Message (índice conversation, timestamp, name)
+        params = {"conversation": conversation_id, "limit": limit + 1, "offset": 0 if (before or after) else cint(offset)}
+        cursor_condition, order_by, ascending = build_keyset_clause(params, before=before, after=after)
+        conditions = ["conversation = %(conversation)s"]
+        if cursor_condition:
+            conditions.append(cursor_condition)
+
+        # Mismas restricciones que frappe.get_all (User Permissions y permission_query_conditions)
+        permission_conditions = frappe.build_match_conditions("WhatsApp Message")
+        if permission_conditions:
+            conditions.append(f"({permission_conditions})")
+
+        rows = frappe.db.sql(f"""
+            SELECT name, message_id, content, message_type, direction, timestamp, from_me,
+                status, has_media, quoted_message, quoted_message_content, creation
+            FROM `tabWhatsApp Message`
+            WHERE {" AND ".join(conditions)}
+            ORDER BY {order_by}
+            LIMIT %(limit)s OFFSET %(offset)s
+        """, params, as_dict=True)
 
         # Mostrar en orden cronológico ascendente en el frontend
-        messages = list(reversed(messages))
+        page = paginate_rows(rows, limit, ascending)
+        messages = page["messages"]
+
+        # Media de la página en una sola consulta: la lista usa la miniatura,
+        # no el archivo completo
+        media_by_message = _get_media_previews([msg.name for msg in messages if msg.has_media])
 
         # Enriquecer mensajes con información adicional
         enriched_messages = []
@@ -749,7 +627,8 @@ def get_messages(conversation_id: str, limit: int = 50, offset: int = 0) -> Dict
                 "quoted_message": msg.quoted_message,
                 "quoted_message_content": msg.quoted_message_content,
                 "creation": msg.creation,
-                "time_ago": time_ago
+                "time_ago": time_ago,
+                "media": media_by_message.get(msg.name, [])
             }
             enriched_messages.append(enriched_msg)
 
@@ -757,6 +636,9 @@ def get_messages(conversation_id: str, limit: int = 50, offset: int = 0) -> Dict
             "success": True,
             "messages": enriched_messages,
             "total": len(enriched_messages),
+            "has_more": page["has_more"],
+            "next_cursor": page["next_cursor"],
+            "latest_cursor": page["latest_cursor"],
             "conversation_name": conversation.contact_name,
             "conversation_phone": conversation.phone_number
         }
@@ -772,18 +654,20 @@ def get_messages(conversation_id: str, limit: int = 50, offset: int = 0) -> Dict
 
 
 @frappe.whitelist()
-def send_message_with_media(conversation_id: str, content: str, file_path: str, media_type: str = None) -> Dict[str, Any]:
+def send_message_with_media(conversation_id: str, content: str, file_path: str, media_type: str = None,
+                            priority: str = "agent") -> Dict[str, Any]:
     """
-    Envía un mensaje con archivo adjunto a una conversación.
+    Guarda un mensaje con archivo adjunto y lo pone en la cola de envío.
 
     Args:
         conversation_id: ID de la conversación
         content: Contenido del mensaje (caption)
         file_path: Ruta del archivo en Frappe
         media_type: Tipo de media (opcional, se detecta automáticamente)
+        priority: "agent" (por defecto) o "bulk" para envíos masivos
 
     Returns:
-        Dict con resultado del envío
+        Dict con resultado del encolado
     """
     try:
         # Validar y procesar archivo
@@ -797,212 +681,63 @@ def send_message_with_media(conversation_id: str, content: str, file_path: str,
 
         # Obtener conversación y sesión
         conversation = frappe.get_doc("WhatsApp Conversation", conversation_id)
-        session = frappe.get_doc("WhatsApp Session", conversation.session)
+        session = _get_connected_session(conversation.session)
 
-        if not session.is_connected:
-            try:
-                from .session_status import get_session_status as refresh_session_status
-                status_result = refresh_session_status(session_name=session.name)
-                if status_result.get("success"):
-                    session.reload()
-            except Exception:
-                pass
-
-        if not session.is_connected:
+        if not session:
             return {
                 "success": False,
                 "message": "La sesión no está conectada"
             }
 
-        # Preparar datos para envío
-        client = WhatsAppAPIClient(session.session_id)
-
-        # Determinar identificador del destinatario
-        to_number = conversation.phone_number or conversation.chat_id
-        if to_number:
-            normalized = to_number.replace("+", "").replace(" ", "")
-            if "@" not in normalized:
-                to_number = f"{normalized}@s.whatsapp.net"
-            else:
-                to_number = normalized.replace("@c.us", "@s.whatsapp.net")
-
-        # Enviar mensaje con media al servidor externo
-        # Según documentación Baileys: usar /api/messages/{sessionId}/send con estructura específica
+        # Según documentación Baileys: /api/messages/{sessionId}/send con estructura específica
         file_url = frappe.utils.get_url() + media_info["file_path"]
-
-        # Construir mensaje según tipo de media según documentación Baileys
-        message_payload = {}
         caption_text = content.strip() if content and content.strip() else ""
 
-        # Si no hay caption, usar el nombre del archivo como contenido para evitar errores de validación
-        # Esto es solo para evitar el error "Message content is required" del servidor
+        # Sin caption se muestra el nombre del archivo en la conversación
         display_content = caption_text if caption_text else f"📎 {media_info['filename']}"
 
+        message_payload = {}
         if media_info["media_type"] == "image":
             message_payload["image"] = {"url": file_url}
-            if caption_text:
-                message_payload["caption"] = caption_text
         elif media_info["media_type"] == "video":
             message_payload["video"] = {"url": file_url}
-            if caption_text:
-                message_payload["caption"] = caption_text
         elif media_info["media_type"] in ["audio", "voice"]:
             message_payload["audio"] = {"url": file_url}
             message_payload["ptt"] = (media_info["media_type"] == "voice")
-        elif media_info["media_type"] == "document":
-            message_payload["document"] = {
-                "url": file_url,
-                "fileName": media_info["filename"],
-                "mimetype": media_info["mimetype"]
-            }
-            if caption_text:
-                message_payload["caption"] = caption_text
         else:
-            # Por defecto, tratar como documento
+            # Documentos y, por defecto, cualquier otro tipo
             message_payload["document"] = {
                 "url": file_url,
                 "fileName": media_info["filename"],
                 "mimetype": media_info["mimetype"]
             }
-            if caption_text:
-                message_payload["caption"] = caption_text
-
-        send_data = {
-            "to": to_number,
-            "message": message_payload,
-            "type": media_info["media_type"]
-        }
-
-        # Log para debugging
-        frappe.logger().info(f"Sending media message - type: {media_info['media_type']}, filename: {media_info['filename']}, mimetype: {media_info['mimetype']}, has_caption: {bool(caption_text)}")
-
-        response = client.post(f"/api/messages/{session.session_id}/send", data=send_data)
-
-        # Manejar respuesta: si hay error pero el archivo puede haberse enviado
-        # (algunos servidores devuelven error de validación pero envían el archivo)
-        error_message = response.get('message', '')
-        is_content_error = 'content is required' in error_message.lower() or 'message content' in error_message.lower()
-        file_sent_despite_error = False
-
-        if not response.get("success"):
-            # Si es un error de "content required" pero el archivo puede haberse enviado,
-            # intentar guardar el mensaje de todas formas (el webhook lo confirmará)
-            if is_content_error:
-                frappe.logger().warning(f"Baileys returned content error but file may have been sent: {error_message}")
-                # Marcar que el archivo puede haberse enviado a pesar del error
-                file_sent_despite_error = True
-                # Continuar para guardar el mensaje de todas formas
-                # El webhook confirmará si realmente se envió
-            else:
-                return {
-                    "success": False,
-                    "message": f"Error al enviar mensaje con media: {error_message}"
-                }
-
-        # Guardar mensaje en DocType (incluso si hubo error de content pero el archivo se envió)
-        payload = response.get("data") or {}
-        message_data = payload.get("message") if isinstance(payload, dict) else response.get("message", {})
-
-        # Si hubo error de content pero el archivo se envió, generar un ID temporal
-        # El webhook lo actualizará con el ID real cuando llegue
-        if file_sent_despite_error and not message_data.get("id"):
-            message_id = f"temp-{frappe.generate_hash(length=20)}"
-            frappe.logger().info(f"Generated temporary message ID for file sent despite content error: {message_id}")
-        else:
-            message_id = (
-                message_data.get("id", {}).get("_serialized")
-                if isinstance(message_data.get("id"), dict)
-                else message_data.get("id")
-            ) or payload.get("messageId") or response.get("messageId") or frappe.generate_hash(length=20)
-
-        # Crear documento WhatsApp Message
-        # Usar display_content que incluye nombre de archivo si no hay caption
-        message_content = display_content if 'display_content' in locals() else (content if content else f"📎 {media_info['filename']}")
-
-        message_doc = frappe.get_doc({
-            "doctype": "WhatsApp Message",
-            "session": session.name,
-            "conversation": conversation_id,
-            "contact": conversation.contact,
-            "message_id": message_id,
-            "content": message_content,
-            "direction": "Outgoing",
-            "message_type": media_info["media_type"],
-            "status": "sent",
-            "timestamp": frappe.utils.now_datetime(),
-            "from_number": session.phone_number,
-            "to_number": to_number,
-            "from_me": True,
-            "has_media": True,
-            "is_forwarded": False,
-            "is_starred": False,
-            "is_status": False
-        })
-
-        # Agregar información del archivo
-        message_doc.append("media_items", {
-            "media_type": media_info["media_type"],
-            "file": media_info["file_path"],
-            "filename": media_info["filename"],
-            "filesize": media_info["filesize"],
-            "mimetype": media_info["mimetype"]
-        })
-
-        message_doc.insert(ignore_permissions=True)
-
-        # Actualizar estadísticas de la sesión
-        frappe.db.set_value("WhatsApp Session", session.name, "total_messages_sent",
-                           (session.total_messages_sent or 0) + 1)
-
-        # Actualizar última actividad de la conversación
-        now_ts = frappe.utils.now_datetime()
-        # Usar message_content que ya tiene el nombre del archivo si no hay caption
-        last_message_text = message_content if 'message_content' in locals() else (f"📎 {media_info['filename']}" if not content else content)
-        frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message", last_message_text)
-        frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message_time", now_ts)
-        frappe.db.set_value("WhatsApp Conversation", conversation_id, "total_messages",
-                           (conversation.total_messages or 0) + 1)
 
+        if caption_text and media_info["media_type"] not in ["audio", "voice"]:
+            message_payload["caption"] = caption_text
+
+        message_doc = queue_outgoing_message(
+            conversation,
+            session,
+            message_payload,
+            display_content,
+            message_type=media_info["media_type"],
+            priority=priority,
+            media_items=[{
+                "media_type": media_info["media_type"],
+                "file": media_info["file_path"],
+                "filename": media_info["filename"],
+                "filesize": media_info["filesize"],
+                "mimetype": media_info["mimetype"]
+            }],
+        )
         frappe.db.commit()
 
-        payload = {
-            "session": session.name,
-            "conversation": conversation_id,
-            "conversation_id": conversation_id,
-            "message_id": message_doc.name,
-            "message": message_content if 'message_content' in locals() else display_content,
-            "content": message_content if 'message_content' in locals() else display_content,
+        response = queued_response(message_doc, "Mensaje con archivo en cola de envío")
+        response.update({
             "media_type": media_info["media_type"],
             "filename": media_info["filename"],
-            "from": session.phone_number,
-            "direction": "outgoing",
-            "timestamp": now_ts.isoformat() if hasattr(now_ts, "isoformat") else str(now_ts),
-            "status": "sent"
-        }
-
-        frappe.publish_realtime("whatsapp_message", payload, user="*")
-        frappe.publish_realtime("whatsapp_message_sent", payload, user="*")
-
-        # Si el archivo se envió a pesar del error de content, marcar como éxito
-        # El mensaje ya está guardado en la BD y aparecerá en la conversación
-        success_message = "Mensaje con archivo enviado correctamente"
-        if file_sent_despite_error:
-            success_message = f"Mensaje con archivo enviado (advertencia del servidor: {error_message})"
-
-        return {
-            "success": True,  # Siempre True porque el mensaje se guardó
-            "message": success_message,
-            "content": message_content if 'message_content' in locals() else display_content,
-            "message_id": message_id,
-            "whatsapp_message": message_doc.name,
-            "conversation_id": conversation_id,
-            "media_type": media_info["media_type"],
-            "filename": media_info["filename"],
-            "timestamp": now_ts.isoformat() if hasattr(now_ts, "isoformat") else str(now_ts),
-            "direction": "Outgoing",
-            "status": "sent",
-            "warning": error_message if file_sent_despite_error else None  # Incluir warning si hubo error de content
-        }
+        })
+        return response
 
     except Exception as e:
         frappe.log_error(f"Error sending message with media: {str(e)}")
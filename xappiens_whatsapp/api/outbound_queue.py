@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cola de envío de mensajes salientes.
+
+Las funciones de envío (send_message, send_message_with_media, portal_send_*,
+send_message_smart) no llaman al servidor de WhatsApp desde la petición web:
+guardan el WhatsApp Message en "Pending" con el cuerpo de la petición en
+`send_payload` y lo envía un job por sesión:
+
+- Cada sesión tiene un solo job (job_id fijo y lock en Redis), así que sus
+  mensajes salen de uno en uno: primero por `send_priority` (respuestas de
+  agentes antes que envíos masivos) y después por antigüedad.
+- Antes de cada envío se consume un token del límite de la sesión
+  (`utils.rate_limit`). Las esperas cortas se hacen dentro del job; si está
+  agotado el límite por hora o por día el job termina y la tarea programada
+  `schedule_outbound_sends` lo relanza cada minuto.
+- Los fallos transitorios (timeouts, 5xx, 429) se reintentan con espera
+  exponencial (`next_send_at`) hasta MAX_SEND_ATTEMPTS; los errores 4xx marcan
+  el mensaje como "Failed". Mientras la sesión está desconectada los mensajes
+  esperan, y caducan a las QUEUE_EXPIRY_HOURS.
+- Un mensaje está en la cola mientras está "Pending" con `send_priority` > 0.
+  Al enviarse o fallar `send_priority` vuelve a 0, así que ningún cambio de
+  estado posterior (p. ej. un webhook atrasado) puede volver a encolarlo.
+- Cada cambio de estado (Sent, Failed y los Delivered/Read que llegan por
+  webhook) se publica en realtime como `whatsapp_message_status` y se notifica
+  al método de `status_callback` del mensaje, si tiene. Solo se admiten los
+  callbacks registrados en el hook `whatsapp_message_status_callbacks`.
+"""
+
+import time
+import frappe
+from typing import Dict, Any, List, Optional
+from frappe.utils import add_to_date, cint, now_datetime
+from .base import WhatsAppAPIClient
+from xappiens_whatsapp.utils.locks import acquire_lock, is_locked, release_lock
+from xappiens_whatsapp.utils.rate_limit import acquire_send_token, get_send_limits, get_send_tokens
+
+
+PRIORITY_AGENT = 20
+PRIORITY_BULK = 10
+PRIORITIES = {"agent": PRIORITY_AGENT, "bulk": PRIORITY_BULK}
+# message_id provisional hasta que el servidor devuelve el real
+PENDING_ID_PREFIX = "pending-"
+DEFAULT_WORKER_QUEUE = "short"
+MAX_SEND_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 15
+MAX_RETRY_DELAY = 30 * 60
+# Esperas por token más largas que esto no se hacen dentro del job
+MAX_INLINE_WAIT = 10
+WORKER_TIMEOUT = 600
+SEND_MARGIN = 120
+QUEUE_EXPIRY_HOURS = 24
+# Orden de los estados de un mensaje saliente: nunca se vuelve a uno anterior
+STATUS_RANK = {"Pending": 0, "Sent": 1, "Delivered": 2, "Read": 3}
+
+
+def _get_worker_queue() -> str:
+    return frappe.db.get_single_value("WhatsApp Settings", "outbound_worker_queue") or DEFAULT_WORKER_QUEUE
+
+
+def get_status_callbacks() -> set:
+    """Métodos admitidos como `status_callback` (hook `whatsapp_message_status_callbacks`)."""
+    return set(frappe.get_hooks("whatsapp_message_status_callbacks") or [])
+
+
+def format_recipient(conversation) -> Optional[str]:
+    """JID del destinatario de una conversación (número@s.whatsapp.net o grupo)."""
+    to_number = conversation.phone_number or conversation.chat_id
+    if not to_number:
+        return None
+
+    normalized = to_number.replace("+", "").replace(" ", "")
+    if "@" not in normalized:
+        return f"{normalized}@s.whatsapp.net"
+    return normalized.replace("@c.us", "@s.whatsapp.net")
+
+
+def queue_outgoing_message(
+    conversation,
+    session,
+    message: Any,
+    content: str,
+    message_type: str = "text",
+    priority: str = "agent",
+    media_items: Optional[List[Dict[str, Any]]] = None,
+    status_callback: Optional[str] = None,
+    schedule: bool = True
+):
+    """
+    Guarda un mensaje saliente en "Pending" y programa su envío.
+
+    Args:
+        conversation: Documento WhatsApp Conversation
+        session: Documento WhatsApp Session
+        message: Campo `message` del cuerpo de envío (texto o dict de Baileys)
+        content: Texto que se muestra en la conversación
+        message_type: Tipo de mensaje (text, image, video, location...)
+        priority: "agent" (respuestas, por defecto) o "bulk" (envíos masivos)
+        media_items: Filas de WhatsApp Message Media del mensaje
+        status_callback: Ruta con puntos de un método que recibe
+            (message, status, error) en cada cambio de estado
+        schedule: Programar el job de envío; al encolar muchos mensajes de
+            golpe se programa una sola vez con `schedule_sender`
+
+    Returns:
+        Documento WhatsApp Message creado
+    """
+    if priority not in PRIORITIES:
+        frappe.throw(f"Prioridad de envío no válida: {priority}")
+    if status_callback and status_callback not in get_status_callbacks():
+        frappe.throw(f"Callback de estado no registrado: {status_callback}")
+
+    to_number = format_recipient(conversation)
+    message_doc = frappe.get_doc({
+        "doctype": "WhatsApp Message",
+        "session": session.name,
+        "conversation": conversation.name,
+        "contact": conversation.contact,
+        "message_id": f"{PENDING_ID_PREFIX}{frappe.generate_hash(length=20)}",
+        "content": content,
+        "direction": "Outgoing",
+        "message_type": message_type,
+        "status": "Pending",
+        "timestamp": now_datetime(),
+        "from_number": session.phone_number,
+        "to_number": to_number,
+        "from_me": True,
+        "has_media": bool(media_items),
+        "is_forwarded": False,
+        "is_starred": False,
+        "is_status": False,
+        "send_priority": PRIORITIES[priority],
+        "send_attempts": 0,
+        "send_payload": {"to": to_number, "message": message, "type": message_type},
+        "status_callback": status_callback,
+    })
+    for item in media_items or []:
+        message_doc.append("media_items", item)
+
+    # after_insert actualiza el último mensaje y los contadores de la conversación
+    message_doc.insert(ignore_permissions=True)
+
+    # En los envíos masivos no se avisa mensaje a mensaje a todos los usuarios
+    if priority == "agent":
+        frappe.publish_realtime("whatsapp_message", _realtime_payload(message_doc, session), user="*")
+
+    if schedule:
+        schedule_sender(session.name)
+    return message_doc
+
+
+def _realtime_payload(message_doc, session) -> Dict[str, Any]:
+    timestamp = message_doc.timestamp
+    payload = {
+        "session": message_doc.session,
+        "conversation": message_doc.conversation,
+        "conversation_id": message_doc.conversation,
+        "message_id": message_doc.name,
+        "message": message_doc.content,
+        "content": message_doc.content,
+        "from": session.phone_number,
+        "direction": "outgoing",
+        "timestamp": timestamp.isoformat() if hasattr(timestamp, "isoformat") else str(timestamp),
+        "status": message_doc.status,
+    }
+    if message_doc.media_items:
+        payload["media_type"] = message_doc.media_items[0].media_type
+        payload["filename"] = message_doc.media_items[0].filename
+    return payload
+
+
+def queued_response(message_doc, success_message: str) -> Dict[str, Any]:
+    """Respuesta común de las funciones de envío para un mensaje encolado."""
+    timestamp = message_doc.timestamp
+    return {
+        "success": True,
+        "message": success_message,
+        "content": message_doc.content,
+        "message_id": message_doc.message_id,
+        "whatsapp_message": message_doc.name,
+        "conversation_id": message_doc.conversation,
+        "timestamp": timestamp.isoformat() if hasattr(timestamp, "isoformat") else str(timestamp),
+        "direction": "Outgoing",
+        "status": "Pending",
+        "queued": True,
+    }
+
+
+def schedule_sender(session: str, queue: Optional[str] = None):
+    """Encola el job de envío de la sesión (uno como mucho) tras el commit."""
+    frappe.enqueue(
+        "xappiens_whatsapp.api.outbound_queue.process_outbound_queue",
+        queue=queue or _get_worker_queue(),
+        timeout=WORKER_TIMEOUT,
+        job_id=f"whatsapp_outbound::{frappe.local.site}::{session}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        session=session,
+    )
+
+
+def _sender_lock_key(session: str) -> str:
+    return f"outbound_send:{session}"
+
+
+def _next_ready(session: str) -> Optional[Dict[str, Any]]:
+    """Siguiente mensaje listo de la sesión: mayor prioridad y más antiguo."""
+    rows = frappe.db.sql("""
+        SELECT name, send_priority
+        FROM `tabWhatsApp Message`
+        WHERE status = 'Pending' AND send_priority > 0 AND session = %s
+            AND (next_send_at IS NULL OR next_send_at <= %s)
+        ORDER BY send_priority DESC, creation ASC
+        LIMIT 1
+    """, (session, now_datetime()), as_dict=True)
+    return rows[0] if rows else None
+
+
+def process_outbound_queue(session: str):
+    """
+    Job en segundo plano: envía los mensajes pendientes de una sesión hasta
+    vaciar su cola, agotar el límite de envío o agotar su tiempo.
+
+    Args:
+        session: Nombre del documento WhatsApp Session
+    """
+    token = acquire_lock(_sender_lock_key(session), timeout=WORKER_TIMEOUT)
+    if not token:
+        return
+
+    try:
+        session_doc = frappe.db.get_value(
+            "WhatsApp Session", session, ["name", "session_id", "is_connected", "phone_number"], as_dict=True
+        )
+        # Desconectada: los mensajes esperan a que se reconecte (o a caducar)
+        if not session_doc or not session_doc.is_connected:
+            return
+
+        limits = get_send_limits()
+        deadline = time.monotonic() + WORKER_TIMEOUT - SEND_MARGIN
+
+        while time.monotonic() < deadline:
+            row = _next_ready(session)
+            if not row:
+                break
+
+            wait = acquire_send_token(session, bulk=row.send_priority < PRIORITY_AGENT, limits=limits)
+            if wait > MAX_INLINE_WAIT:
+                break
+            if wait > 0:
+                time.sleep(wait)
+                continue
+
+            sent = _send(row.name, session_doc)
+            frappe.db.commit()
+            # Con el servidor caído no se sigue probando mensaje a mensaje
+            if not sent:
+                break
+
+    finally:
+        release_lock(_sender_lock_key(session), token)
+
+
+def _send(name: str, session_doc: Dict[str, Any]) -> bool:
+    """
+    Envía un mensaje de la cola y guarda el resultado.
+
+    Returns:
+        False si el envío falló por un error transitorio y se reintentará
+    """
+    message = frappe.db.get_value(
+        "WhatsApp Message",
+        name,
+        ["name", "status", "conversation", "send_payload", "send_attempts", "status_callback"],
+        as_dict=True,
+        for_update=True,
+    )
+    if not message or message.status != "Pending":
+        return True
+
+    # El intento cuenta aunque el worker caiga durante la petición
+    attempts = cint(message.send_attempts) + 1
+    frappe.db.set_value("WhatsApp Message", name, "send_attempts", attempts, update_modified=False)
+    frappe.db.commit()
+
+    payload = frappe.parse_json(message.send_payload) or {}
+    try:
+        client = WhatsAppAPIClient(session_doc.session_id)
+        response = client.post(f"/api/messages/{session_doc.session_id}/send", data=payload, use_session_id=False)
+    except Exception as e:
+        response = {"success": False, "status_code": None, "message": str(e)}
+
+    return _record_send_result(message, attempts, payload, response, session_doc)
+
+
+def _is_content_error(payload: Dict[str, Any], response: Dict[str, Any]) -> bool:
+    """
+    Baileys responde "Message content is required" a algunos envíos de media
+    sin caption aunque el archivo sí se envía; el webhook confirma el envío.
+    """
+    error_message = (response.get("message") or "").lower()
+    return payload.get("type") != "text" and ("content is required" in error_message or "message content" in error_message)
+
+
+def _extract_message_id(response: Dict[str, Any]) -> Optional[str]:
+    data = response.get("data") or {}
+    message_data = data.get("message") if isinstance(data, dict) else None
+    message_data = message_data if isinstance(message_data, dict) else {}
+    message_id = message_data.get("id")
+    if isinstance(message_id, dict):
+        message_id = message_id.get("_serialized")
+    return message_id or (data.get("messageId") if isinstance(data, dict) else None) or response.get("messageId")
+
+
+def _retry_delay(attempts: int) -> int:
+    """Espera antes del reintento número `attempts` (15 s, 30 s, 60 s...)."""
+    return min(RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), MAX_RETRY_DELAY)
+
+
+def _record_send_result(message: Dict[str, Any], attempts: int, payload: Dict[str, Any],
+                        response: Dict[str, Any], session_doc: Dict[str, Any]) -> bool:
+    """
+    Marca el mensaje como enviado o programa el reintento / el fallo.
+
+    Returns:
+        False si se reintentará más tarde
+    """
+    if response.get("success") or _is_content_error(payload, response):
+        _mark_sent(message, _extract_message_id(response), session_doc)
+        return True
+
+    error = (response.get("message") or "Error desconocido")[:1000]
+    status_code = response.get("status_code")
+    retry = (status_code is None or status_code == 429 or status_code >= 500) and attempts < MAX_SEND_ATTEMPTS
+
+    if retry:
+        frappe.db.set_value("WhatsApp Message", message.name, {
+            "error_message": error,
+            "next_send_at": add_to_date(now_datetime(), seconds=_retry_delay(attempts)),
+        }, update_modified=False)
+        return False
+
+    fail_queued_message(message, error)
+    return True
+
+
+def fail_queued_message(message: Dict[str, Any], error: str):
+    """
+    Saca un mensaje de la cola como "Failed" y lo notifica.
+
+    Args:
+        message: Dict con name, conversation y status_callback del WhatsApp Message
+        error: Motivo del fallo
+    """
+    frappe.db.set_value("WhatsApp Message", message.name, {
+        "status": "Failed",
+        "error_message": error,
+        "next_send_at": None,
+        "send_priority": 0,
+    })
+    notify_message_status(message.name, "Failed", error, message.conversation, message.status_callback)
+
+
+def _mark_sent(message: Dict[str, Any], message_id: Optional[str], session_doc: Dict[str, Any]):
+    values = {"status": "Sent", "sent_at": now_datetime(), "error_message": None, "next_send_at": None, "send_priority": 0}
+
+    if message_id:
+        # El eco del webhook puede haber llegado antes que la respuesta y creado su propio mensaje
+        echo = frappe.db.get_value(
+            "WhatsApp Message", {"message_id": message_id, "name": ["!=", message.name]}, "name"
+        )
+        if echo:
+            frappe.delete_doc("WhatsApp Message", echo, ignore_permissions=True, force=True)
+        values["message_id"] = message_id
+
+    frappe.db.set_value("WhatsApp Message", message.name, values)
+    frappe.db.sql("""
+        UPDATE `tabWhatsApp Session`
+        SET total_messages_sent = IFNULL(total_messages_sent, 0) + 1
+        WHERE name = %s
+    """, (session_doc.name,))
+
+    sent = frappe.db.get_value(
+        "WhatsApp Message", message.name, ["name", "session", "conversation", "content", "timestamp", "status"], as_dict=True
+    )
+    payload = {
+        "session": sent.session,
+        "conversation": sent.conversation,
+        "conversation_id": sent.conversation,
+        "message_id": sent.name,
+        "whatsapp_message_id": message_id,
+        "message": sent.content,
+        "content": sent.content,
+        "from": session_doc.phone_number,
+        "direction": "outgoing",
+        "timestamp": sent.timestamp.isoformat() if hasattr(sent.timestamp, "isoformat") else str(sent.timestamp),
+        "status": "Sent",
+    }
+    frappe.publish_realtime("whatsapp_message_sent", payload, user="*")
+    notify_message_status(message.name, "Sent", None, message.conversation, message.status_callback)
+
+
+def notify_message_status(message: str, status: str, error: Optional[str] = None,
+                          conversation: Optional[str] = None, callback: Optional[str] = None):
+    """
+    Publica el cambio de estado de un mensaje saliente y llama a su callback.
+    Un callback que falla se registra en el Error Log sin afectar al envío.
+
+    Args:
+        message: Nombre del documento WhatsApp Message
+        status: Nuevo estado (Sent, Delivered, Read, Failed)
+        error: Error del envío, si falló
+        conversation: Conversación del mensaje
+        callback: Ruta con puntos del método a notificar
+    """
+    frappe.publish_realtime("whatsapp_message_status", {
+        "message_id": message,
+        "conversation_id": conversation,
+        "status": status,
+        "error": error,
+    }, user="*")
+
+    if not callback:
+        return
+
+    if callback not in get_status_callbacks():
+        frappe.log_error(f"Callback {callback} del mensaje {message} no registrado; se ignora", "WhatsApp Outbound Callback")
+        return
+
+    try:
+        frappe.get_attr(callback)(message=message, status=status, error=error)
+    except Exception as e:
+        frappe.log_error(f"Error en el callback {callback} del mensaje {message}: {str(e)}", "WhatsApp Outbound Callback")
+
+
+def schedule_outbound_sends():
+    """
+    Tarea programada (cada minuto): relanza el job de las sesiones con
+    mensajes listos (reintentos cuya espera ha vencido, límites que se han
+    recuperado, sesiones reconectadas) y da por fallidos los mensajes que
+    llevan más de QUEUE_EXPIRY_HOURS en cola.
+    """
+    expired = frappe.db.sql("""
+        SELECT name, conversation, status_callback
+        FROM `tabWhatsApp Message`
+        WHERE status = 'Pending' AND send_priority > 0 AND creation < %s
+    """, (add_to_date(now_datetime(), hours=-QUEUE_EXPIRY_HOURS),), as_dict=True)
+
+    for row in expired:
+        fail_queued_message(row, "No se pudo enviar: el mensaje ha caducado en la cola de envío")
+    frappe.db.commit()
+
+    sessions = frappe.db.sql_list("""
+        SELECT DISTINCT m.session
+        FROM `tabWhatsApp Message` m
+        INNER JOIN `tabWhatsApp Session` s ON s.name = m.session
+        WHERE m.status = 'Pending' AND m.send_priority > 0
+            AND (m.next_send_at IS NULL OR m.next_send_at <= %s)
+            AND s.is_connected = 1
+    """, (now_datetime(),))
+
+    queue = _get_worker_queue()
+    for session in sessions:
+        if not is_locked(_sender_lock_key(session)):
+            schedule_sender(session, queue)
+
+
+@frappe.whitelist()
+def retry_failed_messages(names: Optional[List[str]] = None, priority: str = "agent") -> Dict[str, Any]:
+    """
+    Vuelve a encolar mensajes salientes fallidos.
+
+    Args:
+        names: WhatsApp Message a reintentar (por defecto, todos los fallidos de la cola)
+        priority: Prioridad con la que vuelven a la cola ("agent" o "bulk")
+
+    Returns:
+        Dict con el número de mensajes reencolados
+    """
+    frappe.only_for(["System Manager", "WhatsApp Manager"])
+
+    if priority not in PRIORITIES:
+        frappe.throw(f"Prioridad de envío no válida: {priority}")
+
+    names = frappe.parse_json(names) if isinstance(names, str) else names
+    # Solo los mensajes que pasaron por la cola tienen send_payload
+    filters = {"status": "Failed", "direction": "Outgoing", "send_payload": ["is", "set"]}
+    if names:
+        filters["name"] = ["in", names]
+
+    failed = frappe.get_all("WhatsApp Message", filters=filters, fields=["name", "session"])
+    if failed:
+        frappe.db.sql("""
+            UPDATE `tabWhatsApp Message`
+            SET status = 'Pending', send_priority = %s, send_attempts = 0, next_send_at = NULL, error_message = NULL
+            WHERE name IN %s AND status = 'Failed'
+        """, (PRIORITIES[priority], tuple(row.name for row in failed)))
+        for session in {row.session for row in failed}:
+            schedule_sender(session)
+
+    return {"success": True, "requeued": len(failed)}
+
+
+@frappe.whitelist()
+def get_outbound_queue_status() -> Dict[str, Any]:
+    """
+    Estado de la cola de envío: mensajes pendientes por sesión y prioridad,
+    tokens disponibles de cada sesión y los últimos fallos.
+
+    Returns:
+        Dict con limits, sessions y recent_failures
+    """
+    frappe.only_for(["System Manager", "WhatsApp Manager"])
+
+    sessions = frappe.db.sql("""
+        SELECT
+            session,
+            SUM(send_priority >= %s) AS agent,
+            SUM(send_priority < %s) AS bulk,
+            SUM(send_attempts > 0) AS retrying,
+            TIMESTAMPDIFF(SECOND, MIN(creation), NOW()) AS lag_seconds
+        FROM `tabWhatsApp Message`
+        WHERE status = 'Pending' AND send_priority > 0
+        GROUP BY session
+        ORDER BY lag_seconds DESC
+    """, (PRIORITY_AGENT, PRIORITY_AGENT), as_dict=True)
+
+    for row in sessions:
+        row.sending = is_locked(_sender_lock_key(row.session))
+        row.tokens = get_send_tokens(row.session)
+
+    recent_failures = frappe.get_all(
+        "WhatsApp Message",
+        filters={"status": "Failed", "direction": "Outgoing", "send_payload": ["is", "set"]},
+        fields=["name", "session", "conversation", "send_attempts", "error_message", "modified"],
+        order_by="modified desc",
+        limit=20,
+    )
+
+    limits = get_send_limits()
+    return {
+        "success": True,
+        "limits": {window: capacity for window, capacity, _period in limits["windows"]},
+        "agent_reserve": limits["agent_reserve"],
+        "sessions": sessions,
+        "recent_failures": recent_failures,
+    }
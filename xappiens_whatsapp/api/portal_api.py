@@ -9,8 +9,10 @@ from typing import Dict, Any, Optional
 from .base import WhatsAppAPIClient
 from .session import get_session_status, get_qr_code, disconnect_session, _resolve_session_doc
 from .messages import send_message, send_message_with_media
-import requests
+from .outbound_queue import queue_outgoing_message, queued_response
 from xappiens_whatsapp.utils.settings import get_api_credentials, get_api_base_url
+from xappiens_whatsapp.utils import transport
+from xappiens_whatsapp.utils.conversation_stats import invalidate_conversation_stats
 
 
 # ==================== SESIONES ====================
@@ -62,7 +64,7 @@ def portal_connect_session(session_id: str):
             }
 
         # Llamar al endpoint de conexión de Baileys
-        response = requests.post(
+        response = transport.post(
             f"{api_base_url}/api/sessions/{session_identifier}/connect",
             headers={
                 "X-API-Key": settings.get('api_key'),
@@ -138,7 +140,7 @@ def portal_restart_session(session_id: str):
             }
 
         # Llamar al endpoint de reinicio de Baileys
-        response = requests.post(
+        response = transport.post(
             f"{api_base_url}/api/sessions/{session_identifier}/restart",
             headers={
                 "X-API-Key": settings.get('api_key'),
@@ -195,6 +197,35 @@ def portal_send_message(
         return send_message(conversation_id, message, message_type)
 
 
+def _queue_portal_message(
+    conversation_id: str,
+    message: Dict[str, Any],
+    content: str,
+    message_type: str,
+    success_message: str,
+    media_items: Optional[list] = None
+) -> Dict[str, Any]:
+    """
+    Pone en la cola de envío un mensaje del portal (ver outbound_queue).
+    El estado final del envío llega por realtime (whatsapp_message_status).
+    """
+    conversation = frappe.get_doc("WhatsApp Conversation", conversation_id)
+    session = frappe.get_doc("WhatsApp Session", conversation.session)
+
+    if not session.is_connected:
+        return {
+            "success": False,
+            "message": "La sesión no está conectada"
+        }
+
+    message_doc = queue_outgoing_message(
+        conversation, session, message, content, message_type=message_type, media_items=media_items
+    )
+    frappe.db.commit()
+
+    return queued_response(message_doc, success_message)
+
+
 @frappe.whitelist()
 def portal_send_video(
     conversation_id: str,
@@ -203,92 +234,23 @@ def portal_send_video(
 ) -> Dict[str, Any]:
     """
     Enviar video usando la API de Baileys
-    POST /api/messages/{sessionId}/send con type=video
+    POST /api/messages/{sessionId}/send con type=video (a través de la cola de envío)
     """
     try:
-        conversation = frappe.get_doc("WhatsApp Conversation", conversation_id)
-        session = frappe.get_doc("WhatsApp Session", conversation.session)
-
-        if not session.is_connected:
-            return {
-                "success": False,
-                "message": "La sesión no está conectada"
-            }
-
-        client = WhatsAppAPIClient(session.session_id)
-
-        # Normalizar número de teléfono
-        to_number = conversation.phone_number or conversation.chat_id
-        if to_number:
-            normalized = to_number.replace("+", "").replace(" ", "")
-            if "@" not in normalized:
-                to_number = f"{normalized}@s.whatsapp.net"
-            else:
-                to_number = normalized.replace("@c.us", "@s.whatsapp.net")
-
-        # Enviar video según documentación de Baileys
-        response = client.post(
-            f"/api/messages/{session.session_id}/send",
-            data={
-                "to": to_number,
-                "message": {
-                    "video": {
-                        "url": video_url
-                    },
-                    "caption": caption or ""
+        return _queue_portal_message(
+            conversation_id,
+            {
+                "video": {
+                    "url": video_url
                 },
-                "type": "video"
+                "caption": caption or ""
             },
-            use_session_id=False
+            caption or "[Video]",
+            "video",
+            "Video en cola de envío",
+            media_items=[{"media_type": "video", "url": video_url}]
         )
 
-        if response.get("success"):
-            # Guardar mensaje en DocType (similar a send_message)
-            payload = response.get("data") or {}
-            message_data = payload.get("message", {})
-            message_id = (
-                message_data.get("id", {}).get("_serialized")
-                if isinstance(message_data.get("id"), dict)
-                else message_data.get("id")
-            ) or payload.get("messageId") or frappe.generate_hash(length=20)
-
-            message_doc = frappe.get_doc({
-                "doctype": "WhatsApp Message",
-                "session": session.name,
-                "conversation": conversation_id,
-                "contact": conversation.contact,
-                "message_id": message_id,
-                "content": caption or "[Video]",
-                "direction": "Outgoing",
-                "message_type": "video",
-                "status": "sent",
-                "timestamp": frappe.utils.now_datetime(),
-                "from_number": session.phone_number,
-                "to_number": to_number,
-                "from_me": True,
-                "has_media": True,
-                "media_url": video_url
-            })
-            message_doc.insert(ignore_permissions=True)
-
-            # Actualizar estadísticas
-            frappe.db.set_value("WhatsApp Session", session.name, "total_messages_sent",
-                               (session.total_messages_sent or 0) + 1)
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message", caption or "[Video]")
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message_time", frappe.utils.now_datetime())
-            frappe.db.commit()
-
-            return {
-                "success": True,
-                "message": "Video enviado correctamente",
-                "message_id": message_id
-            }
-        else:
-            return {
-                "success": False,
-                "message": response.get('message', 'Error enviando video')
-            }
-
     except Exception as e:
         frappe.log_error(f"Error enviando video: {str(e)}", "WhatsApp Portal Send Video")
         return {
@@ -305,92 +267,23 @@ def portal_send_audio(
 ) -> Dict[str, Any]:
     """
     Enviar audio usando la API de Baileys
-    POST /api/messages/{sessionId}/send con type=audio
+    POST /api/messages/{sessionId}/send con type=audio (a través de la cola de envío)
     """
     try:
-        conversation = frappe.get_doc("WhatsApp Conversation", conversation_id)
-        session = frappe.get_doc("WhatsApp Session", conversation.session)
-
-        if not session.is_connected:
-            return {
-                "success": False,
-                "message": "La sesión no está conectada"
-            }
-
-        client = WhatsAppAPIClient(session.session_id)
-
-        # Normalizar número de teléfono
-        to_number = conversation.phone_number or conversation.chat_id
-        if to_number:
-            normalized = to_number.replace("+", "").replace(" ", "")
-            if "@" not in normalized:
-                to_number = f"{normalized}@s.whatsapp.net"
-            else:
-                to_number = normalized.replace("@c.us", "@s.whatsapp.net")
-
-        # Enviar audio según documentación de Baileys
-        response = client.post(
-            f"/api/messages/{session.session_id}/send",
-            data={
-                "to": to_number,
-                "message": {
-                    "audio": {
-                        "url": audio_url
-                    },
-                    "ptt": ptt
+        return _queue_portal_message(
+            conversation_id,
+            {
+                "audio": {
+                    "url": audio_url
                 },
-                "type": "audio"
+                "ptt": ptt
             },
-            use_session_id=False
+            "[Audio]",
+            "audio",
+            "Audio en cola de envío",
+            media_items=[{"media_type": "voice" if ptt else "audio", "url": audio_url}]
         )
 
-        if response.get("success"):
-            # Guardar mensaje en DocType
-            payload = response.get("data") or {}
-            message_data = payload.get("message", {})
-            message_id = (
-                message_data.get("id", {}).get("_serialized")
-                if isinstance(message_data.get("id"), dict)
-                else message_data.get("id")
-            ) or payload.get("messageId") or frappe.generate_hash(length=20)
-
-            message_doc = frappe.get_doc({
-                "doctype": "WhatsApp Message",
-                "session": session.name,
-                "conversation": conversation_id,
-                "contact": conversation.contact,
-                "message_id": message_id,
-                "content": "[Audio]",
-                "direction": "Outgoing",
-                "message_type": "audio",
-                "status": "sent",
-                "timestamp": frappe.utils.now_datetime(),
-                "from_number": session.phone_number,
-                "to_number": to_number,
-                "from_me": True,
-                "has_media": True,
-                "media_url": audio_url
-            })
-            message_doc.insert(ignore_permissions=True)
-
-            # Actualizar estadísticas
-            frappe.db.set_value("WhatsApp Session", session.name, "total_messages_sent",
-                               (session.total_messages_sent or 0) + 1)
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message", "[Audio]")
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message_time", frappe.utils.now_datetime())
-            frappe.db.commit()
-
-            return {
-                "success": True,
-                "message": "Audio enviado correctamente",
-                "message_id": message_id
-            }
-        else:
-            return {
-                "success": False,
-                "message": response.get('message', 'Error enviando audio')
-            }
-
     except Exception as e:
         frappe.log_error(f"Error enviando audio: {str(e)}", "WhatsApp Portal Send Audio")
         return {
@@ -408,29 +301,9 @@ def portal_send_document(
 ) -> Dict[str, Any]:
     """
     Enviar documento usando la API de Baileys
-    POST /api/messages/{sessionId}/send con type=document
+    POST /api/messages/{sessionId}/send con type=document (a través de la cola de envío)
     """
     try:
-        conversation = frappe.get_doc("WhatsApp Conversation", conversation_id)
-        session = frappe.get_doc("WhatsApp Session", conversation.session)
-
-        if not session.is_connected:
-            return {
-                "success": False,
-                "message": "La sesión no está conectada"
-            }
-
-        client = WhatsAppAPIClient(session.session_id)
-
-        # Normalizar número de teléfono
-        to_number = conversation.phone_number or conversation.chat_id
-        if to_number:
-            normalized = to_number.replace("+", "").replace(" ", "")
-            if "@" not in normalized:
-                to_number = f"{normalized}@s.whatsapp.net"
-            else:
-                to_number = normalized.replace("@c.us", "@s.whatsapp.net")
-
         # Detectar mimetype básico
         mimetype = "application/pdf"
         if filename.lower().endswith(('.doc', '.docx')):
@@ -438,71 +311,22 @@ def portal_send_document(
         elif filename.lower().endswith(('.xls', '.xlsx')):
             mimetype = "application/vnd.ms-excel"
 
-        # Enviar documento según documentación de Baileys
-        response = client.post(
-            f"/api/messages/{session.session_id}/send",
-            data={
-                "to": to_number,
-                "message": {
-                    "document": {
-                        "url": document_url,
-                        "fileName": filename,
-                        "mimetype": mimetype
-                    },
-                    "caption": caption or ""
+        return _queue_portal_message(
+            conversation_id,
+            {
+                "document": {
+                    "url": document_url,
+                    "fileName": filename,
+                    "mimetype": mimetype
                 },
-                "type": "document"
+                "caption": caption or ""
             },
-            use_session_id=False
+            caption or filename,
+            "document",
+            "Documento en cola de envío",
+            media_items=[{"media_type": "document", "url": document_url, "filename": filename, "mimetype": mimetype}]
         )
 
-        if response.get("success"):
-            # Guardar mensaje en DocType
-            payload = response.get("data") or {}
-            message_data = payload.get("message", {})
-            message_id = (
-                message_data.get("id", {}).get("_serialized")
-                if isinstance(message_data.get("id"), dict)
-                else message_data.get("id")
-            ) or payload.get("messageId") or frappe.generate_hash(length=20)
-
-            message_doc = frappe.get_doc({
-                "doctype": "WhatsApp Message",
-                "session": session.name,
-                "conversation": conversation_id,
-                "contact": conversation.contact,
-                "message_id": message_id,
-                "content": caption or filename,
-                "direction": "Outgoing",
-                "message_type": "document",
-                "status": "sent",
-                "timestamp": frappe.utils.now_datetime(),
-                "from_number": session.phone_number,
-                "to_number": to_number,
-                "from_me": True,
-                "has_media": True,
-                "media_url": document_url
-            })
-            message_doc.insert(ignore_permissions=True)
-
-            # Actualizar estadísticas
-            frappe.db.set_value("WhatsApp Session", session.name, "total_messages_sent",
-                               (session.total_messages_sent or 0) + 1)
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message", caption or filename)
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message_time", frappe.utils.now_datetime())
-            frappe.db.commit()
-
-            return {
-                "success": True,
-                "message": "Documento enviado correctamente",
-                "message_id": message_id
-            }
-        else:
-            return {
-                "success": False,
-                "message": response.get('message', 'Error enviando documento')
-            }
-
     except Exception as e:
         frappe.log_error(f"Error enviando documento: {str(e)}", "WhatsApp Portal Send Document")
         return {
@@ -521,30 +345,9 @@ def portal_send_location(
 ) -> Dict[str, Any]:
     """
     Enviar ubicación usando la API de Baileys
-    POST /api/messages/{sessionId}/send con type=location
+    POST /api/messages/{sessionId}/send con type=location (a través de la cola de envío)
     """
     try:
-        conversation = frappe.get_doc("WhatsApp Conversation", conversation_id)
-        session = frappe.get_doc("WhatsApp Session", conversation.session)
-
-        if not session.is_connected:
-            return {
-                "success": False,
-                "message": "La sesión no está conectada"
-            }
-
-        client = WhatsAppAPIClient(session.session_id)
-
-        # Normalizar número de teléfono
-        to_number = conversation.phone_number or conversation.chat_id
-        if to_number:
-            normalized = to_number.replace("+", "").replace(" ", "")
-            if "@" not in normalized:
-                to_number = f"{normalized}@s.whatsapp.net"
-            else:
-                to_number = normalized.replace("@c.us", "@s.whatsapp.net")
-
-        # Enviar ubicación según documentación de Baileys
         location_data = {
             "degreesLatitude": latitude,
             "degreesLongitude": longitude
@@ -554,64 +357,16 @@ def portal_send_location(
         if address:
             location_data["address"] = address
 
-        response = client.post(
-            f"/api/messages/{session.session_id}/send",
-            data={
-                "to": to_number,
-                "message": {
-                    "location": location_data
-                },
-                "type": "location"
+        return _queue_portal_message(
+            conversation_id,
+            {
+                "location": location_data
             },
-            use_session_id=False
+            f"📍 {name or 'Ubicación'}",
+            "location",
+            "Ubicación en cola de envío"
         )
 
-        if response.get("success"):
-            # Guardar mensaje en DocType
-            payload = response.get("data") or {}
-            message_data = payload.get("message", {})
-            message_id = (
-                message_data.get("id", {}).get("_serialized")
-                if isinstance(message_data.get("id"), dict)
-                else message_data.get("id")
-            ) or payload.get("messageId") or frappe.generate_hash(length=20)
-
-            message_doc = frappe.get_doc({
-                "doctype": "WhatsApp Message",
-                "session": session.name,
-                "conversation": conversation_id,
-                "contact": conversation.contact,
-                "message_id": message_id,
-                "content": f"📍 {name or 'Ubicación'}",
-                "direction": "Outgoing",
-                "message_type": "location",
-                "status": "sent",
-                "timestamp": frappe.utils.now_datetime(),
-                "from_number": session.phone_number,
-                "to_number": to_number,
-                "from_me": True,
-                "has_media": False
-            })
-            message_doc.insert(ignore_permissions=True)
-
-            # Actualizar estadísticas
-            frappe.db.set_value("WhatsApp Session", session.name, "total_messages_sent",
-                               (session.total_messages_sent or 0) + 1)
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message", f"📍 {name or 'Ubicación'}")
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message_time", frappe.utils.now_datetime())
-            frappe.db.commit()
-
-            return {
-                "success": True,
-                "message": "Ubicación enviada correctamente",
-                "message_id": message_id
-            }
-        else:
-            return {
-                "success": False,
-                "message": response.get('message', 'Error enviando ubicación')
-            }
-
     except Exception as e:
         frappe.log_error(f"Error enviando ubicación: {str(e)}", "WhatsApp Portal Send Location")
         return {
@@ -629,29 +384,9 @@ def portal_send_contact(
 ) -> Dict[str, Any]:
     """
     Enviar contacto usando la API de Baileys
-    POST /api/messages/{sessionId}/send con type=contact
+    POST /api/messages/{sessionId}/send con type=contact (a través de la cola de envío)
     """
     try:
-        conversation = frappe.get_doc("WhatsApp Conversation", conversation_id)
-        session = frappe.get_doc("WhatsApp Session", conversation.session)
-
-        if not session.is_connected:
-            return {
-                "success": False,
-                "message": "La sesión no está conectada"
-            }
-
-        client = WhatsAppAPIClient(session.session_id)
-
-        # Normalizar número de teléfono
-        to_number = conversation.phone_number or conversation.chat_id
-        if to_number:
-            normalized = to_number.replace("+", "").replace(" ", "")
-            if "@" not in normalized:
-                to_number = f"{normalized}@s.whatsapp.net"
-            else:
-                to_number = normalized.replace("@c.us", "@s.whatsapp.net")
-
         # Generar vCard si no se proporciona
         if not vcard:
             vcard = f"""BEGIN:VCARD
@@ -660,72 +395,23 @@ FN:{contact_name}
 TEL;TYPE=CELL:{phone_number}
 END:VCARD"""
 
-        # Enviar contacto según documentación de Baileys
-        response = client.post(
-            f"/api/messages/{session.session_id}/send",
-            data={
-                "to": to_number,
-                "message": {
-                    "contacts": {
-                        "displayName": contact_name,
-                        "contacts": [
-                            {
-                                "vcard": vcard
-                            }
-                        ]
-                    }
-                },
-                "type": "contact"
+        return _queue_portal_message(
+            conversation_id,
+            {
+                "contacts": {
+                    "displayName": contact_name,
+                    "contacts": [
+                        {
+                            "vcard": vcard
+                        }
+                    ]
+                }
             },
-            use_session_id=False
+            f"👤 {contact_name}",
+            "contact",
+            "Contacto en cola de envío"
         )
 
-        if response.get("success"):
-            # Guardar mensaje en DocType
-            payload = response.get("data") or {}
-            message_data = payload.get("message", {})
-            message_id = (
-                message_data.get("id", {}).get("_serialized")
-                if isinstance(message_data.get("id"), dict)
-                else message_data.get("id")
-            ) or payload.get("messageId") or frappe.generate_hash(length=20)
-
-            message_doc = frappe.get_doc({
-                "doctype": "WhatsApp Message",
-                "session": session.name,
-                "conversation": conversation_id,
-                "contact": conversation.contact,
-                "message_id": message_id,
-                "content": f"👤 {contact_name}",
-                "direction": "Outgoing",
-                "message_type": "contact",
-                "status": "sent",
-                "timestamp": frappe.utils.now_datetime(),
-                "from_number": session.phone_number,
-                "to_number": to_number,
-                "from_me": True,
-                "has_media": False
-            })
-            message_doc.insert(ignore_permissions=True)
-
-            # Actualizar estadísticas
-            frappe.db.set_value("WhatsApp Session", session.name, "total_messages_sent",
-                               (session.total_messages_sent or 0) + 1)
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message", f"👤 {contact_name}")
-            frappe.db.set_value("WhatsApp Conversation", conversation_id, "last_message_time", frappe.utils.now_datetime())
-            frappe.db.commit()
-
-            return {
-                "success": True,
-                "message": "Contacto enviado correctamente",
-                "message_id": message_id
-            }
-        else:
-            return {
-                "success": False,
-                "message": response.get('message', 'Error enviando contacto')
-            }
-
     except Exception as e:
         frappe.log_error(f"Error enviando contacto: {str(e)}", "WhatsApp Portal Send Contact")
         return {
@@ -767,6 +453,7 @@ def portal_mark_chat_as_read(conversation_id: str) -> Dict[str, Any]:
         if response.get("success"):
             # Actualizar contador de no leídos en Frappe
             frappe.db.set_value("WhatsApp Conversation", conversation_id, "unread_count", 0)
+            invalidate_conversation_stats(conversation.session)
 
             # Marcar mensajes como leídos en Frappe
             frappe.db.sql("""
@@ -12,6 +12,7 @@ import qrcode
 from typing import Optional
 from datetime import datetime
 from xappiens_whatsapp.utils.settings import get_api_credentials, get_api_base_url
+from xappiens_whatsapp.utils import transport
 from .base import WhatsAppAPIClient
 
 
@@ -78,7 +79,7 @@ def test_connection():
             "Content-Type": "application/json"
         }
 
-        test_response = requests.get(url, headers=headers, timeout=30)
+        test_response = transport.get(url, headers=headers, timeout=30)
 
         if test_response.status_code in [200, 401]:  # 401 es OK, significa que la API responde
             success_msg = "Conexión exitosa con el servidor de WhatsApp (solo API Key)"
@@ -211,7 +212,7 @@ def get_session_status(session_id: Optional[str] = None):
                 "error": "No se encontró ID de sesión válido"
             }
 
-        response = requests.get(
+        response = transport.get(
             status_url,
             headers={
                 "X-API-Key": settings.get('api_key'),
@@ -311,7 +312,7 @@ def get_session_status(session_id: Optional[str] = None):
             # Sesión no encontrada en el servidor - puede ser que aún no esté lista
             # Intentar obtener estado desde la lista de sesiones como fallback
             try:
-                list_response = requests.get(
+                list_response = transport.get(
                     f"{api_base_url}/api/sessions",
                     headers={
                         "X-API-Key": settings.get('api_key'),
@@ -449,7 +450,7 @@ def create_session(session_id, session_name, description=""):
         if webhook_secret and webhook_secret.strip():
             create_data["webhookSecret"] = webhook_secret.strip()
 
-        create_response = requests.post(
+        create_response = transport.post(
             f"{api_base_url}/api/sessions",
             json=create_data,
             headers={
@@ -480,7 +481,7 @@ def create_session(session_id, session_name, description=""):
                 connect_response = None
                 connect_exception = None
                 try:
-                    connect_response = requests.post(
+                    connect_response = transport.post(
                         f"{api_base_url}/api/sessions/{session_id_created}/connect",
                         headers={
                             "X-API-Key": settings.get('api_key'),
@@ -495,7 +496,7 @@ def create_session(session_id, session_name, description=""):
                     connect_exception = str(e)
 
                 # Obtener estado actualizado de la sesión
-                status_response = requests.get(
+                status_response = transport.get(
                     f"{api_base_url}/api/sessions/{session_id_created}/status",
                     headers={
                         "X-API-Key": settings.get('api_key'),
@@ -526,7 +527,7 @@ def create_session(session_id, session_name, description=""):
                 for attempt in range(3):  # Reducido a 3 intentos para evitar rate limiting
                     try:
                         # Intentar obtener QR directamente (el servidor ya está arreglado)
-                        qr_response = requests.get(
+                        qr_response = transport.get(
                             f"{api_base_url}/api/sessions/{session_id_created}/qr",
                             headers={
                                 "X-API-Key": settings.get('api_key'),
@@ -731,7 +732,7 @@ def disconnect_session(session_id):
             }
 
         # Llamar al servidor de WhatsApp usando session_db_id
-        response = requests.delete(
+        response = transport.delete(
             f"{api_base_url}/api/sessions/{session_identifier}",
             headers={
                 "X-API-Key": settings.get('api_key'),
@@ -825,7 +826,7 @@ def update_session_webhook(session_id, webhook_url=None, webhook_secret=None):
 			}
 
 		# Actualizar webhook en el servidor
-		response = requests.put(
+		response = transport.put(
 			f"{api_base_url}/api/sessions/{session_identifier}/webhook",
 			json=update_data,
 			headers={
@@ -888,7 +889,7 @@ def delete_session_from_api(session_id):
 			}
 
 		# Llamar al servidor de WhatsApp para eliminar la sesión
-		response = requests.delete(
+		response = transport.delete(
 			f"{api_base_url}/api/sessions/{session_identifier}",
 			headers={
 				"X-API-Key": settings.get('api_key'),
@@ -946,7 +947,7 @@ def get_qr_code(session_id):
 
         # Llamar al servidor de WhatsApp - SOLO API Key según nueva documentación
         # Usar session_db_id (numérico) que es lo que requiere el endpoint
-        response = requests.get(
+        response = transport.get(
             f"{api_base_url}/api/sessions/{session_identifier}/qr",
             headers={
                 "X-API-Key": settings.get('api_key'),
@@ -1028,7 +1029,7 @@ def list_sessions():
         api_base_url = get_api_base_url()
 
         # Llamar al servidor de WhatsApp
-        response = requests.get(
+        response = transport.get(
             f"{api_base_url}/api/sessions",
             headers={
                 "Content-Type": "application/json"
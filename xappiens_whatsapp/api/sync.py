@@ -10,9 +10,9 @@ from .base import WhatsAppAPIClient
 from .session import get_session_status
 from .contacts import sync_contacts
 from .conversations import sync_conversations
-from .messages import sync_messages
+from .message_sync import sync_session_messages
+from xappiens_whatsapp.utils.timestamps import parse_remote_timestamp
 from typing import Dict, Any, List
-from datetime import datetime
 
 
 @frappe.whitelist()
@@ -74,28 +74,8 @@ def sync_session_data(session_name: str, sync_contacts_flag: bool = True, sync_c
                 user=frappe.session.user
             )
 
-            # Obtener todas las conversaciones activas
-            conversations = frappe.get_all(
-                "WhatsApp Conversation",
-                filters={
-                    "session": session.name,
-                    "status": "Active"
-                },
-                limit=20  # Limitar a las 20 conversaciones más recientes
-            )
-
-            messages_results = []
-            for conv in conversations:
-                try:
-                    msg_result = sync_messages(conv.name, limit=20)
-                    messages_results.append(msg_result)
-                except:
-                    pass
-
-            results["sync_status"]["messages"] = {
-                "conversations_synced": len(messages_results),
-                "total_messages": sum(r.get("created", 0) + r.get("updated", 0) for r in messages_results)
-            }
+            # Solo las conversaciones con mensajes posteriores a su marca de agua
+            results["sync_status"]["messages"] = sync_session_messages(session)
 
         # 5. Actualizar estadísticas de la sesión
         update_session_stats(session_name)
@@ -119,63 +99,13 @@ def sync_session_data(session_name: str, sync_contacts_flag: bool = True, sync_c
 @frappe.whitelist()
 def auto_sync_all_sessions():
     """
-    Sincroniza automáticamente todas las sesiones activas.
-    Esta función se ejecuta desde un scheduled job.
+    Encola la sincronización de todas las sesiones activas y conectadas sin
+    esperar al intervalo. La ejecución es en paralelo, un job por sesión
+    (ver api/sync_scheduler.py).
     """
-    settings = frappe.get_single("WhatsApp Settings")
-
-    if not settings.enabled or not settings.auto_sync_enabled:
-        return {"success": False, "message": "Auto-sync deshabilitado"}
-
-    # Obtener todas las sesiones activas y conectadas
-    sessions = frappe.get_all(
-        "WhatsApp Session",
-        filters={
-            "is_active": 1,
-            "is_connected": 1
-        },
-        pluck="name"
-    )
-
-    results = {
-        "total_sessions": len(sessions),
-        "synced": 0,
-        "failed": 0,
-        "errors": []
-    }
-
-    for session_name in sessions:
-        try:
-            frappe.set_user("Administrator")  # Ejecutar como administrador en jobs
-
-            # Sincronizar contactos, conversaciones y mensajes
-            sync_result = sync_session_data(
-                session_name,
-                sync_contacts_flag=True,
-                sync_conversations_flag=True,
-                sync_messages_flag=True
-            )
-
-            if sync_result.get("success"):
-                results["synced"] += 1
-            else:
-                results["failed"] += 1
-                results["errors"].append({
-                    "session": session_name,
-                    "error": sync_result.get("error", "Unknown error")
-                })
-
-        except Exception as e:
-            results["failed"] += 1
-            results["errors"].append({
-                "session": session_name,
-                "error": str(e)
-            })
-            # Continuar con la siguiente sesión
+    from .sync_scheduler import schedule_auto_sync
 
-    # Auto-sync completado
-
-    return results
+    return schedule_auto_sync(ignore_interval=True)
 
 
 def _create_message_from_data(message_data: Dict, conversation: str, session: Any) -> Any:
@@ -491,7 +421,7 @@ def _sync_chats_baileys(client: WhatsAppAPIClient, session: Any) -> Dict[str, An
                         conversation.last_message = last_msg_content
                         conversation.last_message_from_me = last_msg_from_me
                         if last_msg_time:
-                            conversation.last_message_time = datetime.fromtimestamp(last_msg_time)
+                            conversation.last_message_time = parse_remote_timestamp(last_msg_time)
 
                     conversation.save(ignore_permissions=True)
                     updated += 1
@@ -521,7 +451,7 @@ def _sync_chats_baileys(client: WhatsAppAPIClient, session: Any) -> Dict[str, An
                         "is_muted": False,
                         "last_message": last_msg_content,
                         "last_message_from_me": last_msg_from_me,
-                        "last_message_time": datetime.fromtimestamp(last_msg_time) if last_msg_time else None
+                        "last_message_time": parse_remote_timestamp(last_msg_time)
                     })
                     conversation.insert(ignore_permissions=True)
                     created += 1
@@ -568,7 +498,7 @@ def _sync_chats_baileys(client: WhatsAppAPIClient, session: Any) -> Dict[str, An
 
 def _sync_messages_baileys(client: WhatsAppAPIClient, session: Any) -> Dict[str, Any]:
     """
-    Sincroniza mensajes recientes de cada conversación desde Baileys.
+    Sincroniza los mensajes nuevos de las conversaciones con actividad desde Baileys.
 
     Args:
         client: Cliente API configurado
@@ -578,128 +508,8 @@ def _sync_messages_baileys(client: WhatsAppAPIClient, session: Any) -> Dict[str,
         Dict con resultado de sincronización
     """
     try:
-        # Obtener conversaciones activas
-        conversations = frappe.get_all(
-            "WhatsApp Conversation",
-            filters={
-                "session": session.name,
-                "status": "Active"
-            },
-            fields=["name", "chat_id"],
-            limit=10,  # REDUCIDO: Solo 10 conversaciones para evitar sobrecarga
-            order_by="last_message_time desc"  # Las más recientes primero
-        )
-
-        total_processed = 0
-        total_created = 0
-        total_updated = 0
-        total_errors = 0
-
-        for idx, conv in enumerate(conversations):
-            try:
-                # Rate limiting: delay de 500ms entre peticiones
-                if idx > 0:
-                    import time
-                    time.sleep(0.5)
-
-                response = client.get_chat_messages(conv.chat_id, page=1, limit=50)
-
-                if not response.get("success"):
-                    continue
-
-                messages_data = response.get("data", {}).get("messages", [])
-
-                for msg_data in messages_data:
-                    try:
-                        message_id = msg_data.get("whatsappMessageId") or msg_data.get("id")
-
-                        if not message_id:
-                            continue
-
-                        # Verificar si existe
-                        existing = frappe.db.exists("WhatsApp Message", {
-                            "session": session.name,
-                            "message_id": message_id
-                        })
-
-                        # Determinar estado
-                        status_map = {
-                            "sent": "Sent",
-                            "delivered": "Delivered",
-                            "read": "Read",
-                            "failed": "Failed",
-                            "received": "Delivered"
-                        }
-                        status = status_map.get(msg_data.get("status", "").lower(), "Pending")
-
-                        if existing:
-                            # Actualizar mensaje
-                            message = frappe.get_doc("WhatsApp Message", existing)
-                            message.status = status
-                            # ✅ CORREGIDO: read_at es Datetime, no Check
-                            # La API no devuelve isRead en la respuesta de mensajes,
-                            # solo podemos inferirlo del status
-                            if status == "Read" and not message.read_at:
-                                message.read_at = frappe.utils.now_datetime()
-                            message.save(ignore_permissions=True)
-                            total_updated += 1
-                        else:
-                            # Crear mensaje
-                            timestamp = msg_data.get("timestamp")
-                            if timestamp:
-                                try:
-                                    timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                                except:
-                                    timestamp = frappe.utils.now_datetime()
-                            else:
-                                timestamp = frappe.utils.now_datetime()
-
-                            message = frappe.get_doc({
-                                "doctype": "WhatsApp Message",
-                                "session": session.name,
-                                "conversation": conv.name,
-                                "message_id": message_id,
-                                "content": msg_data.get("content") or msg_data.get("text_content", ""),
-                                "direction": "Outgoing" if msg_data.get("fromMe") else "Incoming",
-                                "message_type": msg_data.get("type", "text"),
-                                "status": status,
-                                "timestamp": timestamp,
-                                "from_number": msg_data.get("from") or msg_data.get("sender"),
-                                "to_number": msg_data.get("to") or msg_data.get("recipients"),
-                                "from_me": msg_data.get("fromMe", False),
-                                "has_media": msg_data.get("has_attachment", False),
-                                # ✅ CORREGIDO: Eliminado is_read (no existe)
-                                # Usamos read_at solo cuando status es "Read"
-                                "read_at": timestamp if status == "Read" else None
-                            })
-                            message.insert(ignore_permissions=True)
-                            total_created += 1
-
-                        total_processed += 1
-
-                    except Exception as e:
-                        total_errors += 1
-                        error_short = str(e)[:100]
-                        frappe.log_error(
-                            message=f"Message error: {error_short}",
-                            title=f"WA Msg - {message_id[:20]}"
-                        )
-
-            except Exception as e:
-                error_short = str(e)[:100]
-                frappe.log_error(
-                    message=f"Chat messages error: {error_short}",
-                    title=f"WA Chat Msgs - {conv.chat_id[:20]}"
-                )
-
-        frappe.db.commit()
-
-        return {
-            "processed": total_processed,
-            "created": total_created,
-            "updated": total_updated,
-            "errors": total_errors
-        }
+        # REDUCIDO: Solo 10 conversaciones para evitar sobrecarga
+        return sync_session_messages(session, client=client, limit=10)
 
     except Exception as e:
         error_msg = str(e)[:150]
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Planificador de la sincronización automática de sesiones.
+
+Cada minuto `schedule_auto_sync` busca las sesiones activas y conectadas cuya
+última sincronización automática supera `WhatsApp Settings.sync_interval` y
+encola un job por sesión en una cola dedicada, sin superar el máximo de
+sincronizaciones simultáneas. Cada sesión tiene un lock en Redis que se toma al
+encolar y se libera al terminar el job, de modo que una sesión lenta nunca
+bloquea a las demás ni se solapa consigo misma. La duración y el resultado de
+cada ejecución se guardan en la sesión.
+"""
+
+import time
+import frappe
+from typing import Dict, Any, List, Optional
+from frappe.utils import add_to_date, cint, flt, now_datetime
+from xappiens_whatsapp.utils.locks import acquire_lock, is_locked, release_lock
+
+
+DEFAULT_SYNC_QUEUE = "long"
+DEFAULT_MAX_CONCURRENCY = 3
+DEFAULT_SYNC_INTERVAL = 5
+# Expiración del lock si el worker muere a mitad de sincronización
+SYNC_LOCK_TIMEOUT = 60 * 60
+
+
+def _lock_key(session_name: str) -> str:
+    return f"auto_sync:{session_name}"
+
+
+def _get_sync_config() -> Dict[str, Any]:
+    settings = frappe.get_single("WhatsApp Settings")
+    return {
+        "enabled": bool(settings.enabled and settings.auto_sync_enabled),
+        "interval": cint(settings.sync_interval) or DEFAULT_SYNC_INTERVAL,
+        "queue": settings.get("sync_worker_queue") or DEFAULT_SYNC_QUEUE,
+        "max_concurrency": cint(settings.get("sync_max_concurrency")) or DEFAULT_MAX_CONCURRENCY,
+    }
+
+
+def schedule_auto_sync(ignore_interval: bool = False) -> Dict[str, Any]:
+    """
+    Tarea programada (cada minuto): encola la sincronización de las sesiones
+    pendientes respetando el intervalo y el máximo de concurrencia.
+
+    Args:
+        ignore_interval: Encolar todas las sesiones libres aunque no toque
+
+    Returns:
+        Dict con sesiones encoladas, en curso y pendientes por falta de hueco
+    """
+    config = _get_sync_config()
+    if not config["enabled"]:
+        return {"success": False, "message": "Auto-sync deshabilitado"}
+
+    sessions = frappe.get_all(
+        "WhatsApp Session",
+        filters={"is_active": 1, "is_connected": 1},
+        fields=["name", "last_auto_sync"],
+        order_by="last_auto_sync asc",
+    )
+
+    due_before = add_to_date(now_datetime(), minutes=-config["interval"])
+    running = [s.name for s in sessions if is_locked(_lock_key(s.name))]
+    due = [
+        s.name for s in sessions
+        if s.name not in running and (ignore_interval or not s.last_auto_sync or s.last_auto_sync <= due_before)
+    ]
+
+    slots = max(config["max_concurrency"] - len(running), 0)
+    enqueued = []
+    for session_name in due:
+        if len(enqueued) >= slots:
+            break
+        token = acquire_lock(_lock_key(session_name), timeout=SYNC_LOCK_TIMEOUT)
+        if not token:
+            continue
+
+        try:
+            frappe.enqueue(
+                "xappiens_whatsapp.api.sync_scheduler.run_session_sync",
+                queue=config["queue"],
+                timeout=SYNC_LOCK_TIMEOUT,
+                job_id=f"whatsapp_auto_sync::{frappe.local.site}::{session_name}",
+                deduplicate=True,
+                session_name=session_name,
+                lock_token=token,
+            )
+            enqueued.append(session_name)
+        except Exception as e:
+            release_lock(_lock_key(session_name), token)
+            frappe.log_error(f"Error encolando auto-sync de {session_name}: {str(e)}", "WhatsApp Auto Sync")
+
+    return {
+        "success": True,
+        "enqueued": enqueued,
+        "running": running,
+        "waiting": [s for s in due if s not in enqueued],
+    }
+
+
+def run_session_sync(session_name: str, lock_token: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Job de sincronización de una sesión. Libera el lock de la sesión al terminar
+    y guarda inicio, duración y resultado en la WhatsApp Session.
+
+    Args:
+        session_name: Nombre del documento WhatsApp Session
+        lock_token: Token del lock tomado por schedule_auto_sync
+
+    Returns:
+        Dict con el resultado de la sincronización
+    """
+    from .sync import sync_session_data
+
+    started_at = now_datetime()
+    start = time.monotonic()
+    status, error, result = "Success", None, {}
+
+    try:
+        frappe.set_user("Administrator")
+        result = sync_session_data(
+            session_name,
+            sync_contacts_flag=True,
+            sync_conversations_flag=True,
+            sync_messages_flag=True
+        )
+        if not result.get("success"):
+            status, error = "Failed", result.get("error") or "Unknown error"
+
+    except Exception as e:
+        frappe.db.rollback()
+        status, error = "Failed", str(e)
+        frappe.log_error(f"Error en auto-sync de {session_name}: {str(e)}", "WhatsApp Auto Sync")
+
+    finally:
+        duration = round(time.monotonic() - start, 2)
+        try:
+            frappe.db.set_value("WhatsApp Session", session_name, {
+                "last_auto_sync": started_at,
+                "last_auto_sync_status": status,
+                "last_auto_sync_duration": duration,
+                "last_auto_sync_error": error,
+            }, update_modified=False)
+            frappe.db.commit()
+        finally:
+            release_lock(_lock_key(session_name), lock_token)
+
+    frappe.logger("whatsapp", allow_site=True).info(
+        f"Auto-sync {session_name}: {status} en {duration}s" + (f" ({error})" if error else "")
+    )
+
+    return {"session": session_name, "status": status, "duration": duration, "error": error, "result": result}
+
+
+@frappe.whitelist()
+def get_auto_sync_status() -> List[Dict[str, Any]]:
+    """
+    Estado de la sincronización automática por sesión: última ejecución,
+    duración, resultado y si está en curso.
+
+    Returns:
+        Lista de sesiones activas con su estado de sincronización
+    """
+    frappe.only_for(["System Manager", "WhatsApp Manager"])
+
+    sessions = frappe.get_all(
+        "WhatsApp Session",
+        filters={"is_active": 1},
+        fields=[
+            "name", "session_name", "is_connected", "last_auto_sync",
+            "last_auto_sync_status", "last_auto_sync_duration", "last_auto_sync_error",
+        ],
+        order_by="session_name asc",
+    )
+
+    for session in sessions:
+        session.running = is_locked(_lock_key(session.name))
+        session.last_auto_sync_duration = flt(session.last_auto_sync_duration)
+
+    return sessions
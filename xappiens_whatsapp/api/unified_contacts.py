@@ -5,32 +5,15 @@ Agrupa conversaciones y mensajes por número de teléfono, independientemente de
 
 import frappe
 from frappe import _
+from frappe.utils import cint
 from typing import Dict, List, Any, Optional
 from datetime import datetime, timedelta
 import re
 
-
-def normalize_phone_number(phone: str) -> str:
-    """Normalizar número de teléfono para comparación"""
-    if not phone:
-        return ""
-
-    # Remover caracteres no numéricos
-    clean_phone = re.sub(r'[^\d+]', '', str(phone))
-
-    # Remover sufijos de WhatsApp (@c.us, @s.whatsapp.net)
-    if '@' in clean_phone:
-        clean_phone = clean_phone.split('@')[0]
-
-    # Normalizar formato internacional
-    if clean_phone.startswith('00'):
-        clean_phone = '+' + clean_phone[2:]
-    elif clean_phone.startswith('34') and len(clean_phone) == 11:
-        clean_phone = '+' + clean_phone
-    elif not clean_phone.startswith('+') and len(clean_phone) == 9:
-        clean_phone = '+34' + clean_phone
-
-    return clean_phone
+from .conversations import _get_leads_by_name
+from .message_projection import get_light_message_columns
+from xappiens_whatsapp.utils.pagination import build_keyset_clause, paginate_rows
+from xappiens_whatsapp.utils.phone import normalize_phone_number
 
 
 def select_best_contact_name(all_names: str, phone_number: str) -> str:
@@ -82,7 +65,7 @@ def select_best_contact_name(all_names: str, phone_number: str) -> str:
         # Verificar si es igual al número de teléfono
         normalized_name = normalize_phone_number(name_clean)
         is_same_as_phone = (
-            normalized_name == normalized_phone or
+            (normalized_name and normalized_name == normalized_phone) or
             normalized_name == phone_without_plus or
             name_clean == phone_number or
             name_clean == normalized_phone or
@@ -151,7 +134,7 @@ def get_unified_contacts(
         # Obtener todos los contact_name posibles para seleccionar el mejor en Python
         base_query = """
             SELECT
-                c.phone_number,
+                c.normalized_phone as phone_number,
                 GROUP_CONCAT(DISTINCT c.contact_name SEPARATOR '|||') as all_contact_names,
                 COUNT(DISTINCT c.session) as session_count,
                 GROUP_CONCAT(DISTINCT c.session) as sessions,
@@ -164,8 +147,8 @@ def get_unified_contacts(
                 MAX(l._assign) as lead_assigned_to
             FROM `tabWhatsApp Conversation` c
             LEFT JOIN `tabCRM Lead` l ON c.linked_lead = l.name
-            WHERE c.phone_number IS NOT NULL
-                AND c.phone_number != ''
+            WHERE c.normalized_phone IS NOT NULL
+                AND c.normalized_phone != ''
                 AND c.status = 'Active'
         """
 
@@ -188,13 +171,13 @@ def get_unified_contacts(
 
         # Agregar filtro de búsqueda si se proporciona
         if search:
-            base_query += " AND (c.contact_name LIKE %s OR c.phone_number LIKE %s)"
+            base_query += " AND (c.contact_name LIKE %s OR c.normalized_phone LIKE %s)"
             search_param = f"%{search}%"
             params.extend([search_param, search_param])
 
         # Agrupar por teléfono
         base_query += """
-            GROUP BY c.phone_number
+            GROUP BY c.normalized_phone
             ORDER BY last_activity DESC
             LIMIT %s OFFSET %s
         """
@@ -202,20 +185,18 @@ def get_unified_contacts(
 
         contacts = frappe.db.sql(base_query, params, as_dict=True)
 
-        # Enriquecer cada contacto con información adicional
+        # Enriquecer la página con tres consultas por lotes (leads, últimos
+        # mensajes y sesiones activas), independientemente del número de contactos
+        phone_numbers = [contact.phone_number for contact in contacts]
+        leads = _get_leads_by_name([contact.linked_lead for contact in contacts if contact.linked_lead])
+        last_messages = get_last_messages_for_phones(phone_numbers)
+        active_sessions_by_phone = get_active_sessions_for_phones(phone_numbers)
+
         enriched_contacts = []
         for contact in contacts:
-            # Obtener información del lead si existe
-            lead_info = None
-            if contact.linked_lead:
-                lead_info = frappe.get_value("CRM Lead", contact.linked_lead,
-                                           ["name", "lead_name", "status"], as_dict=True)
-
-            # Obtener último mensaje
-            last_message = get_last_message_for_phone(contact.phone_number)
-
-            # Obtener sesiones activas para este contacto
-            active_sessions = get_active_sessions_for_phone(contact.phone_number)
+            lead_info = leads.get(contact.linked_lead) if contact.linked_lead else None
+            last_message = last_messages.get(contact.phone_number)
+            active_sessions = active_sessions_by_phone.get(contact.phone_number, [])
 
             # Verificar si el lead está asignado al usuario actual
             is_assigned_to_me = False
@@ -239,7 +220,7 @@ def get_unified_contacts(
                 "conversation_count": contact.conversation_count,
                 "linked_lead": lead_info,
                 "last_message": last_message,
-                "normalized_phone": normalize_phone_number(contact.phone_number),
+                "normalized_phone": contact.phone_number,
                 "is_assigned_to_me": is_assigned_to_me,
                 "assigned_to": contact.lead_assigned_to
             }
@@ -248,11 +229,11 @@ def get_unified_contacts(
 
         # Obtener total para paginación (usar la misma lógica de filtros)
         count_query = """
-            SELECT COUNT(DISTINCT c.phone_number) as total
+            SELECT COUNT(DISTINCT c.normalized_phone) as total
             FROM `tabWhatsApp Conversation` c
             LEFT JOIN `tabCRM Lead` l ON c.linked_lead = l.name
-            WHERE c.phone_number IS NOT NULL
-                AND c.phone_number != ''
+            WHERE c.normalized_phone IS NOT NULL
+                AND c.normalized_phone != ''
                 AND c.status = 'Active'
         """
 
@@ -272,7 +253,7 @@ def get_unified_contacts(
             count_params.append(time_cutoff)
 
         if search:
-            count_query += " AND (c.contact_name LIKE %s OR c.phone_number LIKE %s)"
+            count_query += " AND (c.contact_name LIKE %s OR c.normalized_phone LIKE %s)"
             count_params.extend([search_param, search_param])
 
         total_count = frappe.db.sql(count_query, count_params, as_dict=True)[0].total
@@ -307,19 +288,20 @@ def get_unified_contacts(
 
 
 @frappe.whitelist()
-def get_unified_conversation(phone_number: str, limit: int = 100) -> Dict[str, Any]:
+def get_unified_conversation(phone_number: str, limit: int = 100, before: str = None, after: str = None) -> Dict[str, Any]:
     """
     Obtener conversación unificada para un número de teléfono
-    Incluye TODOS los mensajes de TODAS las sesiones para ese número
+    Incluye TODOS los mensajes de TODAS las sesiones para ese número,
+    paginados por cursor (before: más antiguos, after: posteriores al cursor)
     """
     try:
         normalized_phone = normalize_phone_number(phone_number)
 
-        # Obtener todas las conversaciones para este número
+        # Obtener todas las conversaciones para este número (de cualquier sesión y formato)
         conversations = frappe.get_all("WhatsApp Conversation",
-            filters={"phone_number": phone_number, "status": "Active"},
+            filters={"normalized_phone": normalized_phone, "status": "Active"},
             fields=["name", "session", "contact_name", "chat_id", "linked_lead", "linked_customer"]
-        )
+        ) if normalized_phone else []
 
         if not conversations:
             return {
@@ -342,21 +324,27 @@ def get_unified_conversation(phone_number: str, limit: int = 100) -> Dict[str, A
         # Obtener TODOS los mensajes de TODAS las conversaciones
         conversation_names = [conv.name for conv in conversations]
 
-        messages_query = """
+        limit = cint(limit) or 100
+        params = {"conversations": tuple(conversation_names), "limit": limit + 1}
+        cursor_condition, order_by, ascending = build_keyset_clause(params, before=before, after=after, alias="m.")
+
+        messages = frappe.db.sql(f"""
             SELECT
-                m.*,
+                {", ".join(f"m.`{column}`" for column in get_light_message_columns())},
                 c.session,
                 c.contact_name as conversation_contact_name,
                 c.chat_id
             FROM `tabWhatsApp Message` m
             JOIN `tabWhatsApp Conversation` c ON m.conversation = c.name
-            WHERE m.conversation IN ({})
-            ORDER BY m.timestamp DESC
-            LIMIT %s
-        """.format(','.join(['%s'] * len(conversation_names)))
+            WHERE m.conversation IN %(conversations)s
+                {f"AND {cursor_condition}" if cursor_condition else ""}
+            ORDER BY {order_by}
+            LIMIT %(limit)s
+        """, params, as_dict=True)
 
-        params = conversation_names + [limit]
-        messages = frappe.db.sql(messages_query, params, as_dict=True)
+        page = paginate_rows(messages, limit, ascending)
+        # Este endpoint devuelve el mensaje más reciente primero
+        messages = list(reversed(page["messages"]))
 
         # Enriquecer mensajes con información de sesión
         enriched_messages = []
@@ -386,6 +374,9 @@ def get_unified_conversation(phone_number: str, limit: int = 100) -> Dict[str, A
             "sessions": list(session_info.values()),
             "session_info": session_info,
             "total_messages": len(enriched_messages),
+            "has_more": page["has_more"],
+            "next_cursor": page["next_cursor"],
+            "latest_cursor": page["latest_cursor"],
             "linked_lead": lead_info
         }
 
@@ -400,7 +391,7 @@ def get_unified_conversation(phone_number: str, limit: int = 100) -> Dict[str, A
 
 
 @frappe.whitelist()
-def send_message_smart(phone_number: str, message: str, preferred_session: str = None, file_path: str = None, media_type: str = None) -> Dict[str, Any]:
+def send_message_smart(phone_number: str, message: str, preferred_session: str = None, file_path: str = None, media_type: str = None, priority: str = "agent") -> Dict[str, Any]:
     """
     Enviar mensaje de forma inteligente (con soporte para archivos adjuntos):
     1. Si se especifica sesión preferida y está activa, usar esa
@@ -413,10 +404,22 @@ def send_message_smart(phone_number: str, message: str, preferred_session: str =
         preferred_session: Sesión preferida (opcional)
         file_path: Ruta del archivo adjunto (opcional)
         media_type: Tipo de media (opcional, se detecta automáticamente)
+        priority: Prioridad en la cola de envío: "agent" (por defecto) o "bulk"
+
+    El mensaje se pone en la cola de envío de la sesión elegida (ver
+    outbound_queue); el resultado indica el mensaje encolado, no su entrega.
     """
     try:
         target_session = None
         target_conversation = None
+        existing_conversations = []
+
+        normalized_phone = normalize_phone_number(phone_number)
+        if not normalized_phone:
+            return {
+                "success": False,
+                "error": f"Número de teléfono no válido: {phone_number}"
+            }
 
         # Opción 1: Usar sesión preferida si está activa
         if preferred_session:
@@ -428,7 +431,7 @@ def send_message_smart(phone_number: str, message: str, preferred_session: str =
         # Opción 2: Buscar sesión con conversación existente más reciente
         if not target_session:
             existing_conversations = frappe.get_all("WhatsApp Conversation",
-                filters={"phone_number": phone_number, "status": "Active"},
+                filters={"normalized_phone": normalized_phone, "status": "Active"},
                 fields=["session", "last_message_time", "name"],
                 order_by="last_message_time desc",
                 limit=1
@@ -468,12 +471,10 @@ def send_message_smart(phone_number: str, message: str, preferred_session: str =
         # Si no hay conversación existente, crear una nueva
         if not target_conversation:
             # Buscar o crear conversación
-            chat_id = normalize_phone_number(phone_number)
-            if not chat_id.endswith('@c.us'):
-                chat_id = chat_id.replace('+', '') + '@c.us'
+            chat_id = normalized_phone.replace('+', '') + '@c.us'
 
             existing_conv = frappe.get_value("WhatsApp Conversation",
-                                           {"session": target_session, "phone_number": phone_number},
+                                           {"session": target_session, "normalized_phone": normalized_phone},
                                            "name")
 
             if existing_conv:
@@ -513,7 +514,7 @@ def send_message_smart(phone_number: str, message: str, preferred_session: str =
 
                 # Enviar mensaje de notificación primero
                 from .messages import send_message
-                notification_result = send_message(target_conversation, notification_message)
+                notification_result = send_message(target_conversation, notification_message, priority=priority)
 
                 if notification_result.get("success"):
                     frappe.log_error(f"Session change notification sent for {phone_number}: {previous_session} -> {target_session}", "WhatsApp Session Change")
@@ -524,11 +525,11 @@ def send_message_smart(phone_number: str, message: str, preferred_session: str =
         if file_path:
             # Enviar mensaje con archivo adjunto
             from .messages import send_message_with_media
-            result = send_message_with_media(target_conversation, message, file_path, media_type)
+            result = send_message_with_media(target_conversation, message, file_path, media_type, priority=priority)
         else:
             # Enviar mensaje de texto normal
             from .messages import send_message
-            result = send_message(target_conversation, message)
+            result = send_message(target_conversation, message, priority=priority)
 
         if result.get("success"):
             # Agregar información de la sesión usada
@@ -555,38 +556,96 @@ def send_message_smart(phone_number: str, message: str, preferred_session: str =
 
 def get_last_message_for_phone(phone_number: str) -> Optional[Dict[str, Any]]:
     """Obtener el último mensaje para un número de teléfono"""
+    normalized_phone = normalize_phone_number(phone_number)
+    return get_last_messages_for_phones([normalized_phone]).get(normalized_phone) if normalized_phone else None
+
+
+def get_last_messages_for_phones(phone_numbers: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Último mensaje de cada número de teléfono en una sola consulta.
+
+    El máximo se agrupa por conversación (usa el índice (conversation, timestamp))
+    y se reduce a un mensaje por teléfono en Python; con timestamps empatados
+    gana el último creado.
+
+    Args:
+        phone_numbers: Teléfonos normalizados (E.164) de la página
+
+    Returns:
+        Dict {teléfono normalizado: mensaje}
+    """
+    if not phone_numbers:
+        return {}
+
     try:
-        query = """
-            SELECT m.content, m.timestamp, m.direction, m.message_type, c.session
+        rows = frappe.db.sql("""
+            SELECT c.normalized_phone AS phone_number, m.content, m.timestamp, m.direction, m.message_type, c.session
             FROM `tabWhatsApp Message` m
-            JOIN `tabWhatsApp Conversation` c ON m.conversation = c.name
-            WHERE c.phone_number = %s
-            ORDER BY m.timestamp DESC
-            LIMIT 1
-        """
-
-        result = frappe.db.sql(query, [phone_number], as_dict=True)
-        return result[0] if result else None
+            INNER JOIN (
+                SELECT lm.conversation, MAX(lm.timestamp) AS max_timestamp
+                FROM `tabWhatsApp Message` lm
+                INNER JOIN `tabWhatsApp Conversation` lc ON lc.name = lm.conversation
+                WHERE lc.normalized_phone IN %(phones)s
+                GROUP BY lm.conversation
+            ) latest ON latest.conversation = m.conversation AND latest.max_timestamp = m.timestamp
+            INNER JOIN `tabWhatsApp Conversation` c ON c.name = m.conversation
+            ORDER BY m.timestamp DESC, m.creation DESC
+        """, {"phones": tuple(set(phone_numbers))}, as_dict=True)
 
     except Exception:
-        return None
+        return {}
+
+    last_messages = {}
+    for row in rows:
+        phone_number = row.pop("phone_number")
+        last_messages.setdefault(phone_number, row)
+
+    return last_messages
 
 
 def get_active_sessions_for_phone(phone_number: str) -> List[Dict[str, Any]]:
     """Obtener sesiones activas que tienen conversación con este número"""
+    normalized_phone = normalize_phone_number(phone_number)
+    return get_active_sessions_for_phones([normalized_phone]).get(normalized_phone, []) if normalized_phone else []
+
+
+def get_active_sessions_for_phones(phone_numbers: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Sesiones activas con conversación con cada número de teléfono, en una sola
+    consulta. Conectadas primero y, después, por actividad más reciente.
+
+    Args:
+        phone_numbers: Teléfonos normalizados (E.164) de la página
+
+    Returns:
+        Dict {teléfono normalizado: [sesiones]}
+    """
+    if not phone_numbers:
+        return {}
+
     try:
-        query = """
-            SELECT DISTINCT s.name, s.session_name, s.phone_number, s.status, s.is_connected
+        rows = frappe.db.sql("""
+            SELECT
+                c.normalized_phone AS contact_phone,
+                s.name, s.session_name, s.phone_number, s.status, s.is_connected,
+                MAX(c.last_message_time) AS last_activity
             FROM `tabWhatsApp Session` s
             JOIN `tabWhatsApp Conversation` c ON s.name = c.session
-            WHERE c.phone_number = %s AND s.is_active = 1
-            ORDER BY s.is_connected DESC, c.last_message_time DESC
-        """
-
-        return frappe.db.sql(query, [phone_number], as_dict=True)
+            WHERE c.normalized_phone IN %(phones)s AND s.is_active = 1
+            GROUP BY c.normalized_phone, s.name
+            ORDER BY s.is_connected DESC, last_activity DESC
+        """, {"phones": tuple(set(phone_numbers))}, as_dict=True)
 
     except Exception:
-        return []
+        return {}
+
+    sessions = {}
+    for row in rows:
+        phone_number = row.pop("contact_phone")
+        row.pop("last_activity")
+        sessions.setdefault(phone_number, []).append(row)
+
+    return sessions
 
 
 @frappe.whitelist()
@@ -597,17 +656,17 @@ def search_unified_contacts(query: str, limit: int = 20) -> Dict[str, Any]:
 
         sql_query = """
             SELECT DISTINCT
-                phone_number,
+                normalized_phone as phone_number,
                 GROUP_CONCAT(DISTINCT contact_name SEPARATOR '|||') as all_contact_names,
                 COUNT(DISTINCT session) as session_count,
                 MAX(last_message_time) as last_activity,
                 SUM(unread_count) as total_unread
             FROM `tabWhatsApp Conversation`
-            WHERE (contact_name LIKE %s OR phone_number LIKE %s)
-                AND phone_number IS NOT NULL
-                AND phone_number != ''
+            WHERE (contact_name LIKE %s OR normalized_phone LIKE %s)
+                AND normalized_phone IS NOT NULL
+                AND normalized_phone != ''
                 AND status = 'Active'
-            GROUP BY phone_number
+            GROUP BY normalized_phone
             ORDER BY last_activity DESC
             LIMIT %s
         """
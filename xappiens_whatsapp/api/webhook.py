@@ -16,6 +16,18 @@ import hashlib
 import json
 from typing import Dict, Any
 from datetime import datetime
+from .webhook_queue import is_queue_mode_enabled, enqueue_webhook_event
+from .media_queue import queue_media_download
+from .outbound_queue import STATUS_RANK, notify_message_status
+from xappiens_whatsapp.utils.trace import trace, get_traces
+from xappiens_whatsapp.utils.conversation_stats import invalidate_conversation_stats
+from xappiens_whatsapp.utils.media_storage import normalize_sha256
+from xappiens_whatsapp.utils.timestamps import parse_remote_timestamp
+
+
+# Aviso de webhook sin secret: como mucho un Error Log por intervalo
+MISSING_SECRET_LOGGED_KEY = "whatsapp_webhook_missing_secret_logged"
+MISSING_SECRET_LOG_INTERVAL = 24 * 60 * 60
 
 
 @frappe.whitelist(allow_guest=True)
@@ -24,6 +36,10 @@ def handle_webhook():
     Endpoint principal para recibir webhooks de Inbox Hub.
     Este método debe estar configurado en Inbox Hub como webhook URL.
 
+    En modo de ingesta "Queued" (WhatsApp Settings) solo se valida la firma, se
+    persiste el evento crudo y se responde de inmediato; el procesamiento lo
+    hace el consumidor de `webhook_queue` en segundo plano.
+
     URL: https://tu-dominio.com/api/method/xappiens_whatsapp.api.webhook.handle_webhook
     """
     try:
@@ -34,6 +50,20 @@ def handle_webhook():
             frappe.log_error("Empty webhook payload received")
             return {"success": False, "error": "Empty payload"}
 
+        signature = (
+            frappe.request.headers.get("X-Webhook-Signature")
+            or frappe.request.headers.get("X-Signature")
+        )
+        header_event = frappe.request.headers.get("X-Webhook-Event")
+        header_session = frappe.request.headers.get("X-Webhook-Session")
+
+        if is_queue_mode_enabled():
+            if not _verify_webhook_signature(raw_payload, signature):
+                frappe.log_error("Webhook signature verification failed")
+                return {"success": False, "error": "Invalid signature"}
+
+            return enqueue_webhook_event(raw_payload, header_event, header_session)
+
         try:
             data = json.loads(raw_payload)
         except json.JSONDecodeError:
@@ -41,80 +71,114 @@ def handle_webhook():
             return {"success": False, "error": "Invalid JSON"}
 
         # Validar firma del webhook (seguridad)
-        signature = (
-            frappe.request.headers.get("X-Webhook-Signature")
-            or frappe.request.headers.get("X-Signature")
-        )
-
         if not _verify_webhook_signature(raw_payload, signature):
             frappe.log_error("Webhook signature verification failed")
             return {"success": False, "error": "Invalid signature"}
 
-        header_event = frappe.request.headers.get("X-Webhook-Event")
-        header_session = frappe.request.headers.get("X-Webhook-Session")
+        result = process_webhook_data(data, header_event, header_session)
 
-        # Procesar evento
-        event = header_event or data.get("event")
-        event_data = data.get("data")
+        frappe.db.commit()
 
-        # Compatibilidad: algunos emisores envían el payload directamente sin 'data'
-        if not event_data and isinstance(data, dict):
-            event_data = data.get("message") or data.get("payload")
+        return result
 
-        if not isinstance(event_data, dict):
-            event_data = {}
+    except Exception as e:
+        frappe.log_error(f"Error processing webhook: {str(e)}")
+        return {"success": False, "error": str(e)}
 
-        # Verificar si es una reacción ANTES de enrutar
-        # Las reacciones pueden venir en data.message.reactionMessage o event_data.reactionMessage
-        reaction_message = (
-            event_data.get("reactionMessage") or
-            (data.get("message") or {}).get("reactionMessage") or
-            data.get("reactionMessage")
-        )
 
-        if reaction_message:
-            # Si es una reacción, procesarla directamente
-            resolved_session = (
-                header_session
-                or data.get("sessionId")
-                or event_data.get("sessionId")
-            )
-            if resolved_session:
-                event_data.setdefault("sessionId", resolved_session)
-                data["sessionId"] = resolved_session
-            return _handle_reaction_received(event_data if event_data.get("sessionId") else data, resolved_session or data.get("sessionId"))
+def process_webhook_data(data: Dict, header_event: str = None, header_session: str = None) -> Dict[str, Any]:
+    """
+    Procesa un webhook ya validado: resuelve evento y sesión y lo enruta a su handler.
+    Se usa tanto en el modo síncrono como desde el consumidor de la cola.
 
-        # Asegurar sessionId disponible para handlers
+    Args:
+        data: Payload JSON del webhook
+        header_event: Valor de la cabecera X-Webhook-Event
+        header_session: Valor de la cabecera X-Webhook-Session
+
+    Returns:
+        Dict con el resultado del procesamiento
+    """
+    # Procesar evento
+    event = header_event or data.get("event")
+    event_data = data.get("data")
+
+    # Compatibilidad: algunos emisores envían el payload directamente sin 'data'
+    if not event_data and isinstance(data, dict):
+        event_data = data.get("message") or data.get("payload")
+
+    if not isinstance(event_data, dict):
+        event_data = {}
+
+    # Verificar si es una reacción ANTES de enrutar
+    # Las reacciones pueden venir en data.message.reactionMessage o event_data.reactionMessage
+    reaction_message = (
+        event_data.get("reactionMessage") or
+        (data.get("message") or {}).get("reactionMessage") or
+        data.get("reactionMessage")
+    )
+
+    if reaction_message:
+        # Si es una reacción, procesarla directamente
         resolved_session = (
             header_session
             or data.get("sessionId")
             or event_data.get("sessionId")
         )
-
         if resolved_session:
             event_data.setdefault("sessionId", resolved_session)
-            # Mantener top-level también para trazabilidad
             data["sessionId"] = resolved_session
+        return _handle_reaction_received(event_data if event_data.get("sessionId") else data, resolved_session or data.get("sessionId"))
+
+    # Asegurar sessionId disponible para handlers
+    resolved_session = (
+        header_session
+        or data.get("sessionId")
+        or event_data.get("sessionId")
+    )
+
+    if resolved_session:
+        event_data.setdefault("sessionId", resolved_session)
+        # Mantener top-level también para trazabilidad
+        data["sessionId"] = resolved_session
+
+    if not event or not event_data:
+        frappe.log_error(f"Invalid webhook data: {data}")
+        return {"success": False, "error": "Invalid data"}
+
+    # Enrutar según tipo de evento
+    result = _route_webhook_event(event, event_data)
+
+    return {
+        "success": True,
+        "received": True,
+        "processed": result,
+        "event": event,
+    }
 
-        if not event or not event_data:
-            frappe.log_error(f"Invalid webhook data: {data}")
-            return {"success": False, "error": "Invalid data"}
-
-        # Enrutar según tipo de evento
-        result = _route_webhook_event(event, event_data)
 
-        frappe.db.commit()
+@frappe.whitelist()
+def get_webhook_traces(session_id: str, limit: int = 100, level: str = None) -> Dict[str, Any]:
+    """
+    Devuelve las trazas recientes de webhooks de una sesión (buffer en Redis).
 
-        return {
-            "success": True,
-            "received": True,
-            "processed": result,
-            "event": event,
-        }
+    Args:
+        session_id: Sesión de Baileys
+        limit: Máximo de trazas (las más recientes primero)
+        level: Nivel mínimo (debug, info, warning, error)
 
-    except Exception as e:
-        frappe.log_error(f"Error processing webhook: {str(e)}")
-        return {"success": False, "error": str(e)}
+    Returns:
+        Dict con las trazas
+    """
+    frappe.only_for(["System Manager", "WhatsApp Manager"])
+
+    traces = get_traces(session_id, frappe.utils.cint(limit) or 100, level)
+    return {
+        "success": True,
+        "session_id": session_id,
+        "count": len(traces),
+        "traces": traces,
+    }
 
 
 def _verify_webhook_signature(raw_payload: str, signature: str) -> bool:
@@ -136,8 +200,11 @@ def _verify_webhook_signature(raw_payload: str, signature: str) -> bool:
         webhook_secret = settings.get_password("webhook_secret")
 
         if not webhook_secret:
-            # Si no hay secret configurado, aceptar el webhook (desarrollo)
-            frappe.log_error("Warning: Webhook secret not configured")
+            # Si no hay secret configurado, aceptar el webhook (desarrollo).
+            # El aviso se registra una vez al día, no en cada webhook
+            if not frappe.cache().get_value(MISSING_SECRET_LOGGED_KEY):
+                frappe.cache().set_value(MISSING_SECRET_LOGGED_KEY, 1, expires_in_sec=MISSING_SECRET_LOG_INTERVAL)
+                frappe.log_error("Warning: Webhook secret not configured")
             return True
 
         # Calcular firma esperada
@@ -222,11 +289,10 @@ def _handle_message_received(data: Dict) -> Dict[str, Any]:
         Dict con resultado
     """
     try:
-        # Log del payload recibido para debugging
-        frappe.log_error(f"📨 Webhook recibido - data completo: {frappe.as_json(data)}", "WhatsApp Webhook Debug")
-
         session_id = data.get("sessionId")
 
+        trace(session_id, "Webhook recibido", "debug", data=data)
+
         # Verificar si es una reacción antes de procesar como mensaje normal
         # Las reacciones pueden venir en diferentes formatos según el ejemplo del usuario:
         # Formato real: data.message.reactionMessage (dentro del objeto message)
@@ -249,85 +315,39 @@ def _handle_message_received(data: Dict) -> Dict[str, Any]:
                 reaction_message = message_data_temp.get("reactionMessage")
 
         if reaction_message:
-            frappe.log_error(f"🎯 Reacción detectada en _handle_message_received: {frappe.as_json(reaction_message)}", "WhatsApp Webhook Reaction Detection")
+            trace(session_id, "Reacción detectada en message.received", "debug", reaction=reaction_message)
             return _handle_reaction_received(data, session_id)
 
         # Extraer message_data - el formato nuevo tiene data.message
         message_data = data.get("message") or data.get("payload") or data
 
         if not message_data:
-            frappe.log_error(f"⚠️ No se encontró message_data en el payload: {frappe.as_json(data)}", "WhatsApp Webhook Error")
+            trace(session_id, "No se encontró message_data en el payload", "warning", data=data)
             return {"processed": False, "error": "Message data missing"}
 
         # Buscar sesión por session_id
         session = frappe.db.get_value("WhatsApp Session", {"session_id": session_id}, "name")
 
         if not session:
-            frappe.log_error(f"⚠️ Sesión no encontrada para session_id: {session_id}", "WhatsApp Webhook Error")
+            trace(session_id, "Sesión no encontrada", "warning")
             return {"processed": False, "error": f"Session not found: {session_id}"}
 
         # Extraer datos del mensaje según formato de Baileys
-        message_id = (
-            message_data.get("whatsappMessageId")
-            or message_data.get("messageId")
-            or message_data.get("id")
-        )
-        chat_id = (
-            message_data.get("chatId")
-            or message_data.get("remoteJid")
-            or message_data.get("jid")
-        )
-        if not chat_id:
-            frappe.log_error(f"⚠️ Chat ID faltante en mensaje: {frappe.as_json(message_data)}", "WhatsApp Webhook Error")
+        fields = _extract_message_fields(data, message_data)
+        if not fields.chat_id:
+            trace(session_id, "Chat ID faltante en mensaje", "warning", message_data=message_data)
             return {"processed": False, "error": "Chat ID missing"}
 
-        content = (
-            message_data.get("content")
-            or message_data.get("body")
-            or message_data.get("text")
-            or message_data.get("text_content")
-            or message_data.get("caption")
-            or ""
-        )
-
-        # Extraer número del remitente (from)
-        from_number_raw = (
-            message_data.get("from")
-            or message_data.get("sender")
-            or message_data.get("participant")
-            or message_data.get("author")
-        )
-
-        # Normalizar from_number: extraer solo el número sin @s.whatsapp.net
-        if from_number_raw:
-            from_number = from_number_raw.replace("@s.whatsapp.net", "").replace("@c.us", "").replace("+", "").strip()
-        else:
-            # Si no hay from, usar chatId
-            from_number = chat_id.replace("@s.whatsapp.net", "").replace("@c.us", "").replace("+", "").strip()
-
-        # Extraer número de destino (to) - este es el número de la sesión que recibe
-        to_number_raw = message_data.get("to")
-        to_number = None
-        if to_number_raw:
-            to_number = to_number_raw.replace("+", "").replace(" ", "").strip()
-
-        timestamp = message_data.get("timestamp") or data.get("timestamp")
+        message_id = fields.message_id
+        chat_id = fields.chat_id
+        from_number = fields.from_number
+        to_number = fields.to_number
 
         # Detectar from_me: comparar con número de sesión
-        # Si el mensaje viene de la sesión misma, es saliente (from_me = True)
-        # Si viene de otro número, es entrante (from_me = False)
-        from_me = bool(message_data.get("fromMe"))
-        if not from_me and to_number:
-            # Comparar el número de destino (to) con el número de la sesión
-            session_doc = frappe.get_doc("WhatsApp Session", session)
-            session_phone = session_doc.phone_number or ""
-            # Normalizar números para comparar
-            session_phone_normalized = session_phone.replace("+", "").replace(" ", "").strip()
-            # Si el mensaje va "to" la sesión, entonces from != session, así que from_me = False
-            # Si el mensaje viene "from" la sesión, entonces from == session, así que from_me = True
-            if session_phone_normalized and from_number:
-                # Si el remitente es la sesión misma, es saliente
-                from_me = session_phone_normalized == from_number
+        session_phone = None
+        if not message_data.get("fromMe") and to_number:
+            session_phone = frappe.db.get_value("WhatsApp Session", session, "phone_number")
+        from_me = _detect_from_me(message_data, to_number, from_number, session_phone)
 
         # Verificar si el mensaje ya existe
         if message_id and frappe.db.exists("WhatsApp Message", {"session": session, "message_id": message_id}):
@@ -340,36 +360,10 @@ def _handle_message_received(data: Dict) -> Dict[str, Any]:
         }, "name")
 
         if not conversation:
-            phone_number = chat_id.split('@')[0] if '@' in chat_id else chat_id
-
-            conv_doc = frappe.get_doc({
-                "doctype": "WhatsApp Conversation",
-                "session": session,
-                "chat_id": chat_id,
-                "conversation_name": from_number or phone_number,
-                "contact_name": from_number or phone_number,
-                "phone_number": phone_number,
-                "is_group": message_data.get("isGroup", False),
-                "status": "Active"
-            })
-            conv_doc.insert(ignore_permissions=True)
-            conversation = conv_doc.name
+            conversation = _create_conversation_from_message(session, chat_id, from_number, message_data).name
 
         # Normalizar timestamp a datetime
-        if timestamp:
-            try:
-                if isinstance(timestamp, (int, float)):
-                    ts_value = int(timestamp)
-                    if ts_value > 1e12:  # milisegundos
-                        timestamp = datetime.fromtimestamp(ts_value / 1000)
-                    else:
-                        timestamp = datetime.fromtimestamp(ts_value)
-                else:
-                    timestamp = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
-            except Exception:
-                timestamp = frappe.utils.now_datetime()
-        else:
-            timestamp = frappe.utils.now_datetime()
+        timestamp = _parse_webhook_timestamp(fields.timestamp)
 
         if not message_id:
             message_id = frappe.generate_hash(length=20)
@@ -377,140 +371,50 @@ def _handle_message_received(data: Dict) -> Dict[str, Any]:
         if not from_number and not from_me and chat_id:
             from_number = chat_id.split('@')[0]
 
-        message_doc = frappe.get_doc({
-            "doctype": "WhatsApp Message",
-            "session": session,
-            "conversation": conversation,
-            "message_id": message_id,
-            "content": content,
-            "direction": "Outgoing" if from_me else "Incoming",
-            "message_type": message_data.get("type", "text"),
-            "status": "Sent" if from_me else "Delivered",
-            "timestamp": timestamp,
-            "from_number": from_number,
-            "from_me": from_me,
-            "has_media": message_data.get("has_attachment", False),
-            "is_read": False
-        })
+        message_doc = frappe.get_doc(_build_message_dict(
+            session, conversation, message_id, fields, from_number, from_me, timestamp
+        ))
 
         # Procesar archivos multimedia si los hay
-        if message_data.get("has_attachment") or message_data.get("hasMedia"):
+        media_item = None
+        if fields.has_media:
             try:
                 from .messages import process_media_items
 
                 # Extraer información de medios del webhook
-                media_list = []
-
-                # Buscar datos de media en diferentes formatos
-                media_info = (
-                    message_data.get("media") or
-                    message_data.get("attachment") or
-                    message_data.get("mediaData") or
-                    {}
-                )
+                media_item = _build_media_item(fields, message_id)
 
-                if media_info:
-                    media_item = {
-                        "media_type": _get_media_type_from_message_type(message_data.get("type", "document")),
-                        "filename": media_info.get("filename") or f"media_{message_id}",
-                        "filesize": media_info.get("filesize") or media_info.get("size"),
-                        "mimetype": media_info.get("mimetype") or media_info.get("mimeType"),
-                        "url": media_info.get("url") or media_info.get("media_url"),
-                        "remote_media_id": media_info.get("mediaKey") or media_info.get("id"),
-                        "media_hash": media_info.get("fileSha256") or media_info.get("hash")
-                    }
-                    media_list.append(media_item)
-
-                if media_list:
-                    process_media_items(message_doc, media_list)
-
-                    # Programar descarga automática en background
-                    frappe.enqueue(
-                        "xappiens_whatsapp.api.media.download_media_from_message",
-                        session=session,
-                        message=message_doc.name,
-                        queue="default",
-                        timeout=300
-                    )
+                if media_item:
+                    process_media_items(message_doc, [media_item])
 
             except Exception as e:
                 frappe.log_error(f"Error processing media in webhook: {str(e)}", "WhatsApp Webhook Media")
 
+        # Los contadores y el último mensaje de la conversación se actualizan
+        # de forma incremental en WhatsApp Message.after_insert
         message_doc.insert(ignore_permissions=True)
 
-        # Actualizar conversación
-        current_unread = frappe.db.get_value("WhatsApp Conversation", conversation, "unread_count") or 0
-        new_unread_count = current_unread if from_me else current_unread + 1
-
-        frappe.db.set_value("WhatsApp Conversation", conversation, {
-            "last_message": content[:140] if content else "",
-            "last_message_time": timestamp,
-            "last_message_from_me": from_me,
-            "unread_count": new_unread_count
-        })
+        # Registrar la descarga de la media en la cola de descargas (ya con nombre de mensaje)
+        if media_item:
+            try:
+                queue_media_download(session, message_doc.name, media_item, conversation)
+            except Exception as e:
+                frappe.log_error(f"Error encolando descarga de media: {str(e)}", "WhatsApp Webhook Media")
 
         # Obtener número de teléfono normalizado para el frontend
         # Para mensajes entrantes, el phone_number es el remitente (from)
         # Para mensajes salientes, el phone_number es el destinatario (to)
-        conversation_doc = frappe.get_doc("WhatsApp Conversation", conversation)
-        phone_number_normalized = conversation_doc.phone_number or from_number
+        conversation_phone = frappe.db.get_value("WhatsApp Conversation", conversation, "phone_number")
 
         # El to_number ya lo tenemos del message_data
         # Si no está disponible, usar el número de la sesión para mensajes entrantes
-        if not to_number:
-            if from_me:
-                # Mensaje saliente: el destino es el chat_id (remitente del mensaje entrante)
-                to_number = chat_id.split('@')[0] if '@' in chat_id else chat_id
-            else:
-                # Mensaje entrante: el destino es el número de la sesión
-                session_doc = frappe.get_doc("WhatsApp Session", session)
-                to_number = session_doc.phone_number or ""
-                if to_number:
-                    to_number = to_number.replace("+", "").replace(" ", "").strip()
-
-        # Preparar información de media para el payload
-        media_payload = None
-        if message_data.get("has_attachment") or message_data.get("hasMedia"):
-            media_info = (
-                message_data.get("media") or
-                message_data.get("attachment") or
-                message_data.get("mediaData") or
-                {}
-            )
-            if media_info:
-                media_payload = {
-                    "filename": media_info.get("filename"),
-                    "filesize": media_info.get("filesize") or media_info.get("size"),
-                    "mimetype": media_info.get("mimetype") or media_info.get("mimeType"),
-                    "url": media_info.get("url") or media_info.get("media_url"),
-                    "media_type": _get_media_type_from_message_type(message_data.get("type", "document"))
-                }
-
-        # Preparar payload para tiempo real - formato optimizado para el frontend
-        payload = {
-            "session": session,
-            "session_id": session_id,  # session_id string de Baileys
-            "conversation": conversation,
-            "conversation_id": conversation,
-            "message_id": message_doc.name,  # ID del documento en Frappe
-            "whatsapp_message_id": message_id,  # ID de WhatsApp (whatsappMessageId)
-            "message": content,
-            "content": content,
-            "from": from_number,  # Número del remitente normalizado
-            "from_number": from_number,  # Alias para compatibilidad
-            "to": to_number,  # Número de destino (sesión para entrantes)
-            "phone_number": phone_number_normalized,  # Número normalizado para identificar contacto en frontend
-            "chat_id": chat_id,  # Chat ID completo con @s.whatsapp.net
-            "direction": "outgoing" if from_me else "incoming",  # Dirección del mensaje
-            "timestamp": timestamp.isoformat() if hasattr(timestamp, "isoformat") else str(timestamp),
-            "message_type": message_data.get("type", "text"),
-            "has_media": message_data.get("has_attachment", False) or message_data.get("hasMedia", False),
-            "status": "Sent" if from_me else "Delivered",
-            "media": media_payload  # Información de media si existe
-        }
+        if not to_number and not from_me:
+            session_phone = session_phone or frappe.db.get_value("WhatsApp Session", session, "phone_number")
 
-        # Log del payload que se va a publicar
-        frappe.log_error(f"📤 Publicando evento realtime - payload: {frappe.as_json(payload)}", "WhatsApp Webhook Realtime")
+        payload = _build_message_realtime_payload(
+            session, session_id, conversation, message_doc.name, message_id, fields,
+            from_number, to_number, from_me, timestamp, conversation_phone, session_phone
+        )
 
         # Publicar eventos realtime para que el frontend los reciba
         # Cuando no se especifica user ni room, Frappe usa get_site_room() que es "all"
@@ -519,14 +423,14 @@ def _handle_message_received(data: Dict) -> Dict[str, Any]:
             # Publicar sin user ni room para que vaya a todos los usuarios del sitio
             frappe.publish_realtime("whatsapp_message", payload)
             frappe.publish_realtime("whatsapp_message_received", payload)
-
-            frappe.log_error(f"✅ Eventos publicados correctamente", "WhatsApp Webhook Realtime")
         except Exception as e:
-            frappe.log_error(f"Error publicando eventos realtime: {str(e)}", "WhatsApp Webhook Realtime Error")
-            import traceback
-            frappe.log_error(f"Traceback: {traceback.format_exc()}", "WhatsApp Webhook Realtime Error")
+            frappe.log_error(
+                f"Error publicando eventos realtime: {str(e)}\n{frappe.get_traceback()}",
+                "WhatsApp Webhook Realtime Error"
+            )
 
-        frappe.log_error(f"✅ Mensaje procesado y publicado en tiempo real - Message ID: {message_doc.name}, From: {from_number}, To: {to_number}", "WhatsApp Webhook Success")
+        trace(session_id, "Mensaje procesado y publicado en tiempo real", "info",
+              message_id=message_doc.name, payload=payload)
 
         return {"processed": True, "action": "created", "message_id": message_doc.name}
 
@@ -535,6 +439,212 @@ def _handle_message_received(data: Dict) -> Dict[str, Any]:
         return {"processed": False, "error": str(e)}
 
 
+def _normalize_number(value: str) -> str:
+    """Quita sufijos de JID y el prefijo + de un número/JID de WhatsApp."""
+    return (value or "").replace("@s.whatsapp.net", "").replace("@c.us", "").replace("+", "").strip()
+
+
+def _extract_message_fields(data: Dict, message_data: Dict) -> Dict[str, Any]:
+    """
+    Extrae los campos de un mensaje de Baileys sin acceder a la BD.
+    Compartido por el procesamiento individual y el procesamiento por lotes.
+
+    Args:
+        data: Datos del evento (data.data del webhook)
+        message_data: Objeto del mensaje (data.message o equivalente)
+
+    Returns:
+        frappe._dict con los campos normalizados
+    """
+    message_id = (
+        message_data.get("whatsappMessageId")
+        or message_data.get("messageId")
+        or message_data.get("id")
+    )
+    chat_id = (
+        message_data.get("chatId")
+        or message_data.get("remoteJid")
+        or message_data.get("jid")
+    )
+
+    content = (
+        message_data.get("content")
+        or message_data.get("body")
+        or message_data.get("text")
+        or message_data.get("text_content")
+        or message_data.get("caption")
+        or ""
+    )
+
+    # Extraer número del remitente (from)
+    from_number_raw = (
+        message_data.get("from")
+        or message_data.get("sender")
+        or message_data.get("participant")
+        or message_data.get("author")
+    )
+
+    # Normalizar from_number: extraer solo el número sin @s.whatsapp.net
+    # Si no hay from, usar chatId
+    from_number = _normalize_number(from_number_raw or chat_id)
+
+    # Extraer número de destino (to) - este es el número de la sesión que recibe
+    to_number_raw = message_data.get("to")
+    to_number = None
+    if to_number_raw:
+        to_number = to_number_raw.replace("+", "").replace(" ", "").strip()
+
+    has_media = bool(message_data.get("has_attachment") or message_data.get("hasMedia"))
+
+    # Buscar datos de media en diferentes formatos
+    media_info = {}
+    if has_media:
+        media_info = (
+            message_data.get("media") or
+            message_data.get("attachment") or
+            message_data.get("mediaData") or
+            {}
+        )
+
+    return frappe._dict({
+        "message_id": message_id,
+        "chat_id": chat_id,
+        "content": content,
+        "from_number": from_number,
+        "to_number": to_number,
+        "timestamp": message_data.get("timestamp") or data.get("timestamp"),
+        "message_type": message_data.get("type", "text"),
+        "is_group": message_data.get("isGroup", False),
+        "has_attachment": message_data.get("has_attachment", False),
+        "has_media": has_media,
+        "media_info": media_info,
+    })
+
+
+def _detect_from_me(message_data: Dict, to_number: str, from_number: str, session_phone: str) -> bool:
+    """
+    Determina si el mensaje sale de la propia sesión.
+    Si viene de la sesión misma es saliente (from_me = True); si viene de otro número, entrante.
+    """
+    from_me = bool(message_data.get("fromMe"))
+    if not from_me and to_number:
+        # Normalizar números para comparar
+        session_phone_normalized = (session_phone or "").replace("+", "").replace(" ", "").strip()
+        if session_phone_normalized and from_number:
+            # Si el remitente es la sesión misma, es saliente
+            from_me = session_phone_normalized == from_number
+    return from_me
+
+
+def _parse_webhook_timestamp(timestamp) -> datetime:
+    """Normaliza un timestamp de Baileys (segundos, milisegundos o ISO) a datetime en hora del sistema."""
+    return parse_remote_timestamp(timestamp) or frappe.utils.now_datetime()
+
+
+def _create_conversation_from_message(session: str, chat_id: str, from_number: str, message_data: Dict):
+    """Crea la conversación para un chat que aún no existe en Frappe."""
+    phone_number = chat_id.split('@')[0] if '@' in chat_id else chat_id
+
+    conv_doc = frappe.get_doc({
+        "doctype": "WhatsApp Conversation",
+        "session": session,
+        "chat_id": chat_id,
+        "conversation_name": from_number or phone_number,
+        "contact_name": from_number or phone_number,
+        "phone_number": phone_number,
+        "is_group": message_data.get("isGroup", False),
+        "status": "Active"
+    })
+    conv_doc.insert(ignore_permissions=True)
+    return conv_doc
+
+
+def _build_message_dict(session: str, conversation: str, message_id: str, fields: Dict,
+                        from_number: str, from_me: bool, timestamp) -> Dict[str, Any]:
+    """Construye el dict del documento WhatsApp Message para un mensaje recibido."""
+    return {
+        "doctype": "WhatsApp Message",
+        "session": session,
+        "conversation": conversation,
+        "message_id": message_id,
+        "content": fields.content,
+        "direction": "Outgoing" if from_me else "Incoming",
+        "message_type": fields.message_type,
+        "status": "Sent" if from_me else "Delivered",
+        "timestamp": timestamp,
+        "from_number": from_number,
+        "from_me": from_me,
+        "has_media": fields.has_attachment,
+        "is_read": False
+    }
+
+
+def _build_media_item(fields: Dict, message_id: str) -> Dict[str, Any]:
+    """Construye el item de media (WhatsApp Message Media) a partir del webhook."""
+    media_info = fields.media_info
+    if not media_info:
+        return None
+
+    return {
+        "media_type": _get_media_type_from_message_type(fields.message_type or "document"),
+        "filename": media_info.get("filename") or f"media_{message_id}",
+        "filesize": media_info.get("filesize") or media_info.get("size"),
+        "mimetype": media_info.get("mimetype") or media_info.get("mimeType"),
+        "url": media_info.get("url") or media_info.get("media_url"),
+        "remote_media_id": media_info.get("mediaKey") or media_info.get("id"),
+        "media_hash": normalize_sha256(media_info.get("fileSha256") or media_info.get("hash"))
+    }
+
+
+def _build_message_realtime_payload(session: str, session_id: str, conversation: str, message_name: str,
+                                    message_id: str, fields: Dict, from_number: str, to_number: str,
+                                    from_me: bool, timestamp, conversation_phone: str,
+                                    session_phone: str) -> Dict[str, Any]:
+    """Prepara el payload realtime de un mensaje recibido - formato optimizado para el frontend."""
+    if not to_number:
+        if from_me:
+            # Mensaje saliente: el destino es el chat_id (remitente del mensaje entrante)
+            chat_id = fields.chat_id
+            to_number = chat_id.split('@')[0] if '@' in chat_id else chat_id
+        else:
+            # Mensaje entrante: el destino es el número de la sesión
+            to_number = (session_phone or "").replace("+", "").replace(" ", "").strip()
+
+    # Preparar información de media para el payload
+    media_payload = None
+    media_info = fields.media_info
+    if media_info:
+        media_payload = {
+            "filename": media_info.get("filename"),
+            "filesize": media_info.get("filesize") or media_info.get("size"),
+            "mimetype": media_info.get("mimetype") or media_info.get("mimeType"),
+            "url": media_info.get("url") or media_info.get("media_url"),
+            "media_type": _get_media_type_from_message_type(fields.message_type or "document")
+        }
+
+    return {
+        "session": session,
+        "session_id": session_id,  # session_id string de Baileys
+        "conversation": conversation,
+        "conversation_id": conversation,
+        "message_id": message_name,  # ID del documento en Frappe
+        "whatsapp_message_id": message_id,  # ID de WhatsApp (whatsappMessageId)
+        "message": fields.content,
+        "content": fields.content,
+        "from": from_number,  # Número del remitente normalizado
+        "from_number": from_number,  # Alias para compatibilidad
+        "to": to_number,  # Número de destino (sesión para entrantes)
+        "phone_number": conversation_phone or from_number,  # Número normalizado para identificar contacto en frontend
+        "chat_id": fields.chat_id,  # Chat ID completo con @s.whatsapp.net
+        "direction": "outgoing" if from_me else "incoming",  # Dirección del mensaje
+        "timestamp": timestamp.isoformat() if hasattr(timestamp, "isoformat") else str(timestamp),
+        "message_type": fields.message_type,
+        "has_media": fields.has_media,
+        "status": "Sent" if from_me else "Delivered",
+        "media": media_payload  # Información de media si existe
+    }
+
+
 def _handle_reaction_received(data: Dict, session_id: str) -> Dict[str, Any]:
     """
     Procesa una reacción recibida a un mensaje existente.
@@ -564,7 +674,7 @@ def _handle_reaction_received(data: Dict, session_id: str) -> Dict[str, Any]:
         Dict con resultado
     """
     try:
-        frappe.log_error(f"🎯 Reacción recibida - data completo: {frappe.as_json(data)}", "WhatsApp Webhook Reaction")
+        trace(session_id, "Reacción recibida", "debug", data=data)
 
         # Extraer reactionMessage del payload
         # Puede venir en diferentes ubicaciones:
@@ -582,7 +692,7 @@ def _handle_reaction_received(data: Dict, session_id: str) -> Dict[str, Any]:
                 reaction_message = message_data.get("reactionMessage")
 
         if not reaction_message:
-            frappe.log_error(f"⚠️ No se encontró reactionMessage en el payload: {frappe.as_json(data)}", "WhatsApp Webhook Reaction Error")
+            trace(session_id, "No se encontró reactionMessage en el payload", "warning", data=data)
             return {"processed": False, "error": "Reaction message data missing"}
 
         # Extraer datos de la reacción
@@ -594,17 +704,17 @@ def _handle_reaction_received(data: Dict, session_id: str) -> Dict[str, Any]:
         remote_jid = reaction_key.get("remoteJid", "")
 
         if not original_message_id:
-            frappe.log_error(f"⚠️ ID del mensaje original faltante en reacción: {frappe.as_json(reaction_message)}", "WhatsApp Webhook Reaction Error")
+            trace(session_id, "ID del mensaje original faltante en reacción", "warning", reaction=reaction_message)
             return {"processed": False, "error": "Original message ID missing"}
 
         if not reaction_emoji:
-            frappe.log_error(f"⚠️ Emoji de reacción faltante: {frappe.as_json(reaction_message)}", "WhatsApp Webhook Reaction Error")
+            trace(session_id, "Emoji de reacción faltante", "warning", reaction=reaction_message)
             return {"processed": False, "error": "Reaction emoji missing"}
 
         # Buscar sesión
         session = frappe.db.get_value("WhatsApp Session", {"session_id": session_id}, "name")
         if not session:
-            frappe.log_error(f"⚠️ Sesión no encontrada para session_id: {session_id}", "WhatsApp Webhook Reaction Error")
+            trace(session_id, "Sesión no encontrada", "warning")
             return {"processed": False, "error": f"Session not found: {session_id}"}
 
         # Buscar el mensaje original por message_id
@@ -614,7 +724,7 @@ def _handle_reaction_received(data: Dict, session_id: str) -> Dict[str, Any]:
         }, "name")
 
         if not original_message:
-            frappe.log_error(f"⚠️ Mensaje original no encontrado para message_id: {original_message_id}", "WhatsApp Webhook Reaction Error")
+            trace(session_id, "Mensaje original de la reacción no encontrado", "warning", message_id=original_message_id)
             return {"processed": False, "error": f"Original message not found: {original_message_id}"}
 
         # Obtener el documento del mensaje original
@@ -631,17 +741,7 @@ def _handle_reaction_received(data: Dict, session_id: str) -> Dict[str, Any]:
                 reacted_by_number = reacted_by_number.replace("+", "").replace(" ", "").strip()
 
         # Normalizar timestamp
-        if sender_timestamp_ms:
-            try:
-                ts_value = int(sender_timestamp_ms)
-                if ts_value > 1e12:  # milisegundos
-                    reacted_at = datetime.fromtimestamp(ts_value / 1000)
-                else:
-                    reacted_at = datetime.fromtimestamp(ts_value)
-            except Exception:
-                reacted_at = frappe.utils.now_datetime()
-        else:
-            reacted_at = frappe.utils.now_datetime()
+        reacted_at = parse_remote_timestamp(sender_timestamp_ms) or frappe.utils.now_datetime()
 
         # Buscar si ya existe una reacción de este usuario para este mensaje
         existing_reaction = None
@@ -656,12 +756,12 @@ def _handle_reaction_received(data: Dict, session_id: str) -> Dict[str, Any]:
             # Si el emoji está vacío o es null, eliminar la reacción
             if not reaction_emoji or reaction_emoji.strip() == "":
                 message_doc.remove(existing_reaction)
-                frappe.log_error(f"🗑️ Reacción eliminada por usuario {reacted_by_number} del mensaje {original_message}", "WhatsApp Webhook Reaction")
+                trace(session_id, "Reacción eliminada", "debug", original_message=original_message, reacted_by=reacted_by_number)
             else:
                 existing_reaction.reaction_emoji = reaction_emoji
                 existing_reaction.reacted_at = reacted_at
                 existing_reaction.is_from_me = from_me
-                frappe.log_error(f"🔄 Reacción actualizada por usuario {reacted_by_number}: {reaction_emoji}", "WhatsApp Webhook Reaction")
+                trace(session_id, "Reacción actualizada", "debug", original_message=original_message, reacted_by=reacted_by_number, emoji=reaction_emoji)
         else:
             # Solo crear si hay emoji
             if reaction_emoji and reaction_emoji.strip() != "":
@@ -681,7 +781,7 @@ def _handle_reaction_received(data: Dict, session_id: str) -> Dict[str, Any]:
                     "reacted_at": reacted_at,
                     "is_from_me": from_me
                 })
-                frappe.log_error(f"➕ Nueva reacción agregada por usuario {reacted_by_number}: {reaction_emoji}", "WhatsApp Webhook Reaction")
+                trace(session_id, "Nueva reacción agregada", "debug", original_message=original_message, reacted_by=reacted_by_number, emoji=reaction_emoji)
 
         # Actualizar has_reaction si hay reacciones
         message_doc.has_reaction = 1 if message_doc.reactions else 0
@@ -724,27 +824,22 @@ def _handle_reaction_received(data: Dict, session_id: str) -> Dict[str, Any]:
             "reaction_count": len(reactions_list) if reactions_list else 0
         }
 
-        frappe.log_error(f"📤 Publicando evento realtime de reacción - payload: {frappe.as_json(payload)}", "WhatsApp Webhook Reaction Realtime")
-
         # Publicar eventos realtime
         try:
             frappe.publish_realtime("whatsapp_reaction", payload)
             frappe.publish_realtime("whatsapp_message_updated", payload)
-
-            frappe.log_error(f"✅ Eventos de reacción publicados correctamente", "WhatsApp Webhook Reaction Realtime")
         except Exception as e:
-            frappe.log_error(f"Error publicando eventos realtime de reacción: {str(e)}", "WhatsApp Webhook Reaction Realtime Error")
-            import traceback
-            frappe.log_error(f"Traceback: {traceback.format_exc()}", "WhatsApp Webhook Reaction Realtime Error")
+            frappe.log_error(
+                f"Error publicando eventos realtime de reacción: {str(e)}\n{frappe.get_traceback()}",
+                "WhatsApp Webhook Reaction Realtime Error"
+            )
 
-        frappe.log_error(f"✅ Reacción procesada exitosamente - Message ID: {original_message}, Reaction: {reaction_emoji}, By: {reacted_by_number}", "WhatsApp Webhook Reaction Success")
+        trace(session_id, "Reacción procesada", "info", payload=payload)
 
         return {"processed": True, "action": "reaction_added" if not existing_reaction else "reaction_updated", "message_id": original_message}
 
     except Exception as e:
-        frappe.log_error(f"Error handling reaction received: {str(e)}", "WhatsApp Webhook Reaction Error")
-        import traceback
-        frappe.log_error(f"Traceback: {traceback.format_exc()}", "WhatsApp Webhook Reaction Error")
+        frappe.log_error(f"Error handling reaction received: {str(e)}\n{frappe.get_traceback()}", "WhatsApp Webhook Reaction Error")
         return {"processed": False, "error": str(e)}
 
 
@@ -770,12 +865,18 @@ def _handle_message_sent(data: Dict) -> Dict[str, Any]:
             return {"processed": False, "error": "Message ID not provided"}
 
         # Buscar mensaje
-        message = frappe.db.get_value("WhatsApp Message", {"message_id": message_id}, "name")
+        message = frappe.db.get_value("WhatsApp Message", {"message_id": message_id}, ["name", "status"], as_dict=True)
 
         if message:
-            frappe.db.set_value("WhatsApp Message", message, {
+            # Solo avanza desde "Pending": no pisa Delivered/Read ni un fallo ya registrado
+            if message.status != "Pending":
+                return {"processed": True, "action": "stale_status"}
+
+            frappe.db.set_value("WhatsApp Message", message.name, {
                 "status": "Sent",
-                "sent_at": frappe.utils.now()
+                "sent_at": frappe.utils.now(),
+                "send_priority": 0,
+                "next_send_at": None
             })
             return {"processed": True, "action": "updated"}
 
@@ -810,26 +911,47 @@ def _handle_message_status(data: Dict) -> Dict[str, Any]:
         if not message_id or not new_status:
             return {"processed": False, "error": "Invalid data"}
 
-        # Mapear estado
+        # Mapear estado; los acks intermedios (pending) no cambian nada
         status_map = {
+            "sent": "Sent",
+            "server_ack": "Sent",
             "delivered": "Delivered",
+            "delivery_ack": "Delivered",
             "read": "Read",
-            "failed": "Failed"
+            "played": "Read",
+            "failed": "Failed",
+            "error": "Failed"
         }
 
-        frappe_status = status_map.get(new_status.lower(), "Pending")
+        frappe_status = status_map.get(new_status.lower())
+        if not frappe_status:
+            return {"processed": True, "action": "ignored_status"}
 
         # Buscar mensaje
-        message = frappe.db.get_value("WhatsApp Message", {"message_id": message_id}, "name")
+        message = frappe.db.get_value(
+            "WhatsApp Message", {"message_id": message_id},
+            ["name", "conversation", "status", "status_callback"], as_dict=True
+        )
 
         if message:
-            update_data = {"status": frappe_status}
+            # Un webhook atrasado nunca hace retroceder el estado (ni vuelve a encolar un envío)
+            if frappe_status == "Failed":
+                if message.status not in ("Pending", "Sent"):
+                    return {"processed": True, "action": "stale_status"}
+            elif message.status not in STATUS_RANK or STATUS_RANK[frappe_status] <= STATUS_RANK[message.status]:
+                return {"processed": True, "action": "stale_status"}
+
+            # Fuera de la cola de envío: el servidor ya conoce el mensaje
+            update_data = {"status": frappe_status, "send_priority": 0, "next_send_at": None}
 
             if frappe_status == "Read":
                 update_data["is_read"] = True
                 update_data["read_at"] = frappe.utils.now()
 
-            frappe.db.set_value("WhatsApp Message", message, update_data)
+            frappe.db.set_value("WhatsApp Message", message.name, update_data)
+
+            # Avisar al frontend y a quien encoló el envío (p. ej. una difusión)
+            notify_message_status(message.name, frappe_status, None, message.conversation, message.status_callback)
             return {"processed": True, "action": "status_updated"}
 
         return {"processed": False, "error": "Message not found"}
@@ -1044,6 +1166,7 @@ def _handle_chat_update(data: Dict) -> Dict[str, Any]:
             frappe.db.set_value("WhatsApp Conversation", conversation, {
                 "is_archived": is_archived
             })
+            invalidate_conversation_stats(session)
             return {"processed": True, "action": "updated"}
 
         return {"processed": True, "action": "conversation_not_found"}
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Procesamiento por lotes de eventos `message.received`.
+
+El consumidor de la cola de webhooks (`webhook_queue`) agrupa los mensajes
+recibidos consecutivos de una sesión y los procesa aquí en una sola pasada:
+resolución de sesiones y conversaciones con consultas IN, deduplicación por
+(session, message_id), INSERT multi-fila de mensajes y media (con los mismos
+valores por defecto, nombre y validación que `Document.insert`), y una única
+actualización agregada por conversación. El resultado por evento es el mismo
+que el del handler individual `webhook._handle_message_received`.
+"""
+
+import frappe
+from typing import Dict, Any, List, Optional
+from frappe.utils import now_datetime
+from xappiens_whatsapp.utils.conversation_stats import apply_message_delta, is_unread
+from xappiens_whatsapp.utils.trace import trace
+
+from .media_queue import queue_media_download
+from .webhook import (
+    _extract_message_fields,
+    _detect_from_me,
+    _parse_webhook_timestamp,
+    _create_conversation_from_message,
+    _build_message_dict,
+    _build_media_item,
+    _build_message_realtime_payload,
+)
+
+
+BATCH_EVENT = "message.received"
+
+
+def prepare_batch_item(data: Dict, header_event: str = None, header_session: str = None) -> Optional[Dict[str, Any]]:
+    """
+    Comprueba si un webhook puede procesarse por lotes y extrae sus datos.
+
+    Solo se agrupan mensajes recibidos normales; reacciones, payloads incompletos
+    y cualquier otro evento devuelven None y siguen el camino individual.
+
+    Args:
+        data: Payload JSON del webhook
+        header_event: Valor de la cabecera X-Webhook-Event
+        header_session: Valor de la cabecera X-Webhook-Session
+
+    Returns:
+        frappe._dict con event_data, session_id y message_data, o None
+    """
+    if not isinstance(data, dict):
+        return None
+
+    event = header_event or data.get("event")
+    if event != BATCH_EVENT:
+        return None
+
+    event_data = data.get("data")
+    if not event_data:
+        event_data = data.get("message") or data.get("payload")
+    if not isinstance(event_data, dict) or not event_data:
+        return None
+
+    message_data = event_data.get("message") or event_data.get("payload") or event_data
+    if not isinstance(message_data, dict):
+        return None
+
+    if (
+        event_data.get("reactionMessage")
+        or message_data.get("reactionMessage")
+        or data.get("reactionMessage")
+        or (data.get("message") if isinstance(data.get("message"), dict) else {}).get("reactionMessage")
+    ):
+        return None
+
+    session_id = header_session or data.get("sessionId") or event_data.get("sessionId")
+    if session_id:
+        event_data.setdefault("sessionId", session_id)
+
+    return frappe._dict({
+        "event": event,
+        "event_data": event_data,
+        "session_id": event_data.get("sessionId"),
+        "message_data": message_data,
+    })
+
+
+def process_message_batch(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Procesa un lote de mensajes recibidos preparados con `prepare_batch_item`.
+
+    No hace commit: el llamador confirma la transacción. Los eventos realtime y
+    las descargas de media se emiten tras el commit.
+
+    Args:
+        items: Lista de items preparados
+
+    Returns:
+        Lista de resultados (mismo orden que `items`) con el formato de
+        `process_webhook_data`
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+
+    # 1. Sesiones en una sola consulta
+    session_ids = {item.session_id for item in items if item.session_id}
+    sessions = {}
+    if session_ids:
+        for row in frappe.get_all(
+            "WhatsApp Session",
+            filters={"session_id": ["in", list(session_ids)]},
+            fields=["name", "session_id", "phone_number"],
+        ):
+            sessions[row.session_id] = row
+
+    # 2. Extraer campos sin acceder a la BD
+    pending = []
+    for index, item in enumerate(items):
+        session_row = sessions.get(item.session_id)
+        if not session_row:
+            results[index] = _processed(False, error=f"Session not found: {item.session_id}")
+            continue
+
+        fields = _extract_message_fields(item.event_data, item.message_data)
+        if not fields.chat_id:
+            results[index] = _processed(False, error="Chat ID missing")
+            continue
+
+        from_me = _detect_from_me(item.message_data, fields.to_number, fields.from_number, session_row.phone_number)
+        pending.append(frappe._dict({
+            "index": index,
+            "item": item,
+            "session": session_row.name,
+            "session_phone": session_row.phone_number,
+            "fields": fields,
+            "from_me": from_me,
+        }))
+
+    # 3. Deduplicar contra la BD (una consulta) y dentro del propio lote
+    existing = set()
+    message_ids = list({row.fields.message_id for row in pending if row.fields.message_id})
+    if message_ids:
+        existing = {
+            (row.session, row.message_id)
+            for row in frappe.get_all(
+                "WhatsApp Message",
+                filters={"message_id": ["in", message_ids]},
+                fields=["session", "message_id"],
+            )
+        }
+
+    unique_rows = []
+    for row in pending:
+        key = (row.session, row.fields.message_id)
+        if row.fields.message_id and key in existing:
+            results[row.index] = _processed(True, action="duplicate")
+            continue
+        if row.fields.message_id:
+            existing.add(key)
+        unique_rows.append(row)
+
+    if not unique_rows:
+        return _wrap_results(items, results)
+
+    # 4. Conversaciones existentes en una sola consulta; las nuevas se crean una a una
+    conversations = _get_conversations(unique_rows)
+    for row in unique_rows:
+        key = (row.session, row.fields.chat_id)
+        if key not in conversations:
+            conv_doc = _create_conversation_from_message(
+                row.session, row.fields.chat_id, row.fields.from_number, row.item.message_data
+            )
+            conversations[key] = frappe._dict({"name": conv_doc.name, "phone_number": conv_doc.phone_number})
+        row.conversation = conversations[key]
+
+    # 5. Construir documentos y asignar nombres en bloque
+    docs = []
+    for row in unique_rows:
+        fields = row.fields
+        message_id = fields.message_id or frappe.generate_hash(length=20)
+        from_number = fields.from_number
+        if not from_number and not row.from_me:
+            from_number = fields.chat_id.split('@')[0]
+
+        row.message_id = message_id
+        row.from_number = from_number
+        row.timestamp = _parse_webhook_timestamp(fields.timestamp)
+
+        message_doc = frappe.get_doc(_build_message_dict(
+            row.session, row.conversation.name, message_id, fields, from_number, row.from_me, row.timestamp
+        ))
+
+        row.media_item = _build_media_item(fields, message_id) if fields.has_media else None
+        if row.media_item:
+            from .messages import process_media_items
+            process_media_items(message_doc, [row.media_item])
+
+        _prepare_for_insert(message_doc)
+        row.doc = message_doc
+        docs.append(message_doc)
+
+    # 6. INSERT multi-fila de mensajes y de sus media
+    inserted = _bulk_insert_messages(docs)
+
+    # Las filas que no entraron: si su (session, message_id) ya existe, otro
+    # proceso lo insertó entre la deduplicación y el INSERT; si no, se insertan
+    # una a una para no perder el mensaje
+    skipped = [row for row in unique_rows if row.doc.name not in inserted]
+    duplicates = set()
+    if skipped:
+        duplicates = {
+            (row.session, row.message_id)
+            for row in frappe.get_all(
+                "WhatsApp Message",
+                filters={"message_id": ["in", [row.message_id for row in skipped]]},
+                fields=["session", "message_id"],
+            )
+        }
+
+    created_rows = []
+    for row in unique_rows:
+        if row.doc.name not in inserted and ((row.session, row.message_id) in duplicates or not _insert_single(row)):
+            results[row.index] = _processed(True, action="duplicate")
+            continue
+        results[row.index] = _processed(True, action="created", message_id=row.doc.name)
+        created_rows.append(row)
+
+    # 7. Una actualización agregada por conversación; las insertadas una a una
+    # ya la hicieron en after_insert
+    _update_conversations([row for row in created_rows if row.doc.name in inserted])
+
+    # 8. Descargas de media (la cola encola sus workers tras el commit) y eventos realtime
+    for row in created_rows:
+        if row.media_item:
+            try:
+                queue_media_download(row.session, row.doc.name, row.media_item, row.conversation.name)
+            except Exception as e:
+                frappe.log_error(f"Error encolando descarga de media: {str(e)}", "WhatsApp Webhook Media")
+
+        payload = _build_message_realtime_payload(
+            row.session, row.item.session_id, row.conversation.name, row.doc.name, row.message_id,
+            row.fields, row.from_number, row.fields.to_number, row.from_me, row.timestamp,
+            row.conversation.phone_number, row.session_phone,
+        )
+        try:
+            frappe.publish_realtime("whatsapp_message", payload, after_commit=True)
+            frappe.publish_realtime("whatsapp_message_received", payload, after_commit=True)
+        except Exception as e:
+            frappe.log_error(f"Error publicando eventos realtime: {str(e)}", "WhatsApp Webhook Realtime Error")
+
+        trace(row.item.session_id, "Mensaje procesado en lote", "debug", message_id=row.doc.name, payload=payload)
+
+    return _wrap_results(items, results)
+
+
+def _processed(processed: bool, **kwargs) -> Dict[str, Any]:
+    result = {"processed": processed}
+    result.update(kwargs)
+    return result
+
+
+def _wrap_results(items: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Envuelve los resultados con el mismo formato que `process_webhook_data`."""
+    return [
+        {
+            "success": True,
+            "received": True,
+            "processed": result,
+            "event": item.event,
+        }
+        for item, result in zip(items, results)
+    ]
+
+
+def _get_conversations(rows: List[Dict[str, Any]]) -> Dict[tuple, Dict[str, Any]]:
+    """Obtiene las conversaciones existentes del lote indexadas por (session, chat_id)."""
+    session_names = list({row.session for row in rows})
+    chat_ids = list({row.fields.chat_id for row in rows})
+
+    conversations = {}
+    for conv in frappe.get_all(
+        "WhatsApp Conversation",
+        filters={"session": ["in", session_names], "chat_id": ["in", chat_ids]},
+        fields=["name", "session", "chat_id", "phone_number"],
+        order_by="creation asc",
+    ):
+        # Igual que frappe.db.get_value: si hubiera duplicados, gana la primera
+        conversations.setdefault((conv.session, conv.chat_id), conv)
+
+    return conversations
+
+
+def _prepare_for_insert(message_doc) -> None:
+    """
+    Lo mismo que hace `Document.insert` antes de escribir, salvo el INSERT:
+    valores por defecto, nombre (con la serie del framework) y los hooks de
+    antes de guardar.
+    """
+    message_doc._set_defaults()
+    message_doc.set_new_name()
+    message_doc.run_method("before_insert")
+    message_doc.set_parent_in_children()
+    message_doc.run_method("before_validate")
+    message_doc.run_method("validate")
+    message_doc.run_method("before_save")
+
+
+def _bulk_insert_messages(docs: List) -> set:
+    """
+    Inserta los mensajes y sus items de media con INSERT multi-fila.
+
+    Returns:
+        Conjunto de nombres efectivamente insertados (nombre y message_id
+        coinciden con los del documento)
+    """
+    now = now_datetime()
+    user = frappe.session.user
+
+    message_rows = []
+    media_rows = []
+    for doc in docs:
+        doc.owner = doc.modified_by = user
+        doc.creation = doc.modified = now
+        doc.docstatus = 0
+
+        for idx, child in enumerate(doc.get("media_items") or [], start=1):
+            child.name = frappe.generate_hash(length=10)
+            child.parent = doc.name
+            child.parenttype = doc.doctype
+            child.parentfield = "media_items"
+            child.idx = idx
+            child.owner = child.modified_by = user
+            child.creation = child.modified = now
+            child.docstatus = 0
+            media_rows.append(child)
+
+        message_rows.append(doc)
+
+    fields = list(message_rows[0].get_valid_dict(convert_dates_to_str=True).keys())
+    frappe.db.bulk_insert(
+        "WhatsApp Message",
+        fields,
+        [[row.get_valid_dict(convert_dates_to_str=True).get(f) for f in fields] for row in message_rows],
+        ignore_duplicates=True,
+    )
+
+    # INSERT IGNORE omite las filas en conflicto (message_id ya existente o,
+    # en teoría, un nombre ya usado): solo cuenta la fila que es la nuestra
+    expected = {doc.name: doc.message_id for doc in docs}
+    inserted = {
+        row.name
+        for row in frappe.get_all(
+            "WhatsApp Message",
+            filters={"name": ["in", list(expected)]},
+            fields=["name", "message_id"],
+        )
+        if row.message_id == expected[row.name]
+    }
+
+    media_rows = [child for child in media_rows if child.parent in inserted]
+    if media_rows:
+        child_fields = list(media_rows[0].get_valid_dict(convert_dates_to_str=True).keys())
+        frappe.db.bulk_insert(
+            media_rows[0].doctype,
+            child_fields,
+            [[child.get_valid_dict(convert_dates_to_str=True).get(f) for f in child_fields] for child in media_rows],
+        )
+
+    return inserted
+
+
+def _insert_single(row: Dict[str, Any]) -> bool:
+    """
+    Inserta un mensaje que el INSERT multi-fila no pudo escribir por un motivo
+    distinto a un message_id duplicado. `after_insert` actualiza la conversación.
+
+    Returns:
+        True si se ha insertado
+    """
+    doc = frappe.get_doc(_build_message_dict(
+        row.session, row.conversation.name, row.message_id, row.fields, row.from_number, row.from_me, row.timestamp
+    ))
+    if row.media_item:
+        from .messages import process_media_items
+        process_media_items(doc, [row.media_item])
+
+    try:
+        doc.insert(ignore_permissions=True)
+    except (frappe.DuplicateEntryError, frappe.UniqueValidationError):
+        return False
+
+    row.doc = doc
+    return True
+
+
+def _update_conversations(rows: List[Dict[str, Any]]) -> None:
+    """
+    Aplica una única actualización por conversación: suma total y no leídos y
+    fija el último mensaje solo si es más reciente que el actual.
+    """
+    by_conversation = {}
+    for row in rows:
+        agg = by_conversation.setdefault(row.conversation.name, frappe._dict({
+            "total": 0,
+            "unread": 0,
+            "last": None,
+        }))
+        agg.total += 1
+        if is_unread(row.doc.direction, row.doc.status):
+            agg.unread += 1
+        if agg.last is None or row.timestamp >= agg.last.timestamp:
+            agg.last = row
+
+    for conversation, agg in by_conversation.items():
+        last = agg.last
+        apply_message_delta(
+            conversation,
+            total=agg.total,
+            unread=agg.unread,
+            last_message=last.fields.content,
+            last_message_time=last.timestamp,
+            last_message_from_me=last.from_me,
+            session=last.session,
+        )
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cola de ingesta asíncrona para webhooks de Baileys/Inbox Hub.
+
+En modo "Queued" el endpoint `webhook.handle_webhook` solo valida la firma HMAC,
+guarda el evento crudo en `WhatsApp Webhook Event` y responde 200 de inmediato.
+Un consumidor en segundo plano drena la cola de cada sesión en orden de llegada
+y procesa los eventos con los mismos handlers que el modo síncrono. Los
+`message.received` consecutivos se agrupan y se procesan por lotes
+(ver `webhook_batch`).
+
+Los eventos que fallan se reintentan con espera exponencial sobre `attempts`
+y `processed_at` (último intento) hasta MAX_ATTEMPTS; después quedan en
+"Failed" con el último error. Los errores que no pueden resolverse reintentando
+(datos inválidos, sesión inexistente, evento desconocido) agotan los intentos
+en el primer fallo. Los eventos procesados y los fallidos definitivos
+se eliminan pasada la retención de logs.
+"""
+
+import json
+import frappe
+from typing import Dict, Any, List, Optional
+from frappe.utils import now_datetime, add_days, add_to_date, cint
+from xappiens_whatsapp.utils.locks import acquire_lock, release_lock
+
+
+QUEUE_MODE = "Queued"
+DEFAULT_WORKER_QUEUE = "short"
+DEFAULT_BATCH_SIZE = 100
+# Eventos en "Processing" más antiguos que esto se consideran huérfanos (worker caído)
+STALE_PROCESSING_MINUTES = 10
+DRAIN_LOCK_TIMEOUT = 600
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 60
+MAX_RETRY_DELAY = 60 * 60
+# Errores de los handlers que se repetirían en cada reintento
+PERMANENT_ERRORS = (
+    "Invalid data",
+    "Unknown event",
+    "Session not found",
+    "Session ID not provided",
+    "Message data missing",
+    "Message ID not provided",
+    "Chat ID missing",
+    "Reaction message data missing",
+    "Original message ID missing",
+    "Reaction emoji missing",
+)
+
+
+def is_queue_mode_enabled() -> bool:
+    """Indica si el sitio tiene activada la ingesta de webhooks por cola."""
+    return frappe.db.get_single_value("WhatsApp Settings", "webhook_ingestion_mode") == QUEUE_MODE
+
+
+def _get_worker_queue() -> str:
+    """Cola RQ donde corre el consumidor (configurable para usar un worker dedicado)."""
+    return frappe.db.get_single_value("WhatsApp Settings", "webhook_worker_queue") or DEFAULT_WORKER_QUEUE
+
+
+def enqueue_webhook_event(raw_payload: str, event: Optional[str] = None, session_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Persiste un webhook crudo (ya validado) y programa su procesamiento.
+
+    Args:
+        raw_payload: Cuerpo original del webhook
+        event: Tipo de evento (cabecera X-Webhook-Event)
+        session_id: Sesión de Baileys (cabecera X-Webhook-Session)
+
+    Returns:
+        Dict de acuse para el proveedor
+    """
+    if not session_id or not event:
+        # Solo se parsea si faltan las cabeceras, para poder ordenar por sesión
+        try:
+            data = json.loads(raw_payload)
+        except json.JSONDecodeError:
+            frappe.log_error(f"Invalid JSON payload: {raw_payload}")
+            return {"success": False, "error": "Invalid JSON"}
+
+        if isinstance(data, dict):
+            event_data = data.get("data") if isinstance(data.get("data"), dict) else {}
+            session_id = session_id or data.get("sessionId") or event_data.get("sessionId")
+            event = event or data.get("event")
+
+    event_doc = frappe.get_doc({
+        "doctype": "WhatsApp Webhook Event",
+        "received_at": now_datetime(),
+        "session_id": session_id or "",
+        "event": event,
+        "status": "Queued",
+        "payload": raw_payload,
+    })
+    # db_insert evita validaciones y hooks: la ingesta debe ser lo más ligera posible
+    event_doc.db_insert()
+    frappe.db.commit()
+
+    _schedule_drain(event_doc.session_id)
+
+    return {
+        "success": True,
+        "received": True,
+        "queued": True,
+        "event": event,
+        "event_id": event_doc.name,
+    }
+
+
+def _schedule_drain(session_id: str):
+    """Encola el consumidor de la sesión (deduplicado por sesión)."""
+    frappe.enqueue(
+        "xappiens_whatsapp.api.webhook_queue.drain_session_events",
+        queue=_get_worker_queue(),
+        timeout=DRAIN_LOCK_TIMEOUT,
+        job_id=f"whatsapp_webhook_drain::{frappe.local.site}::{session_id}",
+        deduplicate=True,
+        session_id=session_id,
+    )
+
+
+def _get_batch_size() -> int:
+    """Eventos leídos por iteración y tamaño máximo de lote de mensajes."""
+    return cint(frappe.db.get_single_value("WhatsApp Settings", "webhook_batch_size")) or DEFAULT_BATCH_SIZE
+
+
+def drain_session_events(session_id: str, batch_size: Optional[int] = None):
+    """
+    Procesa en orden de llegada todos los eventos en cola de una sesión.
+
+    Solo un consumidor por sesión a la vez (lock en Redis). Tras liberar el lock
+    se vuelve a comprobar la cola para no dejar eventos que llegaron justo al final.
+
+    Args:
+        session_id: Sesión de Baileys
+        batch_size: Eventos leídos por iteración (por defecto, `webhook_batch_size`)
+    """
+    lock_key = f"webhook_drain:{session_id}"
+    batch_size = cint(batch_size) or _get_batch_size()
+
+    while True:
+        token = acquire_lock(lock_key, timeout=DRAIN_LOCK_TIMEOUT)
+        if not token:
+            break
+
+        try:
+            while True:
+                events = frappe.get_all(
+                    "WhatsApp Webhook Event",
+                    filters={"status": "Queued", "session_id": session_id or ""},
+                    fields=["name", "event", "session_id", "payload", "attempts"],
+                    order_by="name asc",
+                    limit_page_length=batch_size,
+                )
+
+                if not events:
+                    break
+
+                _process_events(events, batchable=batch_size > 1)
+        finally:
+            release_lock(lock_key, token)
+
+        if not _has_pending_events(session_id):
+            break
+
+
+def _process_events(events: List[Dict[str, Any]], batchable: bool = True):
+    """
+    Procesa eventos en orden de llegada. Las rachas de `message.received`
+    consecutivos se procesan juntas con `webhook_batch.process_message_batch`;
+    el resto de eventos (y cualquier lote que falle) va por `_process_event`.
+    """
+    from .webhook_batch import prepare_batch_item
+
+    batch = []
+    for event_row in events:
+        data = None
+        item = None
+        try:
+            data = json.loads(event_row.payload or "{}")
+            if batchable:
+                item = prepare_batch_item(data, event_row.event, event_row.session_id or None)
+        except Exception:
+            pass
+
+        if item:
+            batch.append((event_row, item))
+            continue
+
+        # Mantener el orden: vaciar el lote antes de un evento no agrupable
+        _process_batch(batch)
+        batch = []
+        _process_event(event_row, data)
+
+    _process_batch(batch)
+
+
+def _process_batch(batch: List[tuple]):
+    """Procesa un lote de mensajes recibidos; si falla, reintenta evento a evento."""
+    if not batch:
+        return
+
+    if len(batch) == 1:
+        _process_event(batch[0][0])
+        return
+
+    from .webhook_batch import process_message_batch
+
+    names = [event_row.name for event_row, _item in batch]
+    frappe.db.sql("""
+        UPDATE `tabWhatsApp Webhook Event`
+        SET status = 'Processing', attempts = attempts + 1, modified = %s
+        WHERE name IN %s
+    """, (now_datetime(), tuple(names)))
+    frappe.db.commit()
+
+    try:
+        results = process_message_batch([item for _event_row, item in batch])
+        frappe.db.commit()
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(
+            f"Error procesando lote de {len(batch)} webhooks, se reintenta uno a uno: {str(e)}\n{frappe.get_traceback()}",
+            "WhatsApp Webhook Queue",
+        )
+        for event_row, _item in batch:
+            _process_event(event_row)
+        return
+
+    processed_at = now_datetime()
+    for (event_row, _item), result in zip(batch, results):
+        status, error = _result_status(result)
+        values = {"status": status, "processed_at": processed_at, "error": (error or "")[:1000] or None}
+        if error and _is_permanent_error(error):
+            values["attempts"] = MAX_ATTEMPTS
+        frappe.db.set_value("WhatsApp Webhook Event", event_row.name, values)
+    frappe.db.commit()
+
+
+def _result_status(result: Dict[str, Any]) -> tuple:
+    """Traduce el resultado de `process_webhook_data` a (status, error)."""
+    error = None if result.get("success") else result.get("error")
+    processed = result.get("processed")
+    if isinstance(processed, dict) and processed.get("processed") is False:
+        error = processed.get("error")
+    return ("Failed" if error else "Processed"), error
+
+
+def _is_permanent_error(error: str) -> bool:
+    """Indica si un error de handler se repetiría al reintentar (ver PERMANENT_ERRORS)."""
+    return str(error).startswith(PERMANENT_ERRORS)
+
+
+def _process_event(event_row: Dict[str, Any], data: Optional[Dict] = None):
+    """Procesa un evento de la cola y registra el resultado."""
+    from .webhook import process_webhook_data
+
+    frappe.db.set_value(
+        "WhatsApp Webhook Event", event_row.name,
+        {"status": "Processing", "attempts": cint(event_row.attempts) + 1},
+    )
+    frappe.db.commit()
+
+    try:
+        if data is None:
+            data = json.loads(event_row.payload or "{}")
+        result = process_webhook_data(data, event_row.event, event_row.session_id or None)
+        frappe.db.commit()
+
+        status, error = _result_status(result)
+        permanent = bool(error) and _is_permanent_error(error)
+
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(
+            f"Error procesando webhook en cola {event_row.name}: {str(e)}\n{frappe.get_traceback()}",
+            "WhatsApp Webhook Queue",
+        )
+        status = "Failed"
+        error = str(e)
+        # Payload corrupto o datos rechazados por validación: reintentar no cambia el resultado
+        permanent = isinstance(e, (ValueError, frappe.ValidationError))
+
+    values = {"status": status, "processed_at": now_datetime(), "error": (error or "")[:1000] or None}
+    if permanent:
+        values["attempts"] = MAX_ATTEMPTS
+    frappe.db.set_value("WhatsApp Webhook Event", event_row.name, values)
+    frappe.db.commit()
+
+
+def _has_pending_events(session_id: str) -> bool:
+    return bool(frappe.db.exists("WhatsApp Webhook Event", {"status": "Queued", "session_id": session_id or ""}))
+
+
+def _retry_delay(attempts: int) -> int:
+    """Espera antes de reintentar un evento con `attempts` intentos (60 s, 120 s, 240 s...)."""
+    return min(RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), MAX_RETRY_DELAY)
+
+
+def _requeue_failed_events() -> int:
+    """
+    Devuelve a la cola los eventos fallidos cuya espera ya venció.
+
+    Returns:
+        Número de eventos reencolados
+    """
+    now = now_datetime()
+    failed = frappe.db.sql("""
+        SELECT name, attempts, processed_at
+        FROM `tabWhatsApp Webhook Event`
+        WHERE status = 'Failed' AND attempts < %s
+        ORDER BY name ASC
+        LIMIT 1000
+    """, (MAX_ATTEMPTS,), as_dict=True)
+
+    due = [
+        row.name for row in failed
+        if not row.processed_at or add_to_date(row.processed_at, seconds=_retry_delay(cint(row.attempts))) <= now
+    ]
+    if due:
+        frappe.db.sql("""
+            UPDATE `tabWhatsApp Webhook Event`
+            SET status = 'Queued'
+            WHERE name IN %s AND status = 'Failed'
+        """, (tuple(due),))
+
+    return len(due)
+
+
+def process_pending_events():
+    """
+    Tarea programada de respaldo: reencola eventos huérfanos en "Processing" y
+    fallidos con reintentos pendientes, y programa el consumidor de cada sesión
+    con eventos pendientes.
+    """
+    stale_before = add_to_date(now_datetime(), minutes=-STALE_PROCESSING_MINUTES)
+    frappe.db.sql("""
+        UPDATE `tabWhatsApp Webhook Event`
+        SET status = 'Queued'
+        WHERE status = 'Processing' AND modified < %s
+    """, (stale_before,))
+    _requeue_failed_events()
+    frappe.db.commit()
+
+    sessions = frappe.db.sql_list("""
+        SELECT DISTINCT session_id
+        FROM `tabWhatsApp Webhook Event`
+        WHERE status = 'Queued'
+    """)
+
+    for session_id in sessions:
+        _schedule_drain(session_id or "")
+
+
+def cleanup_processed_events():
+    """
+    Elimina los eventos procesados y los fallidos sin más reintentos más
+    antiguos que la retención de logs configurada.
+    """
+    retention_days = cint(frappe.db.get_single_value("WhatsApp Settings", "max_log_retention_days")) or 30
+
+    frappe.db.sql("""
+        DELETE FROM `tabWhatsApp Webhook Event`
+        WHERE received_at < %s
+            AND (status = 'Processed' OR (status = 'Failed' AND attempts >= %s))
+    """, (add_days(now_datetime(), -retention_days), MAX_ATTEMPTS))
+    frappe.db.commit()
+
+
+@frappe.whitelist()
+def get_webhook_queue_metrics() -> Dict[str, Any]:
+    """
+    Métricas de la cola de ingesta: profundidad por estado y sesión, y retraso.
+
+    Returns:
+        Dict con depth, lag (segundos) del evento más antiguo pendiente y
+        latencia media de procesamiento de los últimos 15 minutos
+    """
+    frappe.only_for(["System Manager", "WhatsApp Manager"])
+
+    by_status = frappe.db.sql("""
+        SELECT status, COUNT(*) AS count
+        FROM `tabWhatsApp Webhook Event`
+        GROUP BY status
+    """, as_dict=True)
+
+    by_session = frappe.db.sql("""
+        SELECT
+            session_id,
+            COUNT(*) AS depth,
+            TIMESTAMPDIFF(SECOND, MIN(received_at), NOW()) AS lag_seconds
+        FROM `tabWhatsApp Webhook Event`
+        WHERE status = 'Queued'
+        GROUP BY session_id
+        ORDER BY depth DESC
+    """, as_dict=True)
+
+    recent = frappe.db.sql("""
+        SELECT
+            COUNT(*) AS processed,
+            AVG(TIMESTAMPDIFF(MICROSECOND, received_at, processed_at)) / 1000000 AS avg_latency_seconds,
+            MAX(TIMESTAMPDIFF(MICROSECOND, received_at, processed_at)) / 1000000 AS max_latency_seconds
+        FROM `tabWhatsApp Webhook Event`
+        WHERE status IN ('Processed', 'Failed') AND processed_at >= %s
+    """, (add_to_date(now_datetime(), minutes=-15),), as_dict=True)[0]
+
+    return {
+        "success": True,
+        "mode": frappe.db.get_single_value("WhatsApp Settings", "webhook_ingestion_mode") or "Inline",
+        "depth": {row.status: row.count for row in by_status},
+        "queued_total": sum(row.depth for row in by_session),
+        "max_lag_seconds": max((row.lag_seconds or 0 for row in by_session), default=0),
+        "sessions": by_session,
+        "last_15_minutes": recent,
+    }
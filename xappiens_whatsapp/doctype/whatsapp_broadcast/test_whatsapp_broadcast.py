@@ -0,0 +1,141 @@
+# Copyright (c) 2025, Xappiens and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from xappiens_whatsapp.api.broadcast import (
+	cancel_broadcast,
+	create_broadcast,
+	on_message_status,
+	process_broadcast,
+	start_broadcast,
+)
+
+
+TEST_SESSION_ID = "_test_broadcast"
+
+
+class TestWhatsAppBroadcast(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.session = frappe.get_doc({
+			"doctype": "WhatsApp Session",
+			"session_id": TEST_SESSION_ID,
+			"session_name": TEST_SESSION_ID,
+			"status": "Connected",
+			"is_connected": 1,
+			"is_active": 1,
+		}).insert(ignore_permissions=True)
+		cls.conversation = frappe.get_doc({
+			"doctype": "WhatsApp Conversation",
+			"session": cls.session.name,
+			"chat_id": "34670000101@s.whatsapp.net",
+			"phone_number": "34670000101",
+			"status": "Active",
+		}).insert(ignore_permissions=True)
+
+	@classmethod
+	def tearDownClass(cls):
+		frappe.db.set_value("WhatsApp Session", cls.session.name, "is_connected", 0)
+		frappe.delete_doc("WhatsApp Session", cls.session.name, force=True, ignore_permissions=True)
+		frappe.db.commit()
+		super().tearDownClass()
+
+	def test_broadcast_fans_out_once_and_tracks_outcomes(self):
+		with patch("xappiens_whatsapp.api.broadcast.frappe.enqueue"):
+			result = create_broadcast(
+				[
+					{"phone_number": "+34 670 000 101", "recipient_name": "Ana", "plan": "Pro"},
+					{"phone": "34670000102", "name": "Luis", "plan": "Basic"},
+					"123",
+					"0034670000101",
+				],
+				"Hola {{ recipient_name }}, tu plan {{ plan }}",
+				title="_Test Broadcast",
+				session=self.session.name,
+			)
+
+		self.assertTrue(result["success"])
+		# El duplicado (mismo número con otro formato) se descarta al validar
+		self.assertEqual(result["total_recipients"], 3)
+
+		with patch("xappiens_whatsapp.api.broadcast.schedule_sender") as schedule_sender:
+			process_broadcast(result["broadcast"])
+			# Relanzar el job (p. ej. tras reiniciar el worker) no vuelve a encolar nada
+			process_broadcast(result["broadcast"])
+
+		schedule_sender.assert_called_once_with(self.session.name)
+
+		broadcast = frappe.get_doc("WhatsApp Broadcast", result["broadcast"])
+		ana, luis, invalid = broadcast.recipients
+		self.assertEqual((ana.status, ana.conversation), ("Queued", self.conversation.name))
+		self.assertEqual(invalid.status, "Skipped")
+		self.assertEqual(luis.status, "Queued")
+		self.assertEqual(
+			frappe.db.get_value("WhatsApp Conversation", luis.conversation, "chat_id"),
+			"34670000102@s.whatsapp.net",
+		)
+
+		message = frappe.db.get_value(
+			"WhatsApp Message", ana.message, ["content", "status", "send_priority"], as_dict=True
+		)
+		self.assertEqual(message.content, "Hola Ana, tu plan Pro")
+		self.assertEqual(message.status, "Pending")
+		self.assertEqual(frappe.db.count("WhatsApp Message", {"conversation": self.conversation.name}), 1)
+		self.assertEqual((broadcast.status, broadcast.pending_count, broadcast.failed_count), ("Running", 2, 1))
+
+		# Los avisos de estado llegan por el callback de la cola; uno atrasado no hace retroceder
+		on_message_status(ana.message, "Delivered")
+		on_message_status(ana.message, "Sent")
+		on_message_status(luis.message, "Failed", "Número no válido")
+
+		broadcast.reload()
+		self.assertEqual(broadcast.recipients[0].status, "Delivered")
+		self.assertEqual(broadcast.recipients[1].error, "Número no válido")
+		self.assertEqual(
+			(broadcast.status, broadcast.sent_count, broadcast.delivered_count, broadcast.failed_count),
+			("Completed", 1, 1, 2),
+		)
+
+	def test_cancel_fails_queued_messages_through_status_path(self):
+		with patch("xappiens_whatsapp.api.broadcast.frappe.enqueue"):
+			result = create_broadcast(["34670000103", "34670000104"], "Hola", session=self.session.name)
+		with patch("xappiens_whatsapp.api.broadcast.schedule_sender"):
+			process_broadcast(result["broadcast"])
+
+		messages = frappe.get_all(
+			"WhatsApp Broadcast Recipient", filters={"parent": result["broadcast"]}, pluck="message"
+		)
+		with patch("xappiens_whatsapp.api.outbound_queue.frappe.publish_realtime") as publish:
+			cancelled = cancel_broadcast(result["broadcast"])
+
+		self.assertEqual((cancelled["status"], cancelled["pending_count"], cancelled["failed_count"]), ("Cancelled", 0, 2))
+		self.assertEqual(
+			[call.args[1]["status"] for call in publish.call_args_list if call.args[0] == "whatsapp_message_status"],
+			["Failed", "Failed"],
+		)
+		for message in messages:
+			self.assertEqual(
+				frappe.db.get_value("WhatsApp Message", message, ["status", "send_priority"]), ("Failed", 0)
+			)
+		self.assertEqual(
+			set(frappe.get_all("WhatsApp Broadcast Recipient", filters={"parent": result["broadcast"]}, pluck="error")),
+			{"Difusión cancelada"},
+		)
+
+	def test_broadcast_fails_when_fixed_session_is_gone(self):
+		result = create_broadcast(["34670000105"], "Hola", session=self.session.name, start=False)
+		frappe.db.set_value("WhatsApp Broadcast", result["broadcast"], "session", "_test_deleted_session")
+
+		with patch("xappiens_whatsapp.api.broadcast.frappe.enqueue"):
+			start_broadcast(result["broadcast"])
+		process_broadcast(result["broadcast"])
+
+		broadcast = frappe.get_doc("WhatsApp Broadcast", result["broadcast"])
+		self.assertEqual((broadcast.status, broadcast.failed_count), ("Completed", 1))
+		self.assertEqual(broadcast.recipients[0].status, "Failed")
+		self.assertIn("_test_deleted_session", broadcast.recipients[0].error)
@@ -0,0 +1,29 @@
+// Copyright (c) 2025, Xappiens and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("WhatsApp Broadcast", {
+	refresh(frm) {
+		if (frm.is_new()) return;
+
+		if (frm.doc.status === "Draft") {
+			frm.add_custom_button(__("Iniciar envío"), () => {
+				frm.call("start_broadcast").then(() => frm.reload_doc());
+			}).addClass("btn-primary");
+		}
+
+		if (["Queued", "Running"].includes(frm.doc.status)) {
+			frm.add_custom_button(__("Cancelar envío"), () => {
+				frappe.confirm(__("¿Cancelar los envíos pendientes de esta difusión?"), () => {
+					frm.call("cancel_broadcast").then(() => frm.reload_doc());
+				});
+			});
+
+			const done = frm.doc.total_recipients - frm.doc.pending_count;
+			frm.dashboard.show_progress(
+				__("Progreso"),
+				frm.doc.total_recipients ? (done * 100) / frm.doc.total_recipients : 0,
+				__("{0} de {1} procesados", [done, frm.doc.total_recipients])
+			);
+		}
+	},
+});
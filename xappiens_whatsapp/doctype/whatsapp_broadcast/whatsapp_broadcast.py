@@ -0,0 +1,47 @@
+# Copyright (c) 2025, Xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+from xappiens_whatsapp.utils.phone import normalize_phone_number
+
+
+class WhatsAppBroadcast(Document):
+	def validate(self):
+		"""Drop repeated recipients while the broadcast is a draft and refresh the totals."""
+		if self.status == "Draft":
+			self.dedupe_recipients()
+			self.pending_count = len(self.recipients)
+
+		self.total_recipients = len(self.recipients)
+
+	def dedupe_recipients(self):
+		"""Keep the first row of each phone number (compared in E.164)."""
+		seen = set()
+		unique = []
+		for row in self.recipients:
+			key = normalize_phone_number(row.phone_number) or (row.phone_number or "").strip()
+			if key in seen:
+				continue
+			seen.add(key)
+			unique.append(row)
+
+		if len(unique) != len(self.recipients):
+			for idx, row in enumerate(unique, start=1):
+				row.idx = idx
+			self.set("recipients", unique)
+
+	@frappe.whitelist()
+	def start_broadcast(self):
+		"""Queue the broadcast for sending."""
+		from xappiens_whatsapp.api.broadcast import start_broadcast
+
+		return start_broadcast(self.name)
+
+	@frappe.whitelist()
+	def cancel_broadcast(self):
+		"""Stop the broadcast; messages already sent are kept."""
+		from xappiens_whatsapp.api.broadcast import cancel_broadcast
+
+		return cancel_broadcast(self.name)
@@ -1,9 +1,176 @@
 # Copyright (c) 2025, Xappiens and Contributors
 # See license.txt
 
-# import frappe
+from io import BytesIO
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, now_datetime
+from PIL import Image
+
+from xappiens_whatsapp.api.avatars import AVATAR_FAILURES_KEY, AVATAR_FIELDS, _get_refresh_days, _store_avatar, refresh_avatars
+from xappiens_whatsapp.api.contacts import _bulk_upsert_contacts
+from xappiens_whatsapp.utils.phone import (
+	backfill_normalized_phones,
+	get_default_country_code,
+	normalize_phone_number,
+	phone_variants,
+)
+
+TEST_SESSION_ID = "_test_contact_sync"
 
 
 class TestWhatsAppContact(FrappeTestCase):
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.session = frappe.get_doc({
+			"doctype": "WhatsApp Session",
+			"session_id": TEST_SESSION_ID,
+			"session_name": TEST_SESSION_ID,
+			"status": "Disconnected",
+		}).insert(ignore_permissions=True)
+
+	@classmethod
+	def tearDownClass(cls):
+		frappe.db.delete("WhatsApp Contact", {"session": cls.session.name})
+		cls.session.delete(ignore_permissions=True)
+		super().tearDownClass()
+
+	def test_bulk_upsert_contacts_constant_query_count(self):
+		def payload(count, name="Contacto"):
+			return [
+				{"id": f"3465000{i:04d}@c.us", "number": f"3465000{i:04d}", "name": f"{name} {i}", "isUser": True}
+				for i in range(count)
+			]
+
+		sql = frappe.db.sql
+		with patch.object(frappe.db, "sql", wraps=sql) as counted:
+			result = _bulk_upsert_contacts(self.session, payload(50))
+		self.assertEqual(result["created"], 50)
+		self.assertLess(counted.call_count, 10)
+		self.assertEqual(
+			frappe.db.get_value("WhatsApp Contact", "34650000007@c.us", "normalized_phone"),
+			"+34650000007"
+		)
+
+		# Sin cambios no se escribe nada; solo se actualizan las filas modificadas
+		self.assertEqual(_bulk_upsert_contacts(self.session, payload(50))["unchanged"], 50)
+
+		changed = payload(50)
+		changed[3]["name"] = "Renombrado"
+		result = _bulk_upsert_contacts(self.session, changed)
+		self.assertEqual((result["updated"], result["unchanged"]), (1, 49))
+		self.assertEqual(frappe.db.get_value("WhatsApp Contact", "34650000003@c.us", "contact_name"), "Renombrado")
+
+	def test_store_avatar_reuses_unchanged_image(self):
+		_bulk_upsert_contacts(self.session, [
+			{"id": f"3466000{i:04d}@c.us", "number": f"3466000{i:04d}", "name": f"Avatar {i}"} for i in range(2)
+		])
+
+		image = BytesIO()
+		Image.new("RGB", (640, 640), (37, 211, 102)).save(image, format="PNG")
+		download = {"content": image.getvalue(), "content_type": "image/png"}
+
+		def store(contact_name):
+			contact = frappe.db.get_value("WhatsApp Contact", contact_name, AVATAR_FIELDS, as_dict=True)
+			return _store_avatar(contact, "https://example.com/avatar.png", download)
+
+		self.assertEqual(store("34660000000@c.us"), "updated")
+		self.assertEqual(store("34660000000@c.us"), "unchanged")
+
+		# Otro contacto con la misma imagen reutiliza los File existentes
+		files = frappe.db.count("File")
+		self.assertEqual(store("34660000001@c.us"), "updated")
+		self.assertEqual(frappe.db.count("File"), files)
+
+		contact = frappe.db.get_value("WhatsApp Contact", "34660000001@c.us", ["profile_pic", "profile_pic_thumb"], as_dict=True)
+		self.assertNotEqual(contact.profile_pic, contact.profile_pic_thumb)
+		thumbnail = frappe.get_doc("File", {"file_url": contact.profile_pic_thumb}).get_content()
+		self.assertLessEqual(max(Image.open(BytesIO(thumbnail)).size), 96)
+
+		# Los File compartidos no van adjuntos: borrar un contacto no borra la foto del otro
+		self.assertFalse(frappe.db.get_value("File", {"file_url": contact.profile_pic}, "attached_to_doctype"))
+		frappe.delete_doc("WhatsApp Contact", "34660000000@c.us", ignore_permissions=True)
+		self.assertTrue(frappe.db.exists("File", {"file_url": contact.profile_pic}))
+		self.assertTrue(frappe.db.exists("File", {"file_url": contact.profile_pic_thumb}))
+
+	def test_failed_avatar_download_backs_off(self):
+		_bulk_upsert_contacts(self.session, [{"id": "34667000000@c.us", "number": "34667000000", "name": "Sin foto"}])
+		frappe.cache().hdel(AVATAR_FAILURES_KEY, "34667000000@c.us")
+
+		def refresh(force=False):
+			with patch("xappiens_whatsapp.api.avatars._download_avatar", return_value={"error": "Error HTTP 404"}):
+				result = refresh_avatars(
+					["34667000000@c.us"], force=force, avatar_urls={"34667000000@c.us": "https://example.com/a.png"}
+				)
+			return result["34667000000@c.us"]["status"]
+
+		def wait_hours():
+			# Horas hasta que el contacto vuelva a caducar
+			checked = frappe.db.get_value("WhatsApp Contact", "34667000000@c.us", "last_profile_pic_update")
+			return round((checked - add_days(now_datetime(), -_get_refresh_days())).total_seconds() / 3600)
+
+		self.assertEqual(refresh(), "error")
+		self.assertEqual(wait_hours(), 1)
+		# Dentro de la espera no se vuelve a intentar
+		self.assertEqual(refresh(), "fresh")
+
+		# Cada fallo consecutivo duplica la espera
+		self.assertEqual(refresh(force=True), "error")
+		self.assertEqual(wait_hours(), 2)
+		frappe.cache().hdel(AVATAR_FAILURES_KEY, "34667000000@c.us")
+
+	def test_normalize_phone_number(self):
+		with patch("xappiens_whatsapp.utils.phone.get_default_country_code", return_value="34"):
+			for phone in (
+				"+34657032985", "34657032985", "0034657032985", "+34 657 03 29 85",
+				"657032985", "34657032985@c.us", "34657032985:12@s.whatsapp.net",
+			):
+				self.assertEqual(normalize_phone_number(phone), "+34657032985", phone)
+
+			# Grupos, difusiones, LIDs y valores que no son un número completo
+			for phone in (None, "", "120363000000000000@g.us", "status@broadcast", "123456789012@lid", "1234", "1" * 16):
+				self.assertEqual(normalize_phone_number(phone), "", phone)
+
+			# Un número de 9 dígitos con + ya es internacional
+			self.assertEqual(normalize_phone_number("+123456789"), "+123456789")
+			self.assertEqual(normalize_phone_number("657032985", country_code="351"), "+351657032985")
+
+	def test_default_country_code_comes_from_settings(self):
+		with patch.object(frappe.db, "get_single_value", return_value="+1 "):
+			self.assertEqual(get_default_country_code(), "1")
+			self.assertEqual(normalize_phone_number("415555267"), "+1415555267")
+			self.assertEqual(phone_variants("415555267")[-2:], ["415555267", "+1 415555267"])
+
+		with patch.object(frappe.db, "get_single_value", return_value=None):
+			self.assertEqual(get_default_country_code(), "34")
+
+	def test_phone_variants(self):
+		with patch("xappiens_whatsapp.utils.phone.get_default_country_code", return_value="34"):
+			self.assertEqual(
+				phone_variants("657 032 985"),
+				["+34657032985", "34657032985", "0034657032985", "657032985", "+34 657032985"],
+			)
+			# Otros países: sin formas nacionales
+			self.assertEqual(phone_variants("+447700900123"), ["+447700900123", "447700900123", "00447700900123"])
+			self.assertEqual(phone_variants("120363000000000000@g.us"), [])
+
+	def test_backfill_normalized_phones(self):
+		_bulk_upsert_contacts(self.session, [
+			{"id": "34668000001@c.us", "number": "34668000001", "name": "Sin normalizar"},
+			{"id": "120363000000000001@g.us", "name": "Grupo", "isGroup": True},
+		])
+		names = ["34668000001@c.us", "120363000000000001@g.us"]
+		frappe.db.set_value("WhatsApp Contact", {"name": ["in", names]}, "normalized_phone", None, update_modified=False)
+
+		with patch("xappiens_whatsapp.utils.phone.get_default_country_code", return_value="34"):
+			updated = backfill_normalized_phones("WhatsApp Contact", chunk_size=1)
+		self.assertGreaterEqual(updated["WhatsApp Contact"], 2)
+		self.assertEqual(list(updated), ["WhatsApp Contact"])
+
+		# Los que no tienen número quedan con "" para no volver a procesarlos
+		self.assertEqual(frappe.db.get_value("WhatsApp Contact", names[0], "normalized_phone"), "+34668000001")
+		self.assertEqual(frappe.db.get_value("WhatsApp Contact", names[1], "normalized_phone"), "")
+		self.assertEqual(backfill_normalized_phones("WhatsApp Contact"), {"WhatsApp Contact": 0})
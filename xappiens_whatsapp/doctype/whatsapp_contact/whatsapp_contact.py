@@ -5,6 +5,8 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import now
 
+from xappiens_whatsapp.utils.phone import get_conversation_phone, phone_variants
+
 
 class WhatsAppContact(Document):
 	def before_insert(self):
@@ -34,6 +36,8 @@ class WhatsAppContact(Document):
 		if not self.session:
 			frappe.throw("Session is required")
 
+		self.normalized_phone = get_conversation_phone(self.phone_number, self.contact_id, self.is_group)
+
 		# Ensure contact_name doesn't exceed 140 characters if provided
 		if self.contact_name and len(self.contact_name) > 140:
 			self.contact_name = self.contact_name[:140]
@@ -47,9 +51,13 @@ class WhatsAppContact(Document):
 		"""Automatically link to Lead if phone number matches."""
 		try:
 			# Search for Lead with matching phone
+			variants = phone_variants(self.normalized_phone)
+			if not variants:
+				return
+
 			lead = frappe.db.get_value(
 				"CRM Lead",
-				{"mobile_no": self.phone_number},
+				{"mobile_no": ["in", variants]},
 				["name", "lead_name"],
 				as_dict=True
 			)
@@ -69,9 +77,13 @@ class WhatsAppContact(Document):
 		"""Automatically link to Customer if phone number matches."""
 		try:
 			# Search for Customer with matching phone
+			variants = phone_variants(self.normalized_phone)
+			if not variants:
+				return
+
 			customer = frappe.db.get_value(
 				"CRM Organization",
-				{"mobile_no": self.phone_number},
+				{"mobile_no": ["in", variants]},
 				["name", "organization_name"],
 				as_dict=True
 			)
@@ -382,3 +394,9 @@ class WhatsAppContact(Document):
 				"message": f"Error en vinculación masiva: {str(e)}"
 			}
 
+
+def on_doctype_update():
+	"""Índices compuestos para las consultas frecuentes (ver utils/indexes.py)"""
+	from xappiens_whatsapp.utils.indexes import ensure_indexes
+
+	ensure_indexes("WhatsApp Contact")
@@ -1,9 +1,439 @@
 # Copyright (c) 2025, Xappiens and Contributors
 # See license.txt
 
-# import frappe
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from zoneinfo import ZoneInfo
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, get_system_timezone, now_datetime
+
+from xappiens_whatsapp.api.conversations import get_conversations
+from xappiens_whatsapp.api.conversations_filters import (
+	build_conversation_conditions,
+	compile_order_by,
+	get_conversation_stats,
+)
+from xappiens_whatsapp.api.message_projection import get_message_history
+from xappiens_whatsapp.api.message_sync import (
+	get_conversations_to_sync,
+	set_resume_point,
+	sync_conversation_messages,
+)
+from xappiens_whatsapp.api.messages import get_messages
+from xappiens_whatsapp.api.unified_contacts import get_unified_contacts
+
+TEST_SESSION_ID = "_test_conversation_list"
+
+
+class FakeMessagesClient:
+	"""Servidor de mensajes en memoria con la paginación de la API (más recientes primero)."""
+
+	def __init__(self):
+		self.messages = []
+		self.pages = []
+
+	def get_chat_messages(self, chat_id, page=1, limit=50):
+		self.pages.append(page)
+		newest_first = list(reversed(self.messages))
+		return {"success": True, "data": {"messages": newest_first[(page - 1) * limit:page * limit]}}
 
 
 class TestWhatsAppConversation(FrappeTestCase):
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+
+		session = frappe.get_doc({
+			"doctype": "WhatsApp Session",
+			"session_id": TEST_SESSION_ID,
+			"session_name": TEST_SESSION_ID,
+			"status": "Disconnected",
+		}).insert(ignore_permissions=True)
+		# Sesión recién sincronizada: get_conversations no programa refrescos
+		session.db_set("last_conversations_sync", now_datetime())
+		cls.session = session.name
+
+		for i in range(30):
+			conversation = frappe.get_doc({
+				"doctype": "WhatsApp Conversation",
+				"session": cls.session,
+				"chat_id": f"3460000{i:04d}@s.whatsapp.net",
+				"contact_name": f"Test {i}",
+				"phone_number": f"3460000{i:04d}",
+				"status": "Active",
+			}).insert(ignore_permissions=True)
+
+			for j in range(2):
+				frappe.get_doc({
+					"doctype": "WhatsApp Message",
+					"session": cls.session,
+					"conversation": conversation.name,
+					"message_id": f"{TEST_SESSION_ID}_{i}_{j}",
+					"content": f"Mensaje {j}",
+					"direction": "Incoming",
+					"message_type": "text",
+					"timestamp": add_to_date(now_datetime(), minutes=-(i * 10 + j)),
+				}).insert(ignore_permissions=True)
+
+	def count_queries(self, method=None, **kwargs):
+		"""Ejecuta get_conversations (u otro método) y devuelve (resultado, número de consultas SQL)."""
+		if method is None:
+			method = get_conversations
+			kwargs["session_id"] = self.session
+
+		sql = frappe.db.sql
+		with patch.object(frappe.db, "sql", wraps=sql) as counted:
+			result = method(**kwargs)
+		return result, counted.call_count
+
+	def test_get_conversations_constant_query_count(self):
+		small, small_queries = self.count_queries(limit=5)
+		large, large_queries = self.count_queries(limit=25)
+
+		self.assertTrue(small["success"])
+		self.assertEqual(len(small["conversations"]), 5)
+		self.assertEqual(len(large["conversations"]), 25)
+		self.assertEqual(small_queries, large_queries)
+
+	def test_get_conversations_last_message(self):
+		result = get_conversations(session_id=self.session, limit=1)
+		conversation = result["conversations"][0]
+
+		self.assertEqual(conversation["last_message"], "Mensaje 0")
+		self.assertEqual(conversation["total_messages"], 2)
+		self.assertEqual(conversation["unread_count"], 2)
+
+	def test_get_conversation_stats_invalidated_by_new_message(self):
+		stats = get_conversation_stats(session_id=self.session)["stats"]
+		self.assertEqual(stats["total"], 30)
+		self.assertEqual(stats["unread"], 30)
+		self.assertEqual(stats["individual"], 30)
+
+		conversation = frappe.get_doc({
+			"doctype": "WhatsApp Conversation",
+			"session": self.session,
+			"chat_id": "34611111111@s.whatsapp.net",
+			"phone_number": "34611111111",
+			"status": "Active",
+		}).insert(ignore_permissions=True)
+
+		stats = get_conversation_stats(session_id=self.session)["stats"]
+		self.assertEqual(stats["total"], 31)
+		self.assertEqual(stats["unread"], 30)
+
+		message = frappe.get_doc({
+			"doctype": "WhatsApp Message",
+			"session": self.session,
+			"conversation": conversation.name,
+			"message_id": f"{TEST_SESSION_ID}_stats",
+			"content": "Nuevo",
+			"direction": "Incoming",
+			"message_type": "text",
+			"timestamp": now_datetime(),
+		}).insert(ignore_permissions=True)
+
+		stats = get_conversation_stats(session_id=self.session)["stats"]
+		self.assertEqual(stats["unread"], 31)
+
+		message.delete(ignore_permissions=True)
+		conversation.delete(ignore_permissions=True)
+		self.assertEqual(get_conversation_stats(session_id=self.session)["stats"]["total"], 30)
+
+	def test_get_unified_contacts_constant_query_count(self):
+		if not frappe.db.table_exists("CRM Lead"):
+			self.skipTest("CRM Lead no está instalado")
+
+		small, small_queries = self.count_queries(get_unified_contacts, search="3460000", limit=5)
+		large, large_queries = self.count_queries(get_unified_contacts, search="3460000", limit=25)
+
+		self.assertTrue(small["success"])
+		self.assertEqual(len(small["contacts"]), 5)
+		self.assertEqual(len(large["contacts"]), 25)
+		self.assertEqual(small_queries, large_queries)
+		self.assertEqual(large["contacts"][0]["last_message"]["content"], "Mensaje 0")
+
+	def test_get_messages_keyset_pagination(self):
+		conversation = frappe.get_doc({
+			"doctype": "WhatsApp Conversation",
+			"session": self.session,
+			"chat_id": "34622222222@s.whatsapp.net",
+			"phone_number": "34622222222",
+			"status": "Active",
+		}).insert(ignore_permissions=True)
+
+		# Timestamps repetidos para comprobar el desempate por name
+		base = now_datetime()
+		messages = []
+		for i in range(7):
+			messages.append(frappe.get_doc({
+				"doctype": "WhatsApp Message",
+				"session": self.session,
+				"conversation": conversation.name,
+				"message_id": f"{TEST_SESSION_ID}_page_{i}",
+				"content": f"Página {i}",
+				"direction": "Incoming",
+				"message_type": "text",
+				"timestamp": add_to_date(base, seconds=i // 2),
+			}).insert(ignore_permissions=True))
+
+		seen = []
+		cursor = None
+		while True:
+			page = get_messages(conversation.name, limit=3, before=cursor)
+			seen = [m["content"] for m in page["messages"]] + seen
+			if not page["has_more"]:
+				break
+			cursor = page["next_cursor"]
+
+		self.assertEqual(seen, [f"Página {i}" for i in range(7)])
+
+		# Relleno de huecos: solo los mensajes posteriores al último conocido
+		latest = get_messages(conversation.name, limit=3)["latest_cursor"]
+		self.assertEqual(get_messages(conversation.name, after=latest)["messages"], [])
+
+		first_page = get_messages(conversation.name, limit=2, before=None)
+		older = get_messages(conversation.name, limit=2, before=first_page["next_cursor"])
+		gap = get_messages(conversation.name, after=older["latest_cursor"])
+		self.assertEqual([m["content"] for m in gap["messages"]], ["Página 5", "Página 6"])
+
+		# Las condiciones de permisos del usuario se aplican junto al cursor
+		restricted = "`tabWhatsApp Message`.`content` != 'Página 6'"
+		with patch("frappe.build_match_conditions", return_value=restricted):
+			gap = get_messages(conversation.name, after=older["latest_cursor"])
+		self.assertEqual([m["content"] for m in gap["messages"]], ["Página 5"])
+
+		for message in messages:
+			message.delete(ignore_permissions=True)
+		conversation.delete(ignore_permissions=True)
+
+	def test_get_message_history_projection(self):
+		conversation = frappe.get_all("WhatsApp Conversation",
+			filters={"session": self.session, "chat_id": "34600000000@s.whatsapp.net"},
+			pluck="name")[0]
+
+		history = get_message_history(conversation_id=conversation, fields=["from_me"])
+		self.assertTrue(history["success"])
+		self.assertEqual(history["columns"], ["name", "timestamp", "from_me"])
+		self.assertEqual(len(history["rows"]), 2)
+		self.assertIsInstance(history["rows"][0][1], int)
+		self.assertLess(history["rows"][0][1], history["rows"][1][1])
+
+		self.assertFalse(get_message_history(conversation_id=conversation, fields=["raw_data"])["success"])
+
+	def test_delta_sync_stops_at_watermark(self):
+		conversation = frappe.get_doc({
+			"doctype": "WhatsApp Conversation",
+			"session": self.session,
+			"chat_id": "34633333333@s.whatsapp.net",
+			"phone_number": "34633333333",
+			"status": "Active",
+		}).insert(ignore_permissions=True)
+
+		session = frappe.get_doc("WhatsApp Session", self.session)
+		client = FakeMessagesClient()
+		base = int(now_datetime().timestamp()) - 1000
+
+		def receive(count):
+			for _ in range(count):
+				i = len(client.messages)
+				client.messages.append({
+					"whatsappMessageId": f"{TEST_SESSION_ID}_delta_{i}",
+					"chatId": "34633333333@s.whatsapp.net",
+					"from": "34633333333@s.whatsapp.net",
+					"fromMe": False,
+					"content": f"Delta {i}",
+					"timestamp": base + i * 10,
+				})
+
+		def sync():
+			client.pages = []
+			return sync_conversation_messages(conversation.name, client=client, session=session, page_size=2)
+
+		# Primera sincronización: solo la página más reciente
+		receive(5)
+		result = sync()
+		self.assertEqual((result["created"], client.pages), (2, [1]))
+
+		# Se pagina hasta la marca de agua y solo se importan los nuevos
+		receive(5)
+		result = sync()
+		self.assertEqual((result["created"], client.pages), (5, [1, 2, 3]))
+		self.assertTrue(result["caught_up"])
+		self.assertEqual(
+			frappe.db.get_value("WhatsApp Conversation", conversation.name, "last_remote_message_id"),
+			f"{TEST_SESSION_ID}_delta_9"
+		)
+
+		result = sync()
+		self.assertEqual((result["created"], client.pages), (0, [1]))
+
+		# Sin mensajes remotos posteriores a la marca de agua la conversación se omite
+		self.assertNotIn(conversation.name, [c.name for c in get_conversations_to_sync(self.session)])
+
+		frappe.db.delete("WhatsApp Message", {"conversation": conversation.name})
+		conversation.delete(ignore_permissions=True)
+
+	def test_delta_sync_resumes_after_page_cap_with_iso_timestamps(self):
+		conversation = frappe.get_doc({
+			"doctype": "WhatsApp Conversation",
+			"session": self.session,
+			"chat_id": "34644444444@s.whatsapp.net",
+			"phone_number": "34644444444",
+			"status": "Active",
+		}).insert(ignore_permissions=True)
+		self.addCleanup(set_resume_point, conversation.name)
+
+		session = frappe.get_doc("WhatsApp Session", self.session)
+		client = FakeMessagesClient()
+		base = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=1)
+
+		def sent_at(i):
+			return base + timedelta(seconds=i * 10)
+
+		def receive(count):
+			for _ in range(count):
+				i = len(client.messages)
+				client.messages.append({
+					"whatsappMessageId": f"{TEST_SESSION_ID}_iso_{i}",
+					"chatId": "34644444444@s.whatsapp.net",
+					"from": "34644444444@s.whatsapp.net",
+					"fromMe": False,
+					"content": f"ISO {i}",
+					# Baileys envía ISO-8601 en UTC
+					"timestamp": sent_at(i).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+				})
+
+		def sync():
+			client.pages = []
+			return sync_conversation_messages(conversation.name, client=client, session=session, page_size=2, max_pages=2)
+
+		receive(5)
+		sync()
+
+		# Mensajes guardados en hora del sistema, igual que la marca de agua
+		stored = frappe.db.get_value(
+			"WhatsApp Message", {"message_id": f"{TEST_SESSION_ID}_iso_4"}, "timestamp"
+		)
+		self.assertEqual(stored, sent_at(4).astimezone(ZoneInfo(get_system_timezone())).replace(tzinfo=None))
+		self.assertNotIn(conversation.name, [c.name for c in get_conversations_to_sync(self.session)])
+
+		# Más mensajes nuevos que el tope de páginas: la marca no se mueve
+		receive(6)
+		result = sync()
+		self.assertEqual((result["created"], client.pages, result["caught_up"]), (4, [1, 2], False))
+		self.assertEqual(result["resume_page"], 3)
+		self.assertEqual(
+			frappe.db.get_value("WhatsApp Conversation", conversation.name, "last_remote_message_id"),
+			f"{TEST_SESSION_ID}_iso_4"
+		)
+		self.assertIn(conversation.name, [c.name for c in get_conversations_to_sync(self.session)])
+
+		# La siguiente ejecución continúa donde lo dejó y cierra el hueco
+		result = sync()
+		self.assertEqual((result["created"], client.pages, result["caught_up"]), (2, [3, 4], True))
+		self.assertEqual(
+			frappe.db.get_value("WhatsApp Conversation", conversation.name, "last_remote_message_id"),
+			f"{TEST_SESSION_ID}_iso_10"
+		)
+		self.assertEqual(frappe.db.count("WhatsApp Message", {"conversation": conversation.name}), 8)
+		self.assertNotIn(conversation.name, [c.name for c in get_conversations_to_sync(self.session)])
+
+		result = sync()
+		self.assertEqual((result["created"], client.pages), (0, [1]))
+
+		frappe.db.delete("WhatsApp Message", {"conversation": conversation.name})
+		conversation.delete(ignore_permissions=True)
+
+	def filtered(self, filters, search=None):
+		"""Nombres de contacto de las conversaciones que devuelve el WHERE compilado."""
+		where, params = build_conversation_conditions(self.session, filters, search)
+		return set(frappe.db.sql_list(f"SELECT contact_name FROM `tabWhatsApp Conversation` WHERE {where}", params))
+
+	def test_conversation_filter_operators(self):
+		names = dict(frappe.db.get_all(
+			"WhatsApp Conversation", filters={"session": self.session}, fields=["contact_name", "name"], as_list=True
+		))
+		changes = {
+			"Test 0": {"priority": "High", "assigned_to": "Administrator", "unread_count": 5},
+			"Test 1": {"priority": "High", "unread_count": 0},
+			"Test 2": {"priority": "Low", "assigned_to": "Administrator"},
+			"Test 3": {"is_archived": 1},
+		}
+		for contact, values in changes.items():
+			original = frappe.db.get_value("WhatsApp Conversation", names[contact], list(values), as_dict=True)
+			frappe.db.set_value("WhatsApp Conversation", names[contact], values)
+			self.addCleanup(frappe.db.set_value, "WhatsApp Conversation", names[contact], original)
+
+		everyone = set(names) - {"Test 3"}
+
+		# Igualdad: valor directo, "=" y "equals"; las archivadas se excluyen salvo que se filtre por ellas
+		self.assertEqual(self.filtered({"priority": "High"}), {"Test 0", "Test 1"})
+		self.assertEqual(self.filtered({"priority": ["=", "High"]}), {"Test 0", "Test 1"})
+		self.assertEqual(self.filtered({"priority": ["equals", "Low"]}), {"Test 2"})
+		self.assertEqual(self.filtered({"is_archived": 1}), {"Test 3"})
+		self.assertEqual(self.filtered({"priority": ["!=", "High"]}), everyone - {"Test 0", "Test 1"})
+		self.assertEqual(self.filtered({"priority": ["not equals", "High"]}), everyone - {"Test 0", "Test 1"})
+
+		# LIKE: los comodines del usuario se escapan
+		self.assertEqual(self.filtered({"contact_name": ["like", "Test 2"]}), {"Test 2"} | {f"Test {i}" for i in range(20, 30)})
+		self.assertEqual(self.filtered({"contact_name": ["not like", "Test 1"]}), everyone - {"Test 1"} - {f"Test {i}" for i in range(10, 20)})
+		self.assertEqual(self.filtered({"contact_name": ["like", "Test_1"]}), set())
+		self.assertEqual(self.filtered({"contact_name": ["like", "%"]}), everyone)
+
+		# Comparaciones y between
+		self.assertEqual(self.filtered({"unread_count": [">", 2]}), {"Test 0"})
+		self.assertEqual(self.filtered({"unread_count": ["<", 2]}), {"Test 1"})
+		self.assertEqual(self.filtered({"unread_count": [">=", 2]}), everyone - {"Test 1"})
+		self.assertEqual(self.filtered({"unread_count": ["<=", 2]}), everyone - {"Test 0"})
+		self.assertEqual(self.filtered({"unread_count": ["between", [3, 10]]}), {"Test 0"})
+		with self.assertRaises(frappe.ValidationError):
+			self.filtered({"unread_count": ["between", 3]})
+
+		# in / not in: lista o texto separado por comas; vacíos sin error
+		self.assertEqual(self.filtered({"priority": ["in", ["High", "Low"]]}), {"Test 0", "Test 1", "Test 2"})
+		self.assertEqual(self.filtered({"priority": ["in", "High, Low"]}), {"Test 0", "Test 1", "Test 2"})
+		self.assertEqual(self.filtered({"priority": ["in", []]}), set())
+		self.assertEqual(self.filtered({"priority": ["not in", ["High"]]}), {"Test 2"})
+		self.assertEqual(self.filtered({"priority": ["not in", ""]}), everyone)
+
+		# is / is not con la convención del CRM: "set" y "not set"
+		assigned = {"Test 0", "Test 2"}
+		self.assertEqual(self.filtered({"assigned_to": ["is", "set"]}), assigned)
+		self.assertEqual(self.filtered({"assigned_to": ["is", "not set"]}), everyone - assigned)
+		self.assertEqual(self.filtered({"assigned_to": ["is not", "set"]}), everyone - assigned)
+		self.assertEqual(self.filtered({"assigned_to": ["is not", "not set"]}), assigned)
+
+		# Varios filtros y búsqueda se combinan con AND
+		self.assertEqual(self.filtered({"priority": "High", "assigned_to": ["is", "set"]}), {"Test 0"})
+		self.assertEqual(self.filtered({"priority": ["is", "set"]}, search="Test 2"), {"Test 2"})
+
+		with self.assertRaises(frappe.ValidationError):
+			self.filtered({"priority": ["regexp", "High"]})
+
+	def test_conversation_filters_apply_permission_conditions(self):
+		# Las condiciones de permisos del usuario (User Permissions, hooks) se suman al WHERE compilado
+		restricted = "`tabWhatsApp Conversation`.`contact_name` in ('Test 1', 'Test 2')"
+		with patch("frappe.build_match_conditions", return_value=restricted):
+			self.assertEqual(self.filtered({}), {"Test 1", "Test 2"})
+			self.assertEqual(self.filtered({"contact_name": ["like", "Test 2"]}), {"Test 2"})
+
+		# Las estadísticas cacheadas no se comparten entre usuarios con distintos permisos
+		self.assertEqual(get_conversation_stats(session_id=self.session)["stats"]["total"], 30)
+		with patch("frappe.build_match_conditions", return_value=restricted):
+			self.assertEqual(get_conversation_stats(session_id=self.session)["stats"]["total"], 2)
+		self.assertEqual(get_conversation_stats(session_id=self.session)["stats"]["total"], 30)
+
+	def test_conversation_filters_reject_unknown_fields(self):
+		# Solo columnas reales del doctype: el nombre del campo va al SQL sin parámetro
+		for field_name in ("not_a_field", "priority` = 'High' OR 1=1 -- ", "section_break_1"):
+			with self.assertRaises(frappe.ValidationError):
+				build_conversation_conditions(self.session, {field_name: "x"})
+
+		self.assertTrue(build_conversation_conditions(self.session, {"modified": [">", "2020-01-01"]})[0])
+
+		# Un orden no válido vuelve al orden por defecto en vez de llegar al SQL
+		self.assertEqual(compile_order_by("contact_name desc"), "`contact_name` desc, `name` desc")
+		self.assertEqual(compile_order_by("contact_name sideways"), "`contact_name` asc, `name` asc")
+		self.assertEqual(compile_order_by("sleep(5) desc"), "`last_message_time` desc, `name` desc")
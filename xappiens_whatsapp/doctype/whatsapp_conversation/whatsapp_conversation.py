@@ -5,6 +5,9 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import now, get_datetime
 
+from xappiens_whatsapp.utils.conversation_stats import invalidate_conversation_stats
+from xappiens_whatsapp.utils.phone import get_conversation_phone, phone_variants
+
 
 class WhatsAppConversation(Document):
 	def validate(self):
@@ -21,6 +24,8 @@ class WhatsAppConversation(Document):
 		if not self.session:
 			frappe.throw("Session is required")
 
+		self.normalized_phone = get_conversation_phone(self.phone_number, self.chat_id, self.is_group)
+
 	def on_update(self):
 		"""Actions after update."""
 		# Auto-link to contact if not a group
@@ -37,6 +42,12 @@ class WhatsAppConversation(Document):
 				self.is_muted = 0
 				self.mute_expiration = None
 
+		invalidate_conversation_stats(self.session)
+
+	def on_trash(self):
+		"""Drop the cached stats of the session."""
+		invalidate_conversation_stats(self.session)
+
 	def auto_link_to_contact(self):
 		"""Auto-link to WhatsApp Contact."""
 		try:
@@ -56,9 +67,13 @@ class WhatsAppConversation(Document):
 	def auto_link_to_lead(self):
 		"""Auto-link to Lead if phone number matches."""
 		try:
+			variants = phone_variants(self.normalized_phone)
+			if not variants:
+				return
+
 			lead = frappe.db.get_value(
 				"CRM Lead",
-				{"mobile_no": self.phone_number},
+				{"mobile_no": ["in", variants]},
 				["name", "lead_name"],
 				as_dict=True
 			)
@@ -243,3 +258,9 @@ class WhatsAppConversation(Document):
 			frappe.log_error(f"Error syncing messages: {str(e)}")
 			return {"success": False, "message": str(e)}
 
+
+def on_doctype_update():
+	"""Índices compuestos para las consultas frecuentes (ver utils/indexes.py)"""
+	from xappiens_whatsapp.utils.indexes import ensure_indexes
+
+	ensure_indexes("WhatsApp Conversation")
@@ -1,9 +1,353 @@
 # Copyright (c) 2025, Xappiens and Contributors
 # See license.txt
 
-# import frappe
+import base64
+import hashlib
+import os
+from io import BytesIO
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import now_datetime
+from PIL import Image
+from werkzeug.test import EnvironBuilder
+
+from xappiens_whatsapp.api.media_proxy import stream_media
+from xappiens_whatsapp.api.media_queue import MAX_RETRIES, process_media_queue, queue_media_download
+from xappiens_whatsapp.utils.media_previews import THUMBNAIL_SUFFIX, build_preview
+
+from xappiens_whatsapp.utils.media_storage import (
+	CHUNK_SIZE,
+	MediaTooLargeError,
+	count_media_references,
+	find_stored_media,
+	get_media_path,
+	normalize_sha256,
+	register_file,
+	release_media,
+	store_derived_file,
+	store_media,
+	stream_to_file,
+)
+
+
+class FakeStreamResponse:
+	"""Respuesta de requests en modo streaming."""
+
+	def __init__(self, content):
+		self.content = content
+		self.headers = {"Content-Length": str(len(content))}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+	def raise_for_status(self):
+		pass
+
+	def iter_content(self, chunk_size=1):
+		for i in range(0, len(self.content), chunk_size):
+			yield self.content[i:i + chunk_size]
+
+
+class FakeUpstream(FakeStreamResponse):
+	"""Respuesta del servidor de WhatsApp para `transport.get`, con soporte de Range."""
+
+	def __init__(self, content, range_header=None):
+		self.status_code = 200
+		if range_header:
+			start, end = (int(value) for value in range_header.split("=")[1].split("-"))
+			super().__init__(content[start:end + 1])
+			self.status_code = 206
+			self.headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+		else:
+			super().__init__(content)
+		self.headers["Content-Type"] = "video/mp4"
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+
+
+TEST_SESSION_ID = "_test_media_queue"
+REMOTE_MEDIA = {"success": True, "media_url": "https://example.com/media/clip", "filename": "clip.mp4", "mimetype": "video/mp4"}
 
 
 class TestWhatsAppMediaFile(FrappeTestCase):
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.session = frappe.get_doc({
+			"doctype": "WhatsApp Session",
+			"session_id": TEST_SESSION_ID,
+			"session_name": TEST_SESSION_ID,
+			"status": "Disconnected",
+		}).insert(ignore_permissions=True)
+		cls.conversation = frappe.get_doc({
+			"doctype": "WhatsApp Conversation",
+			"session": cls.session.name,
+			"chat_id": "34670000000@s.whatsapp.net",
+			"phone_number": "34670000000",
+			"status": "Active",
+		}).insert(ignore_permissions=True)
+
+	@classmethod
+	def tearDownClass(cls):
+		frappe.db.delete("WhatsApp Media File", {"session": cls.session.name})
+		frappe.db.delete("WhatsApp Message", {"session": cls.session.name})
+		cls.conversation.delete(ignore_permissions=True)
+		cls.session.delete(ignore_permissions=True)
+		frappe.db.commit()
+		super().tearDownClass()
+
+	def test_stream_to_file_hashes_and_limits_size(self):
+		chunks = [os.urandom(64 * 1024) for _ in range(4)]
+		content = b"".join(chunks)
+
+		stored = stream_to_file(iter(chunks), "_test_stream.bin", max_bytes=len(content))
+		self.addCleanup(os.remove, stored["path"])
+		self.assertEqual(stored["size"], len(content))
+		self.assertEqual(stored["sha256"], hashlib.sha256(content).hexdigest())
+		with open(stored["path"], "rb") as f:
+			self.assertEqual(f.read(), content)
+
+		file_doc = register_file(stored)
+		self.addCleanup(frappe.db.delete, "File", file_doc.name)
+		self.assertEqual(frappe.get_doc("File", file_doc.name).get_content(), content)
+		self.assertEqual(file_doc.content_hash, hashlib.md5(content).hexdigest())
+
+		# Se corta al superar el límite y no deja temporales en la carpeta
+		directory = os.path.dirname(stored["path"])
+		before = set(os.listdir(directory))
+		with self.assertRaises(MediaTooLargeError):
+			stream_to_file(iter(chunks), "_test_stream_big.bin", max_bytes=len(content) - 1)
+		self.assertEqual(set(os.listdir(directory)), before)
+
+		with self.assertRaises(MediaTooLargeError):
+			stream_to_file(iter(chunks), "_test_stream_big.bin", max_bytes=1024, expected_size=len(content))
+
+	def test_store_media_deduplicates_by_sha256(self):
+		content = os.urandom(300 * 1024)
+		sha256 = hashlib.sha256(content).hexdigest()
+		files = frappe.db.count("File")
+
+		first = store_media(FakeStreamResponse(content), "foto.JPG")
+		# El mismo contenido con otra extensión no se guarda dos veces
+		second = store_media(FakeStreamResponse(content), "reenviada.jpeg")
+		self.assertEqual((first["reused"], second["reused"]), (False, True))
+		self.assertEqual(first["file_url"], second["file_url"])
+		self.assertTrue(first["file_url"].endswith(f"/{sha256}.jpg"))
+		self.assertEqual(frappe.db.count("File"), files + 1)
+		directory = os.path.dirname(get_media_path(first["file_url"]))
+		self.assertEqual([name for name in os.listdir(directory) if name.startswith(sha256)], [f"{sha256}.jpg"])
+
+		# fileSha256 de Baileys llega en base64
+		known = normalize_sha256(base64.b64encode(bytes.fromhex(sha256)).decode())
+		self.assertEqual(known, sha256)
+		self.assertEqual(find_stored_media(known), first["file_url"])
+
+		# Sin referencias se borra el File y el archivo del disco
+		self.assertEqual(count_media_references(sha256), 0)
+		path = get_media_path(first["file_url"])
+		self.assertTrue(release_media(sha256))
+		self.assertFalse(os.path.exists(path))
+		self.assertIsNone(find_stored_media(sha256))
+
+	def test_media_queue_dedupes_and_backs_off(self):
+		message = frappe.get_doc({
+			"doctype": "WhatsApp Message",
+			"session": self.session.name,
+			"conversation": self.conversation.name,
+			"message_id": "_test_media_queue_1",
+			"timestamp": now_datetime(),
+			"direction": "Incoming",
+			"message_type": "image",
+			"status": "Delivered",
+			"has_media": 1,
+		}).insert(ignore_permissions=True)
+
+		item = {"media_type": "image", "filename": "foto.jpg", "mimetype": "image/jpeg"}
+		name = queue_media_download(self.session.name, message.name, item, self.conversation.name)
+		self.assertEqual(queue_media_download(self.session.name, message.name, item), name)
+		self.assertEqual(frappe.db.count("WhatsApp Media File", {"message": message.name}), 1)
+
+		# Un fallo transitorio se reprograma con espera; uno permanente no
+		failure = {"success": False, "message": "Servidor no disponible"}
+		with patch("xappiens_whatsapp.api.media.download_media_from_message", return_value=failure) as download:
+			process_media_queue()
+			self.assertEqual(download.call_count, 1)
+
+			media_file = frappe.get_doc("WhatsApp Media File", name)
+			self.assertEqual((media_file.status, media_file.retry_count), ("Pending", 1))
+			self.assertGreater(media_file.next_attempt_at, now_datetime())
+
+			# En espera: el worker no la vuelve a intentar
+			process_media_queue()
+			self.assertEqual(download.call_count, 1)
+
+		frappe.db.set_value("WhatsApp Media File", name, "next_attempt_at", None)
+		permanent = {"success": False, "retryable": False, "message": "Archivo demasiado grande"}
+		with patch("xappiens_whatsapp.api.media.download_media_from_message", return_value=permanent):
+			process_media_queue()
+
+		media_file.reload()
+		self.assertEqual((media_file.status, media_file.retry_count), ("Failed", 2))
+		self.assertLess(media_file.retry_count, MAX_RETRIES)
+		self.assertEqual(media_file.download_error, "Archivo demasiado grande")
+
+	def test_build_preview_makes_webp_thumbnail(self):
+		image = BytesIO()
+		Image.new("RGB", (1280, 720), (18, 140, 126)).save(image, format="JPEG")
+		stored = stream_to_file([image.getvalue()], "foto.jpg", content_addressed=True)
+		register_file(stored)
+		self.addCleanup(release_media, stored["sha256"])
+
+		preview = build_preview(stored["path"], "image", stored["sha256"])
+		self.assertEqual(preview["dimensions"], "1280x720")
+		self.assertTrue(preview["thumbnail"].endswith(f"{stored['sha256']}{THUMBNAIL_SUFFIX}"))
+
+		with Image.open(get_media_path(preview["thumbnail"])) as thumbnail:
+			self.assertEqual(thumbnail.format, "WEBP")
+			self.assertEqual(thumbnail.size, (320, 180))
+
+		# La búsqueda por hash devuelve el original, no la miniatura
+		self.assertEqual(find_stored_media(stored["sha256"]), stored["file_url"])
+
+		# El mismo contenido reutiliza la miniatura ya guardada
+		files = frappe.db.count("File")
+		self.assertEqual(build_preview(stored["path"], "image", stored["sha256"])["thumbnail"], preview["thumbnail"])
+		self.assertEqual(frappe.db.count("File"), files)
+
+	def test_find_stored_media_skips_derived_files(self):
+		content = os.urandom(32 * 1024)
+		sha256 = hashlib.sha256(content).hexdigest()
+		self.addCleanup(release_media, sha256)
+
+		# Un derivado registrado antes que el original no se confunde con él
+		thumbnail = store_derived_file(sha256, THUMBNAIL_SUFFIX, b"miniatura")
+		self.assertIsNone(find_stored_media(sha256))
+
+		stored = store_media(FakeStreamResponse(content), "video.mp4")
+		self.assertNotEqual(stored["file_url"], thumbnail)
+		self.assertEqual(find_stored_media(sha256), stored["file_url"])
+
+	def media_message(self, message_id):
+		return frappe.get_doc({
+			"doctype": "WhatsApp Message",
+			"session": self.session.name,
+			"conversation": self.conversation.name,
+			"message_id": message_id,
+			"timestamp": now_datetime(),
+			"direction": "Incoming",
+			"message_type": "video",
+			"status": "Delivered",
+			"has_media": 1,
+			"media_items": [{"media_type": "video", "filename": "clip.mp4", "mimetype": "video/mp4"}],
+		}).insert(ignore_permissions=True)
+
+	def stream(self, message, content, range_header=None):
+		"""Llama a stream_media como una petición del navegador y devuelve (respuesta, cuerpo, upstreams)."""
+		frappe.local.request = EnvironBuilder(headers={"Range": range_header} if range_header else {}).get_request()
+		self.addCleanup(setattr, frappe.local, "request", None)
+
+		upstreams = []
+
+		def get(url, headers=None, **kwargs):
+			upstreams.append(FakeUpstream(content, (headers or {}).get("Range")))
+			return upstreams[-1]
+
+		with (
+			patch("xappiens_whatsapp.api.media_proxy._get_remote_media", return_value=REMOTE_MEDIA),
+			patch("xappiens_whatsapp.api.media_proxy.transport.get", side_effect=get),
+			patch("xappiens_whatsapp.api.media.queue_media_preview"),
+		):
+			response = stream_media(message)
+			body = b"".join(response.iter_encoded())
+		return response, body, upstreams
+
+	def test_stream_media_caches_on_miss_and_serves_locally_on_hit(self):
+		content = os.urandom(200 * 1024)
+		sha256 = hashlib.sha256(content).hexdigest()
+		message = self.media_message("_test_media_proxy_1")
+
+		with patch("xappiens_whatsapp.utils.media_storage.get_media_folder", return_value=("_test_media_proxy", True)):
+			# Miss: "bytes=0-" se trata como la descarga completa y se cachea mientras se envía
+			response, body, upstreams = self.stream(message.name, content, "bytes=0-")
+			self.assertEqual(response.status_code, 200)
+			self.assertEqual(body, content)
+			self.assertEqual(response.headers["Content-Length"], str(len(content)))
+			self.assertTrue(upstreams[0].closed)
+
+			# Al terminar la respuesta el archivo queda registrado y enlazado con el mensaje
+			file_url = find_stored_media(sha256)
+			self.assertTrue(file_url.startswith("/private/files/_test_media_proxy/"))
+			self.assertTrue(frappe.db.exists("File", {"file_url": file_url}))
+			item = frappe.get_doc("WhatsApp Message", message.name).media_items[0]
+			self.assertEqual((item.file, item.media_hash, item.filesize), (file_url, sha256, len(content)))
+
+			# Hit: se sirve del disco sin volver al servidor, con Range parcial
+			response, body, upstreams = self.stream(message.name, content, "bytes=1000-1999")
+			self.assertEqual(upstreams, [])
+			self.assertEqual(response.status_code, 206)
+			self.assertEqual(body, content[1000:2000])
+			self.assertEqual(response.headers["Content-Range"], f"bytes 1000-1999/{len(content)}")
+
+			response, body, upstreams = self.stream(message.name, content)
+			self.assertEqual((response.status_code, body, upstreams), (200, content, []))
+
+			# Otro mensaje con el mismo contenido se enlaza al archivo ya almacenado
+			other = self.media_message("_test_media_proxy_2")
+			frappe.db.set_value("WhatsApp Message Media", other.media_items[0].name, "media_hash", sha256)
+			response, body, upstreams = self.stream(other.name, content)
+			self.assertEqual((body, upstreams), (content, []))
+			self.assertEqual(frappe.get_doc("WhatsApp Message", other.name).media_items[0].file, file_url)
+
+			# Al borrar los mensajes se libera el archivo del almacén
+			frappe.delete_doc("WhatsApp Message", message.name, ignore_permissions=True)
+			frappe.delete_doc("WhatsApp Message", other.name, ignore_permissions=True)
+			self.assertIsNone(find_stored_media(sha256))
+
+	def test_stream_media_proxies_partial_ranges_without_caching(self):
+		content = os.urandom(64 * 1024)
+		sha256 = hashlib.sha256(content).hexdigest()
+		message = self.media_message("_test_media_proxy_3")
+
+		with patch("xappiens_whatsapp.api.media_proxy.queue_media_download") as queue_download:
+			response, body, upstreams = self.stream(message.name, content, "bytes=100-199")
+
+		# El Range se reenvía tal cual y se encola la descarga completa
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(body, content[100:200])
+		self.assertEqual(response.headers["Content-Range"], f"bytes 100-199/{len(content)}")
+		self.assertEqual(response.headers["Content-Type"], "video/mp4")
+		self.assertTrue(upstreams[0].closed)
+		self.assertTrue(queue_download.call_args.kwargs["force"])
+
+		# Un trozo suelto no se guarda en el almacén
+		self.assertIsNone(find_stored_media(sha256))
+		self.assertFalse(frappe.get_doc("WhatsApp Message", message.name).media_items[0].file)
+
+	def test_stream_media_discards_cache_when_client_disconnects(self):
+		content = os.urandom(CHUNK_SIZE * 3)
+		sha256 = hashlib.sha256(content).hexdigest()
+		message = self.media_message("_test_media_proxy_4")
+
+		frappe.local.request = EnvironBuilder().get_request()
+		self.addCleanup(setattr, frappe.local, "request", None)
+		upstream = FakeUpstream(content)
+		with (
+			patch("xappiens_whatsapp.api.media_proxy._get_remote_media", return_value=REMOTE_MEDIA),
+			patch("xappiens_whatsapp.api.media_proxy.transport.get", return_value=upstream),
+		):
+			response = stream_media(message.name)
+			chunks = iter(response.response)
+			next(chunks)
+			# El navegador corta la descarga tras el primer bloque
+			chunks.close()
+
+		self.assertTrue(upstream.closed)
+		self.assertIsNone(find_stored_media(sha256))
+		self.assertFalse(frappe.get_doc("WhatsApp Message", message.name).media_items[0].file)
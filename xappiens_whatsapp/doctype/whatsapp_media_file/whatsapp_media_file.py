@@ -12,6 +12,13 @@ class WhatsAppMediaFile(Document):
 		if self.filename and not self.file_extension:
 			self.file_extension = self.filename.split('.')[-1] if '.' in self.filename else ''
 
+	def after_delete(self):
+		"""Release the stored file if nothing else references it."""
+		if self.sha256_hash:
+			from xappiens_whatsapp.utils.media_storage import release_media
+
+			release_media(self.sha256_hash)
+
 	@frappe.whitelist()
 	def download_from_api(self):
 		"""Download media file from WhatsApp API."""
@@ -22,6 +29,7 @@ class WhatsAppMediaFile(Document):
 
 			if result.get("success"):
 				self.file = result.get("file_path")
+				self.sha256_hash = result.get("sha256")
 				self.is_downloaded = 1
 				self.downloaded_at = now()
 				self.status = "Downloaded"
@@ -45,3 +53,10 @@ class WhatsAppMediaFile(Document):
 
 			return {"success": False, "message": str(e)}
 
+
+
+def on_doctype_update():
+	"""Índices compuestos para las consultas frecuentes (ver utils/indexes.py)"""
+	from xappiens_whatsapp.utils.indexes import ensure_indexes
+
+	ensure_indexes("WhatsApp Media File")
@@ -0,0 +1,159 @@
+# Copyright (c) 2025, Xappiens and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from xappiens_whatsapp.api import webhook_batch
+from xappiens_whatsapp.api.webhook_batch import prepare_batch_item, process_message_batch
+from xappiens_whatsapp.utils.conversation_stats import reconcile_conversations
+
+TEST_SESSION_ID = "_test_message_batch"
+
+
+def received(message_id, chat="34670000201", content="Hola", **extra):
+	"""Webhook message.received de Baileys."""
+	message = {
+		"whatsappMessageId": message_id,
+		"content": content,
+		"chatId": f"{chat}@s.whatsapp.net",
+		"from": f"{chat}@s.whatsapp.net",
+		"to": "34600000000",
+		"timestamp": 1762518118,
+		"type": "text",
+	}
+	message.update(extra)
+	return prepare_batch_item({"event": "message.received", "data": {"sessionId": TEST_SESSION_ID, "message": message}})
+
+
+class TestWhatsAppMessage(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.session = frappe.get_doc({
+			"doctype": "WhatsApp Session",
+			"session_id": TEST_SESSION_ID,
+			"session_name": TEST_SESSION_ID,
+			"phone_number": "34600000000",
+			"status": "Disconnected",
+		}).insert(ignore_permissions=True)
+
+	@classmethod
+	def tearDownClass(cls):
+		frappe.delete_doc("WhatsApp Session", cls.session.name, force=True, ignore_permissions=True)
+		frappe.db.commit()
+		super().tearDownClass()
+
+	def process(self, items):
+		with patch("xappiens_whatsapp.api.webhook_batch.queue_media_download") as queue_media_download:
+			results = process_message_batch(items)
+		return [result["processed"] for result in results], queue_media_download
+
+	def test_message_batch_inserts_like_single_path(self):
+		image = {"hasMedia": True, "type": "image", "media": {"filename": "foto.jpg", "mimetype": "image/jpeg"}}
+		results, queue_media_download = self.process([
+			received("_test_batch_1"),
+			received("_test_batch_2", content="Foto", **image),
+			received("_test_batch_1"),
+		])
+
+		self.assertEqual([result["action"] for result in results], ["created", "created", "duplicate"])
+		self.assertEqual(queue_media_download.call_count, 1)
+
+		first = frappe.get_doc("WhatsApp Message", results[0]["message_id"])
+		second = frappe.get_doc("WhatsApp Message", results[1]["message_id"])
+		# Nombre de la serie del framework, valores por defecto y validate como en insert()
+		self.assertTrue(first.name.startswith("WAMSG-"))
+		self.assertEqual((first.status, first.from_me, first.normalized_phone), ("Delivered", 0, "+34670000201"))
+		self.assertEqual(first.docstatus, 0)
+		self.assertEqual([item.filename for item in second.media_items], ["foto.jpg"])
+
+		conversation = frappe.db.get_value(
+			"WhatsApp Conversation", first.conversation, ["total_messages", "unread_count", "last_message"], as_dict=True
+		)
+		self.assertEqual((conversation.total_messages, conversation.unread_count, conversation.last_message), (2, 2, "Foto"))
+
+		# Reenviar el lote no duplica nada
+		results, _queue = self.process([received("_test_batch_1"), received("_test_batch_2")])
+		self.assertEqual([result["action"] for result in results], ["duplicate", "duplicate"])
+
+	def test_message_batch_keeps_messages_on_name_collision(self):
+		bulk_insert = webhook_batch._bulk_insert_messages
+
+		def collide(docs):
+			# Otro proceso ocupa el nombre ya asignado con un mensaje distinto
+			other = frappe.get_doc({
+				"doctype": "WhatsApp Message",
+				"session": self.session.name,
+				"conversation": docs[0].conversation,
+				"message_id": "_test_collision_other",
+				"direction": "Incoming",
+				"message_type": "text",
+				"timestamp": docs[0].timestamp,
+			})
+			other.name = docs[0].name
+			other.db_insert()
+			return bulk_insert(docs)
+
+		with patch("xappiens_whatsapp.api.webhook_batch._bulk_insert_messages", side_effect=collide):
+			results, _queue = self.process([received("_test_collision_1", chat="34670000202")])
+
+		self.assertEqual(results[0]["action"], "created")
+		message = frappe.db.get_value(
+			"WhatsApp Message", results[0]["message_id"], ["message_id", "conversation"], as_dict=True
+		)
+		self.assertEqual(message.message_id, "_test_collision_1")
+		# El mensaje insertado aparte suma una sola vez en la conversación
+		self.assertEqual(frappe.db.get_value("WhatsApp Conversation", message.conversation, "total_messages"), 1)
+
+	def counters(self, conversation):
+		return frappe.db.get_value(
+			"WhatsApp Conversation", conversation, ["total_messages", "unread_count", "last_message"], as_dict=True
+		)
+
+	def test_conversation_counters_follow_message_changes(self):
+		conversation = frappe.get_doc({
+			"doctype": "WhatsApp Conversation",
+			"session": self.session.name,
+			"chat_id": "34670000203@s.whatsapp.net",
+			"phone_number": "34670000203",
+			"status": "Active",
+		}).insert(ignore_permissions=True)
+
+		def message(message_id, direction, content, minutes):
+			return frappe.get_doc({
+				"doctype": "WhatsApp Message",
+				"session": self.session.name,
+				"conversation": conversation.name,
+				"message_id": message_id,
+				"content": content,
+				"direction": direction,
+				"message_type": "text",
+				"timestamp": add_to_date(now_datetime(), minutes=minutes),
+			}).insert(ignore_permissions=True)
+
+		incoming = message("_test_stats_in", "Incoming", "Entrante", -1)
+		# Un mensaje más antiguo suma al total pero no cambia el último mensaje
+		message("_test_stats_out", "Outgoing", "Saliente", -5)
+		self.assertEqual(self.counters(conversation.name), {"total_messages": 2, "unread_count": 1, "last_message": "Entrante"})
+
+		incoming.status = "Read"
+		incoming.save(ignore_permissions=True)
+		self.assertEqual(self.counters(conversation.name).unread_count, 0)
+
+		incoming.status = "Delivered"
+		incoming.save(ignore_permissions=True)
+		self.assertEqual(self.counters(conversation.name).unread_count, 1)
+
+		# Al borrar se descuenta y el último mensaje pasa al anterior
+		incoming.delete(ignore_permissions=True)
+		self.assertEqual(self.counters(conversation.name), {"total_messages": 1, "unread_count": 0, "last_message": "Saliente"})
+
+		# Contadores desviados (p. ej. por SQL directo): la reconciliación los corrige
+		frappe.db.set_value("WhatsApp Conversation", conversation.name, {"total_messages": 7, "unread_count": 3})
+		self.assertEqual(reconcile_conversations([conversation.name]), {"success": True, "checked": 1, "repaired": 1})
+		self.assertEqual(self.counters(conversation.name), {"total_messages": 1, "unread_count": 0, "last_message": "Saliente"})
+		self.assertEqual(reconcile_conversations([conversation.name])["repaired"], 0)
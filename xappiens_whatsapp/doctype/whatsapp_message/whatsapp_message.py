@@ -5,6 +5,10 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import now
 
+from xappiens_whatsapp.utils.conversation_stats import apply_message_delta, is_unread, refresh_last_message
+from xappiens_whatsapp.utils.media_storage import release_media
+from xappiens_whatsapp.utils.phone import get_message_phone
+
 
 class WhatsAppMessage(Document):
 	def validate(self):
@@ -18,9 +22,20 @@ class WhatsAppMessage(Document):
 		# Set initial status if pending
 		if self.direction == "Outgoing" and not self.sent_at:
 			self.status = "Pending"
-		elif self.direction == "Incoming":
+		elif self.direction == "Incoming" and self.is_new():
+			# Only on insert, so later status changes (e.g. Read) are kept
 			self.status = "Delivered"
 
+		self.set_normalized_phone()
+
+	def set_normalized_phone(self):
+		"""Store the E.164 number of the other party, falling back to the conversation's."""
+		self.normalized_phone = get_message_phone(self.direction, self.from_number, self.to_number)
+		if not self.normalized_phone and self.conversation:
+			self.normalized_phone = frappe.db.get_value(
+				"WhatsApp Conversation", self.conversation, "normalized_phone"
+			) or ""
+
 	def after_insert(self):
 		"""Actions after insert."""
 		# Update conversation with last message
@@ -28,9 +43,10 @@ class WhatsAppMessage(Document):
 
 	def on_update(self):
 		"""Actions after update."""
-		# Update conversation when message changes
-		if self.has_value_changed("content") or self.has_value_changed("timestamp"):
-			self.update_conversation()
+		# on_update also runs on insert; after_insert already counted the message
+		previous = self.get_doc_before_save()
+		if previous:
+			self.update_conversation_on_change(previous)
 
 		# Set status timestamps
 		if self.has_value_changed("status"):
@@ -41,41 +57,59 @@ class WhatsAppMessage(Document):
 			elif self.status == "Read" and not self.read_at:
 				self.read_at = now()
 
+	def after_delete(self):
+		"""Remove the message from the conversation counters."""
+		try:
+			apply_message_delta(
+				self.conversation,
+				total=-1,
+				unread=-1 if is_unread(self.direction, self.status) else 0,
+				session=self.session,
+			)
+			refresh_last_message(self.conversation)
+
+		except Exception as e:
+			frappe.log_error(f"Error updating conversation after message delete: {str(e)}")
+
+		# Media rows are already deleted: release stored files nobody else references
+		for media_hash in {item.media_hash for item in self.media_items if item.media_hash}:
+			release_media(media_hash)
+
 	def update_conversation(self):
-		"""Update parent conversation with last message info."""
+		"""Add this new message to the parent conversation counters and last message."""
 		try:
-			conversation = frappe.get_doc("WhatsApp Conversation", self.conversation)
-
-			# Get the latest message for this conversation
-			latest_message = frappe.db.sql("""
-				SELECT content, timestamp, direction
-				FROM `tabWhatsApp Message`
-				WHERE conversation = %s
-				ORDER BY timestamp DESC
-				LIMIT 1
-			""", self.conversation, as_dict=True)
-
-			if latest_message:
-				msg = latest_message[0]
-				conversation.last_message = msg.content
-				conversation.last_message_time = msg.timestamp
-				conversation.last_message_from_me = 1 if msg.direction == "Outgoing" else 0
-
-			# Update unread count for incoming messages
-			if self.direction == "Incoming" and self.status != "Read":
-				conversation.unread_count = frappe.db.count("WhatsApp Message", {
-					"conversation": self.conversation,
-					"direction": "Incoming",
-					"status": ["!=", "Read"]
-				})
-
-			# Update total messages
-			conversation.total_messages = frappe.db.count("WhatsApp Message", {
-				"conversation": self.conversation
-			})
-
-			conversation.flags.ignore_version = True
-			conversation.save(ignore_permissions=True)
+			apply_message_delta(
+				self.conversation,
+				total=1,
+				unread=1 if is_unread(self.direction, self.status) else 0,
+				last_message=self.content,
+				last_message_time=self.timestamp,
+				last_message_from_me=self.direction == "Outgoing",
+				session=self.session,
+			)
+
+		except Exception as e:
+			frappe.log_error(f"Error updating conversation from message: {str(e)}")
+
+	def update_conversation_on_change(self, previous):
+		"""Apply counter deltas for a status, content or conversation change."""
+		try:
+			was_unread = is_unread(previous.direction, previous.status)
+			now_unread = is_unread(self.direction, self.status)
+
+			if previous.conversation != self.conversation:
+				# Message moved to another conversation
+				apply_message_delta(previous.conversation, total=-1, unread=-1 if was_unread else 0, session=previous.session)
+				refresh_last_message(previous.conversation)
+				apply_message_delta(self.conversation, total=1, unread=1 if now_unread else 0, session=self.session)
+				refresh_last_message(self.conversation)
+				return
+
+			if was_unread != now_unread:
+				apply_message_delta(self.conversation, unread=1 if now_unread else -1, session=self.session)
+
+			if self.has_value_changed("content") or self.has_value_changed("timestamp"):
+				refresh_last_message(self.conversation)
 
 		except Exception as e:
 			frappe.log_error(f"Error updating conversation from message: {str(e)}")
@@ -86,11 +120,9 @@ class WhatsAppMessage(Document):
 		if self.direction == "Incoming":
 			self.status = "Read"
 			self.read_at = now()
+			# Saving applies the unread delta to the conversation
 			self.save()
 
-			# Update conversation unread count
-			self.update_conversation()
-
 			return {"success": True, "message": "Message marked as read"}
 
 		return {"success": False, "message": "Only incoming messages can be marked as read"}
@@ -208,3 +240,9 @@ class WhatsAppMessage(Document):
 			frappe.log_error(f"Error downloading media: {str(e)}")
 			return {"success": False, "message": str(e)}
 
+
+def on_doctype_update():
+	"""Índices compuestos para las consultas frecuentes (ver utils/indexes.py)"""
+	from xappiens_whatsapp.utils.indexes import ensure_indexes
+
+	ensure_indexes("WhatsApp Message")
@@ -1,9 +1,219 @@
 # Copyright (c) 2025, Xappiens and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from xappiens_whatsapp.api.outbound_queue import process_outbound_queue, queue_outgoing_message
+from xappiens_whatsapp.api.sync_scheduler import _lock_key, run_session_sync, schedule_auto_sync
+from xappiens_whatsapp.api.webhook import _handle_message_sent, _handle_message_status
+from xappiens_whatsapp.utils.locks import acquire_lock, is_locked, release_lock
+from xappiens_whatsapp.utils.rate_limit import acquire_send_token, reset_send_tokens
+from xappiens_whatsapp.utils.trace import clear_trace_config, is_enabled
+
+
+TEST_SESSION_ID = "_test_outbound_queue"
+STATUS_CALLBACK = "xappiens_whatsapp.doctype.whatsapp_session.test_whatsapp_session.record_status"
+status_updates = []
+
+
+def record_status(message, status, error=None):
+	status_updates.append((message, status, error))
 
 
 class TestWhatsAppSession(FrappeTestCase):
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.session = frappe.get_doc({
+			"doctype": "WhatsApp Session",
+			"session_id": TEST_SESSION_ID,
+			"session_name": TEST_SESSION_ID,
+			"status": "Connected",
+			"is_connected": 1,
+		}).insert(ignore_permissions=True)
+		cls.conversation = frappe.get_doc({
+			"doctype": "WhatsApp Conversation",
+			"session": cls.session.name,
+			"chat_id": "34670000001@s.whatsapp.net",
+			"phone_number": "34670000001",
+			"status": "Active",
+		}).insert(ignore_permissions=True)
+
+	@classmethod
+	def tearDownClass(cls):
+		reset_send_tokens(cls.session.name)
+		# Sin conexión on_trash no llama al servidor; borra también sus mensajes y conversaciones
+		frappe.db.set_value("WhatsApp Session", cls.session.name, "is_connected", 0)
+		frappe.delete_doc("WhatsApp Session", cls.session.name, force=True, ignore_permissions=True)
+		frappe.db.commit()
+		super().tearDownClass()
+
+	def setUp(self):
+		status_updates.clear()
+		callbacks = patch(
+			"xappiens_whatsapp.api.outbound_queue.get_status_callbacks", return_value={STATUS_CALLBACK}
+		)
+		callbacks.start()
+		self.addCleanup(callbacks.stop)
+		reset_send_tokens(self.session.name)
+		settings = frappe.get_single("WhatsApp Settings")
+		previous = {
+			field: settings.get(field)
+			for field in ("rate_limit_enabled", "rate_limit_messages_per_minute", "rate_limit_agent_reserve")
+		}
+		self.addCleanup(frappe.db.set_single_value, "WhatsApp Settings", previous)
+		frappe.db.set_single_value("WhatsApp Settings", {
+			"rate_limit_enabled": 1,
+			"rate_limit_messages_per_minute": 2,
+			"rate_limit_agent_reserve": 50,
+		})
+
+	def queue(self, text, priority):
+		return queue_outgoing_message(
+			self.conversation, self.session, text, text,
+			priority=priority, status_callback=STATUS_CALLBACK, schedule=False
+		)
+
+	def test_outbound_queue_prioritises_agents_within_rate_limit(self):
+		bulk = self.queue("Oferta", "bulk")
+		agent = self.queue("Respuesta", "agent")
+
+		sent = []
+		def post(endpoint, data=None, use_session_id=True):
+			sent.append(data["message"])
+			return {"success": True, "data": {"messageId": f"_test_sent_{len(sent)}"}}
+
+		with patch("xappiens_whatsapp.api.outbound_queue.WhatsAppAPIClient") as client:
+			client.return_value.post.side_effect = post
+			process_outbound_queue(self.session.name)
+
+		# La respuesta sale antes aunque se encoló después; el masivo no puede
+		# gastar la reserva de agentes (1 de 2 tokens) y espera en la cola
+		self.assertEqual(sent, ["Respuesta"])
+		agent.reload()
+		self.assertEqual((agent.status, agent.message_id, agent.send_attempts), ("Sent", "_test_sent_1", 1))
+		self.assertEqual(frappe.db.get_value("WhatsApp Message", bulk.name, "status"), "Pending")
+		self.assertEqual(status_updates, [(agent.name, "Sent", None)])
+
+		self.assertGreater(acquire_send_token(self.session.name, bulk=True), 0)
+		self.assertEqual(acquire_send_token(self.session.name), 0)
+
+		# Un 4xx no se reintenta: el mensaje queda fallido y se notifica
+		reset_send_tokens(self.session.name)
+		rejected = {"success": False, "status_code": 400, "message": "Número no válido"}
+		with patch("xappiens_whatsapp.api.outbound_queue.WhatsAppAPIClient") as client:
+			client.return_value.post.return_value = rejected
+			process_outbound_queue(self.session.name)
+
+		bulk.reload()
+		self.assertEqual((bulk.status, bulk.error_message), ("Failed", "Número no válido"))
+		self.assertEqual(status_updates[-1], (bulk.name, "Failed", "Número no válido"))
+
+	def test_status_webhooks_never_requeue_a_sent_message(self):
+		message = self.queue("Hola", "agent")
+
+		sent = []
+		def post(endpoint, data=None, use_session_id=True):
+			sent.append(data["message"])
+			return {"success": True, "data": {"messageId": "_test_requeue_1"}}
+
+		with patch("xappiens_whatsapp.api.outbound_queue.WhatsAppAPIClient") as client:
+			client.return_value.post.side_effect = post
+			process_outbound_queue(self.session.name)
+
+			# Acks intermedios y avisos atrasados llegan después de Delivered
+			_handle_message_status({"messageId": "_test_requeue_1", "status": "delivered"})
+			for ack in ("pending", "server_ack", "sent", "failed"):
+				_handle_message_status({"messageId": "_test_requeue_1", "status": ack})
+			_handle_message_sent({"messageId": "_test_requeue_1"})
+
+			process_outbound_queue(self.session.name)
+
+		self.assertEqual(sent, ["Hola"])
+		message.reload()
+		self.assertEqual((message.status, message.send_priority), ("Delivered", 0))
+		self.assertEqual([status for _name, status, _error in status_updates], ["Sent", "Delivered"])
+
+	def test_unregistered_status_callback_is_rejected(self):
+		with self.assertRaises(frappe.ValidationError):
+			queue_outgoing_message(
+				self.conversation, self.session, "Hola", "Hola",
+				status_callback="frappe.delete_doc", schedule=False
+			)
+
+	def test_trace_sample_rate_inherits_settings_unless_overridden(self):
+		settings = frappe.get_single("WhatsApp Settings")
+		previous = {field: settings.get(field) for field in ("trace_level", "trace_sample_rate")}
+		self.addCleanup(clear_trace_config)
+		self.addCleanup(frappe.db.set_single_value, "WhatsApp Settings", previous)
+		frappe.db.set_single_value("WhatsApp Settings", {"trace_level": "Debug", "trace_sample_rate": 1})
+		clear_trace_config()
+
+		# Sin tasa propia (la columna Float vale 0) se usa la de WhatsApp Settings
+		self.assertEqual(frappe.db.get_value("WhatsApp Session", self.session.name, "trace_sample_rate"), 0)
+		self.assertTrue(is_enabled(TEST_SESSION_ID, "debug"))
+
+		session = frappe.get_doc("WhatsApp Session", self.session.name)
+		session.override_trace_sample_rate = 1
+		session.trace_sample_rate = 0
+		session.save(ignore_permissions=True)
+		self.addCleanup(frappe.db.set_value, "WhatsApp Session", self.session.name, "override_trace_sample_rate", 0)
+		self.addCleanup(clear_trace_config, TEST_SESSION_ID)
+		self.assertFalse(is_enabled(TEST_SESSION_ID, "debug"))
+		# Warning y Error no se muestrean
+		self.assertTrue(is_enabled(TEST_SESSION_ID, "warning"))
+
+	def test_auto_sync_enqueues_due_sessions_within_concurrency(self):
+		now = now_datetime()
+		sessions = [
+			frappe._dict(name="_test_sync_never", last_auto_sync=None),
+			frappe._dict(name="_test_sync_old", last_auto_sync=add_to_date(now, hours=-1)),
+			frappe._dict(name="_test_sync_locked", last_auto_sync=add_to_date(now, hours=-1)),
+			frappe._dict(name="_test_sync_recent", last_auto_sync=now),
+			frappe._dict(name="_test_sync_older", last_auto_sync=add_to_date(now, hours=-2)),
+		]
+		locked_token = acquire_lock(_lock_key("_test_sync_locked"))
+		self.addCleanup(release_lock, _lock_key("_test_sync_locked"), locked_token)
+
+		def schedule(max_concurrency):
+			config = {"enabled": True, "interval": 5, "queue": "long", "max_concurrency": max_concurrency}
+			with (
+				patch("xappiens_whatsapp.api.sync_scheduler._get_sync_config", return_value=config),
+				patch("xappiens_whatsapp.api.sync_scheduler.frappe.get_all", return_value=sessions),
+				patch("xappiens_whatsapp.api.sync_scheduler.frappe.enqueue") as enqueue,
+			):
+				result = schedule_auto_sync()
+			for call in enqueue.call_args_list:
+				self.addCleanup(release_lock, _lock_key(call.kwargs["session_name"]), call.kwargs["lock_token"])
+			return result, [call.kwargs["session_name"] for call in enqueue.call_args_list]
+
+		# La sesión con lock cuenta como en curso y ocupa uno de los dos huecos
+		result, enqueued = schedule(max_concurrency=2)
+		self.assertEqual(enqueued, ["_test_sync_never"])
+		self.assertEqual(result["running"], ["_test_sync_locked"])
+		self.assertEqual(result["waiting"], ["_test_sync_old", "_test_sync_older"])
+		self.assertTrue(is_locked(_lock_key("_test_sync_never")))
+
+		# Con más huecos entran las pendientes; nunca las que están en curso ni las recientes
+		result, enqueued = schedule(max_concurrency=5)
+		self.assertEqual(enqueued, ["_test_sync_old", "_test_sync_older"])
+		self.assertEqual(result["running"], ["_test_sync_never", "_test_sync_locked"])
+		self.assertEqual(result["waiting"], [])
+
+	def test_auto_sync_error_is_recorded_and_releases_lock(self):
+		# run_session_sync hace rollback ante un error: la sesión de prueba debe estar confirmada
+		frappe.db.commit()
+		token = acquire_lock(_lock_key(self.session.name))
+
+		with patch("xappiens_whatsapp.api.sync.sync_session_data", side_effect=Exception("Servidor caído")):
+			run_session_sync(self.session.name, lock_token=token)
+
+		status, error = frappe.db.get_value(
+			"WhatsApp Session", self.session.name, ["last_auto_sync_status", "last_auto_sync_error"]
+		)
+		self.assertEqual((status, error), ("Failed", "Servidor caído"))
+		self.assertFalse(is_locked(_lock_key(self.session.name)))
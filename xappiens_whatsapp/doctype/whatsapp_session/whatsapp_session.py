@@ -234,6 +234,13 @@ class WhatsAppSession(Document):
 
 		self.db_set("updated_at", frappe.utils.now())
 
+		if self.session_id and (
+			self.has_value_changed("trace_sample_rate") or self.has_value_changed("override_trace_sample_rate")
+		):
+			from xappiens_whatsapp.utils.trace import clear_trace_config
+
+			clear_trace_config(self.session_id)
+
 	def get_merge_statistics(self):
 		"""Obtener estadísticas para fusión"""
 		from .whatsapp_session_merge import WhatsAppSessionMerge
@@ -1,9 +1,37 @@
 # Copyright (c) 2025, Xappiens and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import frappe
+import requests
 from frappe.tests.utils import FrappeTestCase
 
+from xappiens_whatsapp.utils import transport
+
 
 class TestWhatsAppSettings(FrappeTestCase):
-	pass
+	def test_http_session_pool_is_per_site_and_never_closed_on_rebuild(self):
+		url = "https://wa.example.com/api/sessions"
+		transport.discard_sessions()
+		self.addCleanup(transport.discard_sessions)
+
+		first = transport.get_http_session(url)
+		self.assertIs(transport.get_http_session("https://wa.example.com/api/messages"), first)
+
+		# Releer la configuración sin cambiar las opciones del pool reutiliza la sesión
+		with patch.object(transport, "_config_cache", {}):
+			self.assertIs(transport.get_http_session(url), first)
+
+		# Otro sitio atendido por el mismo worker tiene su propio pool
+		with patch.object(frappe.local, "site", "other.example.com"):
+			self.assertIsNot(transport.get_http_session(url), first)
+		self.assertIs(transport.get_http_session(url), first)
+
+		# Si cambian las opciones del pool se construye otro sin cerrar el anterior
+		with (
+			patch.object(transport, "_pool_fingerprint", return_value=("changed",)),
+			patch.object(requests.Session, "close") as close,
+		):
+			self.assertIsNot(transport.get_http_session(url), first)
+		close.assert_not_called()
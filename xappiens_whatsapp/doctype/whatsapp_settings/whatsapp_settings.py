@@ -25,3 +25,21 @@ class WhatsAppSettings(Document):
 		if self.webhook_url != expected_url:
 			self.webhook_url = expected_url
 
+		if not self.webhook_secret:
+			frappe.msgprint(
+				"Sin Webhook Secret se aceptan webhooks sin verificar la firma",
+				title="Webhook Secret no configurado",
+				indicator="orange",
+			)
+
+	def on_update(self):
+		"""Invalidar la configuración de API y de trazas cacheada en los workers y el aviso de secret"""
+		from xappiens_whatsapp.api.webhook import MISSING_SECRET_LOGGED_KEY
+		from xappiens_whatsapp.utils.trace import clear_trace_config
+		from xappiens_whatsapp.utils.transport import invalidate_api_config
+
+		invalidate_api_config()
+		clear_trace_config()
+		# Volver a avisar si el secret se ha quitado
+		frappe.cache().delete_value(MISSING_SECRET_LOGGED_KEY)
+
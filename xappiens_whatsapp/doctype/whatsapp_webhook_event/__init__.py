@@ -0,0 +1,3 @@
+# Copyright (c) 2025, Xappiens and contributors
+# For license information, please see license.txt
+
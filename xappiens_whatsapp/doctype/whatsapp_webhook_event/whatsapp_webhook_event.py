@@ -0,0 +1,14 @@
+# Copyright (c) 2026, Xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class WhatsAppWebhookEvent(Document):
+	pass
+
+
+def on_doctype_update():
+	"""Índice para que el consumidor lea la cola de cada sesión en orden"""
+	frappe.db.add_index("WhatsApp Webhook Event", ["status", "session_id", "name"])
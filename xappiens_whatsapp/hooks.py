@@ -170,6 +170,28 @@ fixtures = [
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"all": [
+		"xappiens_whatsapp.api.webhook_queue.process_pending_events",
+		"xappiens_whatsapp.api.media_queue.schedule_media_downloads",
+		"xappiens_whatsapp.api.broadcast.resume_broadcasts"
+	],
+	"hourly": [
+		"xappiens_whatsapp.api.avatars.queue_stale_avatars"
+	],
+	"daily": [
+		"xappiens_whatsapp.api.webhook_queue.cleanup_processed_events",
+		"xappiens_whatsapp.utils.conversation_stats.reconcile_conversations",
+		"xappiens_whatsapp.utils.media_storage.cleanup_unreferenced_media"
+	],
+	"cron": {
+		"* * * * *": [
+			"xappiens_whatsapp.api.sync_scheduler.schedule_auto_sync",
+			"xappiens_whatsapp.api.outbound_queue.schedule_outbound_sends"
+		]
+	},
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"xappiens_whatsapp.tasks.all"
@@ -188,6 +210,12 @@ fixtures = [
 # 	],
 # }
 
+# Métodos que pueden recibir los cambios de estado de los mensajes encolados
+# (status_callback de api.outbound_queue.queue_outgoing_message)
+whatsapp_message_status_callbacks = [
+	"xappiens_whatsapp.api.broadcast.on_message_status"
+]
+
 # Testing
 # -------
 
@@ -56,6 +56,7 @@ def install_all_doctypes():
         "WhatsApp Activity Log",       # Depende de Session
         "WhatsApp Webhook Config",     # Sin dependencias fuertes
         "WhatsApp Webhook Log",        # Depende de Webhook Config
+        "WhatsApp Webhook Event",      # Sin dependencias (cola de ingesta)
     ]
 
     print("\n" + "="*70)
@@ -175,6 +176,7 @@ def verify_installation():
         "WhatsApp Activity Log",
         "WhatsApp Webhook Config",
         "WhatsApp Webhook Log",
+        "WhatsApp Webhook Event",
     ]
 
     print("\n" + "="*70)
@@ -238,6 +240,7 @@ def uninstall_all_doctypes():
 
     # Lista en orden inverso para eliminar dependencias primero
     doctypes = [
+        "WhatsApp Webhook Event",
         "WhatsApp Webhook Log",
         "WhatsApp Webhook Config",
         "WhatsApp Activity Log",
@@ -38,6 +38,7 @@ def install_all_doctypes_v2():
         "whatsapp_activity_log",
         "whatsapp_webhook_config",
         "whatsapp_webhook_log",
+        "whatsapp_webhook_event",
     ]
 
     print("\n" + "="*70)
@@ -0,0 +1,16 @@
+"""
+Patch para crear los índices compuestos de mensajes, conversaciones y contactos.
+Se ejecuta después de cleanup_duplicate_message_ids para que el índice único
+(session, message_id) no falle por duplicados.
+"""
+
+import frappe
+from xappiens_whatsapp.utils.indexes import ensure_indexes
+
+
+def execute():
+    """Crear los índices compuestos que falten"""
+    created = ensure_indexes(raise_on_error=True)
+
+    if created:
+        frappe.msgprint("Índices creados: {0}".format(", ".join(created)))
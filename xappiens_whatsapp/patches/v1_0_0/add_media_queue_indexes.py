@@ -0,0 +1,16 @@
+"""
+Patch para la cola de descargas de media: índices de WhatsApp Media File por
+(status, next_attempt_at), para reservar la siguiente descarga, y por message,
+para no registrar dos veces la misma descarga.
+"""
+
+import frappe
+from xappiens_whatsapp.utils.indexes import ensure_indexes
+
+
+def execute():
+    """Crear los índices de la cola de descargas de media"""
+    created = ensure_indexes("WhatsApp Media File", raise_on_error=True)
+
+    if created:
+        frappe.msgprint("Índices creados: {0}".format(", ".join(created)))
@@ -0,0 +1,19 @@
+"""
+Patch para la paginación por cursor de mensajes: crea el índice
+(conversation, timestamp, name) y elimina el antiguo (conversation, timestamp),
+que queda cubierto por el nuevo.
+"""
+
+import frappe
+from xappiens_whatsapp.utils.indexes import drop_retired_indexes, ensure_indexes
+
+
+def execute():
+    """Crear el índice de paginación por cursor y eliminar el que sustituye"""
+    created = ensure_indexes("WhatsApp Message", raise_on_error=True)
+    dropped = drop_retired_indexes()
+
+    if created or dropped:
+        frappe.msgprint("Índices creados: {0}; eliminados: {1}".format(
+            ", ".join(created) or "-", ", ".join(dropped) or "-"
+        ))
@@ -0,0 +1,16 @@
+"""
+Patch para la cola de envío: índice de WhatsApp Message por
+(session, status, send_priority), para encontrar los mensajes pendientes de
+envío sin recorrer el histórico de mensajes.
+"""
+
+import frappe
+from xappiens_whatsapp.utils.indexes import ensure_indexes
+
+
+def execute():
+    """Crear el índice de la cola de envío"""
+    created = ensure_indexes("WhatsApp Message", raise_on_error=True)
+
+    if created:
+        frappe.msgprint("Índices creados: {0}".format(", ".join(created)))
@@ -0,0 +1,18 @@
+"""
+Patch para rellenar normalized_phone (E.164) en conversaciones, contactos y
+mensajes existentes. Se procesa por bloques con commit tras cada uno, así que
+puede relanzarse si se interrumpe.
+"""
+
+import frappe
+from xappiens_whatsapp.utils.phone import backfill_normalized_phones
+
+
+def execute():
+    """Rellenar normalized_phone en los registros existentes"""
+    updated = backfill_normalized_phones()
+
+    if any(updated.values()):
+        frappe.msgprint("Teléfonos normalizados: {0}".format(
+            ", ".join(f"{doctype}: {count}" for doctype, count in updated.items())
+        ))
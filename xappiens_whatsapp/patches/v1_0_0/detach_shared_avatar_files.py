@@ -0,0 +1,32 @@
+"""
+Patch para los avatares compartidos: los File de fotos de perfil se adjuntaban
+al primer contacto que los descargaba y se reutilizaban en otros contactos con
+la misma imagen, así que borrar ese contacto borraba la foto de los demás.
+Se desadjuntan los File que usa como avatar algún contacto distinto del suyo.
+"""
+
+import frappe
+
+
+def execute():
+    """Desadjuntar los File de avatares compartidos entre contactos"""
+    shared = frappe.db.sql_list("""
+        SELECT DISTINCT f.name
+        FROM `tabFile` f
+        INNER JOIN `tabWhatsApp Contact` c
+            ON c.profile_pic = f.file_url OR c.profile_pic_thumb = f.file_url
+        WHERE f.attached_to_doctype = 'WhatsApp Contact'
+            AND f.is_private = 0
+            AND c.name != f.attached_to_name
+    """)
+
+    for i in range(0, len(shared), 500):
+        frappe.db.sql("""
+            UPDATE `tabFile`
+            SET attached_to_doctype = NULL, attached_to_name = NULL, attached_to_field = NULL
+            WHERE name IN %s
+        """, (tuple(shared[i:i + 500]),))
+        frappe.db.commit()
+
+    if shared:
+        frappe.msgprint("Avatares compartidos desadjuntados: {0}".format(len(shared)))
@@ -0,0 +1,189 @@
+"""
+Benchmarks de regresión de las consultas calientes sobre un dataset sintético.
+
+Se ejecutan en un sitio de pruebas (nunca en producción) con bench:
+
+    bench --site [sitio] execute xappiens_whatsapp.utils.benchmarks.benchmark_unified_contacts
+    bench --site [sitio] execute xappiens_whatsapp.utils.benchmarks.benchmark_unified_contacts --kwargs "{'messages': 1000000}"
+    bench --site [sitio] execute xappiens_whatsapp.utils.benchmarks.cleanup_benchmark_dataset
+
+El dataset se inserta con `bulk_insert` (sin controladores) y se marca con el
+prefijo BENCHMARK_PREFIX para poder borrarlo después.
+"""
+
+import statistics
+import time
+from typing import Any, Dict
+from unittest.mock import patch
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+
+BENCHMARK_PREFIX = "_bench"
+INSERT_CHUNK_SIZE = 10000
+
+CONVERSATION_FIELDS = [
+    "name", "creation", "modified", "owner", "modified_by",
+    "session", "chat_id", "phone_number", "normalized_phone", "contact_name", "status",
+    "unread_count", "total_messages", "last_message", "last_message_time",
+]
+MESSAGE_FIELDS = [
+    "name", "creation", "modified", "owner", "modified_by",
+    "session", "conversation", "normalized_phone", "message_id", "content", "direction",
+    "message_type", "status", "timestamp",
+]
+
+
+def seed_benchmark_dataset(messages: int = 1000000, phones: int = 5000, sessions: int = 3) -> Dict[str, Any]:
+    """
+    Crea el dataset sintético si no existe: `sessions` sesiones, una conversación
+    por teléfono y sesión, y `messages` mensajes repartidos entre ellas.
+
+    Args:
+        messages: Número total de mensajes
+        phones: Números de teléfono distintos
+        sessions: Sesiones con conversación con cada teléfono
+
+    Returns:
+        Dict con el tamaño del dataset
+    """
+    existing = frappe.db.count("WhatsApp Message", {"name": ["like", f"{BENCHMARK_PREFIX}-%"]})
+    if existing >= messages:
+        return {"seeded": False, "messages": existing}
+
+    cleanup_benchmark_dataset()
+
+    session_names = []
+    for i in range(sessions):
+        session = frappe.get_doc({
+            "doctype": "WhatsApp Session",
+            "session_id": f"{BENCHMARK_PREFIX}_session_{i}",
+            "session_name": f"{BENCHMARK_PREFIX}_session_{i}",
+            "status": "Disconnected",
+            "is_active": 1,
+        }).insert(ignore_permissions=True)
+        session_names.append(session.name)
+
+    now = now_datetime()
+    user = frappe.session.user
+
+    conversations = []
+    for phone_index in range(phones):
+        phone_number = f"3490{phone_index:07d}"
+        for session_name in session_names:
+            conversations.append((
+                f"{BENCHMARK_PREFIX}-C{len(conversations):08d}", now, now, user, user,
+                session_name, f"{phone_number}@s.whatsapp.net", phone_number, f"+{phone_number}", f"Benchmark {phone_index}", "Active",
+                0, 0, None, None,
+            ))
+
+    frappe.db.bulk_insert("WhatsApp Conversation", CONVERSATION_FIELDS, conversations, chunk_size=INSERT_CHUNK_SIZE)
+
+    for start in range(0, messages, INSERT_CHUNK_SIZE):
+        rows = []
+        for i in range(start, min(start + INSERT_CHUNK_SIZE, messages)):
+            conversation = conversations[i % len(conversations)]
+            incoming = i % 3 != 0
+            rows.append((
+                f"{BENCHMARK_PREFIX}-M{i:09d}", now, now, user, user,
+                conversation[5], conversation[0], conversation[8], f"{BENCHMARK_PREFIX}_{i}", f"Mensaje {i}",
+                "Incoming" if incoming else "Outgoing", "text", "Delivered" if incoming else "Sent",
+                add_to_date(now, seconds=-(messages - i)),
+            ))
+        frappe.db.bulk_insert("WhatsApp Message", MESSAGE_FIELDS, rows, chunk_size=INSERT_CHUNK_SIZE)
+        frappe.db.commit()
+
+    # Contadores y último mensaje de las conversaciones sintéticas
+    frappe.db.sql("""
+        UPDATE `tabWhatsApp Conversation` c
+        INNER JOIN (
+            SELECT
+                conversation,
+                COUNT(*) AS total,
+                SUM(direction = 'Incoming' AND status != 'Read') AS unread,
+                MAX(timestamp) AS last_time
+            FROM `tabWhatsApp Message`
+            WHERE name LIKE %(prefix)s
+            GROUP BY conversation
+        ) m ON m.conversation = c.name
+        SET c.total_messages = m.total, c.unread_count = m.unread, c.last_message_time = m.last_time
+    """, {"prefix": f"{BENCHMARK_PREFIX}-%"})
+    frappe.db.commit()
+
+    return {"seeded": True, "messages": messages, "conversations": len(conversations), "sessions": sessions}
+
+
+def cleanup_benchmark_dataset():
+    """Borra sesiones, conversaciones y mensajes del dataset sintético."""
+    frappe.db.sql("DELETE FROM `tabWhatsApp Message` WHERE name LIKE %s", (f"{BENCHMARK_PREFIX}-%",))
+    frappe.db.sql("DELETE FROM `tabWhatsApp Conversation` WHERE name LIKE %s", (f"{BENCHMARK_PREFIX}-%",))
+    for session in frappe.get_all("WhatsApp Session", filters={"session_id": ["like", f"{BENCHMARK_PREFIX}_%"]}, pluck="name"):
+        frappe.delete_doc("WhatsApp Session", session, ignore_permissions=True, force=True)
+    frappe.db.commit()
+
+
+def _measure(method, runs: int, **kwargs) -> Dict[str, Any]:
+    """Ejecuta `method` `runs` veces y devuelve tiempos (ms) y consultas SQL de la última ejecución."""
+    timings = []
+    queries = 0
+    sql = frappe.db.sql
+
+    for _ in range(runs):
+        with patch.object(frappe.db, "sql", wraps=sql) as counted:
+            start = time.perf_counter()
+            result = method(**kwargs)
+            timings.append((time.perf_counter() - start) * 1000)
+        queries = counted.call_count
+
+        if not result.get("success"):
+            frappe.throw(f"{method.__name__} falló: {result.get('error') or result.get('message')}")
+
+    return {
+        "median_ms": round(statistics.median(timings), 2),
+        "max_ms": round(max(timings), 2),
+        "queries": queries,
+    }
+
+
+def benchmark_unified_contacts(messages: int = 1000000, limit: int = 50, runs: int = 5, max_median_ms: int = 1000) -> Dict[str, Any]:
+    """
+    Benchmark de regresión de get_unified_contacts sobre el dataset sintético.
+
+    Falla si el número de consultas depende del tamaño de página (vuelta al
+    enriquecimiento por fila) o si la mediana supera `max_median_ms`.
+
+    Args:
+        messages: Tamaño del dataset (se siembra si no existe)
+        limit: Tamaño de página medido
+        runs: Repeticiones por medición
+        max_median_ms: Umbral de la mediana en milisegundos
+
+    Returns:
+        Dict con las mediciones
+    """
+    from xappiens_whatsapp.api.unified_contacts import get_unified_contacts
+
+    dataset = seed_benchmark_dataset(messages=messages)
+
+    small = _measure(get_unified_contacts, runs, limit=5)
+    page = _measure(get_unified_contacts, runs, limit=limit)
+
+    result = {
+        "dataset": dataset,
+        "limit_5": small,
+        f"limit_{limit}": page,
+    }
+
+    # bench execute muestra el resultado; si falla, las mediciones van en el error
+    if small["queries"] != page["queries"]:
+        frappe.throw(
+            f"get_unified_contacts ejecuta {small['queries']} consultas con limit=5 "
+            f"y {page['queries']} con limit={limit}: el enriquecimiento debe ir por lotes\n{frappe.as_json(result)}"
+        )
+    if page["median_ms"] > max_median_ms:
+        frappe.throw(
+            f"get_unified_contacts tarda {page['median_ms']} ms (umbral {max_median_ms} ms)\n{frappe.as_json(result)}"
+        )
+
+    return result
@@ -0,0 +1,216 @@
+"""
+Contadores incrementales de WhatsApp Conversation.
+
+`total_messages` y `unread_count` se mantienen con UPDATE atómicos de deltas
+(+1 al insertar, ±1 al cambiar de estado, -1 al borrar) en lugar de recontar los
+mensajes del chat en cada cambio. El último mensaje solo se reemplaza si el
+nuevo es más reciente. `reconcile_conversations` (tarea diaria) recalcula los
+contadores desde los mensajes y corrige cualquier desviación.
+
+Los agregados de `get_conversation_stats` (contadores de la UI) se cachean en
+Redis por sesión, filtro y permisos del usuario con un TTL corto; cualquier escritura de mensajes o
+conversaciones de la sesión invalida su caché con `invalidate_conversation_stats`.
+"""
+
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import frappe
+from frappe.utils import now_datetime
+
+
+RECONCILE_CHUNK_SIZE = 500
+
+STATS_CACHE_TTL = 30
+STATS_CACHE_KEY = "whatsapp_conversation_stats"
+
+
+def is_unread(direction: str, status: str) -> bool:
+    """Un mensaje cuenta como no leído si es entrante y no está en estado Read."""
+    return direction == "Incoming" and (status or "") != "Read"
+
+
+def apply_message_delta(
+    conversation: str,
+    total: int = 0,
+    unread: int = 0,
+    last_message: Optional[str] = None,
+    last_message_time=None,
+    last_message_from_me: Optional[bool] = None,
+    session: Optional[str] = None,
+):
+    """
+    Aplica deltas a los contadores de una conversación en un único UPDATE.
+
+    Args:
+        conversation: Nombre de la WhatsApp Conversation
+        total: Delta de total_messages
+        unread: Delta de unread_count
+        last_message: Contenido del mensaje candidato a último mensaje
+        last_message_time: Timestamp del candidato (si se omite, no se toca el último mensaje)
+        last_message_from_me: Si el candidato es saliente
+        session: Sesión de la conversación, para invalidar sus estadísticas
+            (si se omite, se consulta)
+    """
+    if not conversation:
+        return
+
+    assignments = [
+        "total_messages = GREATEST(IFNULL(total_messages, 0) + %(total)s, 0)",
+        "unread_count = GREATEST(IFNULL(unread_count, 0) + %(unread)s, 0)",
+    ]
+
+    if last_message_time:
+        # El SET se evalúa en orden: last_message_time debe asignarse al final
+        newer = "(last_message_time IS NULL OR last_message_time <= %(ts)s)"
+        assignments += [
+            f"last_message = IF({newer}, %(content)s, last_message)",
+            f"last_message_from_me = IF({newer}, %(from_me)s, last_message_from_me)",
+            f"last_message_time = IF({newer}, %(ts)s, last_message_time)",
+        ]
+
+    assignments.append("modified = %(now)s")
+
+    frappe.db.sql(f"""
+        UPDATE `tabWhatsApp Conversation`
+        SET {", ".join(assignments)}
+        WHERE name = %(name)s
+    """, {
+        "total": total,
+        "unread": unread,
+        "content": last_message or "",
+        "from_me": 1 if last_message_from_me else 0,
+        "ts": last_message_time,
+        "now": now_datetime(),
+        "name": conversation,
+    })
+
+    invalidate_conversation_stats(
+        session or frappe.db.get_value("WhatsApp Conversation", conversation, "session")
+    )
+
+
+def refresh_last_message(conversation: str):
+    """
+    Vuelve a calcular el último mensaje de la conversación (usa el índice
+    (conversation, timestamp)). Se usa al editar o borrar un mensaje.
+    """
+    if not conversation:
+        return
+
+    latest = frappe.db.sql("""
+        SELECT content, timestamp, direction
+        FROM `tabWhatsApp Message`
+        WHERE conversation = %s
+        ORDER BY timestamp DESC
+        LIMIT 1
+    """, (conversation,), as_dict=True)
+
+    msg = latest[0] if latest else frappe._dict()
+    frappe.db.set_value("WhatsApp Conversation", conversation, {
+        "last_message": msg.get("content"),
+        "last_message_time": msg.get("timestamp"),
+        "last_message_from_me": 1 if msg.get("direction") == "Outgoing" else 0,
+    }, update_modified=False)
+
+
+def reconcile_conversations(conversations: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Recalcula total_messages y unread_count desde los mensajes y corrige las
+    conversaciones desviadas. Tarea programada diaria; también puede lanzarse a mano:
+
+        bench --site [sitio] execute xappiens_whatsapp.utils.conversation_stats.reconcile_conversations
+
+    Args:
+        conversations: Limitar a estas conversaciones (por defecto, todas)
+
+    Returns:
+        Dict con conversaciones revisadas y corregidas
+    """
+    if conversations is None:
+        conversations = frappe.get_all("WhatsApp Conversation", pluck="name", order_by="name asc")
+
+    checked = 0
+    repaired = 0
+
+    for start in range(0, len(conversations), RECONCILE_CHUNK_SIZE):
+        chunk = conversations[start:start + RECONCILE_CHUNK_SIZE]
+        checked += len(chunk)
+
+        frappe.db.sql("""
+            UPDATE `tabWhatsApp Conversation` c
+            LEFT JOIN (
+                SELECT
+                    conversation,
+                    COUNT(*) AS total,
+                    SUM(direction = 'Incoming' AND IFNULL(status, '') != 'Read') AS unread
+                FROM `tabWhatsApp Message`
+                WHERE conversation IN %(chunk)s
+                GROUP BY conversation
+            ) m ON m.conversation = c.name
+            SET
+                c.total_messages = IFNULL(m.total, 0),
+                c.unread_count = IFNULL(m.unread, 0)
+            WHERE c.name IN %(chunk)s
+                AND (
+                    IFNULL(c.total_messages, 0) != IFNULL(m.total, 0)
+                    OR IFNULL(c.unread_count, 0) != IFNULL(m.unread, 0)
+                )
+        """, {"chunk": tuple(chunk)})
+        repaired += max(frappe.db._cursor.rowcount or 0, 0)
+        frappe.db.commit()
+
+    if repaired:
+        invalidate_conversation_stats()
+        frappe.logger("whatsapp", allow_site=True).info(
+            f"Contadores de conversaciones corregidos: {repaired} de {checked}"
+        )
+
+    return {"success": True, "checked": checked, "repaired": repaired}
+
+
+def _stats_cache_key(session: str) -> str:
+    return f"{STATS_CACHE_KEY}:{session}"
+
+
+def get_cached_conversation_stats(session: str, filters_key: str, generator: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Devuelve los agregados cacheados de una sesión para un filtro, o los calcula
+    con `generator` si no hay entrada o tiene más de STATS_CACHE_TTL segundos.
+
+    Args:
+        session: Nombre del documento WhatsApp Session
+        filters_key: Hash de los filtros y la búsqueda
+        generator: Función que calcula los agregados
+
+    Returns:
+        Agregados de la sesión para ese filtro
+    """
+    cache = frappe.cache()
+    key = _stats_cache_key(session)
+
+    entry = cache.hget(key, filters_key)
+    if entry and time.time() - entry.get("cached_at", 0) < STATS_CACHE_TTL:
+        return entry["stats"]
+
+    stats = generator()
+    cache.hset(key, filters_key, {"stats": stats, "cached_at": time.time()})
+    # Las entradas caducan por TTL; el hash completo no debe quedarse en Redis
+    cache.expire(cache.make_key(key), STATS_CACHE_TTL * 10)
+    return stats
+
+
+def invalidate_conversation_stats(session: Optional[str] = None):
+    """
+    Invalida los agregados cacheados de una sesión (o de todas). Se repite
+    tras el commit para que una lectura concurrente no cachee datos anteriores
+    a la escritura.
+    """
+    def clear():
+        if session:
+            frappe.cache().delete_value(_stats_cache_key(session))
+        else:
+            frappe.cache().delete_keys(f"{STATS_CACHE_KEY}:")
+
+    clear()
+    frappe.db.after_commit.add(clear)
@@ -0,0 +1,78 @@
+"""
+Utilidades de imagen: miniaturas para listas y vistas previas.
+"""
+
+from io import BytesIO
+from typing import Optional, Tuple, Union
+
+import frappe
+from PIL import Image, ImageOps
+
+
+AVATAR_THUMBNAIL_SIZE = (96, 96)
+MEDIA_THUMBNAIL_SIZE = (320, 320)
+VIDEO_POSTER_SIZE = (640, 640)
+THUMBNAIL_QUALITY = 80
+
+
+def make_thumbnail(content: bytes, size: Tuple[int, int] = AVATAR_THUMBNAIL_SIZE) -> Optional[bytes]:
+    """
+    Genera una miniatura JPEG que cabe en `size` conservando la proporción.
+
+    Args:
+        content: Bytes de la imagen original
+        size: Ancho y alto máximos
+
+    Returns:
+        Bytes JPEG de la miniatura, o None si la imagen no se puede leer
+    """
+    try:
+        with Image.open(BytesIO(content)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail(size)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+
+            output = BytesIO()
+            image.save(output, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            return output.getvalue()
+
+    except Exception as e:
+        frappe.log_error(f"Error generando miniatura: {str(e)}", "WhatsApp Thumbnail")
+        return None
+
+
+def make_webp_thumbnail(source: Union[str, bytes], size: Tuple[int, int] = MEDIA_THUMBNAIL_SIZE) -> Optional[Tuple[bytes, Tuple[int, int]]]:
+    """
+    Genera una miniatura WebP que cabe en `size` conservando la proporción y la
+    transparencia.
+
+    Args:
+        source: Ruta del archivo o bytes de la imagen original
+        size: Ancho y alto máximos
+
+    Returns:
+        Tupla (bytes WebP, (ancho, alto) de la imagen original), o None si la
+        imagen no se puede leer
+    """
+    try:
+        with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as image:
+            # Tamaño original ya orientado (EXIF 5-8 giran la imagen 90°)
+            dimensions = image.size
+            if image.getexif().get(0x0112) in (5, 6, 7, 8):
+                dimensions = dimensions[::-1]
+
+            # En JPEG decodifica directamente a una escala reducida
+            image.draft("RGB", (size[0] * 2, size[1] * 2))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail(size)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+            output = BytesIO()
+            image.save(output, format="WEBP", quality=THUMBNAIL_QUALITY, method=4)
+            return output.getvalue(), dimensions
+
+    except Exception as e:
+        frappe.log_error(f"Error generando miniatura: {str(e)}", "WhatsApp Thumbnail")
+        return None
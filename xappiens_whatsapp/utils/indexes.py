@@ -0,0 +1,349 @@
+"""
+Índices compuestos de los doctypes principales de WhatsApp.
+
+Los JSON de los doctypes solo indexan columnas sueltas (message_id, contact_id,
+session_id...), pero las consultas calientes filtran por combinaciones de
+columnas. Este módulo declara esos índices, los crea si faltan (desde
+`on_doctype_update` y el patch `add_composite_indexes`) y permite comprobar en
+un sitio en vivo, con SHOW INDEX y EXPLAIN, que existen y que se usan:
+
+    bench --site [sitio] execute xappiens_whatsapp.utils.indexes.check_indexes
+
+Solo MariaDB/MySQL.
+"""
+
+from typing import Any, Dict, List, Optional
+
+import frappe
+
+
+INDEXES = [
+    {
+        "doctype": "WhatsApp Message",
+        "name": "session_message_id_unique",
+        "columns": ["session", "message_id"],
+        "unique": True,
+    },
+    {
+        "doctype": "WhatsApp Message",
+        "name": "conversation_timestamp_name_index",
+        "columns": ["conversation", "timestamp", "name"],
+    },
+    {
+        "doctype": "WhatsApp Message",
+        "name": "normalized_phone_timestamp_index",
+        "columns": ["normalized_phone", "timestamp"],
+    },
+    {
+        "doctype": "WhatsApp Conversation",
+        "name": "session_chat_id_index",
+        "columns": ["session", "chat_id"],
+    },
+    {
+        "doctype": "WhatsApp Conversation",
+        "name": "phone_number_status_index",
+        "columns": ["phone_number", "status"],
+    },
+    {
+        "doctype": "WhatsApp Conversation",
+        "name": "session_phone_number_index",
+        "columns": ["session", "phone_number"],
+    },
+    {
+        "doctype": "WhatsApp Conversation",
+        "name": "normalized_phone_status_index",
+        "columns": ["normalized_phone", "status"],
+    },
+    {
+        "doctype": "WhatsApp Contact",
+        "name": "session_phone_number_index",
+        "columns": ["session", "phone_number"],
+    },
+    {
+        "doctype": "WhatsApp Contact",
+        "name": "normalized_phone_index",
+        "columns": ["normalized_phone"],
+    },
+    {
+        "doctype": "WhatsApp Media File",
+        "name": "status_next_attempt_index",
+        "columns": ["status", "next_attempt_at"],
+    },
+    {
+        "doctype": "WhatsApp Media File",
+        "name": "message_index",
+        "columns": ["message"],
+    },
+    {
+        "doctype": "WhatsApp Message",
+        "name": "outbound_queue_index",
+        "columns": ["session", "status", "send_priority"],
+    },
+]
+
+# Índices sustituidos por otro que los cubre: se eliminan una vez creado el nuevo
+RETIRED_INDEXES = [
+    {
+        "doctype": "WhatsApp Message",
+        "name": "conversation_timestamp_index",
+        "replaced_by": "conversation_timestamp_name_index",
+    },
+]
+
+# Consultas representativas de cada índice para el EXPLAIN.
+# `sample` obtiene valores reales: con valores inexistentes el optimizador
+# puede resolver la consulta sin tocar ningún índice ("Impossible WHERE").
+CHECK_QUERIES = [
+    {
+        "label": "Deduplicación de mensajes del webhook",
+        "index": ("WhatsApp Message", "session_message_id_unique"),
+        "sample": "SELECT session, message_id FROM `tabWhatsApp Message` WHERE message_id IS NOT NULL LIMIT 1",
+        "query": "SELECT name FROM `tabWhatsApp Message` WHERE session = %s AND message_id = %s",
+    },
+    {
+        "label": "Mensajes de una conversación por cursor (get_messages)",
+        "index": ("WhatsApp Message", "conversation_timestamp_name_index"),
+        "sample": "SELECT conversation, timestamp, timestamp, name FROM `tabWhatsApp Message` WHERE conversation IS NOT NULL LIMIT 1",
+        "query": (
+            "SELECT name FROM `tabWhatsApp Message` WHERE conversation = %s"
+            " AND (timestamp < %s OR (timestamp = %s AND name < %s))"
+            " ORDER BY timestamp DESC, name DESC LIMIT 50"
+        ),
+    },
+    {
+        "label": "Conversación por chat",
+        "index": ("WhatsApp Conversation", "session_chat_id_index"),
+        "sample": "SELECT session, chat_id FROM `tabWhatsApp Conversation` WHERE chat_id IS NOT NULL LIMIT 1",
+        "query": "SELECT name FROM `tabWhatsApp Conversation` WHERE session = %s AND chat_id = %s",
+    },
+    {
+        "label": "Conversaciones activas de un teléfono (contactos unificados)",
+        "index": ("WhatsApp Conversation", "phone_number_status_index"),
+        "sample": "SELECT phone_number, status FROM `tabWhatsApp Conversation` WHERE phone_number IS NOT NULL LIMIT 1",
+        "query": "SELECT name FROM `tabWhatsApp Conversation` WHERE phone_number = %s AND status = %s",
+    },
+    {
+        "label": "Conversación de una sesión por teléfono",
+        "index": ("WhatsApp Conversation", "session_phone_number_index"),
+        "sample": "SELECT session, phone_number FROM `tabWhatsApp Conversation` WHERE phone_number IS NOT NULL LIMIT 1",
+        "query": "SELECT name FROM `tabWhatsApp Conversation` WHERE session = %s AND phone_number = %s",
+    },
+    {
+        "label": "Conversaciones activas de un teléfono normalizado (contactos unificados)",
+        "index": ("WhatsApp Conversation", "normalized_phone_status_index"),
+        "sample": "SELECT normalized_phone, status FROM `tabWhatsApp Conversation` WHERE IFNULL(normalized_phone, '') != '' LIMIT 1",
+        "query": "SELECT name FROM `tabWhatsApp Conversation` WHERE normalized_phone = %s AND status = %s",
+    },
+    {
+        "label": "Mensajes de un teléfono normalizado",
+        "index": ("WhatsApp Message", "normalized_phone_timestamp_index"),
+        "sample": "SELECT normalized_phone FROM `tabWhatsApp Message` WHERE IFNULL(normalized_phone, '') != '' LIMIT 1",
+        "query": "SELECT name FROM `tabWhatsApp Message` WHERE normalized_phone = %s ORDER BY timestamp DESC LIMIT 50",
+    },
+    {
+        "label": "Contacto de una sesión por teléfono",
+        "index": ("WhatsApp Contact", "session_phone_number_index"),
+        "sample": "SELECT session, phone_number FROM `tabWhatsApp Contact` WHERE phone_number IS NOT NULL LIMIT 1",
+        "query": "SELECT name FROM `tabWhatsApp Contact` WHERE session = %s AND phone_number = %s",
+    },
+    {
+        "label": "Descargas de media listas (media_queue)",
+        "index": ("WhatsApp Media File", "status_next_attempt_index"),
+        "sample": "SELECT status, next_attempt_at FROM `tabWhatsApp Media File` LIMIT 1",
+        "query": (
+            "SELECT name FROM `tabWhatsApp Media File` WHERE status = %s"
+            " AND (next_attempt_at IS NULL OR next_attempt_at <= %s) ORDER BY creation ASC LIMIT 50"
+        ),
+    },
+    {
+        "label": "Descarga de media de un mensaje",
+        "index": ("WhatsApp Media File", "message_index"),
+        "sample": "SELECT message FROM `tabWhatsApp Media File` WHERE message IS NOT NULL LIMIT 1",
+        "query": "SELECT name FROM `tabWhatsApp Media File` WHERE message = %s",
+    },
+    {
+        "label": "Siguiente mensaje de la cola de envío (outbound_queue)",
+        "index": ("WhatsApp Message", "outbound_queue_index"),
+        "sample": "SELECT session FROM `tabWhatsApp Message` WHERE session IS NOT NULL LIMIT 1",
+        "query": (
+            "SELECT name FROM `tabWhatsApp Message` WHERE session = %s AND status = 'Pending'"
+            " AND send_priority > 0 ORDER BY send_priority DESC, creation ASC LIMIT 1"
+        ),
+    },
+]
+
+
+def ensure_indexes(doctype: Optional[str] = None, raise_on_error: bool = False) -> List[str]:
+    """
+    Crea los índices compuestos que falten.
+
+    Args:
+        doctype: Limitar a un doctype (por defecto, todos)
+        raise_on_error: Propagar el error si un índice no se puede crear. Los
+            patches lo activan para que la migración falle en vez de dejar sin
+            garantizar, por ejemplo, la deduplicación del índice único
+
+    Returns:
+        Nombres de los índices creados
+    """
+    created = []
+
+    for spec in INDEXES:
+        if doctype and spec["doctype"] != doctype:
+            continue
+        if not frappe.db.table_exists(spec["doctype"]):
+            continue
+        if _find_matching_index(spec):
+            continue
+
+        try:
+            if spec.get("unique"):
+                frappe.db.add_unique(spec["doctype"], spec["columns"], constraint_name=spec["name"])
+            else:
+                frappe.db.add_index(spec["doctype"], spec["columns"], index_name=spec["name"])
+            created.append(f"{spec['doctype']}.{spec['name']}")
+        except Exception as e:
+            # p. ej. duplicados que impiden el índice único
+            frappe.log_error(
+                f"No se pudo crear el índice {spec['name']} en {spec['doctype']}: {str(e)}",
+                "WhatsApp Indexes",
+            )
+            if raise_on_error:
+                raise
+
+    return created
+
+
+def drop_retired_indexes() -> List[str]:
+    """
+    Elimina los índices de RETIRED_INDEXES cuyo sustituto ya existe.
+
+    Returns:
+        Nombres de los índices eliminados
+    """
+    dropped = []
+
+    for retired in RETIRED_INDEXES:
+        if not frappe.db.table_exists(retired["doctype"]):
+            continue
+
+        table_indexes = _get_table_indexes(retired["doctype"])
+        spec = next(s for s in INDEXES if s["doctype"] == retired["doctype"] and s["name"] == retired["replaced_by"])
+        if retired["name"] not in table_indexes or not _find_matching_index(spec, table_indexes):
+            continue
+
+        try:
+            frappe.db.sql_ddl(f"ALTER TABLE `tab{retired['doctype']}` DROP INDEX `{retired['name']}`")
+            dropped.append(f"{retired['doctype']}.{retired['name']}")
+        except Exception as e:
+            frappe.log_error(
+                f"No se pudo eliminar el índice {retired['name']} de {retired['doctype']}: {str(e)}",
+                "WhatsApp Indexes",
+            )
+
+    return dropped
+
+
+def _get_table_indexes(doctype: str) -> Dict[str, Dict[str, Any]]:
+    """Índices de la tabla del doctype: {nombre: {"columns": [...], "unique": bool}}."""
+    indexes = {}
+    for row in frappe.db.sql(f"SHOW INDEX FROM `tab{doctype}`", as_dict=True):
+        index = indexes.setdefault(row.Key_name, {"columns": {}, "unique": not row.Non_unique})
+        index["columns"][row.Seq_in_index] = row.Column_name
+
+    for index in indexes.values():
+        index["columns"] = [index["columns"][seq] for seq in sorted(index["columns"])]
+
+    return indexes
+
+
+def _find_matching_index(spec: Dict[str, Any], table_indexes: Optional[Dict] = None) -> Optional[str]:
+    """
+    Busca un índice existente que cubra el declarado: mismas columnas iniciales
+    y, si es único, exactamente esas columnas.
+    """
+    if table_indexes is None:
+        table_indexes = _get_table_indexes(spec["doctype"])
+
+    columns = spec["columns"]
+    for name, index in table_indexes.items():
+        if spec.get("unique"):
+            if index["unique"] and index["columns"] == columns:
+                return name
+        elif index["columns"][:len(columns)] == columns:
+            return name
+
+    return None
+
+
+@frappe.whitelist()
+def check_indexes() -> Dict[str, Any]:
+    """
+    Comprueba en el sitio actual que los índices compuestos existen y que el
+    optimizador los usa en las consultas calientes (EXPLAIN).
+
+    Returns:
+        Dict con el estado de cada índice, el plan de cada consulta y la lista
+        de índices que faltan
+    """
+    frappe.only_for("System Manager")
+
+    table_indexes = {}
+    indexes = []
+    missing = []
+
+    for spec in INDEXES:
+        if not frappe.db.table_exists(spec["doctype"]):
+            continue
+        if spec["doctype"] not in table_indexes:
+            table_indexes[spec["doctype"]] = _get_table_indexes(spec["doctype"])
+
+        found = _find_matching_index(spec, table_indexes[spec["doctype"]])
+        indexes.append({
+            "doctype": spec["doctype"],
+            "index": spec["name"],
+            "columns": spec["columns"],
+            "unique": bool(spec.get("unique")),
+            "present": bool(found),
+            "existing_index": found,
+        })
+        if not found:
+            missing.append(f"{spec['doctype']}.{spec['name']}")
+
+    queries = []
+    for check in CHECK_QUERIES:
+        doctype, index_name = check["index"]
+        if doctype not in table_indexes:
+            continue
+
+        spec = next(s for s in INDEXES if s["doctype"] == doctype and s["name"] == index_name)
+        found = _find_matching_index(spec, table_indexes[doctype])
+        result = {
+            "label": check["label"],
+            "doctype": doctype,
+            "expected_index": found or index_name,
+            "key": None,
+            "rows": None,
+            "uses_index": False,
+        }
+
+        sample = frappe.db.sql(check["sample"])
+        if not sample:
+            result["skipped"] = "Tabla sin datos para el EXPLAIN"
+            queries.append(result)
+            continue
+
+        plan = frappe.db.sql(f"EXPLAIN {check['query']}", tuple(sample[0]), as_dict=True)
+        if plan:
+            result["key"] = plan[0].get("key")
+            result["rows"] = plan[0].get("rows")
+            result["uses_index"] = bool(found) and plan[0].get("key") == found
+
+        queries.append(result)
+
+    return {
+        "success": not missing,
+        "missing": missing,
+        "indexes": indexes,
+        "queries": queries,
+    }
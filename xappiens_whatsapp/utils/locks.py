@@ -0,0 +1,69 @@
+"""
+Locks distribuidos sencillos sobre el Redis de caché de Frappe.
+Sirven para evitar ejecuciones concurrentes de la misma tarea entre workers.
+"""
+
+from contextlib import contextmanager
+from typing import Optional
+
+import frappe
+
+
+# Borra el lock solo si sigue guardando el token de quien lo adquirió: un lock
+# expirado y retomado por otro worker no se libera por error
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def acquire_lock(key: str, timeout: int = 300) -> Optional[str]:
+    """
+    Intenta adquirir un lock con expiración.
+
+    Args:
+        key: Nombre del lock
+        timeout: Segundos tras los que el lock expira aunque no se libere
+
+    Returns:
+        Token del propietario (necesario para liberarlo) o None si está tomado
+    """
+    cache = frappe.cache()
+    token = frappe.generate_hash(length=20)
+    if cache.set(cache.make_key(f"whatsapp_lock:{key}"), token, nx=True, ex=timeout):
+        return token
+    return None
+
+
+def release_lock(key: str, token: Optional[str]) -> bool:
+    """
+    Libera un lock adquirido con `acquire_lock` si `token` sigue siendo su propietario.
+
+    Returns:
+        True si se liberó el lock
+    """
+    if not token:
+        return False
+    cache = frappe.cache()
+    return bool(cache.eval(RELEASE_SCRIPT, 1, cache.make_key(f"whatsapp_lock:{key}"), token))
+
+
+def is_locked(key: str) -> bool:
+    """Indica si el lock está tomado actualmente."""
+    cache = frappe.cache()
+    return bool(cache.exists(cache.make_key(f"whatsapp_lock:{key}")))
+
+
+@contextmanager
+def lock(key: str, timeout: int = 300):
+    """
+    Context manager que adquiere el lock si está libre.
+    Devuelve True/False según se haya adquirido; solo libera si lo adquirió.
+    """
+    token = acquire_lock(key, timeout)
+    try:
+        yield bool(token)
+    finally:
+        release_lock(key, token)
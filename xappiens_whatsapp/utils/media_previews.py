@@ -0,0 +1,201 @@
+"""
+Vistas previas de la media descargada: miniaturas WebP para la lista de
+mensajes, póster del primer fotograma de los vídeos y dimensiones/duración.
+
+Se ejecuta como un job después de cada descarga (`queue_media_preview`). Las
+miniaturas se guardan en el almacén por contenido junto al original
+(`<sha256>.thumb.webp`, `<sha256>.poster.webp`), así que un contenido repetido
+solo se procesa una vez. Para vídeo y audio se usan `ffprobe`/`ffmpeg` si están
+instalados en el servidor; sin ellos solo se generan las vistas previas de
+imágenes.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+from typing import Any, Dict, Optional
+
+import frappe
+from frappe.utils import flt
+
+from xappiens_whatsapp.utils.images import (
+    MEDIA_THUMBNAIL_SIZE, VIDEO_POSTER_SIZE, make_webp_thumbnail
+)
+from xappiens_whatsapp.utils.media_storage import (
+    get_media_path, normalize_sha256, store_derived_file
+)
+
+
+THUMBNAIL_SUFFIX = ".thumb.webp"
+POSTER_SUFFIX = ".poster.webp"
+PREVIEW_MEDIA_TYPES = {"image", "sticker", "video", "audio", "voice"}
+FFMPEG_TIMEOUT = 60
+# Segundo del vídeo del que se extrae el póster (el primero suele ser negro)
+POSTER_SEEK_SECONDS = 1
+
+
+def queue_media_preview(message: str, media_type: str):
+    """Programa la generación de la vista previa de un mensaje tras el commit."""
+    if media_type not in PREVIEW_MEDIA_TYPES:
+        return
+
+    frappe.enqueue(
+        "xappiens_whatsapp.utils.media_previews.generate_message_preview",
+        queue="short" if media_type in ("image", "sticker") else "long",
+        timeout=FFMPEG_TIMEOUT * 3,
+        job_id=f"whatsapp_media_preview::{frappe.local.site}::{message}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        message=message,
+    )
+
+
+def generate_message_preview(message: str) -> Dict[str, Any]:
+    """
+    Genera la vista previa de la media de un mensaje y la guarda en su
+    WhatsApp Message Media (thumbnail) y en su WhatsApp Media File
+    (thumbnail, preview_url, dimensions, duration).
+
+    Args:
+        message: Nombre del documento WhatsApp Message
+
+    Returns:
+        Dict con thumbnail, poster, dimensions y duration
+    """
+    item = frappe.db.get_value(
+        "WhatsApp Message Media",
+        {"parent": message, "parenttype": "WhatsApp Message"},
+        ["name", "media_type", "mimetype", "file", "media_hash"],
+        as_dict=True,
+        order_by="idx asc",
+    )
+    if not item or not item.file:
+        return {}
+
+    path = get_media_path(item.file)
+    if not os.path.exists(path):
+        return {}
+
+    preview = build_preview(path, item.media_type, normalize_sha256(item.media_hash))
+
+    if preview.get("thumbnail"):
+        frappe.db.set_value("WhatsApp Message Media", item.name, "thumbnail", preview["thumbnail"], update_modified=False)
+
+    values = {
+        "thumbnail": preview.get("thumbnail"),
+        "preview_url": preview.get("poster"),
+        "dimensions": preview.get("dimensions"),
+        "duration": preview.get("duration"),
+    }
+    values = {key: value for key, value in values.items() if value}
+    if values:
+        for name in frappe.get_all("WhatsApp Media File", filters={"message": message}, pluck="name"):
+            frappe.db.set_value("WhatsApp Media File", name, values, update_modified=False)
+
+    frappe.db.commit()
+    return preview
+
+
+def build_preview(path: str, media_type: str, sha256: Optional[str]) -> Dict[str, Any]:
+    """
+    Calcula la vista previa de un archivo.
+
+    Args:
+        path: Ruta del archivo original
+        media_type: Tipo de media (image, sticker, video, audio, voice...)
+        sha256: Hash del original; sin él las miniaturas no se guardan
+
+    Returns:
+        Dict con thumbnail y poster (file_url), dimensions ("ancho x alto") y duration (segundos)
+    """
+    preview = {}
+
+    if media_type in ("image", "sticker"):
+        result = make_webp_thumbnail(path, MEDIA_THUMBNAIL_SIZE)
+        if result:
+            content, (width, height) = result
+            preview["dimensions"] = f"{width}x{height}"
+            if sha256:
+                preview["thumbnail"] = store_derived_file(sha256, THUMBNAIL_SUFFIX, content)
+        return preview
+
+    if media_type not in ("video", "audio", "voice") or not shutil.which("ffprobe"):
+        return preview
+
+    info = probe_media(path)
+    if info.get("duration"):
+        preview["duration"] = info["duration"]
+    if media_type != "video":
+        return preview
+    if info.get("width") and info.get("height"):
+        preview["dimensions"] = f"{info['width']}x{info['height']}"
+
+    frame = extract_video_frame(path, POSTER_SEEK_SECONDS if flt(info.get("duration")) > POSTER_SEEK_SECONDS else 0)
+    if frame and sha256:
+        poster = make_webp_thumbnail(frame, VIDEO_POSTER_SIZE)
+        thumbnail = make_webp_thumbnail(frame, MEDIA_THUMBNAIL_SIZE)
+        if poster:
+            preview["poster"] = store_derived_file(sha256, POSTER_SUFFIX, poster[0])
+        if thumbnail:
+            preview["thumbnail"] = store_derived_file(sha256, THUMBNAIL_SUFFIX, thumbnail[0])
+
+    return preview
+
+
+def probe_media(path: str) -> Dict[str, Any]:
+    """
+    Duración y dimensiones de un vídeo o audio con ffprobe.
+
+    Returns:
+        Dict con duration (segundos), width y height, vacío si ffprobe falla
+    """
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe", "-v", "error", "-print_format", "json",
+                "-show_entries", "format=duration:stream=codec_type,width,height",
+                path,
+            ],
+            capture_output=True,
+            timeout=FFMPEG_TIMEOUT,
+            check=True,
+        )
+        data = json.loads(result.stdout or "{}")
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        frappe.log_error(f"Error leyendo metadatos de {os.path.basename(path)}: {str(e)}", "WhatsApp Media Preview")
+        return {}
+
+    video = next((s for s in data.get("streams", []) if s.get("codec_type") == "video"), {})
+    return {
+        "duration": round(flt((data.get("format") or {}).get("duration")), 2) or None,
+        "width": video.get("width"),
+        "height": video.get("height"),
+    }
+
+
+def extract_video_frame(path: str, seek: float = 0) -> Optional[bytes]:
+    """
+    Extrae un fotograma de un vídeo como PNG con ffmpeg.
+
+    Returns:
+        Bytes PNG, o None si ffmpeg no está disponible o falla
+    """
+    if not shutil.which("ffmpeg"):
+        return None
+
+    try:
+        result = subprocess.run(
+            [
+                "ffmpeg", "-v", "error", "-ss", str(seek), "-i", path,
+                "-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "-",
+            ],
+            capture_output=True,
+            timeout=FFMPEG_TIMEOUT,
+            check=True,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        frappe.log_error(f"Error extrayendo fotograma de {os.path.basename(path)}: {str(e)}", "WhatsApp Media Preview")
+        return None
+
+    return result.stdout or None
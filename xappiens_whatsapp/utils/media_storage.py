@@ -0,0 +1,443 @@
+"""
+Almacenamiento de archivos multimedia descargados de WhatsApp.
+
+Las descargas se escriben por bloques directamente en la carpeta de archivos del
+sitio (`WhatsApp Settings.media_storage_path`), calculando los hashes a medida
+que llegan los datos y cortando la descarga en cuanto supera `max_media_size`.
+El documento File se registra con el tamaño y el hash ya calculados, sin volver
+a leer el contenido del disco.
+
+Los medios de los mensajes se guardan además por contenido: cada SHA-256 se
+almacena una sola vez en `<carpeta>/store/<2 primeros>/<sha256>.<ext>` (con la
+extensión del primero que llegó; la clave es solo el hash) con un único File
+sin adjuntar, y todos los `WhatsApp Message Media` (`media_hash`) y
+`WhatsApp Media File` (`sha256_hash`) con ese hash lo enlazan. El número de
+referencias se cuenta sobre esas dos tablas; un archivo solo se borra cuando ya
+no lo referencia ninguna fila (`release_media`, `cleanup_unreferenced_media`).
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import frappe
+from frappe.utils import cint, get_files_path
+
+
+DEFAULT_MEDIA_DIR = "whatsapp_media"
+STORE_DIR = "store"
+DEFAULT_MAX_MEDIA_MB = 16
+CHUNK_SIZE = 256 * 1024
+
+
+class MediaTooLargeError(frappe.ValidationError):
+    pass
+
+
+def get_max_media_bytes() -> int:
+    """Tamaño máximo de descarga en bytes (`max_media_size` está en MB)."""
+    max_mb = cint(frappe.db.get_single_value("WhatsApp Settings", "max_media_size")) or DEFAULT_MAX_MEDIA_MB
+    return max_mb * 1024 * 1024
+
+
+def get_media_folder() -> Tuple[str, bool]:
+    """
+    Carpeta de destino relativa a la carpeta de archivos del sitio.
+
+    `media_storage_path` admite "/public/files/<carpeta>" o
+    "/private/files/<carpeta>"; cualquier otro valor se trata como una
+    subcarpeta de los archivos públicos.
+
+    Returns:
+        Tupla (subcarpeta, is_private)
+    """
+    path = (frappe.db.get_single_value("WhatsApp Settings", "media_storage_path") or "").strip("/")
+    is_private = path.startswith("private/")
+
+    for prefix in ("public/files", "private/files", "files"):
+        if path == prefix or path.startswith(prefix + "/"):
+            path = path[len(prefix):].strip("/")
+            break
+
+    folder = "/".join(part for part in path.split("/") if part not in ("", ".", ".."))
+    return folder or DEFAULT_MEDIA_DIR, is_private
+
+
+def _file_url(folder: str, file_name: str, is_private: bool) -> str:
+    return f"{'/private' if is_private else ''}/files/{folder}/{file_name}"
+
+
+class MediaWriter:
+    """
+    Escritura incremental de un archivo en la carpeta de medios.
+
+    Las rutas y el límite de tamaño se resuelven al crear el objeto, así que
+    `write`, `commit` y `abort` no acceden a la base de datos y pueden usarse
+    mientras se envía una respuesta en streaming.
+    """
+
+    def __init__(self, file_name: str, max_bytes: Optional[int] = None, content_addressed: bool = False):
+        self.max_bytes = max_bytes or get_max_media_bytes()
+        self.content_addressed = content_addressed
+        self.folder, self.is_private = get_media_folder()
+        self.files_root = get_files_path(is_private=self.is_private)
+        self.directory = os.path.join(self.files_root, *self.folder.split("/"))
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.file_name = os.path.basename(file_name or "") or "media.bin"
+        self.temp_path = os.path.join(self.directory, f".{frappe.generate_hash(length=12)}.part")
+        self.file = open(self.temp_path, "wb")
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        """Añade un bloque; lanza MediaTooLargeError si se supera el límite."""
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise MediaTooLargeError(f"Archivo demasiado grande: más de {self.max_bytes} bytes")
+        self.file.write(chunk)
+        self.sha256.update(chunk)
+        self.md5.update(chunk)
+
+    def commit(self) -> Dict[str, Any]:
+        """
+        Cierra el temporal y lo mueve a su nombre definitivo. En el almacén por
+        contenido, si el hash ya existe en disco (con cualquier extensión) se
+        descarta la copia nueva.
+
+        Returns:
+            Dict con file_name, file_url, path, size, sha256, content_hash (md5) e is_private
+        """
+        self.file.close()
+        digest = self.sha256.hexdigest()
+        folder, directory = self.folder, self.directory
+
+        if self.content_addressed:
+            folder = f"{folder}/{STORE_DIR}/{digest[:2]}"
+            directory = os.path.join(self.files_root, *folder.split("/"))
+            os.makedirs(directory, exist_ok=True)
+            # La clave es solo el hash: el mismo contenido como .jpg y .jpeg se guarda una vez
+            final_name = _find_stored_original_name(directory, digest) or (
+                f"{digest}{os.path.splitext(self.file_name)[1].lower()}"
+            )
+        else:
+            final_name = self.file_name
+            if os.path.exists(os.path.join(directory, final_name)):
+                stem, extension = os.path.splitext(self.file_name)
+                final_name = f"{stem}-{digest[:10]}{extension}"
+
+        final_path = os.path.join(directory, final_name)
+        if self.content_addressed and os.path.exists(final_path):
+            os.remove(self.temp_path)
+        else:
+            os.replace(self.temp_path, final_path)
+
+        return {
+            "file_name": final_name,
+            "file_url": _file_url(folder, final_name, self.is_private),
+            "path": final_path,
+            "size": self.size,
+            "sha256": digest,
+            "content_hash": self.md5.hexdigest(),
+            "is_private": self.is_private,
+        }
+
+    def abort(self):
+        """Descarta el temporal."""
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def stream_to_file(
+    chunks: Iterable[bytes],
+    file_name: str,
+    max_bytes: Optional[int] = None,
+    expected_size: Optional[int] = None,
+    content_addressed: bool = False
+) -> Dict[str, Any]:
+    """
+    Escribe un flujo de bloques en la carpeta de medios sin mantenerlo en memoria.
+
+    El contenido se escribe primero en un archivo temporal que se renombra al
+    terminar; si la descarga falla o supera el límite, el temporal se borra.
+
+    Args:
+        chunks: Iterable de bloques de bytes (p. ej. `response.iter_content`)
+        file_name: Nombre de archivo deseado
+        max_bytes: Tamaño máximo (por defecto `max_media_size`)
+        expected_size: Tamaño anunciado (Content-Length) para rechazar antes de escribir
+        content_addressed: Guardar en el almacén por contenido; si el hash ya
+            existe en disco se descarta la copia nueva
+
+    Returns:
+        Dict con file_name, file_url, path, size, sha256, content_hash (md5) e is_private
+    """
+    max_bytes = max_bytes or get_max_media_bytes()
+    if expected_size and cint(expected_size) > max_bytes:
+        raise MediaTooLargeError(f"Archivo demasiado grande: {cint(expected_size)} bytes (máximo {max_bytes})")
+
+    writer = MediaWriter(file_name, max_bytes=max_bytes, content_addressed=content_addressed)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+        return writer.commit()
+
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def download_to_file(response, file_name: str, max_bytes: Optional[int] = None, content_addressed: bool = False) -> Dict[str, Any]:
+    """
+    Guarda en disco una respuesta HTTP pedida con `stream=True`.
+
+    Args:
+        response: Respuesta de requests abierta en modo streaming
+        file_name: Nombre de archivo deseado
+        max_bytes: Tamaño máximo (por defecto `max_media_size`)
+        content_addressed: Guardar en el almacén por contenido
+
+    Returns:
+        Dict como `stream_to_file`
+    """
+    with response:
+        response.raise_for_status()
+        return stream_to_file(
+            response.iter_content(chunk_size=CHUNK_SIZE),
+            file_name,
+            max_bytes=max_bytes,
+            expected_size=response.headers.get("Content-Length"),
+            content_addressed=content_addressed
+        )
+
+
+def register_file(stored: Dict[str, Any], attached_to_doctype: str = None, attached_to_name: str = None):
+    """
+    Crea el documento File de un archivo ya escrito en disco.
+
+    Se inserta directamente con el tamaño y el hash calculados durante la
+    descarga: `File.insert` volvería a leer todo el contenido para calcularlos.
+
+    Args:
+        stored: Resultado de `stream_to_file`
+        attached_to_doctype: DocType al que se adjunta
+        attached_to_name: Documento al que se adjunta
+
+    Returns:
+        Documento File
+    """
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": stored["file_name"],
+        "file_url": stored["file_url"],
+        "file_size": stored["size"],
+        "file_type": os.path.splitext(stored["file_name"])[1].lstrip(".").upper(),
+        "content_hash": stored["content_hash"],
+        "is_private": 1 if stored["is_private"] else 0,
+        "folder": "Home/Attachments" if attached_to_doctype else "Home",
+        "attached_to_doctype": attached_to_doctype,
+        "attached_to_name": attached_to_name,
+    })
+    file_doc.db_insert()
+    return file_doc
+
+
+def normalize_sha256(value: Any) -> Optional[str]:
+    """
+    SHA-256 en hexadecimal a partir del formato que envíe el servidor:
+    hex, base64 (`fileSha256` de Baileys) o Buffer serializado ({"data": [...]}).
+
+    Returns:
+        Hash en hex minúsculas, o None si el valor no es un SHA-256
+    """
+    if isinstance(value, dict):
+        value = value.get("data")
+    if isinstance(value, (list, bytes, bytearray)):
+        try:
+            raw = bytes(value)
+        except (TypeError, ValueError):
+            return None
+        return raw.hex() if len(raw) == 32 else None
+    if not isinstance(value, str) or not value:
+        return None
+
+    value = value.strip()
+    if re.fullmatch(r"[0-9a-fA-F]{64}", value):
+        return value.lower()
+
+    try:
+        raw = base64.b64decode(value + "=" * (-len(value) % 4), altchars=b"-_" if "-" in value or "_" in value else None)
+    except (binascii.Error, ValueError):
+        return None
+    return raw.hex() if len(raw) == 32 else None
+
+
+def find_stored_media(sha256: str) -> Optional[str]:
+    """
+    URL del archivo del almacén con este contenido, si existe en disco.
+
+    Args:
+        sha256: Hash del contenido en hex
+
+    Returns:
+        file_url, o None si hay que descargarlo
+    """
+    if not sha256:
+        return None
+
+    folder, is_private = get_media_folder()
+    prefix = _file_url(f"{folder}/{STORE_DIR}/{sha256[:2]}", sha256, is_private)
+    for file_url in frappe.get_all(
+        "File",
+        filters={"file_url": ["like", f"{prefix}%"], "is_folder": 0},
+        pluck="file_url",
+        order_by="creation asc"
+    ):
+        # Los derivados (`<sha256>.thumb.webp`...) comparten el prefijo
+        if is_stored_original(file_url, sha256) and os.path.exists(get_media_path(file_url)):
+            return file_url
+
+    return None
+
+
+def is_stored_original(file_url: str, sha256: str) -> bool:
+    """True si el file_url es el original del almacén (`<sha256>` o `<sha256>.<ext>`), no un derivado."""
+    return bool(re.fullmatch(rf"{re.escape(sha256)}(\.[^.]+)?", os.path.basename(file_url or "")))
+
+
+def _find_stored_original_name(directory: str, sha256: str) -> Optional[str]:
+    """Nombre del original ya escrito en la carpeta del almacén, con la extensión que tenga."""
+    try:
+        names = sorted(name for name in os.listdir(directory) if is_stored_original(name, sha256))
+    except FileNotFoundError:
+        return None
+    return names[0] if names else None
+
+
+def store_media(response, file_name: str, max_bytes: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Descarga un medio al almacén por contenido y devuelve su File, creándolo
+    solo si es la primera vez que se ve ese contenido.
+
+    Args:
+        response: Respuesta de requests abierta en modo streaming
+        file_name: Nombre original (se usa su extensión)
+        max_bytes: Tamaño máximo (por defecto `max_media_size`)
+
+    Returns:
+        Dict como `stream_to_file` más `reused` (el contenido ya estaba almacenado)
+    """
+    stored = download_to_file(response, file_name, max_bytes=max_bytes, content_addressed=True)
+    stored["reused"] = bool(frappe.db.exists("File", {"file_url": stored["file_url"]}))
+    if not stored["reused"]:
+        register_file(stored)
+    return stored
+
+
+def store_derived_file(sha256: str, suffix: str, content: bytes) -> str:
+    """
+    Guarda junto al original del almacén un archivo derivado (miniatura,
+    póster) como `<sha256><suffix>`. Si ya existe se reutiliza, y se borra
+    con el original en `release_media`.
+
+    Args:
+        sha256: Hash del contenido original
+        suffix: Sufijo con extensión, p. ej. ".thumb.webp"
+        content: Bytes del archivo derivado
+
+    Returns:
+        file_url del archivo derivado
+    """
+    folder, is_private = get_media_folder()
+    folder = f"{folder}/{STORE_DIR}/{sha256[:2]}"
+    file_name = f"{sha256}{suffix}"
+    file_url = _file_url(folder, file_name, is_private)
+    path = get_media_path(file_url)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{frappe.generate_hash(length=8)}.part"
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+    if not frappe.db.exists("File", {"file_url": file_url}):
+        register_file({
+            "file_name": file_name,
+            "file_url": file_url,
+            "size": len(content),
+            "content_hash": hashlib.md5(content).hexdigest(),
+            "is_private": is_private,
+        })
+
+    return file_url
+
+
+def count_media_references(sha256: str) -> int:
+    """Filas de WhatsApp Message Media y WhatsApp Media File que enlazan este contenido."""
+    if not sha256:
+        return 0
+    return (
+        frappe.db.count("WhatsApp Message Media", {"media_hash": sha256})
+        + frappe.db.count("WhatsApp Media File", {"sha256_hash": sha256})
+    )
+
+
+def release_media(sha256: str) -> bool:
+    """
+    Borra el archivo del almacén (File y disco) si ya no tiene referencias.
+
+    Args:
+        sha256: Hash del contenido en hex
+
+    Returns:
+        True si se ha borrado
+    """
+    sha256 = normalize_sha256(sha256)
+    if not sha256 or count_media_references(sha256):
+        return False
+
+    folder, is_private = get_media_folder()
+    prefix = _file_url(f"{folder}/{STORE_DIR}/{sha256[:2]}", sha256, is_private)
+    deleted = False
+    for name in frappe.get_all("File", filters={"file_url": ["like", f"{prefix}%"]}, pluck="name"):
+        # File.on_trash borra también el archivo del disco
+        frappe.delete_doc("File", name, ignore_permissions=True, force=True)
+        deleted = True
+
+    return deleted
+
+
+def cleanup_unreferenced_media() -> int:
+    """
+    Tarea programada (diaria): borra los archivos del almacén que ya no
+    referencia ningún mensaje, p. ej. tras borrados masivos por SQL.
+
+    Returns:
+        Número de archivos borrados
+    """
+    folder, is_private = get_media_folder()
+    prefix = _file_url(f"{folder}/{STORE_DIR}", "", is_private)
+    deleted = 0
+
+    for file_url in frappe.get_all("File", filters={"file_url": ["like", f"{prefix}%"]}, pluck="file_url"):
+        sha256 = os.path.basename(file_url).split(".", 1)[0]
+        if release_media(sha256):
+            deleted += 1
+            frappe.db.commit()
+
+    return deleted
+
+
+def get_media_path(file_url: str) -> str:
+    """Ruta en disco de un file_url de la carpeta de archivos del sitio."""
+    is_private = file_url.startswith("/private/files/")
+    path = file_url.split("/files/", 1)[1]
+    return get_files_path(*path.split("/"), is_private=is_private)
@@ -0,0 +1,107 @@
+"""
+Paginación por cursor (keyset) del historial de mensajes.
+
+En lugar de LIMIT/OFFSET, que recorre y descarta las filas anteriores, cada
+página continúa desde la posición (timestamp, name) del último mensaje
+devuelto, usando el índice (conversation, timestamp, name). El cursor es un
+token opaco para el frontend:
+
+- before: mensajes más antiguos que el cursor (scroll hacia arriba)
+- after: mensajes más recientes que el cursor (rellenar huecos tras reconectar)
+"""
+
+import base64
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import frappe
+from frappe import _
+from frappe.utils import get_datetime
+
+
+def encode_cursor(timestamp, name: str) -> str:
+    """Codifica la posición (timestamp, name) de un mensaje como token opaco."""
+    if timestamp and hasattr(timestamp, "isoformat"):
+        timestamp = timestamp.isoformat()
+    payload = json.dumps([str(timestamp), name], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, str]:
+    """
+    Decodifica un token de encode_cursor.
+
+    Returns:
+        Tupla (timestamp, name)
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, name = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        return get_datetime(timestamp), name
+    except Exception:
+        frappe.throw(_("Cursor de paginación no válido"))
+
+
+def build_keyset_clause(
+    params: Dict[str, Any],
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    alias: str = "",
+) -> Tuple[Optional[str], str, bool]:
+    """
+    Construye la condición y el orden de una página por cursor.
+
+    Args:
+        params: Parámetros de la consulta (se añaden los del cursor)
+        before: Cursor para mensajes más antiguos
+        after: Cursor para mensajes más recientes (tiene prioridad sobre before)
+        alias: Alias de la tabla de mensajes en la consulta (p. ej. "m.")
+
+    Returns:
+        Tupla (condición o None, ORDER BY, ascendente)
+    """
+    ascending = bool(after)
+    cursor = after or before
+
+    condition = None
+    if cursor:
+        params["cursor_timestamp"], params["cursor_name"] = decode_cursor(cursor)
+        op = ">" if ascending else "<"
+        condition = (
+            f"({alias}timestamp {op} %(cursor_timestamp)s"
+            f" OR ({alias}timestamp = %(cursor_timestamp)s AND {alias}name {op} %(cursor_name)s))"
+        )
+
+    direction = "asc" if ascending else "desc"
+    return condition, f"{alias}timestamp {direction}, {alias}name {direction}", ascending
+
+
+def paginate_rows(rows: List[Dict[str, Any]], limit: int, ascending: bool) -> Dict[str, Any]:
+    """
+    Recorta una página consultada con limit + 1 filas y calcula los cursores.
+
+    Args:
+        rows: Filas en el orden de la consulta (incluida la fila extra)
+        limit: Tamaño de página
+        ascending: Si la consulta era en modo after
+
+    Returns:
+        Dict con messages (orden cronológico), has_more, next_cursor
+        (continúa en la misma dirección) y latest_cursor (mensaje más reciente
+        de la página, para pedir después con after)
+    """
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].name) if rows and has_more else None
+    if not ascending:
+        rows = list(reversed(rows))
+
+    latest_cursor = encode_cursor(rows[-1].timestamp, rows[-1].name) if rows else None
+
+    return {
+        "messages": rows,
+        "has_more": has_more,
+        "next_cursor": next_cursor,
+        "latest_cursor": latest_cursor,
+    }
@@ -0,0 +1,176 @@
+"""
+Normalización de números de teléfono a E.164.
+
+Los números llegan en formatos distintos según el origen (`+34...`, `34...`,
+`0034...`, `34...@c.us`, `34...:12@s.whatsapp.net`). WhatsApp Conversation,
+WhatsApp Contact y WhatsApp Message guardan además la forma canónica en
+`normalized_phone` (indexada), que es la que usan las agrupaciones y búsquedas
+entre sesiones. Los números nacionales de 9 dígitos reciben el prefijo de
+*Prefijo de País por Defecto* (WhatsApp Settings).
+
+`backfill_normalized_phones` rellena los registros existentes:
+
+    bench --site [sitio] execute xappiens_whatsapp.utils.phone.backfill_normalized_phones
+"""
+
+import re
+from typing import Any, Dict, List, Optional
+
+import frappe
+
+
+# Prefijo para números nacionales de 9 dígitos sin prefijo internacional, si
+# WhatsApp Settings no define `default_country_code`
+DEFAULT_COUNTRY_CODE = "34"
+
+# JIDs que no corresponden a un número de teléfono
+NON_PHONE_DOMAINS = ("g.us", "broadcast", "newsletter", "lid")
+
+BACKFILL_CHUNK_SIZE = 2000
+
+
+def get_default_country_code() -> str:
+    """Prefijo de país para números nacionales (solo dígitos), según WhatsApp Settings."""
+    code = frappe.db.get_single_value("WhatsApp Settings", "default_country_code")
+    return re.sub(r"\D", "", code or "") or DEFAULT_COUNTRY_CODE
+
+
+def normalize_phone_number(phone: Optional[str], country_code: Optional[str] = None) -> str:
+    """
+    Devuelve el número en formato E.164 (+34657032985), o "" si no es un
+    número de teléfono (grupos, listas de difusión, LIDs o valores inválidos).
+
+    Args:
+        phone: Número o JID de WhatsApp en cualquier formato
+        country_code: Prefijo para números nacionales (por defecto, el de WhatsApp Settings)
+
+    Returns:
+        Número normalizado
+    """
+    if not phone:
+        return ""
+
+    value = str(phone).strip()
+    if "@" in value:
+        value, domain = value.split("@", 1)
+        if domain in NON_PHONE_DOMAINS:
+            return ""
+
+    # Sufijo de dispositivo de Baileys (34657032985:12@s.whatsapp.net)
+    value = value.split(":", 1)[0]
+
+    digits = re.sub(r"\D", "", value)
+    if digits.startswith("00"):
+        digits = digits[2:]
+    elif len(digits) == 9 and not value.startswith("+"):
+        digits = (country_code or get_default_country_code()) + digits
+
+    # E.164: como máximo 15 dígitos; por debajo de 8 no es un número completo
+    if not 8 <= len(digits) <= 15:
+        return ""
+
+    return f"+{digits}"
+
+
+def phone_variants(phone: Optional[str]) -> List[str]:
+    """
+    Formatos en los que un número puede estar guardado en doctypes externos
+    (p. ej. CRM Lead.mobile_no), para buscarlos con un único IN.
+
+    Args:
+        phone: Número en cualquier formato
+
+    Returns:
+        Lista de variantes (vacía si el número no es válido)
+    """
+    country_code = get_default_country_code()
+    normalized = normalize_phone_number(phone, country_code)
+    if not normalized:
+        return []
+
+    digits = normalized[1:]
+    variants = [normalized, digits, f"00{digits}"]
+    if digits.startswith(country_code) and len(digits) == len(country_code) + 9:
+        national = digits[len(country_code):]
+        variants += [national, f"+{country_code} {national}"]
+
+    return variants
+
+
+def get_conversation_phone(phone_number: Optional[str], chat_id: Optional[str], is_group=False) -> str:
+    """Número normalizado de una conversación o contacto ("" para grupos y difusiones)."""
+    if is_group or (chat_id or "").split("@")[-1] in ("g.us", "broadcast", "newsletter"):
+        return ""
+    return normalize_phone_number(phone_number or chat_id)
+
+
+def get_message_phone(direction: Optional[str], from_number: Optional[str], to_number: Optional[str]) -> str:
+    """Número normalizado del interlocutor de un mensaje (remitente si es entrante)."""
+    return normalize_phone_number(from_number if direction == "Incoming" else to_number)
+
+
+# Columnas necesarias para calcular normalized_phone en cada doctype
+BACKFILL_SOURCES = {
+    "WhatsApp Conversation": ["phone_number", "chat_id", "is_group"],
+    "WhatsApp Contact": ["phone_number", "contact_id", "is_group"],
+    "WhatsApp Message": ["direction", "from_number", "to_number"],
+}
+
+
+def _compute_normalized_phone(doctype: str, row: Dict[str, Any]) -> str:
+    if doctype == "WhatsApp Message":
+        return get_message_phone(row.direction, row.from_number, row.to_number)
+    if doctype == "WhatsApp Contact":
+        return get_conversation_phone(row.phone_number, row.contact_id, row.is_group)
+    return get_conversation_phone(row.phone_number, row.chat_id, row.is_group)
+
+
+def backfill_normalized_phones(doctype: Optional[str] = None, chunk_size: int = BACKFILL_CHUNK_SIZE) -> Dict[str, int]:
+    """
+    Rellena normalized_phone en los registros que no lo tienen, por bloques de
+    `chunk_size` con commit tras cada bloque (se puede interrumpir y relanzar).
+    Los registros sin número válido quedan con "" para no volver a procesarlos.
+
+    Args:
+        doctype: Limitar a un doctype (por defecto, los tres)
+        chunk_size: Registros por bloque
+
+    Returns:
+        Dict {doctype: registros actualizados}
+    """
+    updated = {}
+
+    for source_doctype, source_fields in BACKFILL_SOURCES.items():
+        if doctype and source_doctype != doctype:
+            continue
+        if not frappe.db.has_column(source_doctype, "normalized_phone"):
+            continue
+
+        count = 0
+        last_name = ""
+        while True:
+            rows = frappe.db.sql(f"""
+                SELECT name, {", ".join(f"`{field}`" for field in source_fields)}
+                FROM `tab{source_doctype}`
+                WHERE normalized_phone IS NULL AND name > %(last_name)s
+                ORDER BY name
+                LIMIT %(limit)s
+            """, {"last_name": last_name, "limit": chunk_size}, as_dict=True)
+
+            if not rows:
+                break
+
+            updates = {}
+            for row in rows:
+                name = row.pop("name")
+                updates[name] = {"normalized_phone": _compute_normalized_phone(source_doctype, row)}
+
+            frappe.db.bulk_update(source_doctype, updates, update_modified=False)
+            frappe.db.commit()
+
+            count += len(rows)
+            last_name = list(updates)[-1]
+
+        updated[source_doctype] = count
+
+    return updated
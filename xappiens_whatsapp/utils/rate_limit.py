@@ -0,0 +1,140 @@
+"""
+Límite de envío por sesión con token buckets sobre el Redis de caché de Frappe.
+
+Cada sesión tiene un bucket por ventana configurada en WhatsApp Settings
+(`rate_limit_messages_per_minute/hour/day`). Un bucket se rellena de forma
+continua hasta su capacidad (N tokens por ventana) y cada envío consume un token
+de todos los buckets a la vez. La comprobación y el consumo se hacen en un
+script Lua, así que el límite se cumple aunque envíen varios workers a la vez.
+
+Los envíos masivos no pueden bajar ningún bucket de `rate_limit_agent_reserve`
+(porcentaje de su capacidad): ese margen queda para las respuestas de los
+agentes, que no deben esperar a que termine una difusión.
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+import frappe
+from frappe.utils import cint, flt
+
+from xappiens_whatsapp.utils.settings import get_rate_limits
+
+
+WINDOWS = (
+    ("minute", "per_minute", 60),
+    ("hour", "per_hour", 60 * 60),
+    ("day", "per_day", 24 * 60 * 60),
+)
+
+# KEYS: un hash {tokens, ts} por ventana
+# ARGV: ahora, y por cada ventana: capacidad, periodo (s), tokens que deben quedar
+# Devuelve "0" si se consumió un token, o los segundos hasta que haya uno
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local period = tonumber(ARGV[i * 3])
+    local keep = tonumber(ARGV[i * 3 + 1])
+    local rate = capacity / period
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < 1 + keep then
+        wait = math.max(wait, (1 + keep - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(tonumber(ARGV[i * 3])))
+end
+return "0"
+"""
+
+
+def get_send_limits() -> Dict[str, Any]:
+    """
+    Límites de envío activos.
+
+    Returns:
+        Dict con windows (lista de tuplas (ventana, capacidad, periodo en
+        segundos), vacía si el rate limiting está deshabilitado) y
+        agent_reserve (fracción 0-1 reservada a los agentes)
+    """
+    limits = get_rate_limits()
+    if not limits or not cint(limits.get("enabled")):
+        return {"windows": [], "agent_reserve": 0}
+
+    return {
+        "windows": [
+            (window, cint(limits.get(field)), period)
+            for window, field, period in WINDOWS
+            if cint(limits.get(field)) > 0
+        ],
+        "agent_reserve": min(max(flt(limits.get("agent_reserve")), 0), 100) / 100,
+    }
+
+
+def _bucket_key(session: str, window: str) -> str:
+    cache = frappe.cache()
+    return cache.make_key(f"whatsapp_send_bucket:{session}:{window}")
+
+
+def acquire_send_token(session: str, bulk: bool = False, limits: Optional[Dict[str, Any]] = None) -> float:
+    """
+    Intenta consumir un token de envío de la sesión.
+
+    Args:
+        session: Nombre del documento WhatsApp Session
+        bulk: Envío masivo; no puede consumir la reserva de los agentes
+        limits: Límites ya leídos con `get_send_limits` (para no releer Settings)
+
+    Returns:
+        0 si se puede enviar ya; si no, segundos hasta que haya token
+    """
+    limits = limits or get_send_limits()
+    if not limits["windows"]:
+        return 0
+
+    reserve = limits["agent_reserve"] if bulk else 0
+    keys = [_bucket_key(session, window) for window, _capacity, _period in limits["windows"]]
+    args = [time.time()]
+    for _window, capacity, period in limits["windows"]:
+        # Con capacidades muy pequeñas la reserva no puede dejar sin envíos a los masivos
+        args.extend([capacity, period, min(capacity * reserve, capacity - 1)])
+
+    script = frappe.cache().register_script(TOKEN_BUCKET_SCRIPT)
+    wait = script(keys=keys, args=args)
+    return flt(wait.decode() if isinstance(wait, bytes) else wait)
+
+
+def get_send_tokens(session: str) -> Dict[str, Dict[str, float]]:
+    """
+    Tokens disponibles de cada ventana de la sesión, sin consumirlos.
+
+    Returns:
+        Dict {ventana: {"capacity", "available"}}
+    """
+    cache = frappe.cache()
+    now = time.time()
+    tokens = {}
+
+    for window, capacity, period in get_send_limits()["windows"]:
+        level, ts = cache.hmget(_bucket_key(session, window), ["tokens", "ts"])
+        available = capacity if level is None else min(capacity, flt(level) + max(0, now - flt(ts)) * capacity / period)
+        tokens[window] = {"capacity": capacity, "available": round(available, 2)}
+
+    return tokens
+
+
+def reset_send_tokens(session: str):
+    """Rellena todos los buckets de la sesión."""
+    cache = frappe.cache()
+    cache.delete(*[_bucket_key(session, window) for window, _field, _period in WINDOWS])
@@ -130,7 +130,7 @@ def get_api_base_url():
 
 def get_rate_limits():
     """
-    Obtiene los límites de rate limiting configurados
+    Obtiene los límites de rate limiting configurados (por sesión)
     """
     settings = get_whatsapp_settings()
     if not settings:
@@ -140,5 +140,6 @@ def get_rate_limits():
         "enabled": settings.rate_limit_enabled,
         "per_minute": settings.rate_limit_messages_per_minute,
         "per_hour": settings.rate_limit_messages_per_hour,
-        "per_day": settings.rate_limit_messages_per_day
+        "per_day": settings.rate_limit_messages_per_day,
+        "agent_reserve": settings.get("rate_limit_agent_reserve")
     }
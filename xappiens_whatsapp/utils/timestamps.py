@@ -0,0 +1,50 @@
+"""
+Timestamps del servidor de WhatsApp.
+
+Baileys envía los timestamps como epoch (segundos o milisegundos) o como
+ISO-8601, normalmente en UTC ("2025-11-07T12:21:58.000Z"). Frappe guarda los
+Datetime sin zona y en la zona horaria del sistema, así que todos los valores
+remotos (mensajes, último mensaje de la conversación, marca de agua de la
+sincronización) pasan por `parse_remote_timestamp` para poder compararse entre sí.
+"""
+
+from datetime import datetime, timezone
+from typing import Any, Optional
+from zoneinfo import ZoneInfo
+
+from frappe.utils import get_system_timezone
+
+
+def parse_remote_timestamp(value: Any) -> Optional[datetime]:
+    """
+    Convierte un timestamp del servidor a datetime sin zona en la hora del sistema.
+
+    Args:
+        value: Epoch en segundos o milisegundos (número o texto) o ISO-8601;
+            un ISO sin zona se toma como UTC
+
+    Returns:
+        datetime, o None si el valor no es un timestamp
+    """
+    if value in (None, ""):
+        return None
+
+    try:
+        if isinstance(value, str) and value.strip().lstrip("-").replace(".", "", 1).isdigit():
+            value = float(value)
+
+        if isinstance(value, (int, float)):
+            ts = float(value)
+            if ts > 1_000_000_000_000:
+                ts = ts / 1000
+            parsed = datetime.fromtimestamp(ts, tz=timezone.utc)
+        elif isinstance(value, str):
+            parsed = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+            if not parsed.tzinfo:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+        else:
+            return None
+    except (ValueError, OverflowError, OSError):
+        return None
+
+    return parsed.astimezone(ZoneInfo(get_system_timezone())).replace(tzinfo=None)
@@ -0,0 +1,171 @@
+"""
+Trazas estructuradas de webhooks por sesión.
+
+Sustituye a los `frappe.log_error` de depuración del camino caliente de los
+webhooks: cada traza se guarda en un buffer circular en Redis por sesión (las
+últimas N entradas) y se replica en el log rotativo `whatsapp_trace` del sitio.
+
+El nivel mínimo y la tasa de muestreo se configuran en WhatsApp Settings; la
+tasa puede sobrescribirse por sesión en WhatsApp Session (*Tasa de Muestreo
+Propia*). Los niveles warning y error no se muestrean. Los errores reales
+siguen registrándose en Error Log.
+"""
+
+import json
+import random
+from typing import Any, Dict, List, Optional
+
+import frappe
+from frappe.utils import cint, flt, now_datetime
+
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+# Opciones del campo trace_level de WhatsApp Settings
+SETTING_LEVELS = {"Off": None, "Error": 40, "Warning": 30, "Info": 20, "Debug": 10}
+
+DEFAULT_LEVEL = "Warning"
+DEFAULT_SAMPLE_RATE = 0.1
+DEFAULT_BUFFER_SIZE = 200
+BUFFER_TTL = 60 * 60 * 24
+
+CONFIG_KEY = "whatsapp_trace_config"
+SESSION_RATES_KEY = "whatsapp_trace_sample_rates"
+
+
+def _get_config() -> Dict[str, Any]:
+    """Configuración de trazas de WhatsApp Settings (cacheada en Redis)."""
+    def generator():
+        settings = frappe.get_single("WhatsApp Settings")
+        return {
+            "level": settings.get("trace_level") or DEFAULT_LEVEL,
+            "sample_rate": (
+                flt(settings.trace_sample_rate)
+                if settings.get("trace_sample_rate") is not None
+                else DEFAULT_SAMPLE_RATE
+            ),
+            "buffer_size": cint(settings.get("trace_buffer_size")) or DEFAULT_BUFFER_SIZE,
+        }
+
+    return frappe.cache().get_value(CONFIG_KEY, generator=generator)
+
+
+def _get_session_sample_rate(session_id: str) -> Optional[float]:
+    """Tasa de muestreo propia de la sesión, o None si usa la global."""
+    def generator():
+        session = frappe.db.get_value(
+            "WhatsApp Session", {"session_id": session_id},
+            ["override_trace_sample_rate", "trace_sample_rate"], as_dict=True
+        )
+        # Se cachea -1 para no volver a consultar sesiones sin tasa propia
+        return flt(session.trace_sample_rate) if session and session.override_trace_sample_rate else -1
+
+    rate = frappe.cache().hget(SESSION_RATES_KEY, session_id, generator=generator)
+    return None if rate is None or flt(rate) < 0 else flt(rate)
+
+
+def clear_trace_config(session_id: Optional[str] = None):
+    """
+    Invalida la configuración cacheada. Se llama al guardar WhatsApp Settings
+    (sin argumentos) o una WhatsApp Session (con su session_id).
+    """
+    if session_id:
+        frappe.cache().hdel(SESSION_RATES_KEY, session_id)
+    else:
+        frappe.cache().delete_value(CONFIG_KEY)
+        frappe.cache().delete_value(SESSION_RATES_KEY)
+
+
+def is_enabled(session_id: Optional[str], level: str = "debug") -> bool:
+    """
+    Indica si una traza de este nivel debe registrarse (nivel y muestreo).
+    Permite evitar construir payloads costosos cuando no se van a guardar.
+    """
+    try:
+        config = _get_config()
+        threshold = SETTING_LEVELS.get(config["level"], SETTING_LEVELS[DEFAULT_LEVEL])
+        levelno = LEVELS.get(level, LEVELS["debug"])
+
+        if threshold is None or levelno < threshold:
+            return False
+
+        if levelno >= LEVELS["warning"]:
+            return True
+
+        rate = _get_session_sample_rate(session_id) if session_id else None
+        if rate is None:
+            rate = config["sample_rate"]
+
+        return rate >= 1 or random.random() < rate
+
+    except Exception:
+        return False
+
+
+def trace(session_id: Optional[str], message: str, level: str = "debug", **data):
+    """
+    Registra una traza de webhook para la sesión si supera nivel y muestreo.
+
+    Args:
+        session_id: Sesión de Baileys
+        message: Descripción corta del paso
+        level: debug, info, warning o error
+        **data: Datos adicionales serializables a JSON
+    """
+    if not is_enabled(session_id, level):
+        return
+
+    try:
+        entry = {
+            "timestamp": now_datetime().isoformat(),
+            "level": level,
+            "session_id": session_id or "",
+            "message": message,
+            "data": data,
+        }
+        serialized = json.dumps(entry, default=str, ensure_ascii=False)
+
+        cache = frappe.cache()
+        key = f"whatsapp_trace:{session_id or ''}"
+        cache.lpush(key, serialized)
+        cache.ltrim(key, 0, _get_config()["buffer_size"] - 1)
+        cache.expire(cache.make_key(key), BUFFER_TTL)
+
+        frappe.logger("whatsapp_trace", allow_site=True, file_count=5).log(
+            LEVELS.get(level, LEVELS["debug"]), serialized
+        )
+
+    except Exception:
+        # Las trazas nunca deben interrumpir el procesamiento del webhook
+        pass
+
+
+def get_traces(session_id: str, limit: int = 100, level: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Devuelve las trazas más recientes de una sesión (la más reciente primero).
+
+    Args:
+        session_id: Sesión de Baileys
+        limit: Máximo de entradas
+        level: Nivel mínimo a devolver
+
+    Returns:
+        Lista de trazas
+    """
+    raw = frappe.cache().lrange(f"whatsapp_trace:{session_id or ''}", 0, -1) or []
+    min_level = LEVELS.get((level or "debug").lower(), LEVELS["debug"])
+
+    traces = []
+    for item in raw:
+        try:
+            entry = json.loads(item)
+        except (TypeError, ValueError):
+            continue
+
+        if LEVELS.get(entry.get("level"), LEVELS["debug"]) < min_level:
+            continue
+
+        traces.append(entry)
+        if len(traces) >= cint(limit):
+            break
+
+    return traces
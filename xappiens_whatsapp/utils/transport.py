@@ -0,0 +1,192 @@
+"""
+Transporte HTTP compartido para el servidor de WhatsApp (Baileys/Inbox Hub).
+
+Mantiene un `requests.Session` por proceso (worker), sitio y URL base, con pool
+de conexiones keep-alive y política de reintentos a nivel de conexión, para no
+pagar un handshake TCP+TLS en cada llamada. Cuando cambian las opciones del
+pool, la sesión se sustituye sin cerrarla: otros hilos pueden estar usándola y
+se libera cuando deja de tener referencias. También cachea la configuración de
+API de WhatsApp Settings para no releer el documento ni la API Key en cada
+petición.
+"""
+
+import os
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.5
+
+# Clave en Redis que se incrementa al guardar WhatsApp Settings para invalidar
+# la configuración cacheada en todos los workers
+CONFIG_VERSION_KEY = "whatsapp_transport_config_version"
+
+_lock = threading.Lock()
+_sessions: Dict[Tuple[int, str, str, str], Tuple[tuple, requests.Session]] = {}
+_config_cache: Dict[str, Tuple[Optional[str], frappe._dict]] = {}
+
+
+def get_api_config() -> frappe._dict:
+    """
+    Obtiene la configuración de API de WhatsApp Settings cacheada por worker.
+
+    La caché se invalida cuando cambia la versión publicada en Redis
+    (ver `invalidate_api_config`).
+
+    Returns:
+        frappe._dict con base_url, api_key, timeout, retry_attempts y opciones del pool
+    """
+    site = getattr(frappe.local, "site", None) or ""
+    version = frappe.cache().get_value(CONFIG_VERSION_KEY)
+
+    cached = _config_cache.get(site)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    settings = frappe.get_single("WhatsApp Settings")
+    config = frappe._dict({
+        "enabled": settings.enabled,
+        "base_url": (settings.api_base_url or "").rstrip("/"),
+        "api_key": settings.get_password("api_key", raise_exception=False),
+        "timeout": settings.api_timeout or 30,
+        "retry_attempts": settings.api_retry_attempts or 3,
+        "pool_size": settings.get("http_pool_size") or DEFAULT_POOL_SIZE,
+        "keep_alive": settings.get("http_keep_alive") is None or bool(settings.http_keep_alive),
+        "connect_retries": (
+            settings.http_connect_retries
+            if settings.get("http_connect_retries") is not None
+            else DEFAULT_CONNECT_RETRIES
+        ),
+        "retry_backoff": settings.get("http_retry_backoff") or DEFAULT_RETRY_BACKOFF,
+    })
+
+    _config_cache[site] = (version, config)
+    return config
+
+
+def invalidate_api_config():
+    """
+    Invalida la configuración cacheada en todos los workers; cada worker
+    reconstruye su pool en la siguiente petición. Se llama desde WhatsApp Settings al guardar.
+    """
+    frappe.cache().set_value(CONFIG_VERSION_KEY, frappe.generate_hash(length=10))
+    site = getattr(frappe.local, "site", None) or ""
+    _config_cache.pop(site, None)
+    discard_sessions(site)
+
+
+def get_http_session(url: str) -> requests.Session:
+    """
+    Devuelve el `requests.Session` compartido para el sitio actual y la URL
+    base de `url`. Si cambiaron las opciones del pool, se construye uno nuevo.
+
+    Args:
+        url: URL (completa o base) del servidor
+
+    Returns:
+        Sesión HTTP con pool de conexiones
+    """
+    parts = urlsplit(url)
+    site = getattr(frappe.local, "site", None) or ""
+    key = (os.getpid(), site, parts.scheme, parts.netloc)
+    config = get_api_config()
+    fingerprint = _pool_fingerprint(config)
+
+    entry = _sessions.get(key)
+    if entry is not None and entry[0] == fingerprint:
+        return entry[1]
+
+    with _lock:
+        entry = _sessions.get(key)
+        if entry is None or entry[0] != fingerprint:
+            # La sesión anterior no se cierra: otro hilo puede tenerla en uso
+            entry = (fingerprint, _build_session(config))
+            _sessions[key] = entry
+
+    return entry[1]
+
+
+def _pool_fingerprint(config: frappe._dict) -> tuple:
+    """Opciones de la configuración que determinan cómo se construye el pool."""
+    return (config.pool_size, config.keep_alive, config.connect_retries, config.retry_backoff)
+
+
+def _build_session(config: frappe._dict) -> requests.Session:
+    """
+    Construye una sesión HTTP con pool y reintentos de conexión.
+
+    Los reintentos del adaptador solo cubren fallos de conexión (p. ej. una
+    conexión keep-alive cerrada por el servidor); los reintentos por estado
+    HTTP siguen a cargo de `WhatsAppAPIClient._make_request`.
+    """
+    retry = Retry(
+        total=config.connect_retries,
+        connect=config.connect_retries,
+        read=0,
+        status=0,
+        backoff_factor=config.retry_backoff,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config.pool_size,
+        pool_maxsize=config.pool_size,
+        max_retries=retry,
+    )
+
+    http_session = requests.Session()
+    http_session.mount("https://", adapter)
+    http_session.mount("http://", adapter)
+
+    if not config.keep_alive:
+        http_session.headers["Connection"] = "close"
+
+    return http_session
+
+
+def discard_sessions(site: Optional[str] = None):
+    """
+    Descarta las sesiones HTTP del proceso actual (solo las de `site` si se
+    indica) para que la siguiente petición construya un pool nuevo. No las
+    cierra: las peticiones en curso terminan con la sesión que ya tienen.
+    """
+    with _lock:
+        for key in list(_sessions):
+            if site is None or key[1] == site:
+                _sessions.pop(key, None)
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Realiza una petición HTTP usando el pool compartido.
+
+    Acepta los mismos argumentos que `requests.request`.
+    """
+    return get_http_session(url).request(method=method, url=url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """Petición GET usando el pool compartido."""
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """Petición POST usando el pool compartido."""
+    return request("POST", url, **kwargs)
+
+
+def put(url: str, **kwargs) -> requests.Response:
+    """Petición PUT usando el pool compartido."""
+    return request("PUT", url, **kwargs)
+
+
+def delete(url: str, **kwargs) -> requests.Response:
+    """Petición DELETE usando el pool compartido."""
+    return request("DELETE", url, **kwargs)